@@ -567,3 +567,23 @@ show_saved_search_box = False
 # exclude_fields_on_paste = ['cover', 'timestamp', '#mycolumn']
 # to prevent pasting of the cover, Date and custom column, mycolumn.
 exclude_fields_on_paste = []
+
+#: Remember search results between restarts
+# Normally, calibre remembers the results of recent searches, including the
+# searches used for Virtual libraries, only while a library is open. If you
+# set this tweak to True, the results are saved in a file next to
+# metadata.db when the library is closed and re-used the next time the
+# library is opened, provided the library has not been changed in the
+# meantime. This can speed up opening very large libraries that use Virtual
+# libraries. Searches that refer to the current date, such as date:today, are
+# never saved.
+persistent_search_cache = False
+
+#: Store book metadata in memory in a compact form
+# Normally, calibre keeps the metadata of every book in memory as separate
+# python objects. If you set this tweak to True, calibre instead stores
+# numbers, dates and yes/no values in compact arrays and stores each distinct
+# text value only once. This uses significantly less memory for very large
+# libraries, which is useful for the Content server, but reading the
+# metadata of an individual book is slightly slower.
+columnar_field_storage = False
@@ -42,6 +42,8 @@ def find_tests(which_tests=None):
         a(test_normalization(return_tests=True))
         from calibre.ebooks.css_transform_rules import test
         a(test(return_tests=True))
+        from calibre.ebooks.oeb.stylizer_test import find_tests
+        a(find_tests())
         from css_selectors.tests import find_tests
         a(find_tests())
     if ok('docx'):
@@ -70,6 +72,10 @@ def find_tests(which_tests=None):
         a(find_tests())
         from calibre.utils.search_query_parser_test import find_tests
         a(find_tests())
+        from calibre.ebooks.conversion.server_test import find_tests
+        a(find_tests())
+        from calibre.ebooks.conversion.profiling_test import find_tests
+        a(find_tests())
     if ok('dbcli'):
         from calibre.db.cli.tests import find_tests
         a(find_tests())
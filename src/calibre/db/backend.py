@@ -1265,6 +1265,10 @@ class DB(object):
                     import pprint
                     pprint.pprint(table.metadata)
                     raise
+        if tweaks['columnar_field_storage']:
+            from calibre.db.columns import use_columnar_storage
+            for table in self.tables.itervalues():
+                use_columnar_storage(table)
 
     def format_abspath(self, book_id, fmt, fname, path):
         path = os.path.join(self.library_path, path)
@@ -23,6 +23,7 @@ from calibre.db.locking import create_locks, DowngradeLockError, SafeReadLock
 from calibre.db.errors import NoSuchFormat
 from calibre.db.fields import create_field, IDENTITY, InvalidLinkTable
 from calibre.db.search import Search
+from calibre.db.sort_cache import SortKeyCache
 from calibre.db.tables import VirtualTable
 from calibre.db.write import get_series_values, uniq
 from calibre.db.lazy import FormatMetadata, FormatsList, ProxyMetadata
@@ -37,6 +38,11 @@ from calibre.utils.date import now as nowf, utcnow, UNDEFINED_DATE
 from calibre.utils.icu import sort_key
 from calibre.utils.localization import canonicalize_lang
 
+# Fields that are sorted on a different field
+SORT_FIELD_MAP = {'title':'sort', 'authors':'author_sort'}
+# Fields that can change when a field is set
+WRITE_SIDE_EFFECTS = {'title':('sort',), 'authors':('author_sort',)}
+
 
 def api(f):
     f.is_cache_api = True
@@ -112,8 +118,10 @@ class Cache(object):
         self.backend = backend
         self.fields = {}
         self.composites = {}
+        self.composite_dependencies = None
         self.read_lock, self.write_lock = create_locks()
         self.format_metadata_cache = defaultdict(dict)
+        self.sort_key_cache = SortKeyCache()
         self.formatter_template_cache = {}
         self.dirtied_cache = {}
         self.dirtied_sequence = 0
@@ -212,9 +220,43 @@ class Cache(object):
         self.backend.set_user_template_functions(user_template_functions)
 
     @write_api
-    def clear_composite_caches(self, book_ids=None):
-        for field in self.composites.itervalues():
-            field.clear_caches(book_ids=book_ids)
+    def clear_composite_caches(self, book_ids=None, changed_fields=None):
+        ''' Clear the cached values of composite columns for the specified
+        books. If changed_fields is specified, only the columns whose
+        templates depend on one of those fields are cleared. '''
+        if changed_fields is None or book_ids is None:
+            for field in self.composites.itervalues():
+                field.clear_caches(book_ids=book_ids)
+            return
+        changed = set(changed_fields)
+        for name in changed_fields:
+            changed.update(WRITE_SIDE_EFFECTS.get(name, ()))
+        for name, deps in self._composite_dependencies().iteritems():
+            if deps is None or not deps.isdisjoint(changed):
+                self.composites[name].clear_caches(book_ids=book_ids)
+
+    def _composite_dependencies(self):
+        ''' Return a map of composite column names to the set of fields they
+        depend on, directly or via other composite columns, or None if they
+        could depend on any field. '''
+        if self.composite_dependencies is None:
+            refs = {name:field.field_references() for name, field in self.composites.iteritems()}
+            ans = {}
+            for name in refs:
+                deps, pending, seen = set(), [name], set()
+                while pending:
+                    x = pending.pop()
+                    if x in seen:
+                        continue
+                    seen.add(x)
+                    if refs[x] is None:
+                        deps = None
+                        break
+                    deps |= refs[x]
+                    pending.extend(y for y in refs[x] if y in refs)
+                ans[name] = None if deps is None else frozenset(deps)
+            self.composite_dependencies = ans
+        return self.composite_dependencies
 
     @write_api
     def clear_search_caches(self, book_ids=None):
@@ -237,6 +279,7 @@ class Cache(object):
                 self.format_metadata_cache.pop(book_id, None)
         else:
             self.format_metadata_cache.clear()
+        self.sort_key_cache.invalidate(book_ids or None)
         if search_cache:
             self._clear_search_caches(book_ids)
 
@@ -251,6 +294,28 @@ class Cache(object):
                 if hasattr(field, 'table'):
                     field.table.read(self.backend)  # Reread data from metadata.db
 
+    @write_api
+    def reload_books_from_db(self, book_ids):
+        ''' Re-read the data for only the specified books from metadata.db,
+        much faster than :meth:`reload_from_db` when a few books have been
+        changed by another process. Books that no longer exist in the database
+        are removed. '''
+        book_ids = set(book_ids)
+        with self.backend.conn:
+            self.backend.prefs.load_from_db()
+            self._search_api.saved_searches.load_from_db()
+            for field in self.fields.itervalues():
+                if hasattr(field, 'table'):
+                    field.table.read_books(book_ids, self.backend)
+        removed = {book_id for book_id in book_ids if book_id not in self.fields['uuid'].table.book_col_map}
+        if removed:
+            self._search_api.discard_books(removed)
+        self._clear_caches(book_ids=book_ids, search_cache=False)
+        if book_ids - removed:
+            self._clear_search_caches(book_ids - removed)
+        for cc in self.cover_caches:
+            cc.invalidate(book_ids)
+
     @property
     def field_metadata(self):
         return self.backend.field_metadata
@@ -379,6 +444,8 @@ class Cache(object):
                     field.author_sort_field = self.fields['author_sort']
                 elif name == 'title':
                     field.title_sort_field = self.fields['sort']
+            if tweaks['persistent_search_cache']:
+                self._search_api.load_persistent_cache(self)
         if self.backend.prefs['update_all_last_mod_dates_on_start']:
             self.update_last_modified(self.all_book_ids())
             self.backend.prefs.set('update_all_last_mod_dates_on_start', False)
@@ -435,6 +502,47 @@ class Cache(object):
         field_obj = self.fields[field]
         return {book_id:self._fast_field_for(field_obj, book_id, default_value=default_value) for book_id in book_ids}
 
+    @read_api
+    def fields_for_books(self, field_names, book_ids, default_value=None):
+        '''
+        Return the values of all the fields in ``field_names`` for all the
+        books in ``book_ids``, acquiring the read lock only once. The result is
+        column oriented: a dict mapping every field name to a dict mapping book
+        ids to values. The values are the same as those returned by
+        :meth:`field_for`. To read the values for a large number of books
+        a chunk at a time, use :meth:`iter_fields_for_books`.
+        '''
+        book_ids = tuple(book_ids)
+        get_metadata = self._get_proxy_metadata
+        ans = {}
+        for name in field_names:
+            try:
+                field = self.fields[name]
+            except KeyError:
+                ans[name] = dict.fromkeys(book_ids, default_value)
+                continue
+            if field.is_composite:
+                gv = field.get_value_with_cache
+                ans[name] = {book_id:gv(book_id, get_metadata) for book_id in book_ids}
+            else:
+                ans[name] = field.values_for_books(book_ids, field.default_value if field.is_multiple else default_value)
+        return ans
+
+    @api
+    def iter_fields_for_books(self, field_names, book_ids, chunk_size=1000, default_value=None):
+        '''
+        Same as :meth:`fields_for_books` except that this is a generator that
+        yields 2-tuples of the form (book_ids, values) for ``chunk_size`` books
+        at a time. The read lock is held only while the values for a chunk are
+        being read, so writers are not blocked while the results are consumed.
+        '''
+        book_ids = tuple(book_ids)
+        for i in xrange(0, len(book_ids), chunk_size):
+            chunk = book_ids[i:i+chunk_size]
+            with self.safe_read_lock:
+                ans = self._fields_for_books(field_names, chunk, default_value=default_value)
+            yield chunk, ans
+
     @read_api
     def composite_for(self, name, book_id, mi=None, default_value=''):
         try:
@@ -908,76 +1016,108 @@ class Cache(object):
 
         return ret
 
-    @read_api
-    def multisort(self, fields, ids_to_sort=None, virtual_fields=None):
-        '''
-        Return a list of sorted book ids. If ids_to_sort is None, all book ids
-        are returned.
-
-        fields must be a list of 2-tuples of the form (field_name,
-        ascending=True or False). The most significant field is the first
-        2-tuple.
-        '''
-        ids_to_sort = self._all_book_ids() if ids_to_sort is None else ids_to_sort
+    def _sort_key_func_factory(self, virtual_fields=None):
+        ''' Return a function that returns the sort key function for a field,
+        handling series type fields, virtual fields and the id field '''
         get_metadata = self._get_proxy_metadata
-        lang_map = self.fields['languages'].book_value_map
         virtual_fields = virtual_fields or {}
-
-        fm = {'title':'sort', 'authors':'author_sort'}
+        lang_map = []
 
         def sort_key_func(field):
-            'Handle series type fields, virtual fields and the id field'
+            if not lang_map:
+                lang_map.append(self.fields['languages'].book_value_map)
             idx = field + '_index'
             is_series = idx in self.fields
             try:
-                func = self.fields[fm.get(field, field)].sort_keys_for_books(get_metadata, lang_map)
+                func = self.fields[SORT_FIELD_MAP.get(field, field)].sort_keys_for_books(get_metadata, lang_map[0])
             except KeyError:
                 if field == 'id':
                     return IDENTITY
                 else:
-                    return virtual_fields[fm.get(field, field)].sort_keys_for_books(get_metadata, lang_map)
+                    return virtual_fields[SORT_FIELD_MAP.get(field, field)].sort_keys_for_books(get_metadata, lang_map[0])
             if is_series:
-                idx_func = self.fields[idx].sort_keys_for_books(get_metadata, lang_map)
+                idx_func = self.fields[idx].sort_keys_for_books(get_metadata, lang_map[0])
 
                 def skf(book_id):
                     return (func(book_id), idx_func(book_id))
                 return skf
             return func
+        return sort_key_func
 
-        # Sort only once on any given field
-        fields = uniq(fields, operator.itemgetter(0))
+    def _sort_keys_are_cacheable(self, field):
+        f = self.fields.get(SORT_FIELD_MAP.get(field, field))
+        return f is not None and not f.is_composite and field != 'ondevice'
 
-        if len(fields) == 1:
-            return sorted(ids_to_sort, key=sort_key_func(fields[0][0]),
-                          reverse=not fields[0][1])
-        sort_key_funcs = tuple(sort_key_func(field) for field, order in fields)
-        orders = tuple(1 if order else -1 for _, order in fields)
-        Lazy = object()  # Lazy load the sort keys for sub-sort fields
+    @read_api
+    def multisort(self, fields, ids_to_sort=None, virtual_fields=None):
+        '''
+        Return a list of sorted book ids. If ids_to_sort is None, all book ids
+        are returned.
 
-        class SortKey(object):
+        fields must be a list of 2-tuples of the form (field_name,
+        ascending=True or False). The most significant field is the first
+        2-tuple.
+        '''
+        ids_to_sort = self._all_book_ids() if ids_to_sort is None else ids_to_sort
+        sort_key_func = self._sort_key_func_factory(virtual_fields)
 
-            __slots__ = ('book_id', 'sort_key')
+        # Sort only once on any given field
+        fields = uniq(fields, operator.itemgetter(0))
 
-            def __init__(self, book_id):
-                self.book_id = book_id
-                # Calculate only the first sub-sort key since that will always be used
-                self.sort_key = [key(book_id) if i == 0 else Lazy for i, key in enumerate(sort_key_funcs)]
+        # Sort on the least significant field first, relying on the sorts
+        # being stable. Sort keys for fields stored in the database are
+        # cached as integer ranks.
+        ans = list(ids_to_sort)
+        for field, ascending in reversed(fields):
+            reverse = not ascending
+            if field == 'id':
+                ans.sort(reverse=reverse)
+                continue
+            if not self._sort_keys_are_cacheable(field) or not self.sort_key_cache.sort(
+                    field, ans, partial(sort_key_func, field), reverse=reverse):
+                ans.sort(key=sort_key_func(field), reverse=reverse)
+        return ans
 
-            def __cmp__(self, other):
-                for i, (order, self_key, other_key) in enumerate(zip(orders, self.sort_key, other.sort_key)):
-                    if self_key is Lazy:
-                        self_key = self.sort_key[i] = sort_key_funcs[i](self.book_id)
-                    if other_key is Lazy:
-                        other_key = other.sort_key[i] = sort_key_funcs[i](other.book_id)
-                    ans = cmp(self_key, other_key)
-                    if ans != 0:
-                        return ans * order
-                return 0
+    @read_api
+    def sort_keys_are_cached(self, fields):
+        ''' Return True iff the sort keys for all the specified fields, a list
+        of 2-tuples as for :meth:`multisort`, are cached, which means that
+        they change only when the books are changed. '''
+        return all(field == 'id' or self._sort_keys_are_cacheable(field) for field, ascending in fields)
 
-        return sorted(ids_to_sort, key=SortKey)
+    @read_api
+    def sort_keys_for_books(self, fields, book_ids):
+        '''
+        Return a list of sort keys, one for every book in book_ids, such that
+        sorting the books on these keys gives the same order as
+        :meth:`multisort` with the same fields, along with the version of the
+        sort key cache the keys were computed at. Use
+        ``sort_key_cache.changed_since(version)`` to find the books whose keys
+        may have changed since. Returns (None, None) if the keys for one of the
+        fields are not cached, for example, for composite columns.
+        '''
+        fields = uniq(fields, operator.itemgetter(0))
+        if not self._sort_keys_are_cached(fields):
+            return None, None
+        sort_key_func = self._sort_key_func_factory()
+        book_ids = list(book_ids)
+        cols = []
+        version = self.sort_key_cache.version
+        for field, ascending in fields:
+            if field == 'id':
+                ranks = book_ids
+            else:
+                ranks = self.sort_key_cache.ranks(field, book_ids, partial(sort_key_func, field))
+                if ranks is None:
+                    return None, None
+            cols.append(ranks if ascending else map(operator.neg, ranks))
+        if self.sort_key_cache.version != version:
+            # The ranks of some fields were renumbered while computing the keys
+            return None, None
+        return (list(zip(*cols)) if len(cols) > 1 else cols[0]), version
 
     @read_api
-    def search(self, query, restriction='', virtual_fields=None, book_ids=None):
+    def search(self, query, restriction='', virtual_fields=None, book_ids=None, as_id_set=False):
         '''
         Search the database for the specified query, returning a set of matched book ids.
 
@@ -988,8 +1128,27 @@ class Cache(object):
 
         :param book_ids: If not None, a set of book ids for which books will
             be searched instead of searching all books.
+
+        :param as_id_set: If True, the result is returned as a compact
+            :class:`calibre.db.id_set.BookIdSet` instead of a set. This avoids
+            converting cached results and supports fast boolean combinations
+            with other BookIdSet objects.
+        '''
+        return self._search_api(self, query, restriction, virtual_fields=virtual_fields, book_ids=book_ids, as_id_set=as_id_set)
+
+    @read_api
+    def explain_search(self, query, restriction='', virtual_fields=None, book_ids=None):
         '''
-        return self._search_api(self, query, restriction, virtual_fields=virtual_fields, book_ids=book_ids)
+        Like :meth:`search` except that the search results are not cached and
+        a dictionary describing how the search was run is returned. The
+        dictionary has the keys: ``result`` (the set of matched book ids),
+        ``time`` and ``plan``. ``plan`` is a tree of nodes, each with the keys
+        ``op``, ``cost``, ``selectivity``, ``time``, ``candidates``,
+        ``matches`` and ``children``. Leaf nodes also have ``location`` and
+        ``query``. Children are listed in the order in which they were
+        evaluated.
+        '''
+        return self._search_api.explain(self, query, restriction, virtual_fields=virtual_fields, book_ids=book_ids)
 
     @read_api
     def books_in_virtual_library(self, vl, search_restriction=None):
@@ -1000,9 +1159,9 @@ class Cache(object):
         # We utilize the search restriction cache to speed this up
         if vl:
             if search_restriction:
-                return frozenset(self._search('', vl) & self._search('', search_restriction))
-            return frozenset(self._search('', vl))
-        return frozenset(self._search('', search_restriction))
+                return frozenset(self._search('', vl, as_id_set=True) & self._search('', search_restriction, as_id_set=True))
+            return frozenset(self._search('', vl, as_id_set=True))
+        return frozenset(self._search('', search_restriction, as_id_set=True))
 
     @api
     def get_categories(self, sort='name', book_ids=None, already_fixed=None,
@@ -1021,19 +1180,21 @@ class Cache(object):
             return self.get_categories(sort=sort, book_ids=book_ids, already_fixed=bad_field)
 
     @write_api
-    def update_last_modified(self, book_ids, now=None):
+    def update_last_modified(self, book_ids, now=None, changed_fields=None):
         if book_ids:
             if now is None:
                 now = nowf()
             f = self.fields['last_modified']
             f.writer.set_books({book_id:now for book_id in book_ids}, self.backend)
+            self.sort_key_cache.invalidate(book_ids)
             if self.composites:
-                self._clear_composite_caches(book_ids)
+                self._clear_composite_caches(book_ids, changed_fields=(
+                    None if changed_fields is None else tuple(changed_fields) + ('last_modified',)))
             self._clear_search_caches(book_ids)
 
     @write_api
-    def mark_as_dirty(self, book_ids):
-        self._update_last_modified(book_ids)
+    def mark_as_dirty(self, book_ids, changed_fields=None):
+        self._update_last_modified(book_ids, changed_fields=changed_fields)
         already_dirtied = set(self.dirtied_cache).intersection(book_ids)
         new_dirtied = book_ids - already_dirtied
         already_dirtied = {book_id:self.dirtied_sequence+i for i, book_id in enumerate(already_dirtied)}
@@ -1098,7 +1259,12 @@ class Cache(object):
         if dirtied and update_path and do_path_update:
             self._update_path(dirtied, mark_as_dirtied=False)
 
-        self._mark_as_dirty(dirtied)
+        changed_fields = [name]
+        if is_series:
+            changed_fields.append(name + '_index')
+        if update_path:
+            changed_fields.append('path')
+        self._mark_as_dirty(dirtied, changed_fields=changed_fields)
 
         return dirtied
 
@@ -1413,7 +1579,7 @@ class Cache(object):
 
             max_size = self.fields['formats'].table.update_fmt(book_id, fmt, fname, size, self.backend)
             self.fields['size'].table.update_sizes({book_id: max_size})
-            self._update_last_modified((book_id,))
+            self._update_last_modified((book_id,), changed_fields=('formats', 'size'))
 
         if run_hooks:
             # Run post import plugins, the write lock is released so the plugin
@@ -1457,7 +1623,7 @@ class Cache(object):
 
         size_map = table.remove_formats(formats_map, self.backend)
         self.fields['size'].table.update_sizes(size_map)
-        self._update_last_modified(tuple(formats_map.iterkeys()))
+        self._update_last_modified(tuple(formats_map.iterkeys()), changed_fields=('formats', 'size'))
 
     @read_api
     def get_next_series_num_for(self, series, field='series', current_indices=False):
@@ -1575,6 +1741,8 @@ class Cache(object):
             elif field == 'uuid':
                 self.fields[field].table.uuid_to_id_map[val] = book_id
             self.fields[field].table.book_col_map[book_id] = val
+        self._search_api.text_index.update_books((book_id,))
+        self.sort_key_cache.invalidate((book_id,))
 
         return book_id
 
@@ -1739,7 +1907,7 @@ class Cache(object):
             elif change_index and hasattr(f, 'index_field') and tweaks['series_index_auto_increment'] != 'no_change':
                 for book_id in moved_books:
                     self._set_field(f.index_field.name, {book_id:self._get_next_series_num_for(self._fast_field_for(f, book_id), field=field)})
-            self._mark_as_dirty(affected_books)
+            self._mark_as_dirty(affected_books, changed_fields=(field, field + '_index'))
         return affected_books, id_map
 
     @write_api
@@ -1756,8 +1924,9 @@ class Cache(object):
         if affected_books:
             if hasattr(field, 'index_field'):
                 self._set_field(field.index_field.name, {bid:1.0 for bid in affected_books})
+                self._clear_composite_caches(affected_books, changed_fields=(field.name,))
             else:
-                self._mark_as_dirty(affected_books)
+                self._mark_as_dirty(affected_books, changed_fields=(field.name,))
         return affected_books
 
     @write_api
@@ -1810,6 +1979,7 @@ class Cache(object):
     def refresh_format_cache(self):
         self.fields['formats'].table.read(self.backend)
         self.format_metadata_cache.clear()
+        self.sort_key_cache.invalidate()
 
     @write_api
     def refresh_ondevice(self):
@@ -1882,7 +2052,7 @@ class Cache(object):
             if val_map:
                 self._set_field('author_sort', val_map)
         if changed_books:
-            self._mark_as_dirty(changed_books)
+            self._mark_as_dirty(changed_books, changed_fields=('authors', 'author_sort'))
         return changed_books
 
     @write_api
@@ -1892,7 +2062,7 @@ class Cache(object):
         for author_id in link_map:
             changed_books |= self._books_for_field('authors', author_id)
         if changed_books:
-            self._mark_as_dirty(changed_books)
+            self._mark_as_dirty(changed_books, changed_fields=('authors',))
         return changed_books
 
     @read_api
@@ -2060,6 +2230,11 @@ class Cache(object):
             except Exception:
                 import traceback
                 traceback.print_exc()
+        try:
+            self._search_api.save_persistent_cache(self)
+        except Exception:
+            import traceback
+            traceback.print_exc()
         self.backend.close()
 
     @write_api
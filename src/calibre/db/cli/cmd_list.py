@@ -59,12 +59,12 @@ def implementation(
             book_ids = book_ids[:limit]
         data = {}
         metadata = {}
+        plain_fields = []
         for field in fields:
             if field in 'id':
                 continue
             if field == 'isbn':
-                x = db.all_field_for('identifiers', book_ids, default_value={})
-                data[field] = {k: v.get('isbn') or '' for k, v in x.iteritems()}
+                plain_fields.append('identifiers')
                 continue
             field = field.replace('*', '#')
             metadata[field] = fm[field]
@@ -75,7 +75,15 @@ def implementation(
                 if field == 'cover':
                     data[field] = {k: cover(db, k) for k in book_ids}
                     continue
-            data[field] = db.all_field_for(field, book_ids)
+            plain_fields.append(field)
+        values = db._fields_for_books(plain_fields, book_ids)
+        for field in fields:
+            if field == 'isbn':
+                data[field] = {k: v.get('isbn') or '' for k, v in values['identifiers'].iteritems()}
+            else:
+                field = field.replace('*', '#')
+                if field in values and field not in data:
+                    data[field] = values[field]
     return {'book_ids': book_ids, "data": data, 'metadata': metadata, 'fields':fields}
 
 
@@ -0,0 +1,373 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+'''
+Optional columnar storage for the book_col_map of tables. Instead of a dict
+holding a python object per book, values are stored in typed arrays indexed
+by book id: numbers and dates in arrays of doubles, booleans in a bytearray
+and strings and tuples of item ids as indices into a pool of interned values.
+Columns behave like dicts, so the rest of the code does not need to know about
+them. Values that do not fit the typed representation are stored in an
+ordinary dict, so every value round trips exactly.
+'''
+
+from array import array
+from collections import MutableMapping, defaultdict
+from datetime import datetime, timedelta
+from itertools import chain, compress
+
+from calibre.db.tables import ONE_ONE, MANY_ONE, MANY_MANY, null
+from calibre.utils.iso8601 import utc_tz
+
+EPOCH = datetime(1970, 1, 1, tzinfo=utc_tz)
+TEXT_TYPES = frozenset(('text', 'comments', 'series', 'enumeration'))
+
+
+class Column(MutableMapping):
+
+    ''' Base class for columns. Sub-classes implement the typed storage. '''
+
+    def __init__(self, items=()):
+        self.present = bytearray()
+        self.extra = {}
+        self.count = 0
+        self._init_storage()
+        for k, v in (items.iteritems() if hasattr(items, 'iteritems') else items):
+            self[k] = v
+
+    # Storage interface {{{
+    def _init_storage(self):
+        raise NotImplementedError()
+
+    def _grow(self, size):
+        raise NotImplementedError()
+
+    def _store(self, book_id, val):
+        ' Store val, returning False if it cannot be stored in the typed storage '
+        raise NotImplementedError()
+
+    def _load(self, book_id):
+        raise NotImplementedError()
+
+    def _release(self, book_id):
+        pass
+    # }}}
+
+    # Mapping API {{{
+    def __getitem__(self, book_id):
+        try:
+            if book_id >= 0 and self.present[book_id]:
+                return self._load(book_id)
+        except (IndexError, TypeError):
+            pass
+        return self.extra[book_id]
+
+    def get(self, book_id, default=None):
+        try:
+            if book_id >= 0 and self.present[book_id]:
+                return self._load(book_id)
+        except (IndexError, TypeError):
+            pass
+        return self.extra.get(book_id, default)
+
+    def __contains__(self, book_id):
+        try:
+            if book_id >= 0 and self.present[book_id]:
+                return True
+        except (IndexError, TypeError):
+            pass
+        return book_id in self.extra
+
+    def __setitem__(self, book_id, val):
+        if isinstance(book_id, (int, long)) and book_id >= 0:
+            if book_id >= len(self.present):
+                size = max(book_id + 1, len(self.present) * 3 // 2)
+                self.present.extend(bytearray(size - len(self.present)))
+                self._grow(size)
+            was_present = self.present[book_id]
+            if was_present:
+                self._release(book_id)
+            if self._store(book_id, val):
+                self.extra.pop(book_id, None)
+                if not was_present:
+                    self.present[book_id] = 1
+                    self.count += 1
+                return
+            if was_present:
+                self.present[book_id] = 0
+                self.count -= 1
+        self.extra[book_id] = val
+
+    def __delitem__(self, book_id):
+        try:
+            if book_id >= 0 and self.present[book_id]:
+                self._release(book_id)
+                self.present[book_id] = 0
+                self.count -= 1
+                return
+        except (IndexError, TypeError):
+            pass
+        del self.extra[book_id]
+
+    def pop(self, book_id, default=null):
+        ans = self.get(book_id, null)
+        if ans is null:
+            if default is null:
+                raise KeyError(book_id)
+            return default
+        del self[book_id]
+        return ans
+
+    def __len__(self):
+        return self.count + len(self.extra)
+
+    def __iter__(self):
+        return chain(compress(xrange(len(self.present)), self.present), self.extra)
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        load = self._load
+        for book_id in compress(xrange(len(self.present)), self.present):
+            yield load(book_id)
+        for val in self.extra.itervalues():
+            yield val
+
+    def iteritems(self):
+        load = self._load
+        for book_id in compress(xrange(len(self.present)), self.present):
+            yield book_id, load(book_id)
+        for item in self.extra.iteritems():
+            yield item
+
+    def clear(self):
+        self.present = bytearray()
+        self.extra = {}
+        self.count = 0
+        self._init_storage()
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.copy())
+    # }}}
+
+    def memoized_getter(self, func, default):
+        ''' Return a function that maps book_id to func(value), where value is
+        default for books not in this column '''
+        get = self.get
+        dval = func(default)
+
+        def getter(book_id):
+            val = get(book_id, null)
+            return dval if val is null else func(val)
+        return getter
+
+    def grouped_values(self, book_ids, default=None):
+        ''' Return a mapping of value to the set of book ids from book_ids
+        that have that value. '''
+        ans = defaultdict(set)
+        get = self.get
+        for book_id in book_ids:
+            ans[get(book_id, default)].add(book_id)
+        return ans
+
+
+class ArrayColumn(Column):
+
+    '''
+    Stores values of a single python type in an array. ``encode`` maps a value
+    to the number stored in the array and ``decode`` maps it back.
+    '''
+
+    def __init__(self, typecode, vtype, encode=None, decode=None, items=()):
+        self.typecode, self.vtype = typecode, vtype
+        self.encode, self.decode = encode, decode
+        Column.__init__(self, items)
+
+    def _init_storage(self):
+        self.values = array(self.typecode)
+
+    def _grow(self, size):
+        self.values.extend(array(self.typecode, (0,)) * (size - len(self.values)))
+
+    def _store(self, book_id, val):
+        if type(val) is not self.vtype:
+            return False
+        try:
+            num = val if self.encode is None else self.encode(val)
+            self.values[book_id] = num
+        except (TypeError, ValueError, OverflowError):
+            return False
+        # Only accept values that round trip exactly
+        return self._load(book_id) == val
+
+    def _load(self, book_id):
+        num = self.values[book_id]
+        return num if self.decode is None else self.decode(num)
+
+    def grouped_values(self, book_ids, default=None):
+        # Group on the stored numbers so that values are decoded once per group
+        groups = defaultdict(set)
+        ans = defaultdict(set)
+        present, values, extra = self.present, self.values, self.extra
+        for book_id in book_ids:
+            try:
+                if book_id >= 0 and present[book_id]:
+                    groups[values[book_id]].add(book_id)
+                    continue
+            except (IndexError, TypeError):
+                pass
+            ans[extra.get(book_id, default)].add(book_id)
+        decode = self.decode or (lambda x: x)
+        for num, ids in groups.iteritems():
+            ans[decode(num)] |= ids
+        return ans
+
+
+class PooledColumn(Column):
+
+    '''
+    Stores hashable values, such as strings or tuples of item ids, as indices
+    into a pool of unique values. Repeated values are stored only once.
+    '''
+
+    def __init__(self, vtype, items=()):
+        self.vtype = vtype
+        Column.__init__(self, items)
+
+    def _init_storage(self):
+        self.refs = array(b'l')
+        self.pool = []
+        self.refcounts = []
+        self.pool_index = {}
+        self.free_slots = []
+
+    def _grow(self, size):
+        self.refs.extend(array(b'l', (-1,)) * (size - len(self.refs)))
+
+    def _store(self, book_id, val):
+        if type(val) is not self.vtype:
+            return False
+        try:
+            idx = self.pool_index.get(val)
+        except TypeError:
+            return False
+        if idx is None:
+            if self.free_slots:
+                idx = self.free_slots.pop()
+                self.pool[idx], self.refcounts[idx] = val, 0
+            else:
+                idx = len(self.pool)
+                self.pool.append(val), self.refcounts.append(0)
+            self.pool_index[val] = idx
+        self.refcounts[idx] += 1
+        self.refs[book_id] = idx
+        return True
+
+    def _release(self, book_id):
+        idx = self.refs[book_id]
+        self.refcounts[idx] -= 1
+        if self.refcounts[idx] < 1:
+            del self.pool_index[self.pool[idx]]
+            self.pool[idx] = None
+            self.free_slots.append(idx)
+
+    def _load(self, book_id):
+        return self.pool[self.refs[book_id]]
+
+    def memoized_getter(self, func, default):
+        ''' As for :meth:`Column.memoized_getter` except that func is called
+        only once per distinct value. '''
+        present, refs, pool, extra = self.present, self.refs, self.pool, self.extra
+        cache = {}
+        dval = func(default)
+
+        def getter(book_id):
+            try:
+                if book_id >= 0 and present[book_id]:
+                    idx = refs[book_id]
+                    try:
+                        return cache[idx]
+                    except KeyError:
+                        ans = cache[idx] = func(pool[idx])
+                        return ans
+            except (IndexError, TypeError):
+                pass
+            val = extra.get(book_id, null)
+            return dval if val is null else func(val)
+        return getter
+
+    def grouped_values(self, book_ids, default=None):
+        groups = defaultdict(set)
+        ans = defaultdict(set)
+        present, refs, extra = self.present, self.refs, self.extra
+        for book_id in book_ids:
+            try:
+                if book_id >= 0 and present[book_id]:
+                    groups[refs[book_id]].add(book_id)
+                    continue
+            except (IndexError, TypeError):
+                pass
+            ans[extra.get(book_id, default)].add(book_id)
+        pool = self.pool
+        for idx, ids in groups.iteritems():
+            ans[pool[idx]] |= ids
+        return ans
+
+
+def encode_date(val):
+    if val.tzinfo is not utc_tz:
+        raise ValueError('Only dates in UTC are stored as numbers')
+    delta = val - EPOCH
+    return delta.days * 86400.0 + delta.seconds + delta.microseconds / 1e6
+
+
+def decode_date(num):
+    return EPOCH + timedelta(seconds=num)
+
+
+def encode_bool(val):
+    return 1 if val else 0
+
+
+def column_for_table(table, items=()):
+    ''' Return a column suitable for storing the book_col_map of table or None
+    if this table should use a dict. '''
+    tt = table.table_type
+    if tt == MANY_ONE:
+        return ArrayColumn(b'l', int, items=items)
+    if tt == MANY_MANY:
+        if table.name == 'identifiers':
+            return None
+        return PooledColumn(tuple, items=items)
+    if tt != ONE_ONE or table.metadata['datatype'] == 'composite' or table.name == 'ondevice':
+        return None
+    dt = table.metadata['datatype']
+    if dt in TEXT_TYPES:
+        return PooledColumn(unicode, items=items)
+    if dt == 'datetime':
+        return ArrayColumn(b'd', datetime, encode_date, decode_date, items=items)
+    if dt == 'bool':
+        return ArrayColumn(b'b', bool, encode_bool, bool, items=items)
+    if dt in ('float', 'rating'):
+        return ArrayColumn(b'd', float, items=items)
+    if dt == 'int':
+        return ArrayColumn(b'l', int, items=items)
+    return None
+
+
+def use_columnar_storage(table):
+    ''' Replace the book_col_map of table, if it has one, with a column '''
+    bcm = getattr(table, 'book_col_map', None)
+    if isinstance(bcm, dict) and not isinstance(bcm, defaultdict):
+        col = column_for_table(table, bcm)
+        if col is not None:
+            table.book_col_map = col
@@ -8,6 +8,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import re
 from threading import Lock
 from collections import defaultdict, Counter
 from functools import partial
@@ -28,6 +29,42 @@ def bool_sort_key(bools_are_tristate):
 
 IDENTITY = lambda x: x
 
+# Template functions whose results can depend on any field or that evaluate
+# templates constructed at runtime
+DYNAMIC_TEMPLATE_FUNCTIONS = frozenset({'eval', 'template', 'virtual_libraries', 'user_categories'})
+# Fields used by template functions and names that are not field names
+IMPLICIT_TEMPLATE_REFERENCES = {
+    'booksize': ('size',), 'has_cover': ('cover',), 'approximate_formats': ('formats',),
+    'formats_modtimes': ('formats',), 'formats_sizes': ('formats',), 'formats_paths': ('formats', 'path'),
+    'author_links': ('authors',), 'author_sorts': ('authors', 'author_sort'), 'series_sort': ('series', 'sort'),
+    'title_sort': ('sort',), 'isbn': ('identifiers',),
+}
+template_word_pat = re.compile(r'#?\w+', re.UNICODE)
+template_call_pat = re.compile(r'(\w+)\s*\(', re.UNICODE)
+dynamic_field_pat = re.compile(r'\b(?:field|raw_field|raw_list)\s*\(\s*(?![\'"])')
+
+
+def template_field_references(template):
+    '''
+    Return the set of (lowercased) names of fields that template could refer
+    to or None if it could refer to any field. This is conservative, every
+    word in the template is considered to be a possible reference and
+    templates that call unknown (user defined) functions or compute field names
+    at runtime are assumed to refer to every field.
+    '''
+    from calibre.utils.formatter_functions import formatter_functions
+    known = formatter_functions().get_builtins_and_aliases()
+    for func in template_call_pat.findall(template):
+        if func in DYNAMIC_TEMPLATE_FUNCTIONS or func not in known:
+            return None
+    if dynamic_field_pat.search(template) is not None:
+        return None
+    ans = set()
+    for word in template_word_pat.findall(template.lower()):
+        ans.add(word), ans.add(word + '_index')
+        ans.update(IMPLICIT_TEMPLATE_REFERENCES.get(word, ()))
+    return frozenset(ans)
+
 
 class InvalidLinkTable(Exception):
 
@@ -102,6 +139,20 @@ class Field(object):
         '''
         raise NotImplementedError()
 
+    def values_for_books(self, book_ids, default_value=None):
+        '''
+        Return a dict mapping every book id in book_ids to the value of this
+        field for that book, as returned by :meth:`for_book`.
+        '''
+        for_book = self.for_book
+        ans = {}
+        for book_id in book_ids:
+            try:
+                ans[book_id] = for_book(book_id, default_value=default_value)
+            except (KeyError, IndexError):
+                ans[book_id] = default_value
+        return ans
+
     def ids_for_book(self, book_id):
         '''
         Return a tuple of items ids for items associated with the book
@@ -177,6 +228,10 @@ class OneToOneField(Field):
     def for_book(self, book_id, default_value=None):
         return self.table.book_col_map.get(book_id, default_value)
 
+    def values_for_books(self, book_ids, default_value=None):
+        get = self.table.book_col_map.get
+        return {book_id:get(book_id, default_value) for book_id in book_ids}
+
     def ids_for_book(self, book_id):
         return (book_id,)
 
@@ -187,15 +242,24 @@ class OneToOneField(Field):
         return self.table.book_col_map.iterkeys()
 
     def sort_keys_for_books(self, get_metadata, lang_map):
-        bcmg = self.table.book_col_map.get
+        bcm = self.table.book_col_map
+        bcmg = bcm.get
         dk = self._default_sort_key
         sk = self._sort_key
         if sk is IDENTITY:
             return lambda book_id:bcmg(book_id, dk)
+        if hasattr(bcm, 'memoized_getter'):
+            # Columnar storage, compute the sort key once per distinct value
+            return bcm.memoized_getter(sk, dk)
         return lambda book_id:sk(bcmg(book_id, dk))
 
     def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         cbm = self.table.book_col_map
+        if hasattr(cbm, 'grouped_values'):
+            # Columnar storage, yield each distinct value only once
+            for val, book_ids in cbm.grouped_values(candidates, default_value).iteritems():
+                yield val, book_ids
+            return
         for book_id in candidates:
             yield cbm.get(book_id, default_value), {book_id}
 
@@ -283,6 +347,10 @@ class CompositeField(OneToOneField):
             return self.__render_composite(book_id, mi, formatter, template_cache)
         return ans
 
+    def field_references(self):
+        ' The names of the fields the template of this column refers to, see :func:`template_field_references` '
+        return template_field_references(self.metadata['display']['composite_template'])
+
     def clear_caches(self, book_ids=None):
         with self._lock:
             if book_ids is None:
@@ -399,6 +467,8 @@ class OnDeviceField(OneToOneField):
                 loc.append(_('Card B'))
         return ', '.join(loc) + ((' (%s books)'%count) if count > 1 else '')
 
+    values_for_books = Field.values_for_books
+
     def __iter__(self):
         return iter(())
 
@@ -446,6 +516,14 @@ class ManyToOneField(Field):
             ans = default_value
         return ans
 
+    def values_for_books(self, book_ids, default_value=None):
+        get, id_map = self.table.book_col_map.get, self.table.id_map
+        ans = {}
+        for book_id in book_ids:
+            item_id = get(book_id)
+            ans[book_id] = default_value if item_id is None else id_map.get(item_id, default_value)
+        return ans
+
     def ids_for_book(self, book_id):
         id_ = self.table.book_col_map.get(book_id, None)
         if id_ is None:
@@ -500,6 +578,26 @@ class ManyToManyField(Field):
             ans = default_value
         return ans
 
+    def values_for_books(self, book_ids, default_value=None):
+        # Books often share the same items, so compute the value only once
+        # for every distinct tuple of item ids
+        get, for_ids = self.table.book_col_map.get, {}
+        ans = {}
+        for book_id in book_ids:
+            ids = get(book_id, ())
+            if ids:
+                try:
+                    val = for_ids[ids]
+                except KeyError:
+                    try:
+                        val = for_ids[ids] = self.for_book(book_id, default_value=default_value)
+                    except (KeyError, IndexError):
+                        val = default_value
+            else:
+                val = default_value
+            ans[book_id] = val
+        return ans
+
     def ids_for_book(self, book_id):
         return self.table.book_col_map.get(book_id, ())
 
@@ -511,14 +609,21 @@ class ManyToManyField(Field):
 
     def sort_keys_for_books(self, get_metadata, lang_map):
         sk_map = LazySortMap(self._default_sort_key, self._sort_key, self.table.id_map)
-        bcmg = self.table.book_col_map.get
+        bcm = self.table.book_col_map
+        bcmg = bcm.get
         dsk = (self._default_sort_key,)
         if self.sort_sort_key:
-            def sk(book_id):
-                return tuple(sorted(sk_map(x) for x in bcmg(book_id, ()))) or dsk
+            def key(item_ids):
+                return tuple(sorted(sk_map(x) for x in item_ids)) or dsk
         else:
-            def sk(book_id):
-                return tuple(sk_map(x) for x in bcmg(book_id, ())) or dsk
+            def key(item_ids):
+                return tuple(sk_map(x) for x in item_ids) or dsk
+        if hasattr(bcm, 'memoized_getter'):
+            # Columnar storage, books with the same items share the sort key
+            return bcm.memoized_getter(key, ())
+
+        def sk(book_id):
+            return key(bcmg(book_id, ()))
         return sk
 
     def iter_searchable_values(self, get_metadata, candidates, default_value=None):
@@ -557,6 +662,8 @@ class IdentifiersField(ManyToManyField):
                 ids = default_value
         return ids
 
+    values_for_books = Field.values_for_books
+
     def sort_keys_for_books(self, get_metadata, lang_map):
         'Sort by identifier keys'
         bcmg = self.table.book_col_map.get
@@ -607,6 +714,10 @@ class FormatsField(ManyToManyField):
     def for_book(self, book_id, default_value=None):
         return self.table.book_col_map.get(book_id, default_value)
 
+    def values_for_books(self, book_ids, default_value=None):
+        get = self.table.book_col_map.get
+        return {book_id:get(book_id, default_value) for book_id in book_ids}
+
     def format_fname(self, book_id, fmt):
         return self.table.fname_map[book_id][fmt.upper()]
 
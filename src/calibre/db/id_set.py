@@ -0,0 +1,381 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+'''
+A compact set of book ids, used to store search results. The ids are split
+into chunks of 65536 consecutive ids. Sparse chunks are stored as sorted
+arrays of 16-bit integers and dense chunks as bitmaps (python longs), in the
+style of roaring bitmaps. Combining dense chunks is done with a single long
+integer operation and conversions between the representations are done with
+C level string and itertools functions, so no python level loop over
+individual ids is needed for the common operations.
+'''
+
+from array import array
+from bisect import bisect_left
+from collections import Iterable, MutableSet, deque
+from itertools import chain, compress, imap, repeat
+from operator import not_
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+LOW_MASK = CHUNK_SIZE - 1
+# Chunks with more ids than this are stored as bitmaps
+MAX_ARRAY_SIZE = 4096
+
+BIN_TO_BYTE = bytes(bytearray(1 if i == ord('1') else 0 for i in xrange(256)))
+BYTE_TO_BIN = bytes(bytearray(ord('1') if i else ord('0') for i in xrange(256)))
+
+
+def bitmap_to_bytemap(bitmap):
+    ' Return a bytearray that has a one at every position whose bit is set in bitmap '
+    return bytearray(bin(bitmap)[:1:-1].translate(BIN_TO_BYTE))
+
+
+def bytemap_to_bitmap(bytemap):
+    return int(bytes(bytemap[::-1]).translate(BYTE_TO_BIN) or b'0', 2)
+
+
+def popcount(bitmap):
+    return bin(bitmap).count('1')
+
+
+def fill_bytemap(bytemap, positions):
+    deque(imap(bytemap.__setitem__, positions, repeat(1)), maxlen=0)
+
+
+def array_to_bitmap(arr):
+    if not arr:
+        return 0
+    bytemap = bytearray(arr[-1] + 1)
+    fill_bytemap(bytemap, arr)
+    return bytemap_to_bitmap(bytemap)
+
+
+def bitmap_to_array(bitmap):
+    return array(b'H', compress(xrange(CHUNK_SIZE), bitmap_to_bytemap(bitmap)))
+
+
+def padded_bytemap(bitmap):
+    ans = bitmap_to_bytemap(bitmap)
+    ans.extend(bytearray(CHUNK_SIZE - len(ans)))
+    return ans
+
+
+def normalize(c):
+    ' Return the canonical representation of the chunk c or None if it is empty '
+    if isinstance(c, array):
+        if not c:
+            return None
+        return c if len(c) <= MAX_ARRAY_SIZE else array_to_bitmap(c)
+    if not c:
+        return None
+    return bitmap_to_array(c) if popcount(c) <= MAX_ARRAY_SIZE else c
+
+
+def chunk_and(a, b):
+    if isinstance(a, array):
+        if isinstance(b, array):
+            return normalize(array(b'H', sorted(set(a).intersection(b))))
+        a, b = b, a
+    if isinstance(b, array):
+        bytemap = padded_bytemap(a)
+        return normalize(array(b'H', compress(b, imap(bytemap.__getitem__, b))))
+    return normalize(a & b)
+
+
+def chunk_or(a, b):
+    if isinstance(a, array) and isinstance(b, array):
+        return normalize(array(b'H', sorted(set(a).union(b))))
+    if isinstance(a, array):
+        a = array_to_bitmap(a)
+    if isinstance(b, array):
+        b = array_to_bitmap(b)
+    return normalize(a | b)
+
+
+def chunk_sub(a, b):
+    if isinstance(a, array):
+        if isinstance(b, array):
+            return normalize(array(b'H', sorted(set(a).difference(b))))
+        bytemap = padded_bytemap(b)
+        return normalize(array(b'H', compress(a, imap(not_, imap(bytemap.__getitem__, a)))))
+    if isinstance(b, array):
+        b = array_to_bitmap(b)
+    return normalize(a & ~b)
+
+
+def chunk_contains(c, low):
+    if isinstance(c, array):
+        i = bisect_left(c, low)
+        return i < len(c) and c[i] == low
+    return bool((c >> low) & 1)
+
+
+class BookIdSet(MutableSet):
+
+    '''
+    A mutable set of non-negative integers that supports the full set API.
+    Operations between two BookIdSet objects work a chunk at a time, operations
+    with other iterables first convert them to a BookIdSet.
+    '''
+
+    __slots__ = ('chunks',)
+
+    def __init__(self, iterable=()):
+        self.chunks = {}
+        if isinstance(iterable, BookIdSet):
+            self.chunks = {k:(array(b'H', c) if isinstance(c, array) else c) for k, c in iterable.chunks.iteritems()}
+        else:
+            self._fill(iterable)
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return cls(iterable)
+
+    @classmethod
+    def _from_chunks(cls, chunks):
+        ans = cls()
+        ans.chunks = chunks
+        return ans
+
+    def _fill(self, ids):
+        if not isinstance(ids, (set, frozenset, list, tuple)):
+            ids = list(ids)
+        if not ids:
+            return
+        top = max(ids)
+        if top > CHUNK_SIZE and top > 64 * len(ids):
+            # Too sparse for a bytemap of all ids
+            for book_id in ids:
+                self.add(book_id)
+            return
+        bytemap = bytearray(top + 1)
+        fill_bytemap(bytemap, ids)
+        for key in xrange((top >> CHUNK_BITS) + 1):
+            part = bytemap[key << CHUNK_BITS:(key + 1) << CHUNK_BITS]
+            num = part.count(b'\x01')
+            if num > MAX_ARRAY_SIZE:
+                self.chunks[key] = bytemap_to_bitmap(part)
+            elif num > 0:
+                self.chunks[key] = array(b'H', compress(xrange(CHUNK_SIZE), part))
+
+    def _binary_op(self, other, op, keep_left=False, keep_right=False):
+        ours, theirs = self.chunks, other.chunks
+        ans = {}
+        for key in (ours.viewkeys() | theirs.viewkeys()):
+            a, b = ours.get(key), theirs.get(key)
+            if a is None:
+                c = b if keep_right else None
+                if c is not None and isinstance(c, array):
+                    c = array(b'H', c)
+            elif b is None:
+                c = a if keep_left else None
+                if c is not None and isinstance(c, array):
+                    c = array(b'H', c)
+            else:
+                c = op(a, b)
+            if c is not None:
+                ans[key] = c
+        return ans
+
+    @staticmethod
+    def _coerce(other):
+        if isinstance(other, BookIdSet):
+            return other
+        if not isinstance(other, Iterable):
+            return None
+        return BookIdSet(other)
+
+    # Set API {{{
+    def __len__(self):
+        return sum(len(c) if isinstance(c, array) else popcount(c) for c in self.chunks.itervalues())
+
+    def __contains__(self, book_id):
+        try:
+            c = self.chunks.get(book_id >> CHUNK_BITS)
+        except TypeError:
+            return False
+        return c is not None and chunk_contains(c, book_id & LOW_MASK)
+
+    def _iter_chunk(self, key):
+        c = self.chunks[key]
+        base = key << CHUNK_BITS
+        if isinstance(c, array):
+            return imap(base.__add__, c) if base else iter(c)
+        return compress(xrange(base, base + CHUNK_SIZE), bitmap_to_bytemap(c))
+
+    def __iter__(self):
+        return chain.from_iterable(imap(self._iter_chunk, sorted(self.chunks)))
+
+    def __nonzero__(self):
+        return bool(self.chunks)
+
+    def __repr__(self):
+        return 'BookIdSet(%r)' % list(self)
+
+    def __eq__(self, other):
+        if isinstance(other, BookIdSet):
+            return self.chunks == other.chunks
+        return MutableSet.__eq__(self, other)
+
+    def __ne__(self, other):
+        ans = self.__eq__(other)
+        return ans if ans is NotImplemented else not ans
+
+    __hash__ = None
+
+    def __and__(self, other):
+        other = self._coerce(other)
+        if other is None:
+            return NotImplemented
+        return self._from_chunks(self._binary_op(other, chunk_and))
+    __rand__ = __and__
+
+    def __or__(self, other):
+        other = self._coerce(other)
+        if other is None:
+            return NotImplemented
+        return self._from_chunks(self._binary_op(other, chunk_or, keep_left=True, keep_right=True))
+    __ror__ = __or__
+
+    def __sub__(self, other):
+        other = self._coerce(other)
+        if other is None:
+            return NotImplemented
+        return self._from_chunks(self._binary_op(other, chunk_sub, keep_left=True))
+
+    def __rsub__(self, other):
+        other = self._coerce(other)
+        if other is None:
+            return NotImplemented
+        return other - self
+
+    def __iand__(self, other):
+        self.chunks = (self & other).chunks
+        return self
+
+    def __ior__(self, other):
+        self.chunks = (self | other).chunks
+        return self
+
+    def __isub__(self, other):
+        self.chunks = (self - other).chunks
+        return self
+
+    def add(self, book_id):
+        key, low = book_id >> CHUNK_BITS, book_id & LOW_MASK
+        c = self.chunks.get(key)
+        if c is None:
+            self.chunks[key] = array(b'H', (low,))
+        elif isinstance(c, array):
+            i = bisect_left(c, low)
+            if i == len(c) or c[i] != low:
+                c.insert(i, low)
+                if len(c) > MAX_ARRAY_SIZE:
+                    self.chunks[key] = array_to_bitmap(c)
+        else:
+            self.chunks[key] = c | (1 << low)
+
+    def discard(self, book_id):
+        key, low = book_id >> CHUNK_BITS, book_id & LOW_MASK
+        c = self.chunks.get(key)
+        if c is None:
+            return
+        if isinstance(c, array):
+            i = bisect_left(c, low)
+            if i < len(c) and c[i] == low:
+                del c[i]
+        else:
+            c &= ~(1 << low)
+        c = normalize(c)
+        if c is None:
+            del self.chunks[key]
+        else:
+            self.chunks[key] = c
+
+    def clear(self):
+        self.chunks = {}
+
+    def copy(self):
+        return BookIdSet(self)
+
+    def update(self, *iterables):
+        for x in iterables:
+            if not isinstance(x, BookIdSet) and hasattr(x, '__len__') and len(x) < 64:
+                for book_id in x:
+                    self.add(book_id)
+            else:
+                self |= x
+
+    def difference_update(self, *iterables):
+        for x in iterables:
+            if not isinstance(x, BookIdSet) and hasattr(x, '__len__') and len(x) < 64:
+                for book_id in x:
+                    self.discard(book_id)
+            else:
+                self -= x
+
+    def intersection_update(self, *iterables):
+        for x in iterables:
+            self &= x
+
+    def union(self, *iterables):
+        ans = self.copy()
+        ans.update(*iterables)
+        return ans
+
+    def intersection(self, *iterables):
+        ans = self
+        for x in iterables:
+            ans = ans & x
+        return ans if ans is not self else self.copy()
+
+    def difference(self, *iterables):
+        ans = self.copy()
+        ans.difference_update(*iterables)
+        return ans
+
+    def isdisjoint(self, other):
+        return not (self & other)
+
+    def issubset(self, other):
+        return not (self - other)
+
+    def issuperset(self, other):
+        return not (self._coerce(other) - self)
+    # }}}
+
+    def filter(self, book_ids):
+        '''
+        Return a list of the ids in the sequence book_ids that are in this
+        set, in the order they appear in book_ids. Useful to restrict a sorted
+        list of books to the books in this set.
+        '''
+        if not isinstance(book_ids, (list, tuple)):
+            book_ids = list(book_ids)
+        if not book_ids or not self.chunks:
+            return []
+        bytemap = self.as_bytemap(max(book_ids) + 1)
+        return list(compress(book_ids, imap(bytemap.__getitem__, book_ids)))
+
+    def as_bytemap(self, size):
+        ' Return a bytearray of length size with a one at the position of every id in this set that is smaller than size '
+        ans = bytearray(size)
+        for key, c in self.chunks.iteritems():
+            base = key << CHUNK_BITS
+            if base >= size:
+                continue
+            if isinstance(c, array):
+                part = bytearray(c[-1] + 1)
+                fill_bytemap(part, c)
+            else:
+                part = bitmap_to_bytemap(c)
+            end = min(base + len(part), size)
+            ans[base:end] = part[:end - base]
+        return ans
@@ -13,12 +13,17 @@ from datetime import timedelta
 from collections import deque, OrderedDict
 
 from calibre.constants import preferred_encoding
+from calibre.db.id_set import BookIdSet
+from calibre.db.search_cache import PersistentSearchCache
+from calibre.db.search_index import TextIndex
 from calibre.db.utils import force_to_bool
 from calibre.utils.config_base import prefs
 from calibre.utils.date import parse_date, UNDEFINED_DATE, now, dt_as_local
 from calibre.utils.icu import primary_contains, sort_key
 from calibre.utils.localization import lang_map, canonicalize_lang
-from calibre.utils.search_query_parser import SearchQueryParser, ParseException
+from calibre.utils.monotonic import monotonic
+from calibre.utils.search_query_parser import (
+    SearchQueryParser, ParseException, DEFAULT_COST, DEFAULT_SELECTIVITY)
 
 CONTAINS_MATCH = 0
 EQUALS_MATCH   = 1
@@ -448,8 +453,9 @@ class Parser(SearchQueryParser):  # {{{
 
     def __init__(self, dbcache, all_book_ids, gst, date_search, num_search,
                  bool_search, keypair_search, limit_search_columns, limit_search_columns_to,
-                 locations, virtual_fields, lookup_saved_search, parse_cache):
+                 locations, virtual_fields, lookup_saved_search, parse_cache, text_index=None):
         self.dbcache, self.all_book_ids = dbcache, all_book_ids
+        self.text_index = text_index
         self.all_search_locations = frozenset(locations)
         self.grouped_search_terms = gst
         self.date_search, self.num_search = date_search, num_search
@@ -481,6 +487,65 @@ class Parser(SearchQueryParser):  # {{{
         for x in ():
             yield x, set()
 
+    def estimate_term(self, location, query):
+        try:
+            return self._estimate_term(location, query)
+        except Exception:
+            return DEFAULT_COST, DEFAULT_SELECTIVITY
+
+    def _estimate_term(self, location, query):
+        # Costs are relative to a lookup of a single value per candidate book
+        location = icu_lower(location.strip())
+        if location == 'search':
+            return 5.0, DEFAULT_SELECTIVITY
+        if location == 'vl':
+            return 1.0, DEFAULT_SELECTIVITY
+        if len(location) > 2 and location.startswith('@') and location[1:] in self.grouped_search_terms:
+            location = location[1:]
+        if location.startswith('@'):
+            return 5.0, DEFAULT_SELECTIVITY
+        original_location = location
+        location = self.field_metadata.search_term_to_field_key(location)
+        if isinstance(location, list):
+            return sum(self._estimate_term(loc, query)[0] for loc in location), DEFAULT_SELECTIVITY
+        if location == 'all':
+            return 20.0, 0.3
+        if location not in self.field_metadata:
+            return DEFAULT_COST, DEFAULT_SELECTIVITY
+        fm = self.field_metadata[location]
+        dt = fm['datatype']
+        if dt == 'composite':
+            return 50.0, DEFAULT_SELECTIVITY
+        if query.startswith('~'):
+            return 10.0, DEFAULT_SELECTIVITY
+        if dt in {'datetime', 'rating', 'int', 'float', 'bool'}:
+            return DEFAULT_COST, DEFAULT_SELECTIVITY
+        field = self.dbcache.fields.get(location)
+        if field is None:
+            return DEFAULT_COST, DEFAULT_SELECTIVITY
+        total = float(len(self.dbcache.fields['uuid'].table.book_col_map) or 1)
+
+        # Use the per value book counts of the field (its histogram) to
+        # estimate the selectivity of terms that match a single value
+        if fm.get('is_csp', False):
+            key = 'isbn' if original_location == 'isbn' else (
+                query.partition(':')[0].lstrip('=') if ':' in query else None)
+            cbm = field.table.col_book_map
+            if key and icu_lower(key) in cbm:
+                return DEFAULT_COST, len(cbm[icu_lower(key)]) / total
+            return DEFAULT_COST, DEFAULT_SELECTIVITY
+        if location == 'formats':
+            if query.startswith('=') and not query.startswith('=.'):
+                return 0.5, len(field.table.col_book_map.get(query[1:].upper(), ())) / total
+            return DEFAULT_COST, DEFAULT_SELECTIVITY
+        idx = None if self.text_index is None else self.text_index.index_for(field)
+        if idx is None:
+            return 5.0, 0.2
+        if query.startswith('=') and not query.startswith('=.'):
+            count = sum(len(field.books_for(item_id)) for item_id in idx.lower_map.get(icu_lower(query[1:]), ()))
+            return 0.1, count / total
+        return 0.5, 0.2
+
     def parse(self, *args, **kwargs):
         self.virtual_field_used = False
         return SearchQueryParser.parse(self, *args, **kwargs)
@@ -699,12 +764,20 @@ class Parser(SearchQueryParser):  # {{{
                 continue
 
             if location in text_fields:
-                for val, book_ids in self.field_iter(location, current_candidates):
-                    if val is not None:
-                        if isinstance(val, basestring):
-                            val = (val,)
-                        if _match(q, val, matchkind, use_primary_find_in_search=upf, case_sensitive=case_sensitive):
-                            matches |= book_ids
+                found = None
+                if self.text_index is not None and not case_sensitive and location in self.dbcache.fields:
+                    found = self.text_index.matches(
+                        self.dbcache.fields[location], q, matchkind, current_candidates,
+                        partial(_match, q, matchkind=matchkind, use_primary_find_in_search=upf, case_sensitive=case_sensitive))
+                if found is not None:
+                    matches |= found
+                else:
+                    for val, book_ids in self.field_iter(location, current_candidates):
+                        if val is not None:
+                            if isinstance(val, basestring):
+                                val = (val,)
+                            if _match(q, val, matchkind, use_primary_find_in_search=upf, case_sensitive=case_sensitive):
+                                matches |= book_ids
 
             if location == 'series_sort':
                 book_lang_map = self.dbcache.fields['languages'].book_value_map
@@ -801,6 +874,9 @@ class LRUCache(object):  # {{{
 class Search(object):
 
     MAX_CACHE_UPDATE = 50
+    # The number of cached results that are also kept as sets, so that
+    # callers that want sets do not pay for converting them on every search
+    MAX_HOT_SETS = 4
 
     def __init__(self, db, opt_name, all_search_locations=()):
         self.all_search_locations = all_search_locations
@@ -810,7 +886,10 @@ class Search(object):
         self.keypair_search = KeyPairSearch()
         self.saved_searches = SavedSearchQueries(db, opt_name)
         self.cache = LRUCache()
+        self.hot_sets = LRUCache(limit=self.MAX_HOT_SETS)
         self.parse_cache = LRUCache(limit=100)
+        self.text_index = TextIndex()
+        self.persistent_cache = None
 
     def get_saved_searches(self):
         return self.saved_searches
@@ -819,9 +898,20 @@ class Search(object):
         if frozenset(newlocs) != frozenset(self.all_search_locations):
             self.clear_caches()
             self.parse_cache.clear()
+            if self.persistent_cache is not None:
+                self.persistent_cache.clear()
         self.all_search_locations = newlocs
 
     def update_or_clear(self, dbcache, book_ids=None):
+        if book_ids is None:
+            self.text_index.invalidate()
+        elif book_ids:
+            self.text_index.update_books(book_ids)
+        if self.persistent_cache is not None:
+            if book_ids:
+                self.persistent_cache.books_changed(book_ids)
+            else:
+                self.persistent_cache.clear()
         if book_ids and (len(book_ids) * len(self.cache)) <= self.MAX_CACHE_UPDATE:
             self.update_caches(dbcache, book_ids)
         else:
@@ -829,6 +919,82 @@ class Search(object):
 
     def clear_caches(self):
         self.cache.clear()
+        self.hot_sets.clear()
+
+    def cached_set(self, query, cached):
+        ''' The cached result for query as a set. The sets of the most
+        recently used results are kept, as long as the results do not change. '''
+        entry = self.hot_sets.get(query)
+        if entry is None or entry[0] is not cached:
+            entry = (cached, set(cached))
+            self.hot_sets.pop(query)
+            self.hot_sets.add(query, entry)
+        return entry[1]
+
+    # Persistent cache {{{
+
+    def persistent_cache_stamp(self, dbcache):
+        ''' Everything that the stored results depend on, apart from the
+        contents of the library itself. '''
+        import hashlib
+        from calibre.constants import numeric_version
+        from calibre.utils.config import tweaks
+        from calibre.utils.localization import get_lang
+        from calibre.utils.serialize import json_dumps
+        context = json_dumps([
+            numeric_version, get_lang(), tweaks['locale_for_sorting'],
+            sorted(self.all_search_locations),
+            [prefs[x] for x in ('limit_search_columns', 'limit_search_columns_to',
+                                'use_primary_find_in_search', 'case_sensitive')],
+            [dbcache._pref(x) for x in ('grouped_search_terms', 'virtual_libraries', 'bools_are_tristate')],
+            self.saved_searches.queries,
+        ], sort_keys=True)
+        return (dbcache.backend.library_id, dbcache.backend.last_modified(),
+                hashlib.sha1(context).hexdigest())
+
+    def load_persistent_cache(self, dbcache):
+        self.persistent_cache = PersistentSearchCache(dbcache.backend.library_path)
+        self.persistent_cache.load(self.persistent_cache_stamp(dbcache))
+
+    def save_persistent_cache(self, dbcache):
+        if self.persistent_cache is None:
+            return
+        definitions = tuple(self.saved_searches.queries.itervalues()) + tuple(
+            dbcache._pref('virtual_libraries', {}).itervalues())
+        results = {query:result for query, result in self.cache if not self.is_time_dependent(query, definitions)}
+        self.persistent_cache.save(self.persistent_cache_stamp(dbcache), results)
+
+    def is_time_dependent(self, query, definitions=()):
+        ''' Return True if the results of query could change without the
+        library changing, for example, date:today. definitions are the saved
+        searches and virtual libraries query could refer to. '''
+        q = icu_lower(query)
+        if 'vl:' in q or 'search:' in q:
+            q = '\n'.join([q] + [icu_lower(x or '') for x in definitions])
+        ds = self.date_search
+        for word in ds.local_today | ds.local_yesterday | ds.local_thismonth | {'daysago', icu_lower(_('daysago'))}:
+            if word in q:
+                return True
+        return False
+
+    def get_cached(self, sqp, query, dbcache):
+        ans = self.cache.get(query)
+        if ans is None and self.persistent_cache is not None and query in self.persistent_cache.entries:
+            def evaluate(query, book_ids):
+                prev, sqp.all_book_ids = sqp.all_book_ids, book_ids
+                try:
+                    return sqp.parse(query)
+                finally:
+                    sqp.all_book_ids = prev
+            try:
+                ans = self.persistent_cache.get(query, dbcache._all_book_ids(type=set), evaluate)
+            except ParseException:
+                ans = None
+            if ans is not None:
+                ans = BookIdSet(ans)
+                self.cache.add(query, ans)
+        return ans
+    # }}}
 
     def update_caches(self, dbcache, book_ids):
         sqp = self.create_parser(dbcache)
@@ -839,11 +1005,14 @@ class Search(object):
 
     def discard_books(self, book_ids):
         book_ids = set(book_ids)
+        self.text_index.discard_books(book_ids)
+        self.hot_sets.clear()
         for query, result in self.cache:
             result.difference_update(book_ids)
 
     def _update_caches(self, sqp, book_ids):
         book_ids = sqp.all_book_ids = set(book_ids)
+        self.hot_sets.clear()
         remove = set()
         for query, result in tuple(self.cache):
             try:
@@ -865,9 +1034,10 @@ class Search(object):
             self.keypair_search,
             prefs['limit_search_columns'],
             prefs['limit_search_columns_to'], self.all_search_locations,
-            virtual_fields, self.saved_searches.lookup, self.parse_cache)
+            virtual_fields, self.saved_searches.lookup, self.parse_cache,
+            text_index=self.text_index)
 
-    def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None):
+    def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None, as_id_set=False):
         '''
         Return the set of ids of all records that match the specified
         query and restriction
@@ -876,51 +1046,87 @@ class Search(object):
         # thread safe.
         sqp = self.create_parser(dbcache, virtual_fields)
         try:
-            return self._do_search(sqp, query, search_restriction, dbcache, book_ids=book_ids)
+            return self._do_search(sqp, query, search_restriction, dbcache, book_ids=book_ids, as_id_set=as_id_set)
+        finally:
+            sqp.dbcache = sqp.lookup_saved_search = None
+
+    def explain(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None):
+        '''
+        Run the search for query without using cached results and return a
+        dictionary describing the evaluated query plan, with the time spent in
+        each node. The restriction, if any, is evaluated normally.
+        '''
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+        query = query.strip()
+        sqp = self.create_parser(dbcache, virtual_fields)
+        try:
+            restricted_ids = self._do_search(sqp, '', search_restriction, dbcache, book_ids=book_ids)
+            sqp.all_book_ids = restricted_ids
+            start = monotonic()
+            if query:
+                result, plan = sqp.explain(query)
+            else:
+                result, plan = restricted_ids, None
+            return {
+                'query': query, 'restriction': search_restriction, 'result': result,
+                'time': monotonic() - start, 'plan': None if plan is None else plan.as_dict(),
+            }
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
-    def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
+    def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None, as_id_set=False):
         ''' Do the search, caching the results. Results are cached only if the
-        search is on the full library and no virtual field is searched on '''
+        search is on the full library and no virtual field is searched on.
+        Cached results are stored as :class:`BookIdSet` objects, which use far
+        less memory than sets. If as_id_set is True, the result is returned as
+        a BookIdSet, otherwise as a set. '''
         if isinstance(search_restriction, bytes):
             search_restriction = search_restriction.decode('utf-8')
         if isinstance(query, bytes):
             query = query.decode('utf-8')
 
+        def ret(x, key=None):
+            if as_id_set:
+                return x if isinstance(x, BookIdSet) else BookIdSet(x)
+            # Only cached results are BookIdSets
+            return self.cached_set(key, x) if isinstance(x, BookIdSet) else x
+
         query = query.strip()
         if book_ids is None and query and not search_restriction:
-            cached = self.cache.get(query)
+            cached = self.get_cached(sqp, query, dbcache)
             if cached is not None:
-                return cached
+                return ret(cached, query)
 
         restricted_ids = all_book_ids = dbcache._all_book_ids(type=set)
         if search_restriction and search_restriction.strip():
-            cached = self.cache.get(search_restriction.strip())
+            cached = self.get_cached(sqp, search_restriction.strip(), dbcache)
             if cached is None:
                 sqp.all_book_ids = all_book_ids if book_ids is None else book_ids
                 restricted_ids = sqp.parse(search_restriction)
                 if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-                    self.cache.add(search_restriction.strip(), restricted_ids)
+                    self.cache.add(search_restriction.strip(), BookIdSet(restricted_ids))
+            elif book_ids is not None:
+                restricted_ids = set(cached.filter(book_ids))
+            elif not query:
+                return ret(cached, search_restriction.strip())
             else:
-                restricted_ids = cached
-                if book_ids is not None:
-                    restricted_ids = book_ids.intersection(restricted_ids)
+                restricted_ids = self.cached_set(search_restriction.strip(), cached)
         elif book_ids is not None:
             restricted_ids = book_ids
 
         if not query:
-            return restricted_ids
+            return ret(restricted_ids)
 
         if restricted_ids is all_book_ids:
-            cached = self.cache.get(query)
+            cached = self.get_cached(sqp, query, dbcache)
             if cached is not None:
-                return cached
+                return ret(cached, query)
 
         sqp.all_book_ids = restricted_ids
         result = sqp.parse(query)
 
         if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-            self.cache.add(query, result)
+            self.cache.add(query, BookIdSet(result))
 
-        return result
+        return ret(result)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+'''
+An optional on-disk cache of search results, so that the results of common
+searches and virtual libraries survive restarts. The cache is stored next to
+metadata.db and is only used if the stamp it was saved with (the library id,
+the last modified time of metadata.db and a hash of the preferences that
+affect searching) matches the library when it is opened.
+'''
+
+import os
+import zlib
+
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.serialize import msgpack_dumps, msgpack_loads
+
+CACHE_NAME = 'search_cache.calibre'
+# The bit offsets that are set in every possible byte value
+BITS = tuple(tuple(i for i in xrange(8) if b & (1 << i)) for b in xrange(256))
+
+
+def encode_book_ids(book_ids):
+    ' Encode a set of book ids as a compressed bitmap '
+    if not book_ids:
+        return b''
+    buf = bytearray((max(book_ids) >> 3) + 1)
+    for book_id in book_ids:
+        buf[book_id >> 3] |= 1 << (book_id & 7)
+    return zlib.compress(bytes(buf), 6)
+
+
+def decode_book_ids(raw):
+    ' The inverse of :func:`encode_book_ids` '
+    ans = set()
+    if raw:
+        for i, b in enumerate(bytearray(zlib.decompress(raw))):
+            if b:
+                base = i << 3
+                ans.update(base + x for x in BITS[b])
+    return ans
+
+
+class PersistentSearchCache(object):
+
+    '''
+    Holds the encoded results loaded from disk. Results are decoded only when
+    they are first needed, at which point they are handed over to the in
+    memory search cache. Changes made to the library before that are recorded
+    in ``pending`` and the affected books are re-checked when an entry is
+    decoded, so that writes remain cheap.
+    '''
+
+    VERSION = 1
+    MAX_PENDING = 1000
+
+    def __init__(self, library_path):
+        self.path = os.path.join(library_path, CACHE_NAME)
+        self.entries = {}
+        self.pending = set()
+
+    def load(self, stamp):
+        self.clear()
+        try:
+            with lopen(self.path, 'rb') as f:
+                data = msgpack_loads(f.read())
+        except EnvironmentError:
+            return
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            return
+        try:
+            if data['version'] == self.VERSION and tuple(data['stamp']) == tuple(stamp):
+                self.entries = dict(data['entries'])
+        except Exception:
+            self.entries = {}
+
+    def clear(self):
+        self.entries = {}
+        self.pending = set()
+
+    def books_changed(self, book_ids):
+        if self.entries:
+            self.pending |= set(book_ids)
+            if len(self.pending) > self.MAX_PENDING:
+                self.clear()
+
+    def get(self, query, all_book_ids, evaluate):
+        '''
+        Return the cached result for query or None. ``evaluate`` is a function
+        that returns the set of books from the specified set of books that
+        match query, it is used to bring the result up to date with changes
+        made since the cache was loaded.
+        '''
+        raw = self.entries.pop(query, None)
+        if raw is None:
+            return None
+        ans = decode_book_ids(raw)
+        if self.pending:
+            ans -= self.pending
+            changed = self.pending & all_book_ids
+            if changed:
+                ans |= evaluate(query, changed)
+        ans &= all_book_ids
+        return ans
+
+    def save(self, stamp, results):
+        ''' Save results, a mapping of query to set of book ids, along with
+        any entries that were never used in this session, if they are still
+        valid. '''
+        entries = {} if self.pending else dict(self.entries)
+        for query, book_ids in results.iteritems():
+            entries[query] = encode_book_ids(book_ids)
+        if not entries:
+            try:
+                os.remove(self.path)
+            except EnvironmentError:
+                pass
+            return
+        data = msgpack_dumps({'version': self.VERSION, 'stamp': tuple(stamp), 'entries': entries})
+        tpath = self.path + '.tmp'
+        try:
+            with lopen(tpath, 'wb') as f:
+                f.write(data)
+            atomic_rename(tpath, self.path)
+        except EnvironmentError:
+            import traceback
+            traceback.print_exc()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+'''
+An inverted index over the values of the text fields in the database, used to
+speed up contains and equals searches. The index maps folded (lowercased,
+accent stripped) word tokens to the ids of the items that contain them. The
+index is only ever used to narrow the set of items that have to be checked,
+every item it returns is still matched against the query using the normal
+matching code, so search results are unchanged.
+'''
+
+import re
+import unicodedata
+from collections import defaultdict
+from threading import Lock
+
+from calibre.db.tables import ONE_ONE
+
+# Fields that are never indexed. Comments are too large to index usefully and
+# the rest are not searched via the text matching code.
+NOT_INDEXED = frozenset({'comments', 'uuid', 'path', 'formats', 'identifiers'})
+INDEXED_DATATYPES = frozenset({'text', 'series', 'enumeration'})
+
+token_pat = re.compile(r'[a-z0-9]+')
+not_plain_ascii = re.compile(r'[^\x20-\x7e]')
+
+
+def fold(val):
+    ' Lowercase and strip accents from val '
+    val = unicodedata.normalize('NFKD', icu_lower(val))
+    return ''.join(c for c in val if not unicodedata.combining(c))
+
+
+def trigrams(token):
+    return {token[i:i+3] for i in xrange(len(token) - 2)}
+
+
+def collator_is_safe():
+    ''' The index assumes that if the collator considers two strings equal,
+    their folded forms are equal. This is not the case for locales that have
+    contractions made up of ASCII characters, for example, aa == å in Danish,
+    so the index is disabled for primary searching in such locales. '''
+    from calibre.utils.icu import contractions, primary_collator
+    try:
+        cont = contractions(primary_collator())
+    except Exception:
+        return False
+    return not any(not_plain_ascii.search(c) is None for c in cont)
+
+
+def can_index(field):
+    if field.name in NOT_INDEXED or field.is_composite:
+        return False
+    m = field.metadata
+    if m.get('datatype') not in INDEXED_DATATYPES or m.get('is_csp'):
+        return False
+    table = getattr(field, 'table', None)
+    if table is None:
+        return False
+    if table.table_type == ONE_ONE:
+        return hasattr(table, 'book_col_map')
+    return hasattr(table, 'id_map')
+
+
+class FieldIndex(object):
+
+    '''
+    The index for a single field. Items are the ids in the id_map of the
+    field's table, or book ids for one-one fields.
+    '''
+
+    def __init__(self, field):
+        self.field = field
+        self.is_one_one = field.table.table_type == ONE_ONE
+        self.item_values = {}
+        self.lower_map = defaultdict(set)
+        self.token_map = defaultdict(set)
+        self.vocab_grams = defaultdict(set)
+        self.residual = set()
+        for item_id, val in self.value_map.iteritems():
+            self.add_item(item_id, val)
+
+    @property
+    def value_map(self):
+        t = self.field.table
+        return t.book_col_map if self.is_one_one else t.id_map
+
+    def add_item(self, item_id, val):
+        if not isinstance(val, basestring) or not val:
+            return
+        self.item_values[item_id] = val
+        self.lower_map[icu_lower(val)].add(item_id)
+        folded = fold(val)
+        if not_plain_ascii.search(folded) is not None:
+            self.residual.add(item_id)
+            return
+        for token in token_pat.findall(folded):
+            items = self.token_map[token]
+            if not items:
+                for g in trigrams(token):
+                    self.vocab_grams[g].add(token)
+            items.add(item_id)
+
+    def remove_item(self, item_id):
+        val = self.item_values.pop(item_id, None)
+        if val is None:
+            return
+        lval = icu_lower(val)
+        items = self.lower_map.get(lval)
+        if items is not None:
+            items.discard(item_id)
+            if not items:
+                del self.lower_map[lval]
+        if item_id in self.residual:
+            self.residual.discard(item_id)
+            return
+        for token in token_pat.findall(fold(val)):
+            items = self.token_map.get(token)
+            if items is None:
+                continue
+            items.discard(item_id)
+            if not items:
+                del self.token_map[token]
+                for g in trigrams(token):
+                    toks = self.vocab_grams.get(g)
+                    if toks is not None:
+                        toks.discard(token)
+                        if not toks:
+                            del self.vocab_grams[g]
+
+    def update_item(self, item_id, val):
+        if self.item_values.get(item_id) != val:
+            self.remove_item(item_id)
+            self.add_item(item_id, val)
+
+    def update_books(self, book_ids):
+        vmap = self.value_map
+        if self.is_one_one:
+            for book_id in book_ids:
+                self.update_item(book_id, vmap.get(book_id))
+            return
+        ids_for_book = self.field.ids_for_book
+        for book_id in book_ids:
+            for item_id in ids_for_book(book_id):
+                self.update_item(item_id, vmap.get(item_id))
+
+    def discard_books(self, book_ids):
+        if self.is_one_one:
+            for book_id in book_ids:
+                self.remove_item(book_id)
+        else:
+            # Items that were removed from the table along with the books
+            vmap = self.value_map
+            for item_id in tuple(self.item_values):
+                if item_id not in vmap:
+                    self.remove_item(item_id)
+
+    def items_containing(self, token):
+        if len(token) < 3:
+            tokens = (t for t in self.token_map if token in t)
+        else:
+            tokens = None
+            for g in sorted(trigrams(token), key=lambda g: len(self.vocab_grams.get(g, ()))):
+                toks = self.vocab_grams.get(g)
+                if not toks:
+                    return set()
+                tokens = set(toks) if tokens is None else tokens & toks
+                if not tokens:
+                    return set()
+            tokens = (t for t in tokens if token in t)
+        ans = set()
+        for t in tokens:
+            ans |= self.token_map[t]
+        return ans
+
+    def candidate_items(self, query, matchkind, use_primary_find, primary_safe):
+        ''' Return the set of items that could possibly match query or None if
+        the index cannot be used for this query. '''
+        from calibre.db.search import CONTAINS_MATCH, EQUALS_MATCH
+        if matchkind == EQUALS_MATCH:
+            if query.startswith('.'):
+                return None
+            return set(self.lower_map.get(query, ()))
+        if matchkind != CONTAINS_MATCH or (use_primary_find and not primary_safe):
+            return None
+        folded = fold(query)
+        if not_plain_ascii.search(folded) is not None:
+            return None
+        tokens = sorted(set(token_pat.findall(folded)), key=len, reverse=True)
+        if not tokens:
+            return None
+        ans = None
+        for token in tokens:
+            items = self.items_containing(token)
+            ans = items if ans is None else (ans & items)
+            if not ans:
+                break
+        return ans | self.residual
+
+
+class TextIndex(object):
+
+    '''
+    Lazily built, incrementally updated index over all indexable text fields
+    of a library. Searches hold only the read lock, so building is protected by
+    an internal lock. Updates happen with the write lock held.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.field_indices = {}
+        self.primary_safe = None
+
+    def invalidate(self):
+        with self.lock:
+            self.field_indices.clear()
+            self.primary_safe = None
+
+    def index_for(self, field):
+        with self.lock:
+            ans = self.field_indices.get(field.name)
+            if ans is None:
+                if self.primary_safe is None:
+                    self.primary_safe = collator_is_safe()
+                if not can_index(field):
+                    return None
+                ans = self.field_indices[field.name] = FieldIndex(field)
+            return ans
+
+    def update_books(self, book_ids):
+        with self.lock:
+            for idx in self.field_indices.itervalues():
+                idx.update_books(book_ids)
+
+    def discard_books(self, book_ids):
+        with self.lock:
+            for idx in self.field_indices.itervalues():
+                idx.discard_books(book_ids)
+
+    def matches(self, field, query, matchkind, candidates, match):
+        '''
+        Return the set of book ids from candidates whose value for field
+        matches query or None if the index cannot be used. ``match`` is a
+        function used to check the values of the candidate items.
+        '''
+        idx = self.index_for(field)
+        if idx is None:
+            return None
+        from calibre.utils.config_base import prefs
+        upf = prefs['use_primary_find_in_search']
+        with self.lock:
+            items = idx.candidate_items(query, matchkind, upf, self.primary_safe)
+        if items is None:
+            return None
+        vmap = idx.value_map
+        ans = set()
+        if idx.is_one_one:
+            for book_id in candidates.intersection(items):
+                val = vmap.get(book_id)
+                if val is not None and match((val,)):
+                    ans.add(book_id)
+            return ans
+        books_for = field.books_for
+        for item_id in items:
+            val = vmap.get(item_id)
+            if val is None:
+                continue
+            book_ids = books_for(item_id)
+            if book_ids and not book_ids.isdisjoint(candidates) and match((val,)):
+                ans |= book_ids
+        return ans & candidates
@@ -0,0 +1,184 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+'''
+A cache of the sort keys of books, per field. Computing sort keys (ICU
+collation keys, series index tuples, etc.) is the expensive part of sorting,
+so the keys are computed once and every distinct key is assigned an integer
+rank that preserves the ordering of the keys. Sorting on several fields then
+becomes a series of stable sorts on integers. Ranks are spaced out, so that
+keys for new or changed books can usually be slotted in between existing ranks
+without re-ranking the whole field.
+'''
+
+from bisect import bisect_left
+from collections import deque
+from threading import Lock
+
+GAP_BITS = 32
+GAP = 1 << GAP_BITS
+# If more than this many books need new keys, the field is re-ranked from
+# scratch instead of inserting the keys one by one
+MAX_INCREMENTAL = 512
+# The number of invalidations remembered for changed_since()
+MAX_LOG = 64
+
+
+class FieldRanks(object):
+
+    __slots__ = ('keys', 'sorted_keys', 'key_rank', 'ranks', 'dirty')
+
+    def __init__(self):
+        self.keys = {}  # book_id -> sort key
+        self.sorted_keys = []  # distinct sort keys, in sorted order
+        self.key_rank = {}  # sort key -> rank
+        self.ranks = {}  # book_id -> rank
+        self.dirty = set()
+
+    def discard_dirty(self):
+        if self.dirty:
+            keys, ranks = self.keys, self.ranks
+            for book_id in self.dirty:
+                keys.pop(book_id, None), ranks.pop(book_id, None)
+            self.dirty = set()
+
+    def rebuild(self, new_keys):
+        self.keys.update(new_keys)
+        self.sorted_keys = sorted(set(self.keys.itervalues()))
+        self.key_rank = kr = {k:i << GAP_BITS for i, k in enumerate(self.sorted_keys)}
+        self.ranks = {book_id:kr[k] for book_id, k in self.keys.iteritems()}
+
+    def insert(self, book_id, key):
+        ' Insert the key for a single book, returning False if there is no room for its rank '
+        kr = self.key_rank
+        rank = kr.get(key)
+        if rank is None:
+            sk = self.sorted_keys
+            pos = bisect_left(sk, key)
+            if sk:
+                lo = kr[sk[pos - 1]] if pos > 0 else kr[sk[0]] - 2 * GAP
+                hi = kr[sk[pos]] if pos < len(sk) else kr[sk[-1]] + 2 * GAP
+            else:
+                lo, hi = -GAP, GAP
+            if hi - lo < 2:
+                return False
+            rank = kr[key] = (lo + hi) // 2
+            sk.insert(pos, key)
+        self.keys[book_id] = key
+        self.ranks[book_id] = rank
+        return True
+
+    def update(self, book_ids, key_func):
+        ' Compute the keys and ranks for book_ids. Returns True if the ranks of other books were changed. '
+        new_keys = {book_id:key_func(book_id) for book_id in book_ids}
+        if not self.keys:
+            self.rebuild(new_keys)
+            return False
+        if len(new_keys) > MAX_INCREMENTAL:
+            self.rebuild(new_keys)
+            return True
+        for book_id, key in new_keys.iteritems():
+            if not self.insert(book_id, key):
+                self.rebuild(new_keys)
+                return True
+        return False
+
+
+class SortKeyCache(object):
+
+    '''
+    Sort keys and ranks for all fields that have been sorted on. Sorting holds
+    only the read lock, so the cache is protected by an internal lock.
+    Invalidation happens with the write lock held. ``version`` is incremented
+    every time the ranks of some books change.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.fields = {}
+        self.version = 0
+        self.log = deque(maxlen=MAX_LOG)
+
+    def _changed(self, book_ids):
+        self.version += 1
+        self.log.append((self.version, None if book_ids is None else frozenset(book_ids)))
+
+    def invalidate(self, book_ids=None):
+        with self.lock:
+            self._changed(book_ids)
+            if book_ids is None:
+                self.fields.clear()
+            else:
+                for fr in self.fields.itervalues():
+                    if fr is not None:
+                        fr.dirty.update(book_ids)
+
+    def changed_since(self, version):
+        ''' Return the set of books whose ranks may have changed since version
+        or None if the ranks of all books may have changed. '''
+        with self.lock:
+            if version == self.version:
+                return set()
+            if not self.log or self.log[0][0] > version + 1:
+                return None
+            ans = set()
+            for v, book_ids in self.log:
+                if v > version:
+                    if book_ids is None:
+                        return None
+                    ans |= book_ids
+            return ans
+
+    def _field_ranks(self, name, book_ids, key_func_factory):
+        # Must be called with the lock held
+        fr = self.fields.get(name, False)
+        if fr is None:
+            return None
+        if fr is False:
+            fr = self.fields[name] = FieldRanks()
+        fr.discard_dirty()
+        ranks = fr.ranks
+        if not ranks.viewkeys() >= set(book_ids):
+            missing = set(book_ids).difference(ranks)
+            try:
+                if fr.update(missing, key_func_factory()):
+                    self._changed(None)
+            except TypeError:
+                # Unhashable or unorderable sort keys
+                self.fields[name] = None
+                return None
+        return fr.ranks
+
+    def ranks(self, name, book_ids, key_func_factory):
+        ''' Return the list of ranks of book_ids for the field name, or None if
+        the sort keys for this field cannot be cached. See :meth:`sort`. '''
+        with self.lock:
+            ranks = self._field_ranks(name, book_ids, key_func_factory)
+            return None if ranks is None else map(ranks.__getitem__, book_ids)
+
+    def sort(self, name, book_ids, key_func_factory, reverse=False):
+        '''
+        Sort the list book_ids in place by the field name. key_func_factory
+        must return the sort key function for the field, it is called only if
+        some sort keys have to be computed. Returns False if the sort keys for
+        this field cannot be cached, in which case book_ids is unchanged.
+        '''
+        with self.lock:
+            fr = self.fields.get(name)
+            if fr is not None and not fr.dirty:
+                # Fast path, avoids building a set of book_ids
+                try:
+                    book_ids.sort(key=fr.ranks.__getitem__, reverse=reverse)
+                    return True
+                except KeyError:
+                    pass
+            ranks = self._field_ranks(name, book_ids, key_func_factory)
+            if ranks is None:
+                return False
+            book_ids.sort(key=ranks.__getitem__, reverse=reverse)
+            return True
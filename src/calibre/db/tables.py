@@ -68,6 +68,12 @@ class Table(object):
     def remove_books(self, book_ids, db):
         return set()
 
+    def read_books(self, book_ids, db):
+        ''' Re-read the data for the specified books from the database, for
+        books that were changed by another process. Books that are no longer
+        in the database are removed from the in-memory maps. '''
+        pass
+
     def fix_link_table(self, db):
         pass
 
@@ -118,6 +124,15 @@ class OneToOneTable(Table):
             us = self.unserialize
             self.book_col_map = {book_id:us(val) for book_id, val in query}
 
+    def read_books(self, book_ids, db):
+        idcol = 'id' if self.metadata['table'] == 'books' else 'book'
+        query = 'SELECT {1} FROM {2} WHERE {0}=?'.format(idcol, self.metadata['column'], self.metadata['table'])
+        us = self.unserialize
+        for book_id in book_ids:
+            self.book_col_map.pop(book_id, None)
+            for (val,) in db.execute(query, (book_id,)):
+                self.book_col_map[book_id] = val if us is None else us(val)
+
     def remove_books(self, book_ids, db):
         clean = set()
         for book_id in book_ids:
@@ -143,6 +158,13 @@ class SizeTable(OneToOneTable):
             'WHERE data.book=books.id) FROM books')
         self.book_col_map = dict(query)
 
+    def read_books(self, book_ids, db):
+        for book_id in book_ids:
+            self.book_col_map.pop(book_id, None)
+            for (val,) in db.execute(
+                'SELECT (SELECT MAX(uncompressed_size) FROM data WHERE data.book=books.id) FROM books WHERE id=?', (book_id,)):
+                self.book_col_map[book_id] = val
+
     def update_sizes(self, size_map):
         self.book_col_map.update(size_map)
 
@@ -153,6 +175,14 @@ class UUIDTable(OneToOneTable):
         OneToOneTable.read(self, db)
         self.uuid_to_id_map = {v:k for k, v in self.book_col_map.iteritems()}
 
+    def read_books(self, book_ids, db):
+        for book_id in book_ids:
+            self.uuid_to_id_map.pop(self.book_col_map.get(book_id, None), None)
+        OneToOneTable.read_books(self, book_ids, db)
+        for book_id in book_ids:
+            if book_id in self.book_col_map:
+                self.uuid_to_id_map[self.book_col_map[book_id]] = book_id
+
     def update_uuid_cache(self, book_id_val_map):
         for book_id, uuid in book_id_val_map.iteritems():
             self.uuid_to_id_map.pop(self.book_col_map.get(book_id, None), None)  # discard old uuid
@@ -182,6 +212,9 @@ class CompositeTable(OneToOneTable):
         self.composite_sort = d.get('composite_sort', False)
         self.use_decorations = d.get('use_decorations', False)
 
+    def read_books(self, book_ids, db):
+        pass
+
     def remove_books(self, book_ids, db):
         return set()
 
@@ -222,6 +255,29 @@ class ManyToOneTable(Table):
             cbm[item_id].add(book)
             bcm[book] = item_id
 
+    def unlink_books(self, book_ids):
+        ' Remove the specified books from the in-memory maps only '
+        cbm = self.col_book_map
+        for book_id in book_ids:
+            val = self.book_col_map.pop(book_id, None)
+            if val is None:
+                continue
+            for item_id in ((val,) if self.table_type == MANY_ONE else val):
+                books = cbm.get(item_id)
+                if books is not None:
+                    books.discard(book_id)
+                    if not books:
+                        del cbm[item_id]
+
+    def read_books(self, book_ids, db):
+        self.read_id_maps(db)
+        self.unlink_books(book_ids)
+        query = 'SELECT {0} FROM {1} WHERE book=?'.format(self.metadata['link_column'], self.link_table)
+        for book_id in book_ids:
+            for (item_id,) in db.execute(query, (book_id,)):
+                self.col_book_map[item_id].add(book_id)
+                self.book_col_map[book_id] = item_id
+
     def fix_link_table(self, db):
         linked_item_ids = {item_id for item_id in self.book_col_map.itervalues()}
         extra_item_ids = linked_item_ids - set(self.id_map)
@@ -381,6 +437,17 @@ class ManyToManyTable(ManyToOneTable):
 
         self.book_col_map = {k:tuple(v) for k, v in bcm.iteritems()}
 
+    def read_books(self, book_ids, db):
+        self.read_id_maps(db)
+        self.unlink_books(book_ids)
+        query = 'SELECT {0} FROM {1} WHERE book=? ORDER BY id'.format(self.metadata['link_column'], self.link_table)
+        for book_id in book_ids:
+            item_ids = tuple(item_id for (item_id,) in db.execute(query, (book_id,)))
+            if item_ids:
+                self.book_col_map[book_id] = item_ids
+                for item_id in item_ids:
+                    self.col_book_map[item_id].add(book_id)
+
     def fix_link_table(self, db):
         linked_item_ids = {item_id for item_ids in self.book_col_map.itervalues() for item_id in item_ids}
         extra_item_ids = linked_item_ids - set(self.id_map)
@@ -601,6 +668,22 @@ class FormatsTable(ManyToManyTable):
 
         self.book_col_map = {k:tuple(sorted(v)) for k, v in bcm.iteritems()}
 
+    def read_books(self, book_ids, db):
+        self.unlink_books(book_ids)
+        for book_id in book_ids:
+            self.fname_map.pop(book_id, None)
+            self.size_map.pop(book_id, None)
+            fmts = []
+            for fmt, name, sz in db.execute('SELECT format, name, uncompressed_size FROM data WHERE book=?', (book_id,)):
+                if fmt is not None:
+                    fmt = fmt.upper()
+                    self.col_book_map[fmt].add(book_id)
+                    fmts.append(fmt)
+                    self.fname_map[book_id][fmt] = name
+                    self.size_map[book_id][fmt] = sz
+            if fmts:
+                self.book_col_map[book_id] = tuple(sorted(fmts))
+
     def remove_books(self, book_ids, db):
         clean = ManyToManyTable.remove_books(self, book_ids, db)
         for book_id in book_ids:
@@ -677,6 +760,14 @@ class IdentifiersTable(ManyToManyTable):
                 self.col_book_map[typ].add(book)
                 self.book_col_map[book][typ] = val
 
+    def read_books(self, book_ids, db):
+        self.unlink_books(book_ids)
+        for book_id in book_ids:
+            for typ, val in db.execute('SELECT type, val FROM identifiers WHERE book=?', (book_id,)):
+                if typ is not None and val is not None:
+                    self.col_book_map[typ].add(book_id)
+                    self.book_col_map[book_id][typ] = val
+
     def remove_books(self, book_ids, db):
         clean = set()
         for book_id in book_ids:
@@ -154,6 +154,39 @@ class LegacyTest(BaseTest):
         self.assertEqual(db.title(1, index_is_id=True), 'xxx')
     # }}}
 
+    def test_incremental_sort(self):  # {{{
+        ' Test that re-sorting the view after changes gives the same results as a full sort '
+        from calibre.ebooks.metadata.book.base import Metadata
+        db = self.init_legacy(self.cloned_library)
+        view = db.data
+
+        def check(spec):
+            db.multisort(spec)
+            ids = list(view._map)
+            self.assertEqual(ids, view._do_sort(sorted(view.cache.all_book_ids()), spec))
+
+        spec = [('title', True), ('rating', False)]
+        check(spec)
+        self.assertIsNone(view.sort_state.keys)
+        db.new_api.set_field('title', {1:'Aaa', 3:'Zzz'})
+        check(spec)
+        self.assertIsNotNone(view.sort_state.keys)
+        for i in xrange(3):
+            db.create_book_entry(Metadata('Mmm %d' % i, ['Some Author']))
+        self.assertEqual(view._map[:3], (6, 5, 4))
+        db.new_api.set_field('rating', {4:10, 6:2})
+        check(spec)
+        db.delete_book(2), db.delete_book(5)
+        check(spec)
+        self.assertIsNotNone(view.sort_state.keys)
+        # Changing the sort spec must cause a full sort
+        check([('rating', True)])
+        self.assertIsNone(view.sort_state.keys)
+        check([('marked', True), ('id', False)])
+        view.set_marked_ids({4, 6})
+        check([('marked', True), ('id', False)])
+    # }}}
+
     def test_legacy_getters(self):  # {{{
         ' Test various functions to get individual bits of metadata '
         old = self.init_old()
@@ -6,10 +6,11 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import os, cProfile
+import os, sys, cProfile
 from tempfile import gettempdir
 
 from calibre.db.legacy import LibraryDatabase
+from calibre.utils.monotonic import monotonic
 
 db = None
 
@@ -40,5 +41,44 @@ def main():
     show_stats(stats)
     print ('Stats saved to', stats)
 
+
+BENCHMARK_TEMPLATES = (
+    '{title} - {authors}',
+    '{series:|[|]}{series_index:0>3s|| - }{title}',
+    "{tags:'uppercase($)'}",
+    '{authors:sublist(0,1,&)}{pubdate:format_date(yyyy)|, |}',
+    "program: test(field('series'), strcat(field('series'), ' ', field('series_index')), field('title'))",
+)
+
+
+def benchmark_templates(path='~/test library', repeat=3):
+    ''' Compare interpreted and compiled evaluation of some templates over all
+    books in the library '''
+    from calibre.ebooks.metadata.book.formatter import SafeFormat
+    initdb(path)
+    cache = db.new_api
+    books = [cache.get_proxy_metadata(book_id) for book_id in cache.all_book_ids()]
+    print('Evaluating templates for', len(books), 'books', repeat, 'times')
+    for template in BENCHMARK_TEMPLATES:
+        times, results = [], []
+        for compiled in (False, True):
+            formatter = SafeFormat()
+            formatter.compile_templates = compiled
+            template_cache = {}
+            start = monotonic()
+            for i in xrange(repeat):
+                ans = [formatter.safe_format(template, mi, 'TEMPLATE ERROR', mi,
+                            column_name='benchmark', template_cache=template_cache) for mi in books]
+            times.append(monotonic() - start)
+            results.append(ans)
+        if results[0] != results[1]:
+            raise SystemExit('Compiled template gave different results: %r' % template)
+        print('%-60s interpreted: %.3fs compiled: %.3fs speedup: %.1fx' % (
+            template[:60], times[0], times[1], times[0] / max(times[1], 1e-9)))
+
+
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:2] == ['templates']:
+        benchmark_templates(*sys.argv[2:3])
+    else:
+        main()
@@ -572,6 +572,221 @@ class ReadingTest(BaseTest):
         test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
     # }}}
 
+    def test_cached_search_sets(self):  # {{{
+        ' Test that cached results are not converted to sets on every search '
+        from calibre.db.id_set import BookIdSet
+        cache = self.init_cache()
+        cache._search_api.MAX_CACHE_UPDATE = 100
+        a = cache.search('Unknown')
+        self.assertEqual(a, {3})
+        self.assertIs(type(a), set)
+        self.assertIs(cache.search('Unknown'), a)
+        self.assertIsInstance(cache.search('Unknown', as_id_set=True), BookIdSet)
+        # Changes to the cached results give new sets
+        cache.set_field('title', {1:'Unknown'})
+        b = cache.search('Unknown')
+        self.assertEqual(b, {1, 3})
+        self.assertIs(cache.search('Unknown'), b)
+        cache.remove_books((1,))
+        self.assertEqual(cache.search('Unknown'), {3})
+        cache._search_api.clear_caches()
+        self.assertEqual(cache.search('Unknown'), {3})
+    # }}}
+
+    def test_search_index(self):  # {{{
+        ' Test that the text index gives the same results as a full scan '
+        cache = self.init_cache()
+        queries = ('one', 'ONE', 'title', 'tit', 'e', 'title one', '"title one"',
+                   'authors:one', 'authors:"author one"', 'tags:=one', 'tags:=ONE',
+                   'series:one', 'publisher:one', 'title:=xxx', 'title:ééé',
+                   '#enum:tw', 'one or xxx', 'not one', 'tags:news')
+
+        def check(msg):
+            cache._search_api.clear_caches()
+            idx = cache._search_api.text_index
+            indexed = {q:cache.search(q) for q in queries}
+            cache._search_api.clear_caches()
+            cache._search_api.text_index = None
+            for q, ans in indexed.iteritems():
+                self.assertEqual(cache.search(q), ans, '%s: different results for: %s' % (msg, q))
+            cache._search_api.text_index = idx
+            cache._search_api.clear_caches()
+
+        check('initial')
+        idx = cache._search_api.text_index
+        self.assertTrue(idx.field_indices)
+        cache.set_field('title', {1:'xxx', 2:'Ééé Title'})
+        cache.set_field('tags', {1:('One', 'News'), 3:('two',)})
+        check('after set_field')
+        cache.rename_items('authors', {next(iter(cache.fields['authors'].table.id_map)):'Renamed Author'})
+        check('after rename')
+        cache.remove_books((1,))
+        check('after remove')
+        cache.reload_from_db()
+        self.assertFalse(idx.field_indices)
+        check('after reload')
+    # }}}
+
+    def test_explain_search(self):  # {{{
+        ' Test the query planner and explain_search() '
+        cache = self.init_cache()
+        for q in ('title:~title and formats:=fmt2', 'one or formats:=fmt1', 'not (#enum:tw and tags:one)'):
+            ans = cache.explain_search(q)
+            self.assertEqual(ans['result'], cache.search(q), 'Explained search gave different result for: %s' % q)
+        plan = cache.explain_search('title:~title and formats:=fmt2 and identifiers:test:')['plan']
+        self.assertEqual(plan['op'], 'and')
+        self.assertEqual([c['location'] for c in plan['children']], ['formats', 'identifiers', 'title'])
+        self.assertEqual(plan['children'][0]['matches'], 1)
+        self.assertEqual(plan['children'][1]['candidates'], 1)
+        self.assertIsNone(cache.explain_search('')['plan'])
+    # }}}
+
+    def test_columnar_storage(self):  # {{{
+        ' Test that columnar storage of fields gives the same results as dicts '
+        from calibre.db.columns import ArrayColumn, PooledColumn, encode_date, decode_date, Column
+        from calibre.utils.config import tweaks
+        from calibre.utils.date import utcnow, local_tz
+        now = utcnow()
+        c = ArrayColumn(b'd', datetime.datetime, encode_date, decode_date, {1:now, 3:now.replace(tzinfo=None), 5:now.astimezone(local_tz)})
+        self.assertEqual(set(c.extra), {3, 5})
+        self.assertEqual(c.copy(), {1:now, 3:now.replace(tzinfo=None), 5:now.astimezone(local_tz)})
+        self.assertIs(c[5].tzinfo, local_tz)
+        c = PooledColumn(unicode, {1:'a', 2:'a', 10:'b', 11:None})
+        self.assertEqual(len(c.pool), 2)
+        self.assertEqual(c.pop(10), 'b'), self.assertNotIn(10, c), self.assertNotIn('b', c.pool_index)
+        c[2] = 'c'
+        self.assertEqual(dict(c), {1:'a', 2:'c', 11:None})
+        self.assertEqual(c.grouped_values((1, 2, 11, 12), 'x'), {'a':{1}, 'c':{2}, None:{11}, 'x':{12}})
+
+        def state(cache):
+            ans = {}
+            for field in cache.fields:
+                if field in ('ondevice', 'last_modified'):
+                    continue
+                ans[field] = {book_id:cache.field_for(field, book_id) for book_id in cache.all_book_ids()}
+                ans[field + ' sort'] = cache.multisort([(field, True), ('id', True)])
+            for q in ('title:one', 'title:=Unknown', 'not rating:<3', 'series_index:2', 'pubdate:>2011-09-01',
+                      '#yesno:true', '#date:2011', 'comments:two', 'tags:one', 'formats:fmt1'):
+                ans[q] = cache.search(q)
+            return ans
+
+        def change(cache):
+            cache.set_field('title', {1:'Changed', 2:'Unknown'})
+            cache.set_field('#yesno', {1:None, 3:True})
+            cache.set_field('pubdate', {2:datetime.datetime(2015, 1, 1, tzinfo=utc_tz), 3:None})
+            cache.set_field('tags', {3:('Tag One', 'News')})
+            cache.remove_books((2,))
+
+        cache = self.init_cache()
+        tweaks['columnar_field_storage'] = True
+        try:
+            ccache = self.init_cache(self.cloned_library)
+        finally:
+            tweaks['columnar_field_storage'] = False
+        self.assertIsInstance(ccache.fields['title'].table.book_col_map, Column)
+        self.assertIsInstance(ccache.fields['tags'].table.book_col_map, Column)
+        self.assertNotIsInstance(ccache.fields['identifiers'].table.book_col_map, Column)
+        self.assertEqual(state(cache), state(ccache))
+        change(cache), change(ccache)
+        self.assertEqual(state(cache), state(ccache))
+    # }}}
+
+    def test_persistent_search_cache(self):  # {{{
+        ' Test that search results are remembered across restarts '
+        from calibre.db.search_cache import encode_book_ids, decode_book_ids
+        from calibre.utils.config import tweaks
+        for ids in (set(), {1}, {0, 7, 8, 9, 1000, 65537}):
+            self.assertEqual(decode_book_ids(encode_book_ids(ids)), ids)
+        tweaks['persistent_search_cache'] = True
+        try:
+            cache = self.init_cache()
+            expected = {q:cache.search(q) for q in ('title:one', 'not tags:one', 'date:>10daysago')}
+            self.assertEqual(cache.search('title:one', 'formats:fmt1'), {2})
+            cache.close()
+            cache = self.init_cache()
+            entries = cache._search_api.persistent_cache.entries
+            self.assertEqual(set(entries), {'title:one', 'not tags:one', 'formats:fmt1'})
+            for q, result in expected.iteritems():
+                self.assertEqual(cache.search(q), result)
+            # Changes made after loading must be applied to the stored results
+            cache.set_field('title', {3: 'One more'})
+            cache.set_field('tags', {1: 'One'})
+            self.assertEqual(cache.search('title:one', 'formats:fmt1'), {2})
+            self.assertEqual(cache.search('title:one'), {2, 3})
+            self.assertEqual(cache.search('not tags:one'), cache.search('not tags:one', book_ids=cache.all_book_ids(type=set)))
+            cache.close()
+            cache = self.init_cache()
+            self.assertEqual(set(cache._search_api.persistent_cache.entries), {'title:one', 'not tags:one', 'formats:fmt1'})
+            self.assertEqual(cache.search('title:one'), {2, 3})
+            cache.close()
+        finally:
+            tweaks['persistent_search_cache'] = False
+        # Changes made while the cache is not in use invalidate it
+        cache = self.init_cache()
+        cache.set_field('title', {1: 'One'})
+        cache.close()
+        tweaks['persistent_search_cache'] = True
+        try:
+            cache = self.init_cache()
+            self.assertFalse(cache._search_api.persistent_cache.entries)
+            self.assertEqual(cache.search('title:one'), {1, 2, 3})
+        finally:
+            tweaks['persistent_search_cache'] = False
+    # }}}
+
+    def test_sort_key_cache(self):  # {{{
+        ' Test that cached sort keys give the same results and are updated on writes '
+        from calibre.db.sort_cache import FieldRanks, GAP_BITS
+        from calibre.ebooks.metadata.book.base import Metadata
+        fr = FieldRanks()
+        fr.update((1, 2, 3), {1:'b', 2:'d', 3:'b'}.get)
+        self.assertEqual(fr.ranks[1], fr.ranks[3])
+        for i in xrange(GAP_BITS + 3):
+            # Keep inserting keys into the same gap until it is used up
+            fr.update((10 + i,), lambda book_id: 'c' * (book_id - 9))
+        order = sorted(fr.ranks, key=lambda book_id: (fr.ranks[book_id], book_id))
+        self.assertEqual(order, sorted(fr.keys, key=lambda book_id: (fr.keys[book_id], book_id)))
+        self.assertEqual(order[:3], [1, 3, 10]), self.assertEqual(order[-1], 2)
+
+        specs = ([('title', True)], [('authors', False), ('title', True)], [('series', True), ('id', False)],
+                 [('#yesno', True), ('rating', False), ('pubdate', True)], [('tags', True), ('#series', False), ('id', True)],
+                 [('languages', False), ('formats', True), ('id', True)], [('#date', False), ('cover', True)])
+
+        def sorts(cache):
+            return [cache.multisort(spec) for spec in specs]
+
+        cache = self.init_cache()
+        before = sorts(cache)
+        self.assertIn('title', cache.sort_key_cache.fields)
+        self.assertEqual(before, sorts(self.init_cache(cache.backend.library_path)))
+        cache.set_field('title', {1:'Zzz', 3:'Aaa'})
+        cache.set_field('authors', {2:['Zed Author']})
+        cache.set_field('#yesno', {1:False})
+        cache.set_field('tags', {3:['Tag Zero', 'News']})
+        cache.set_field('#series', {2:'Aaa Series'})
+        cache.rename_items('series', {cache.get_item_id('series', 'A Series One'):'Zzz'})
+        cache.create_book_entry(Metadata('Mmm', ['Mr. Author']))
+        after = sorts(cache)
+        self.assertNotEqual(before, after)
+        self.assertEqual(after, sorts(self.init_cache(cache.backend.library_path)))
+        cache.remove_books((1,))
+        self.assertEqual(sorts(cache), sorts(self.init_cache(cache.backend.library_path)))
+    # }}}
+
+    def test_fields_for_books(self):  # {{{
+        ' Test reading the values of many fields for many books at once '
+        cache = self.init_cache()
+        fields = tuple(cache.fields) + ('#does_not_exist',)
+        book_ids = (1, 2, 3, 9999)
+        for default_value in (None, 'dv'):
+            expected = {f:{book_id:cache.field_for(f, book_id, default_value=default_value) for book_id in book_ids} for f in fields}
+            self.assertEqual(expected, cache.fields_for_books(fields, book_ids, default_value=default_value))
+        chunks = list(cache.iter_fields_for_books(('title', 'tags'), book_ids, chunk_size=3))
+        self.assertEqual([c[0] for c in chunks], [(1, 2, 3), (9999,)])
+        self.assertEqual(chunks[1][1], {'title':{9999:None}, 'tags':{9999:()}})
+        self.assertEqual(chunks[0][1]['tags'], {book_id:cache.field_for('tags', book_id) for book_id in (1, 2, 3)})
+    # }}}
+
     def test_proxy_metadata(self):  # {{{
         ' Test the ProxyMetadata object used for composite columns '
         from calibre.ebooks.metadata.book.base import STANDARD_METADATA_FIELDS
@@ -678,6 +893,34 @@ class ReadingTest(BaseTest):
         self.assertEqual('FMT2', cache.field_for('#ccf', 1))
     # }}}
 
+    def test_compiled_templates(self):  # {{{
+        ' Test that compiled templates give the same results as the interpreter '
+        from calibre.ebooks.metadata.book.formatter import SafeFormat
+        cache = self.init_cache()
+        templates = (
+            '{title} - {authors}', '{series:|[|]}{series_index:0>3s|| - }{title}', '{#float:5.2f}',
+            '{tags:uppercase()}', '{tags:sublist(0,1,\\,)}', '{title:shorten(3,-,2)}', '{title:nosuch()}',
+            "{title:'uppercase($)'}", "{#yesno:'test($, \"y\", \"n\")'|(|)}", '{title:d}', '{nosuchfield}',
+            "program: test(field('series'), strcat(field('series'), ' ', field('series_index')), field('title'))",
+            "program: x = field('rating'); assign(y, strcat(x, '*')); y", "program: eval('[[y]]')",
+            "program: template('[[title:lowercase()]]')", 'program: nosuch(1)', 'program: x', 'program: test(1, 2)',
+            'program: strcat(1 2)', 'program: assign(1, 2)', 'program: 1 2', '{title:|', '{title!r}',
+        )
+        for book_id in cache.all_book_ids():
+            mi = cache.get_proxy_metadata(book_id)
+            for template in templates:
+                results = []
+                for compiled in (False, True):
+                    f = SafeFormat()
+                    f.compile_templates = compiled
+                    results.append(f.safe_format(template, mi, 'TEMPLATE ERROR', mi, column_name='x', template_cache={}))
+                    try:
+                        results.append(f.unsafe_format(template, mi, mi))
+                    except Exception as e:
+                        results.append((type(e), e.message))
+                self.assertEqual(results[:2], results[2:], 'The template %r gave different results for book %d' % (template, book_id))
+    # }}}
+
     def test_find_identical_books(self):  # {{{
         ' Test find_identical_books '
         from calibre.ebooks.metadata.book.base import Metadata
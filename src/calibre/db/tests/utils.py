@@ -82,3 +82,43 @@ class UtilsTest(BaseTest):
         self.assertEqual(len(c), 0)
         self.assertEqual(tuple(walk(c.location)), ())
     # }}}
+
+    def test_book_id_set(self):  # {{{
+        ' Test the compact BookIdSet used for search results '
+        import random
+        from calibre.db.id_set import BookIdSet, MAX_ARRAY_SIZE
+        r = random.Random(42)
+        dense = set(xrange(70000, 90000))
+        for top in (10, 1000, 200000, 10**7):
+            for i in xrange(4):
+                a, b = (set(r.sample(xrange(top), r.randint(0, min(top, 5000)))) for i in xrange(2))
+                if i % 2:
+                    a |= dense
+                ba, bb = BookIdSet(a), BookIdSet(b)
+                self.assertEqual(set(ba), a)
+                self.assertEqual(list(ba), sorted(a))
+                self.assertEqual(len(ba), len(a))
+                self.assertEqual(ba, a)
+                for res, expected in ((ba & bb, a & b), (ba | bb, a | b), (ba - bb, a - b), (ba ^ bb, a ^ b), (b - ba, b - a), (ba & b, a & b)):
+                    self.assertEqual(set(res), expected)
+                    # Results must be in canonical form
+                    self.assertEqual(res, BookIdSet(expected))
+                for x in r.sample(xrange(top), min(top, 100)):
+                    self.assertEqual(x in ba, x in a)
+                seq = r.sample(xrange(top), min(top, 1000))
+                self.assertEqual(ba.filter(seq), [x for x in seq if x in a])
+                self.assertEqual(ba.isdisjoint(bb), a.isdisjoint(b))
+                self.assertTrue(ba.issubset(a | b))
+                c, bc = set(a), ba.copy()
+                for x in r.sample(xrange(top), min(top, 2 * MAX_ARRAY_SIZE)):
+                    if x % 2:
+                        c.add(x), bc.add(x)
+                    else:
+                        c.discard(x), bc.discard(x)
+                self.assertEqual(bc, BookIdSet(c))
+                bc.update({1, 2}), bc.difference_update([2])
+                c.update({1, 2}), c.difference_update([2])
+                self.assertEqual(set(bc), c)
+        self.assertFalse(BookIdSet())
+        self.assertEqual(BookIdSet([3, 1]) | {5}, {1, 3, 5})
+    # }}}
@@ -616,12 +616,34 @@ class WritingTest(BaseTest):
         cache = self.init_cache()
         cache.create_custom_column('tc', 'TC', 'composite', False, display={
             'composite_template':'{title} {author_sort} {title_sort} {formats} {tags} {series} {series_index}'})
+        cache.create_custom_column('rt', 'RT', 'composite', False, display={'composite_template':'{rating}'})
+        cache.create_custom_column('nested', 'NE', 'composite', False, display={'composite_template':'{#rt} {#yesno}'})
+        cache.create_custom_column('prog', 'PR', 'composite', False, display={'composite_template':"program: field('pubdate')"})
+        cache.create_custom_column('dyn', 'DY', 'composite', False, display={'composite_template':"program: field(strcat('ra', 'ting'))"})
         cache = self.init_cache()
+        composites = ('#tc', '#rt', '#nested', '#prog', '#dyn')
 
         def test_invalidate():
             c = self.init_cache()
             for bid in cache.all_book_ids():
-                self.assertEqual(cache.field_for('#tc', bid), c.field_for('#tc', bid))
+                for name in composites:
+                    self.assertEqual(cache.field_for(name, bid), c.field_for(name, bid))
+
+        deps = cache._composite_dependencies()
+        self.assertIsNone(deps['#dyn'])
+        self.assertTrue({'rating', '#yesno', '#rt'}.issubset(deps['#nested']))
+        self.assertIn('pubdate', deps['#prog'])
+        self.assertNotIn('rating', deps['#tc'])
+        test_invalidate()
+        # Only the columns that depend on rating must be re-rendered
+        cache.set_field('rating', {1:4})
+        self.assertEqual({name for name in composites if 1 not in cache.fields[name]._render_cache}, {'#rt', '#nested', '#dyn'})
+        test_invalidate()
+        cache.set_field('#yesno', {2:True})
+        self.assertEqual({name for name in composites if 2 not in cache.fields[name]._render_cache}, {'#nested', '#dyn'})
+        test_invalidate()
+        cache.set_field('pubdate', {3:None})
+        test_invalidate()
 
         cache.set_field('title', {1:'xx', 3:'yy'})
         test_invalidate()
@@ -748,3 +770,34 @@ class WritingTest(BaseTest):
         prefs['test mutable'] = {k:k for k in reversed(range(10))}
         self.assertEqual(len(changes), 3, 'The database was written to despite there being no change in value')
     # }}}
+
+    def test_reload_books_from_db(self):  # {{{
+        ' Test re-reading the data for books changed by another process '
+        cache, other = self.init_cache(), self.init_cache()
+        self.assertEqual(cache.search('tags:=News'), {1})
+        other.set_field('title', {1:'New title'})
+        other.set_field('tags', {1:('News', 'new tag'), 2:()})
+        other.set_field('authors', {2:('Someone Else',)})
+        other.set_field('#series', {1:'cs'})
+        other.set_field('#series_index', {1:7})
+        other.set_field('identifiers', {1:{'isbn':'123'}})
+        other.remove_formats({1:('FMT1',)})
+        other.remove_books((3,))
+        cache.reload_books_from_db((1, 2, 3))
+        fresh = self.init_cache()
+        self.assertEqual(cache.all_book_ids(), fresh.all_book_ids())
+        for field in fresh.fields:
+            if field in ('ondevice', 'marked'):
+                continue
+            for book_id in fresh.all_book_ids():
+                self.assertEqual(cache.field_for(field, book_id), fresh.field_for(field, book_id),
+                                 'Field %s of book %d was not reloaded' % (field, book_id))
+            t, ft = cache.fields[field].table, fresh.fields[field].table
+            if hasattr(ft, 'col_book_map'):
+                self.assertEqual(dict(t.col_book_map), dict(ft.col_book_map), 'Items of %s were not reloaded' % field)
+        self.assertEqual(cache.fields['uuid'].table.uuid_to_id_map, fresh.fields['uuid'].table.uuid_to_id_map)
+        # Cached search results are updated
+        self.assertEqual(cache.search('tags:=News'), {1})
+        self.assertEqual(cache.search('not tags:="new tag"'), {2})
+        self.assertEqual(cache.search('title:"=New title"'), {1})
+    # }}}
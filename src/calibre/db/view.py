@@ -8,14 +8,27 @@ __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
 import weakref, operator
+from bisect import bisect_right
+from collections import namedtuple
 from functools import partial
-from itertools import izip, imap
+from itertools import izip, imap, compress
 from future_builtins import map
 
 from calibre.ebooks.metadata import title_sort
 from calibre.utils.config_base import tweaks, prefs
 from calibre.db.write import uniq
 
+# If more than this many books have changed since the last sort, they are not
+# inserted one by one into the sorted list of books, instead all books are
+# sorted again
+MAX_INCREMENTAL_SORT = 100
+
+# The result of the last full sort of all books: spec is the list of fields
+# sorted on, keys are the sort keys of the books in book_ids, computed when
+# they are first needed, and version is the version of the sort key cache at
+# which the keys are valid.
+SortState = namedtuple('SortState', 'spec version book_ids keys')
+
 
 def sanitize_sort_field_name(field_metadata, field):
     field = field_metadata.search_term_to_field_key(field.lower().strip())
@@ -131,6 +144,7 @@ class View(object):
         self._map_filtered = tuple(self._map)
         self.full_map_is_sorted = True
         self.sort_history = [('id', True)]
+        self.sort_state = None
 
     def add_marked_listener(self, func):
         self.marked_listeners[id(func)] = weakref.ref(func)
@@ -233,7 +247,7 @@ class View(object):
             ans = [':::'.join((adata[aid]['name'], adata[aid]['sort'], adata[aid]['link'])) for aid in ids if aid in adata]
         return ':#:'.join(ans) if ans else default_value
 
-    def _do_sort(self, ids_to_sort, fields=(), subsort=False):
+    def _sort_spec(self, fields=(), subsort=False):
         fields = [(sanitize_sort_field_name(self.field_metadata, x), bool(y)) for x, y in fields]
         keys = self.field_metadata.sortable_field_keys()
         fields = [x for x in fields if x[0] in keys]
@@ -241,14 +255,66 @@ class View(object):
             fields += [('sort', True)]
         if not fields:
             fields = [('timestamp', False)]
+        return fields
 
+    def _do_sort(self, ids_to_sort, fields=(), subsort=False):
         return self.cache.multisort(
-            fields, ids_to_sort=ids_to_sort,
+            self._sort_spec(fields, subsort), ids_to_sort=ids_to_sort,
             virtual_fields={'marked':MarkedVirtualField(self.marked_ids)})
 
+    def _resort_incrementally(self, spec):
+        '''
+        Return the list of all book ids sorted on spec, by inserting the books
+        that were added or changed since the last sort into the result of the
+        last sort at the correct positions. Returns None if a full sort is
+        needed: the sort spec has changed, too many books have changed or the
+        sort keys for the spec are not cached.
+        '''
+        st = self.sort_state
+        if st is None or st.spec != spec or not self.cache.sort_keys_are_cached(spec):
+            return None
+        skc = self.cache.sort_key_cache
+        changed = skc.changed_since(st.version)
+        if changed is None:
+            return None
+        book_ids, keys = st.book_ids, st.keys
+        current, previous = frozenset(self._map), frozenset(book_ids)
+        added, removed = current - previous, previous - current
+        to_insert = list((changed & current) | added)
+        if len(to_insert) > MAX_INCREMENTAL_SORT:
+            return None
+        drop = removed | (changed & previous)
+        if not to_insert and not drop:
+            return list(book_ids)
+        if drop:
+            keep = list(map(operator.not_, map(drop.__contains__, book_ids)))
+            book_ids = list(compress(book_ids, keep))
+            if keys is not None:
+                keys = list(compress(keys, keep))
+        if keys is None:
+            # The keys of the existing books are needed to find the insertion points
+            keys, version = self.cache.sort_keys_for_books(spec, book_ids)
+            if keys is None:
+                return None
+        new_keys, version = self.cache.sort_keys_for_books(spec, to_insert)
+        if new_keys is None or skc.changed_since(st.version) != changed:
+            # More books were changed in the meantime
+            return None
+        book_ids, keys = list(book_ids), list(keys)
+        for book_id, key in sorted(izip(to_insert, new_keys), key=operator.itemgetter(1)):
+            pos = bisect_right(keys, key)
+            keys.insert(pos, key), book_ids.insert(pos, book_id)
+        self.sort_state = SortState(spec, version, book_ids, keys)
+        return book_ids
+
     def multisort(self, fields=[], subsort=False, only_ids=None):
-        sorted_book_ids = self._do_sort(self._map if only_ids is None else only_ids, fields=fields, subsort=subsort)
         if only_ids is None:
+            spec = self._sort_spec(fields, subsort)
+            sorted_book_ids = self._resort_incrementally(spec)
+            if sorted_book_ids is None:
+                version = self.cache.sort_key_cache.version
+                sorted_book_ids = self._do_sort(self._map, fields=fields, subsort=subsort)
+                self.sort_state = SortState(spec, version, sorted_book_ids, None)
             self._map = tuple(sorted_book_ids)
             self.full_map_is_sorted = True
             self.add_to_sort_history(fields)
@@ -258,6 +324,7 @@ class View(object):
                 fids = frozenset(self._map_filtered)
                 self._map_filtered = tuple(i for i in self._map if i in fids)
         else:
+            sorted_book_ids = self._do_sort(only_ids, fields=fields, subsort=subsort)
             smap = {book_id:i for i, book_id in enumerate(sorted_book_ids)}
             only_ids.sort(key=smap.get)
 
@@ -305,18 +372,20 @@ class View(object):
                 self.full_map_is_sorted = True
             return rv
         matches = self.cache.search(
-            query, search_restriction, virtual_fields={'marked':MarkedVirtualField(self.marked_ids)})
-        if len(matches) == len(self._map):
+            query, search_restriction, virtual_fields={'marked':MarkedVirtualField(self.marked_ids)}, as_id_set=True)
+        num_matches = len(matches)
+        if num_matches == len(self._map):
             rv = list(self._map)
         else:
-            rv = [x for x in self._map if x in matches]
+            rv = matches.filter(self._map)
         if sort_results and not self.full_map_is_sorted:
             # We need to sort the search results
-            if matches.issubset(frozenset(self._map_filtered)):
-                rv = [x for x in self._map_filtered if x in matches]
+            frv = matches.filter(self._map_filtered)
+            if len(frv) == num_matches:
+                rv = frv
             else:
                 rv = self._do_sort(rv, fields=self.sort_history)
-            if len(matches) == len(self._map):
+            if num_matches == len(self._map):
                 # We have sorted all ids, update self._map
                 self._map = tuple(rv)
                 self.full_map_is_sorted = True
@@ -397,6 +466,7 @@ class View(object):
         self._map_filtered = tuple(self._map)
         self.full_map_is_sorted = True
         self.sort_history = [('id', True)]
+        self.sort_state = None
         if clear_caches:
             self.cache.clear_caches()
         if field is not None:
@@ -183,6 +183,7 @@ def add_pipeline_options(parser, plumber):
                     [
                      'input_profile',
                      'output_profile',
+                     'parallel_jobs',
                      ]
                     )),
               (_('LOOK AND FEEL') , (
@@ -250,6 +251,8 @@ def add_pipeline_options(parser, plumber):
                         [
                          'verbose',
                          'debug_pipeline',
+                         'profile_pipeline',
+                         'profile_pipeline_cprofile',
                          ])),
 
               ))
@@ -272,6 +275,15 @@ def option_parser():
             help=_('List builtin recipe names. You can create an e-book from '
                 'a builtin recipe like this: ebook-convert "Recipe Name.recipe" '
                 'output.epub'))
+    parser.add_option('--server', default=False, action='store_true',
+            help=_('Run the conversion in the conversion server started with '
+                '--start-server, instead of in a new process. This is much '
+                'faster when converting many small files.'))
+    parser.add_option('--start-server', default=False, action='store_true',
+            help=_('Start a conversion server, that keeps worker processes '
+                'ready to run conversions. Use --start-server --help for its options.'))
+    parser.add_option('--stop-server', default=False, action='store_true',
+            help=_('Stop the running conversion server.'))
     return parser
 
 
@@ -358,6 +370,15 @@ def read_sr_patterns(path, log=None):
 
 
 def main(args=sys.argv):
+    if '--start-server' in args:
+        from calibre.ebooks.conversion.server import main
+        return main(args)
+    if '--stop-server' in args:
+        from calibre.ebooks.conversion.server import stop_server
+        return stop_server()
+    if '--server' in args:
+        from calibre.ebooks.conversion.server import run_on_server
+        return run_on_server([x for x in args[1:] if x != '--server'])
     log = Log()
     parser, plumber = create_option_parser(args, log)
     opts, leftover_args = parser.parse_args(args)
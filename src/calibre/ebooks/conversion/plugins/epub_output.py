@@ -13,6 +13,7 @@ from calibre.customize.conversion import (OutputFormatPlugin,
 from calibre.ptempfile import TemporaryDirectory
 from calibre import CurrentDir
 from calibre.constants import filesystem_encoding
+from calibre.ebooks.conversion.profiling import pipeline_stage
 
 block_level_tags = (
       'address',
@@ -202,7 +203,8 @@ class EPUBOutput(OutputFormatPlugin):
                 no_default_cover=self.opts.no_default_epub_cover,
                 no_svg_cover=self.opts.no_svg_cover,
                 preserve_aspect_ratio=self.opts.preserve_cover_aspect_ratio)
-        cm(self.oeb, self.opts, self.log)
+        with pipeline_stage(opts, 'CoverManager'):
+            cm(self.oeb, self.opts, self.log)
 
         self.workaround_sony_quirks()
 
@@ -245,7 +247,8 @@ class EPUBOutput(OutputFormatPlugin):
                     metadata_xml, atom_xml = sony_metadata(oeb)
                     extra_entries = [(u'atom.xml', 'application/atom+xml', atom_xml)]
             oeb_output = plugin_for_output_format('oeb')
-            oeb_output.convert(oeb, tdir, input_plugin, opts, log)
+            with pipeline_stage(opts, 'serialize'):
+                oeb_output.convert(oeb, tdir, input_plugin, opts, log)
             opf = [x for x in os.listdir(tdir) if x.endswith('.opf')][0]
             self.condense_ncx([os.path.join(tdir, x) for x in os.listdir(tdir)
                     if x.endswith('.ncx')][0])
@@ -254,7 +257,7 @@ class EPUBOutput(OutputFormatPlugin):
                 encryption = self.encrypt_fonts(encrypted_fonts, tdir, uuid)
 
             from calibre.ebooks.epub import initialize_container
-            with initialize_container(output_path, os.path.basename(opf),
+            with pipeline_stage(opts, 'zip'), initialize_container(output_path, os.path.basename(opf),
                     extra_entries=extra_entries) as epub:
                 epub.add_dir(tdir)
                 if encryption is not None:
@@ -462,6 +465,7 @@ class EPUBOutput(OutputFormatPlugin):
             if stylesheet is not None:
                 # ADE doesn't render lists correctly if they have left margins
                 from cssutils.css import CSSRule
+                from calibre.ebooks.oeb.stylizer import stylesheet_cache
                 for lb in XPath('//h:ul[@class]|//h:ol[@class]')(root):
                     sel = '.'+lb.get('class')
                     for rule in stylesheet.data.cssRules.rulesOfType(CSSRule.STYLE_RULE):
@@ -476,6 +480,7 @@ class EPUBOutput(OutputFormatPlugin):
                     ws = style.getPropertyValue('white-space')
                     if ws == 'pre':
                         style.setProperty('white-space', 'pre-wrap')
+                stylesheet_cache(self.oeb).invalidate(stylesheet.data)
 
     # }}}
 
@@ -107,6 +107,7 @@ class HTMLInput(InputFormatPlugin):
         from calibre.ebooks.html.input import get_filelist
         from calibre.ebooks.metadata import string_to_authors
         from calibre.utils.localization import canonicalize_lang
+        from calibre.ebooks.oeb.stylizer import stylesheet_cache
         import cssutils, logging
         cssutils.log.setLevel(logging.WARN)
         self.OEB_STYLES = OEB_STYLES
@@ -189,6 +190,7 @@ class HTMLInput(InputFormatPlugin):
                         break
                 cssutils.replaceUrls(item.data,
                         partial(self.resource_adder, base=dpath))
+                stylesheet_cache(oeb).invalidate(item.data)
 
         toc = self.oeb.toc
         self.oeb.auto_generated_toc = True
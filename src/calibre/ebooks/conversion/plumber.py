@@ -12,6 +12,7 @@ from calibre.customize.ui import input_profiles, output_profiles, \
         available_input_formats, available_output_formats, \
         run_plugins_on_preprocess, run_plugins_on_postprocess
 from calibre.ebooks.conversion.preprocess import HTMLPreProcessor
+from calibre.ebooks.conversion.profiling import pipeline_stage
 from calibre.ptempfile import PersistentTemporaryDirectory
 from calibre.utils.date import parse_date
 from calibre.utils.zipfile import ZipFile
@@ -124,6 +125,34 @@ OptionRecommendation(name='debug_pipeline',
                    'of the conversion process a bug is occurring.')
         ),
 
+OptionRecommendation(name='parallel_jobs',
+            recommended_value=0, level=OptionRecommendation.LOW,
+            help=_('Number of worker processes to use to compute the styles '
+                   'of the HTML files of the book in parallel. Starting the '
+                   'worker processes takes time, so this only makes the conversion '
+                   'faster for books with many large HTML files or large '
+                   'stylesheets. The default of zero means the styles are '
+                   'computed in the conversion process itself.')
+        ),
+
+OptionRecommendation(name='profile_pipeline',
+            recommended_value=False, level=OptionRecommendation.LOW,
+            help=_('Record the time, CPU time and memory used by every stage '
+                   'of the conversion pipeline and the number of files in the '
+                   'book after it. The peak memory of a stage is the largest '
+                   'memory use of the conversion so far, at the end of the stage. '
+                   'The results are saved as JSON to a file named '
+                   'after the output file, with .profile.json appended. Useful '
+                   'to find out which stage makes a conversion slow.')
+        ),
+
+OptionRecommendation(name='profile_pipeline_cprofile',
+            recommended_value=False, level=OptionRecommendation.LOW,
+            help=_('Also run every stage of the conversion pipeline under the '
+                   'Python profiler, saving the statistics to a folder named after '
+                   'the output file, with .profile appended. Implies %s.') % '--profile-pipeline'
+        ),
+
 OptionRecommendation(name='input_profile',
             recommended_value='default', level=OptionRecommendation.LOW,
             choices=[x.short_name for x in input_profiles()],
@@ -1026,6 +1055,27 @@ OptionRecommendation(name='search_replace',
         '''
         # Setup baseline option values
         self.setup_options()
+        self.opts.pipeline_profiler = profiler = None
+        if self.opts.profile_pipeline or self.opts.profile_pipeline_cprofile:
+            from calibre.ebooks.conversion.profiling import PipelineProfiler
+            base = os.path.abspath(self.output)
+            profiler = self.opts.pipeline_profiler = PipelineProfiler(
+                cprofile_dir=base + '.profile' if self.opts.profile_pipeline_cprofile else None, log=self.log)
+        try:
+            self.run_pipeline()
+        finally:
+            if profiler is not None:
+                # Do not hide an error in the conversion with an error in
+                # saving the profile
+                try:
+                    profiler.save(base + '.profile.json', input=self.input, output=self.output,
+                            input_plugin=self.input_plugin.name, output_plugin=self.output_plugin.name)
+                except Exception:
+                    self.log.exception('Failed to write the pipeline profile to', base + '.profile.json')
+                else:
+                    self.log('Pipeline profile written to', base + '.profile.json')
+
+    def run_pipeline(self):
         if self.opts.verbose:
             self.log.filter_level = self.log.DEBUG
         if self.for_regex_wizard and hasattr(self.opts, 'no_process'):
@@ -1052,7 +1102,8 @@ OptionRecommendation(name='search_replace',
 
         # Run any preprocess plugins
         from calibre.customize.ui import run_plugins_on_preprocess
-        self.input = run_plugins_on_preprocess(self.input)
+        with pipeline_stage(self.opts, 'preprocess_plugins'):
+            self.input = run_plugins_on_preprocess(self.input)
 
         self.flush()
         # Create an OEBBook from the input file. The input plugin does all the
@@ -1083,9 +1134,12 @@ OptionRecommendation(name='search_replace',
         if self.for_regex_wizard:
             self.input_plugin.for_viewer = True
         with self.input_plugin:
-            self.oeb = self.input_plugin(stream, self.opts,
-                                        self.input_fmt, self.log,
-                                        accelerators, tdir)
+            with pipeline_stage(self.opts, 'input'):
+                self.oeb = self.input_plugin(stream, self.opts,
+                                            self.input_fmt, self.log,
+                                            accelerators, tdir)
+                if self.opts.pipeline_profiler is not None:
+                    self.opts.pipeline_profiler.oeb = self.oeb
             if self.opts.debug_pipeline is not None:
                 self.dump_input(self.oeb, tdir)
                 if self.abort_after_input_dump:
@@ -1093,13 +1147,17 @@ OptionRecommendation(name='search_replace',
             if self.input_fmt in ('recipe', 'downloaded_recipe'):
                 self.opts_to_mi(self.user_metadata)
             if not hasattr(self.oeb, 'manifest'):
-                self.oeb = create_oebbook(
-                    self.log, self.oeb, self.opts,
-                    encoding=self.input_plugin.output_encoding,
-                    for_regex_wizard=self.for_regex_wizard)
+                with pipeline_stage(self.opts, 'parse'):
+                    self.oeb = create_oebbook(
+                        self.log, self.oeb, self.opts,
+                        encoding=self.input_plugin.output_encoding,
+                        for_regex_wizard=self.for_regex_wizard)
+                    if self.opts.pipeline_profiler is not None:
+                        self.opts.pipeline_profiler.oeb = self.oeb
             if self.for_regex_wizard:
                 return
-            self.input_plugin.postprocess_book(self.oeb, self.opts, self.log)
+            with pipeline_stage(self.opts, 'postprocess'):
+                self.input_plugin.postprocess_book(self.oeb, self.opts, self.log)
             self.opts.is_image_collection = self.input_plugin.is_image_collection
             pr = CompositeProgressReporter(0.34, 0.67, self.ui_reporter)
             self.flush()
@@ -1107,17 +1165,20 @@ OptionRecommendation(name='search_replace',
                 out_dir = os.path.join(self.opts.debug_pipeline, 'parsed')
                 self.dump_oeb(self.oeb, out_dir)
                 self.log('Parsed HTML written to:', out_dir)
-            self.input_plugin.specialize(self.oeb, self.opts, self.log,
-                    self.output_fmt)
+            with pipeline_stage(self.opts, 'specialize'):
+                self.input_plugin.specialize(self.oeb, self.opts, self.log,
+                        self.output_fmt)
 
         pr(0., _('Running transforms on e-book...'))
 
         self.oeb.plumber_output_format = self.output_fmt or ''
 
         from calibre.ebooks.oeb.transforms.data_url import DataURL
-        DataURL()(self.oeb, self.opts)
+        with pipeline_stage(self.opts, 'DataURL'):
+            DataURL()(self.oeb, self.opts)
         from calibre.ebooks.oeb.transforms.guide import Clean
-        Clean()(self.oeb, self.opts)
+        with pipeline_stage(self.opts, 'Clean'):
+            Clean()(self.oeb, self.opts)
         pr(0.1)
         self.flush()
 
@@ -1125,15 +1186,18 @@ OptionRecommendation(name='search_replace',
         self.opts.dest = self.opts.output_profile
 
         from calibre.ebooks.oeb.transforms.jacket import RemoveFirstImage
-        RemoveFirstImage()(self.oeb, self.opts, self.user_metadata)
+        with pipeline_stage(self.opts, 'RemoveFirstImage'):
+            RemoveFirstImage()(self.oeb, self.opts, self.user_metadata)
         from calibre.ebooks.oeb.transforms.metadata import MergeMetadata
-        MergeMetadata()(self.oeb, self.user_metadata, self.opts,
-                override_input_metadata=self.override_input_metadata)
+        with pipeline_stage(self.opts, 'MergeMetadata'):
+            MergeMetadata()(self.oeb, self.user_metadata, self.opts,
+                    override_input_metadata=self.override_input_metadata)
         pr(0.2)
         self.flush()
 
         from calibre.ebooks.oeb.transforms.structure import DetectStructure
-        DetectStructure()(self.oeb, self.opts)
+        with pipeline_stage(self.opts, 'DetectStructure'):
+            DetectStructure()(self.oeb, self.opts)
         pr(0.35)
         self.flush()
 
@@ -1159,7 +1223,8 @@ OptionRecommendation(name='search_replace',
                 fkey = self.opts.dest.fkey
 
         from calibre.ebooks.oeb.transforms.jacket import Jacket
-        Jacket()(self.oeb, self.opts, self.user_metadata)
+        with pipeline_stage(self.opts, 'Jacket'):
+            Jacket()(self.oeb, self.opts, self.user_metadata)
         pr(0.4)
         self.flush()
 
@@ -1183,11 +1248,13 @@ OptionRecommendation(name='search_replace',
         if self.opts.linearize_tables and \
                 self.output_plugin.file_type not in ('mobi', 'lrf'):
             from calibre.ebooks.oeb.transforms.linearize_tables import LinearizeTables
-            LinearizeTables()(self.oeb, self.opts)
+            with pipeline_stage(self.opts, 'LinearizeTables'):
+                LinearizeTables()(self.oeb, self.opts)
 
         if self.opts.unsmarten_punctuation:
             from calibre.ebooks.oeb.transforms.unsmarten import UnsmartenPunctuation
-            UnsmartenPunctuation()(self.oeb, self.opts)
+            with pipeline_stage(self.opts, 'UnsmartenPunctuation'):
+                UnsmartenPunctuation()(self.oeb, self.opts)
 
         mobi_file_type = getattr(self.opts, 'mobi_file_type', 'old')
         needs_old_markup = (self.output_plugin.file_type == 'lit' or
@@ -1206,7 +1273,8 @@ OptionRecommendation(name='search_replace',
                 transform_css_rules=transform_css_rules,
                 specializer=partial(self.output_plugin.specialize_css_for_output,
                     self.log, self.opts))
-        flattener(self.oeb, self.opts)
+        with pipeline_stage(self.opts, 'CSSFlattener'):
+            flattener(self.oeb, self.opts)
         self.opts._final_base_font_size = fbase
 
         self.opts.insert_blank_line = oibl
@@ -1214,16 +1282,20 @@ OptionRecommendation(name='search_replace',
 
         from calibre.ebooks.oeb.transforms.page_margin import \
             RemoveFakeMargins, RemoveAdobeMargins
-        RemoveFakeMargins()(self.oeb, self.log, self.opts)
-        RemoveAdobeMargins()(self.oeb, self.log, self.opts)
+        with pipeline_stage(self.opts, 'RemoveFakeMargins'):
+            RemoveFakeMargins()(self.oeb, self.log, self.opts)
+        with pipeline_stage(self.opts, 'RemoveAdobeMargins'):
+            RemoveAdobeMargins()(self.oeb, self.log, self.opts)
 
         if self.opts.embed_all_fonts:
             from calibre.ebooks.oeb.transforms.embed_fonts import EmbedFonts
-            EmbedFonts()(self.oeb, self.log, self.opts)
+            with pipeline_stage(self.opts, 'EmbedFonts'):
+                EmbedFonts()(self.oeb, self.log, self.opts)
 
         if self.opts.subset_embedded_fonts and self.output_plugin.file_type != 'pdf':
             from calibre.ebooks.oeb.transforms.subset import SubsetFonts
-            SubsetFonts()(self.oeb, self.log, self.opts)
+            with pipeline_stage(self.opts, 'SubsetFonts'):
+                SubsetFonts()(self.oeb, self.log, self.opts)
 
         pr(0.9)
         self.flush()
@@ -1232,7 +1304,8 @@ OptionRecommendation(name='search_replace',
 
         self.log.info('Cleaning up manifest...')
         trimmer = ManifestTrimmer()
-        trimmer(self.oeb, self.opts)
+        with pipeline_stage(self.opts, 'ManifestTrimmer'):
+            trimmer(self.oeb, self.opts)
 
         self.oeb.toc.rationalize_play_orders()
         pr(1.)
@@ -1247,12 +1320,13 @@ OptionRecommendation(name='search_replace',
         our = CompositeProgressReporter(0.67, 1., self.ui_reporter)
         self.output_plugin.report_progress = our
         our(0., _('Running %s plugin')%self.output_plugin.name)
-        with self.output_plugin:
+        with self.output_plugin, pipeline_stage(self.opts, 'output'):
             self.output_plugin.convert(self.oeb, self.output, self.input_plugin,
                 self.opts, self.log)
         self.oeb.clean_temp_files()
         self.ui_reporter(1.)
-        run_plugins_on_postprocess(self.output, self.output_fmt)
+        with pipeline_stage(self.opts, 'postprocess_plugins'):
+            run_plugins_on_postprocess(self.output, self.output_fmt)
 
         self.log(self.output_fmt.upper(), 'output written to', self.output)
         self.flush()
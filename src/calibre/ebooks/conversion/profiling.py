@@ -0,0 +1,140 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+import errno, json, os, re
+from contextlib import contextmanager
+
+from calibre.constants import isosx, iswindows
+from calibre.utils.monotonic import monotonic
+
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def current_rss():
+    try:
+        from calibre.utils.mem import get_memory
+        return get_memory()
+    except Exception:
+        return None
+
+
+def peak_rss_so_far():
+    ''' The largest resident memory of this process so far, in bytes. This is
+    the high-water mark of the whole process, not of any single stage. '''
+    try:
+        if iswindows:
+            import psutil
+            return psutil.Process(os.getpid()).memory_info().peak_wset
+        import resource
+        ans = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return ans if isosx else ans * 1024
+    except Exception:
+        return None
+
+
+@contextmanager
+def pipeline_stage(opts, name):
+    ''' Record the resources used by the code in the with block as a stage of
+    the conversion pipeline, if the pipeline is being profiled. '''
+    profiler = getattr(opts, 'pipeline_profiler', None)
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(name):
+            yield
+
+
+class PipelineProfiler(object):
+
+    ''' Records the wall time, CPU time, memory and number of files in the
+    book for the stages of the conversion pipeline. Stages can be nested, the
+    name of a nested stage is prefixed by the name of its parent. If
+    cprofile_dir is specified, the top level stages are also run under
+    cProfile, with their statistics saved in that directory. The peak memory
+    recorded for a stage is the largest memory use of the process up to the
+    end of that stage. Failures to save statistics are logged to log. '''
+
+    def __init__(self, cprofile_dir=None, log=None):
+        self.cprofile_dir = cprofile_dir
+        self.log = log
+        self.stages = []
+        self.stack = []
+        self.oeb = None
+        self.started = monotonic()
+        self.started_cpu = cpu_time()
+
+    def item_counts(self):
+        oeb = self.oeb
+        if oeb is None or not hasattr(oeb, 'manifest'):
+            return {}
+        return {'manifest_items': len(oeb.manifest), 'spine_items': len(oeb.spine)}
+
+    @contextmanager
+    def stage(self, name):
+        self.stack.append(name)
+        stage = {'name': '/'.join(self.stack), 'rss_before': current_rss()}
+        self.stages.append(stage)
+        profile = None
+        if self.cprofile_dir is not None and len(self.stack) == 1:
+            import cProfile
+            profile = cProfile.Profile()
+        start, start_cpu = monotonic(), cpu_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            stage['wall_time'] = monotonic() - start
+            stage['cpu_time'] = cpu_time() - start_cpu
+            stage['rss_after'], stage['peak_rss_so_far'] = current_rss(), peak_rss_so_far()
+            stage.update(self.item_counts())
+            self.stack.pop()
+            if profile is not None:
+                # Failing to save the statistics must not hide the result, or
+                # the error, of the stage
+                try:
+                    stage['cprofile'] = self.save_cprofile(profile, name)
+                except Exception:
+                    self.log_exception('Failed to save the Python profile of the stage:', name)
+
+    def log_exception(self, *args):
+        if self.log is None:
+            import traceback
+            traceback.print_exc()
+        else:
+            self.log.exception(*args)
+
+    def save_cprofile(self, profile, name):
+        try:
+            os.makedirs(self.cprofile_dir)
+        except EnvironmentError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        num = sum(1 for s in self.stages if '/' not in s['name'])
+        path = os.path.join(self.cprofile_dir, '%02d-%s.prof' % (num, re.sub(r'[^a-zA-Z0-9]+', '_', name)))
+        profile.dump_stats(path)
+        return path
+
+    def as_dict(self):
+        return {
+            'wall_time': monotonic() - self.started,
+            'cpu_time': cpu_time() - self.started_cpu,
+            'peak_rss_so_far': peak_rss_so_far(),
+            'stages': self.stages,
+        }
+
+    def save(self, path, **extra):
+        data = self.as_dict()
+        data.update(extra)
+        with open(path, 'wb') as f:
+            f.write(json.dumps(data, indent=2, sort_keys=True).encode('utf-8'))
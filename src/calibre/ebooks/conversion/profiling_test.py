@@ -0,0 +1,123 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+import json, os, pstats, shutil, tempfile, unittest
+
+from calibre.ebooks.conversion.profiling import PipelineProfiler, pipeline_stage
+from calibre.utils.logging import Log
+
+
+class Opts(object):
+    pass
+
+
+class Book(object):
+
+    def __init__(self, manifest, spine):
+        self.manifest, self.spine = range(manifest), range(spine)
+
+
+class PipelineProfilerTest(unittest.TestCase):
+
+    ae = unittest.TestCase.assertEqual
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+    def test_stages(self):
+        opts = Opts()
+        with pipeline_stage(opts, 'input'):
+            pass  # Profiling is disabled, so this does nothing
+        p = opts.pipeline_profiler = PipelineProfiler()
+        with pipeline_stage(opts, 'input'):
+            p.oeb = Book(3, 2)
+        with pipeline_stage(opts, 'output'):
+            with pipeline_stage(opts, 'Split'):
+                p.oeb = Book(5, 4)
+            with self.assertRaises(ValueError):
+                with pipeline_stage(opts, 'serialize'):
+                    raise ValueError('failed')
+        self.ae([s['name'] for s in p.stages], ['input', 'output', 'output/Split', 'output/serialize'])
+        self.ae(p.stack, [])
+        for s in p.stages:
+            self.assertGreaterEqual(s['wall_time'], 0)
+            self.assertGreaterEqual(s['cpu_time'], 0)
+            for k in ('rss_before', 'rss_after', 'peak_rss_so_far'):
+                self.assertIn(k, s)
+            self.assertNotIn('cprofile', s)
+        self.ae((p.stages[0]['manifest_items'], p.stages[0]['spine_items']), (3, 2))
+        self.ae((p.stages[1]['manifest_items'], p.stages[1]['spine_items']), (5, 4))
+
+    def test_save(self):
+        p = PipelineProfiler()
+        with p.stage('input'):
+            pass
+        path = os.path.join(self.tdir, 'book.epub.profile.json')
+        p.save(path, input='book.txt', output='book.epub')
+        with open(path, 'rb') as f:
+            data = json.loads(f.read())
+        self.ae(data['input'], 'book.txt')
+        self.ae(data['output'], 'book.epub')
+        self.ae([s['name'] for s in data['stages']], ['input'])
+        for k in ('wall_time', 'cpu_time', 'peak_rss_so_far'):
+            self.assertIn(k, data)
+
+    def test_cprofile(self):
+        cdir = os.path.join(self.tdir, 'book.epub.profile')
+        p = PipelineProfiler(cprofile_dir=cdir)
+        with p.stage('input'):
+            pass
+        with p.stage('output'):
+            with p.stage('Split'):
+                pass
+        with p.stage('Odd name!'):
+            pass
+        # Only the top level stages are profiled, nested stages are part of
+        # the profile of their parent
+        self.ae(sorted(os.listdir(cdir)), ['01-input.prof', '02-output.prof', '03-Odd_name_.prof'])
+        self.ae([os.path.basename(s.get('cprofile', '')) for s in p.stages], ['01-input.prof', '02-output.prof', '', '03-Odd_name_.prof'])
+        pstats.Stats(os.path.join(cdir, '02-output.prof'))
+
+    def test_save_failures(self):
+        cdir = os.path.join(self.tdir, 'book.epub.profile')
+        with open(cdir, 'wb'):
+            pass
+        log = Log(level=Log.ERROR)
+        log.outputs = []
+        p = PipelineProfiler(cprofile_dir=cdir, log=log)
+        # Errors saving the statistics do not replace the error of the stage
+        with self.assertRaises(ValueError):
+            with p.stage('input'):
+                raise ValueError('failed')
+        with p.stage('output'):
+            pass
+        self.ae([s['name'] for s in p.stages], ['input', 'output'])
+        for s in p.stages:
+            self.assertNotIn('cprofile', s)
+            self.assertIn('wall_time', s)
+
+
+def find_tests():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(PipelineProfilerTest)
+
+
+class TestRunner(unittest.main):
+
+    def createTests(self):
+        self.test = find_tests()
+
+
+def run(verbosity=4):
+    TestRunner(verbosity=verbosity, exit=False)
+
+
+if __name__ == '__main__':
+    run()
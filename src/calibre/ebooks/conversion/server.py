@@ -0,0 +1,294 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+# A long running service that runs conversions in a pool of worker processes
+# that have already imported the conversion code, so that running many small
+# conversions does not pay the startup cost of a worker for every conversion.
+# Start it with ebook-convert --start-server and send conversions to it with
+# ebook-convert --server input_file output_file [options]
+
+import cPickle, errno, os, sys
+from contextlib import closing
+from itertools import count
+from Queue import Empty
+from threading import Lock, Thread
+
+from calibre import prints
+from calibre.constants import cache_dir
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.ipc import eintr_retry_call
+
+# The modules used by most conversions, imported by the workers before they
+# run any conversions
+WARM_UP_MODULES = (
+    'calibre.ebooks.conversion.cli',
+    'calibre.ebooks.conversion.plumber',
+    'calibre.ebooks.conversion.preprocess',
+    'calibre.ebooks.oeb.base',
+    'calibre.ebooks.oeb.reader',
+    'calibre.ebooks.oeb.stylizer',
+    'calibre.ebooks.oeb.transforms.flatcss',
+    'calibre.ebooks.oeb.transforms.structure',
+    'calibre.ebooks.oeb.polish.container',
+    'calibre.ebooks.metadata.opf2',
+)
+
+
+def server_info_path():
+    return os.path.join(cache_dir(), 'conversion-server')
+
+
+def warm_up():
+    ' Run in every worker process before it runs any conversions '
+    from importlib import import_module
+    from calibre.customize.ui import available_input_formats, available_output_formats
+    available_input_formats(), available_output_formats()
+    for module in WARM_UP_MODULES:
+        try:
+            import_module(module)
+        except Exception:
+            # The conversions that need this module will report the error
+            import traceback
+            traceback.print_exc()
+
+
+def convert(args, cwd):
+    ''' Run a conversion in a worker process, returning the exit code and
+    the output of ebook-convert '''
+    import traceback
+    from tempfile import TemporaryFile
+    from calibre.ebooks.conversion.cli import main
+    orig_cwd = os.getcwdu()
+    with TemporaryFile() as output:
+        # The conversion log is written to the stdout of the process, which
+        # is not connected to the client, so capture it at the file
+        # descriptor level, which also captures the output of any child processes
+        sys.stdout.flush(), sys.stderr.flush()
+        orig_fds = os.dup(1), os.dup(2)
+        os.dup2(output.fileno(), 1), os.dup2(output.fileno(), 2)
+        try:
+            os.chdir(cwd)
+            ret = main(['ebook-convert'] + list(args))
+        except SystemExit as err:
+            ret = err.code
+            if isinstance(ret, basestring):
+                prints(ret, file=sys.stderr)
+                ret = 1
+        except Exception:
+            traceback.print_exc()
+            ret = 1
+        finally:
+            sys.stdout.flush(), sys.stderr.flush()
+            for fd, orig_fd in enumerate(orig_fds, 1):
+                os.dup2(orig_fd, fd), os.close(orig_fd)
+            os.chdir(orig_cwd)
+        output.seek(0)
+        return ret or 0, output.read()
+
+
+class ConversionServer(object):
+
+    # The function that runs a conversion in a worker process
+    worker_function = ('calibre.ebooks.conversion.server', 'convert')
+
+    def __init__(self, max_workers=None, max_jobs_per_worker=50, max_worker_memory=1024, log=prints, info_path=None):
+        self.max_workers, self.max_jobs_per_worker, self.max_worker_memory = max_workers, max_jobs_per_worker, max_worker_memory
+        self.log = log
+        self.info_path = info_path or server_info_path()
+        self.lock = Lock()
+        self.pending = {}
+        self.job_ids = count()
+        self.pool = self.create_pool()
+        self.shutting_down = False
+
+    def create_pool(self):
+        from calibre.utils.ipc.pool import Pool
+        return Pool(max_workers=self.max_workers, name='ConversionServer',
+                    initializer=('calibre.ebooks.conversion.server', 'warm_up'),
+                    max_jobs_per_worker=self.max_jobs_per_worker,
+                    max_worker_memory=self.max_worker_memory, prestart_workers=True)
+
+    def serve_forever(self):
+        from calibre.utils.ipc.server import create_listener
+        self.auth_key = os.urandom(32)
+        self.address, self.listener = create_listener(self.auth_key, backlog=64)
+        path = self.info_path
+        # Write the file atomically, so that clients never read a partial file
+        with os.fdopen(os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+            cPickle.dump((self.address, self.auth_key), f, -1)
+        atomic_rename(path + '.tmp', path)
+        t = Thread(target=self.dispatch_results, name='ConversionServerResults')
+        t.daemon = True
+        t.start()
+        self.log('Conversion server started with %d worker processes' % self.pool.max_workers)
+        try:
+            while not self.shutting_down:
+                try:
+                    conn = eintr_retry_call(self.listener.accept)
+                except Exception:
+                    if self.shutting_down:
+                        break
+                    import traceback
+                    traceback.print_exc()
+                    continue
+                if self.shutting_down:
+                    # The connection made to wake up this loop
+                    conn.close()
+                    break
+                t = Thread(target=self.handle_client, args=(conn,), name='ConversionServerClient')
+                t.daemon = True
+                t.start()
+        finally:
+            try:
+                os.remove(path)
+            except EnvironmentError:
+                pass
+            self.listener.close()
+            self.pool.shutdown()
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            for conn in pending.itervalues():
+                self.send_result(conn, (1, b'The conversion server is shutting down'))
+
+    def handle_client(self, conn):
+        try:
+            request = eintr_retry_call(conn.recv)
+        except Exception:
+            conn.close()
+            return
+        if request[0] == 'shutdown':
+            from multiprocessing.connection import Client
+            self.shutting_down = True
+            self.send_result(conn, (0, b''))
+            # Wake up the thread waiting for connections, if it is not
+            # already stopped
+            try:
+                Client(self.address, authkey=self.auth_key).close()
+            except EnvironmentError:
+                pass
+            return
+        from calibre.utils.ipc.pool import Failure
+        args, cwd = request[1:]
+        with self.lock:
+            job_id = next(self.job_ids)
+            self.pending[job_id] = conn
+            try:
+                self.pool(job_id, self.worker_function[0], self.worker_function[1], args, cwd)
+            except Failure as err:
+                del self.pending[job_id]
+                self.send_result(conn, (1, ('The conversion server has failed: %s' % err.failure_message).encode('utf-8')))
+                return
+        self.log('Started conversion %d: %s' % (job_id, ' '.join(args)))
+
+    def send_result(self, conn, result):
+        try:
+            eintr_retry_call(conn.send, result)
+        except Exception:
+            pass  # The client has gone away
+        finally:
+            conn.close()
+
+    def dispatch_results(self):
+        while not self.shutting_down:
+            pool = self.pool
+            try:
+                result = pool.results.get(timeout=1)
+            except Empty:
+                if pool.failed:
+                    self.replace_pool(pool)
+                continue
+            if result.is_terminal_failure:
+                self.replace_pool(pool)
+                continue
+            with self.lock:
+                conn = self.pending.pop(result.id, None)
+            if conn is None:
+                continue
+            if result.result.err:
+                ans = (1, result.result.traceback.encode('utf-8'))
+            else:
+                ans = result.result.value
+            self.log('Finished conversion %d with exit code: %s' % (result.id, ans[0]))
+            self.send_result(conn, ans)
+
+    def replace_pool(self, pool):
+        # A worker crashed, which also shuts down the pool. Fail the
+        # conversions that were running in it and start a new pool.
+        tf = pool.terminal_failure
+        self.log('A conversion worker process crashed: %s' % tf.message)
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            pool.shutdown()
+            self.pool = self.create_pool()
+        for job_id, conn in pending.iteritems():
+            self.send_result(conn, (1, ('The worker process running the conversion crashed:\n%s' % (tf.tb or '')).encode('utf-8')))
+
+
+def send_request(request, info_path=None):
+    from multiprocessing.connection import Client
+    try:
+        with open(info_path or server_info_path(), 'rb') as f:
+            address, auth_key = cPickle.load(f)
+        conn = Client(address, authkey=auth_key)
+    except EnvironmentError as err:
+        if err.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            raise SystemExit('No conversion server is running, start one with: ebook-convert --start-server')
+        raise
+    with closing(conn):
+        eintr_retry_call(conn.send, request)
+        try:
+            return eintr_retry_call(conn.recv)
+        except EOFError:
+            raise SystemExit('The conversion server closed the connection without sending a result')
+
+
+def run_on_server(args, info_path=None):
+    ' Run the conversion specified by the ebook-convert command line args on the conversion server '
+    ret, output = send_request(('convert', args, os.getcwdu()), info_path)
+    sys.stdout.write(output)
+    sys.stdout.flush()
+    return ret
+
+
+def stop_server(info_path=None):
+    send_request(('shutdown',), info_path)
+    return 0
+
+
+def option_parser():
+    from calibre.utils.config import OptionParser
+    parser = OptionParser(usage=_('''\
+%prog --start-server [options]
+
+Start a conversion server, which runs the conversions sent to it with
+ebook-convert --server input_file output_file [options]
+in worker processes that are started in advance and reused for many
+conversions. This is much faster than running ebook-convert for every file
+when converting many small files. Stop it with ebook-convert --stop-server'''))
+    parser.add_option('--start-server', default=False, action='store_true', help=_(
+        'Start the conversion server'))
+    parser.add_option('--max-workers', default=0, type=int, help=_(
+        'The number of worker processes to use. Defaults to the number of CPUs.'))
+    parser.add_option('--max-jobs-per-worker', default=50, type=int, help=_(
+        'Replace a worker process after it has run this many conversions.'
+        ' Zero means worker processes are never replaced.'))
+    parser.add_option('--max-worker-memory', default=1024, type=int, help=_(
+        'Replace a worker process if it is using more than this many MB of'
+        ' memory after a conversion. Zero means no limit.'))
+    return parser
+
+
+def main(args=sys.argv):
+    opts, args = option_parser().parse_args(args)
+    server = ConversionServer(max_workers=opts.max_workers or None, max_jobs_per_worker=opts.max_jobs_per_worker,
+                              max_worker_memory=opts.max_worker_memory)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
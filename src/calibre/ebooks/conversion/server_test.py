@@ -0,0 +1,131 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+import os, shutil, sys, tempfile, time, unittest
+from io import BytesIO
+from threading import Thread
+
+from calibre.ebooks.conversion import server
+from calibre.ebooks.conversion.server import ConversionServer, run_on_server, send_request, stop_server
+
+
+def convert(args, cwd):
+    ' Run in the worker processes of the test server '
+    if args[0] == 'crash':
+        os._exit(1)
+    if args[0] == 'sleep':
+        time.sleep(float(args[1]))
+        return 0, b''
+    return server.convert(args, cwd)
+
+
+class TestServer(ConversionServer):
+    worker_function = ('calibre.ebooks.conversion.server_test', 'convert')
+
+
+class Client(Thread):
+
+    def __init__(self, request, info_path):
+        Thread.__init__(self, name='TestConversionClient')
+        self.daemon = True
+        self.request, self.info_path = request, info_path
+        self.result = None
+
+    def run(self):
+        self.result = send_request(self.request, self.info_path)
+
+
+class ConversionServerTest(unittest.TestCase):
+
+    ae = unittest.TestCase.assertEqual
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.info_path = os.path.join(self.tdir, 'conversion-server')
+        self.server = TestServer(max_workers=1, log=lambda *a: None, info_path=self.info_path)
+        self.server_thread = Thread(target=self.server.serve_forever, name='TestConversionServer')
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        for i in xrange(200):
+            if os.path.exists(self.info_path):
+                break
+            time.sleep(0.05)
+
+    def tearDown(self):
+        if self.server_thread.is_alive():
+            stop_server(self.info_path)
+            self.server_thread.join(10)
+        shutil.rmtree(self.tdir)
+
+    def request(self, *args):
+        return send_request(('convert', args, self.tdir), self.info_path)
+
+    def wait_for_pending(self):
+        for i in xrange(200):
+            if self.server.pending:
+                return
+            time.sleep(0.05)
+        self.fail('The request never reached the server')
+
+    def test_conversion(self):
+        src, dest = os.path.join(self.tdir, 'in.txt'), os.path.join(self.tdir, 'out.txt')
+        with open(src, 'wb') as f:
+            f.write(b'Some text\n\nAnother paragraph\n')
+        orig, sys.stdout = sys.stdout, BytesIO()
+        try:
+            ret = run_on_server([src, dest], self.info_path)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = orig
+        self.ae(ret, 0)
+        self.assertIn(b'Output saved to', output)
+        with open(dest, 'rb') as f:
+            raw = f.read()
+        self.assertIn(b'Another paragraph', raw)
+        ret, output = self.request(os.path.join(self.tdir, 'missing.txt'), dest)
+        self.assertNotEqual(ret, 0)
+
+    def test_worker_crash(self):
+        ret, output = self.request('crash')
+        self.ae(ret, 1)
+        self.assertIn(b'crashed', output)
+        # The crashed pool is replaced by a working one
+        self.ae(self.request('sleep', '0'), (0, b''))
+
+    def test_stop_server(self):
+        client = Client(('convert', ('sleep', '30'), self.tdir), self.info_path)
+        client.start()
+        self.wait_for_pending()
+        stop_server(self.info_path)
+        self.server_thread.join(10)
+        self.assertFalse(self.server_thread.is_alive())
+        # Conversions that are running when the server stops get an error
+        client.join(10)
+        self.assertFalse(client.is_alive())
+        self.ae(client.result[0], 1)
+        self.assertIn(b'shutting down', client.result[1])
+        self.assertFalse(os.path.exists(self.info_path))
+        self.assertRaises(SystemExit, stop_server, self.info_path)
+
+
+def find_tests():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(ConversionServerTest)
+
+
+class TestRunner(unittest.main):
+
+    def createTests(self):
+        self.test = find_tests()
+
+
+def run(verbosity=4):
+    TestRunner(verbosity=verbosity, exit=False)
+
+
+if __name__ == '__main__':
+    run()
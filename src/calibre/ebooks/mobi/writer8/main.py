@@ -25,6 +25,7 @@ from calibre.ebooks.oeb.base import (OEB_DOCS, OEB_STYLES, SVG_MIME, XPath,
         extract, XHTML, urlnormalize)
 from calibre.ebooks.oeb.normalize_css import condense_sheet
 from calibre.ebooks.oeb.parse_utils import barename
+from calibre.ebooks.oeb.stylizer import stylesheet_cache
 from calibre.ebooks.mobi.writer8.skeleton import Chunker, aid_able_tags, to_href
 from calibre.ebooks.mobi.writer8.index import (NCXIndex, SkelIndex,
         ChunkIndex, GuideIndex, NonLinearNCXIndex)
@@ -151,6 +152,7 @@ class KF8Writer(object):
                 sheet = self.data(item)
                 replacer = partial(pointer, item)
                 cssutils.replaceUrls(sheet, replacer, ignoreImportRules=True)
+                stylesheet_cache(self.oeb).invalidate(sheet)
 
     def extract_css_into_flows(self):
         inlines = defaultdict(list)  # Ensure identical <style>s not repeated
@@ -0,0 +1,227 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+# Compute the styles of the HTML files of a book in worker processes. The
+# workers get the flattened stylesheets of the book once, then each job is the
+# serialized tree of one HTML file, for which the worker returns the tree (the
+# Stylizer modifies it a little) and the dump of its Stylizer.
+
+import os, logging
+from functools import partial
+
+from cssutils import CSSParser, parseString
+from cssutils.css import CSSStyleSheet
+from lxml import etree
+
+from calibre.ebooks.oeb.base import OEB_STYLES, XHTML_MIME
+from calibre.utils.logging import Log, Stream
+
+# The book reconstructed in a worker process, reused for all the jobs that
+# share the same common data
+worker_book = None
+
+
+class Recorder(Stream):
+
+    def __init__(self):
+        Stream.__init__(self)
+        self.messages = []
+
+    def prints(self, level, *args, **kwargs):
+        self.messages.append((level, ' '.join(a if isinstance(a, unicode) else unicode(a) for a in args)))
+
+
+class WorkerOpts(object):
+
+    def __init__(self, output_profile, change_justification):
+        self.output_profile, self.change_justification = output_profile, change_justification
+
+
+def find_profile(kind, short_name):
+    from calibre.customize.ui import input_profiles, output_profiles
+    for profile in (input_profiles if kind == 'input' else output_profiles)():
+        if profile.short_name == short_name:
+            return profile
+    raise KeyError('No %s profile named %s' % (kind, short_name))
+
+
+def profile_spec(profile):
+    from calibre.customize.profiles import InputProfile
+    if profile is None:
+        return None
+    return ('input' if isinstance(profile, InputProfile) else 'output', profile.short_name)
+
+
+def pickleable_flattened(flattened):
+    # The selectors are not needed to match the rules, and the font face rules
+    # are re-parsed from their text
+    rules, page_styles, font_face_rules, count = flattened
+    return [r[:2] + (None,) + r[3:] for r in rules], page_styles, [r.cssText for r in font_face_rules], count
+
+
+def restored_flattened(flattened, stylesheet):
+    rules, page_styles, font_face_rules, count = flattened
+    return rules, page_styles, [parseString(text, validate=False).cssRules[0] for text in font_face_rules], count
+
+
+def common_data(oeb, opts, profile, user_css, extra_css):
+    ''' The stylesheets of the book, already flattened into rules, so that the
+    workers do not need to parse and flatten them again. This also fills the
+    StylesheetCache of oeb. '''
+    from calibre.ebooks.oeb.stylizer import Stylizer, stylesheet_cache
+    stylizer = Stylizer.__new__(Stylizer)
+    stylizer.setup(oeb, opts, profile)
+    cache = stylesheet_cache(oeb)
+    parser = CSSParser(fetcher=stylizer._fetch_css_file, log=logging.getLogger('calibre.css'))
+    stylesheets, extra_stylesheets = [], []
+    for item in oeb.manifest.values():
+        if item.media_type in OEB_STYLES and hasattr(item.data, 'cssRules'):
+            stylesheets.append((item.id, item.href, item.media_type, item.data.href, pickleable_flattened(
+                cache.flatten(item.data, stylizer.flatten_key, stylizer.flatten_stylesheet))))
+    for w, text in (('extra_css', extra_css), ('user_css', user_css)):
+        if text:
+            try:
+                sheet = cache.parse((w, text), partial(parser.parseString, text, validate=False))
+            except Exception:
+                # Let the worker report the error
+                continue
+            extra_stylesheets.append((w, text, pickleable_flattened(
+                cache.flatten(sheet, stylizer.flatten_key, stylizer.flatten_stylesheet))))
+    return {
+        'token': os.urandom(16),
+        'stylesheets': stylesheets,
+        'extra_stylesheets': extra_stylesheets,
+        'profile': profile_spec(profile),
+        'output_profile': opts.output_profile.short_name,
+        'change_justification': opts.change_justification,
+        'plumber_output_format': getattr(oeb, 'plumber_output_format', ''),
+        'user_css': user_css, 'extra_css': extra_css,
+    }
+
+
+def book_from_common_data(data):
+    from calibre.ebooks.oeb.base import OEBBook
+    from calibre.ebooks.oeb.stylizer import Stylizer, stylesheet_cache
+    recorder = Recorder()
+    log = Log(level=Log.DEBUG)
+    log.outputs = [recorder]
+    oeb = OEBBook(log, None)
+    oeb.plumber_output_format = data['plumber_output_format']
+    profile = data['profile']
+    if profile is not None:
+        profile = find_profile(*profile)
+    opts = WorkerOpts(find_profile('output', data['output_profile']), data['change_justification'])
+    stylizer = Stylizer.__new__(Stylizer)
+    stylizer.setup(oeb, opts, profile)
+    cache = stylesheet_cache(oeb)
+    # The stylesheets are empty, the Stylizer only uses their flattened rules
+    for id_, href, media_type, sheet_href, flattened in data['stylesheets']:
+        sheet = CSSStyleSheet(href=sheet_href)
+        oeb.manifest.add(id_, href, media_type, data=sheet)
+        cache.flatten(sheet, stylizer.flatten_key, partial(restored_flattened, flattened))
+    for w, text, flattened in data['extra_stylesheets']:
+        sheet = cache.parse((w, text), CSSStyleSheet)
+        cache.flatten(sheet, stylizer.flatten_key, partial(restored_flattened, flattened))
+    return data['token'], oeb, opts, profile, recorder
+
+
+def stylize(id_, href, raw, common_data=None):
+    ' Run in a worker process by the Pool '
+    global worker_book
+    from calibre.ebooks.oeb.stylizer import Stylizer
+    if worker_book is None or worker_book[0] != common_data['token']:
+        worker_book = book_from_common_data(common_data)
+    token, oeb, opts, profile, recorder = worker_book
+    del recorder.messages[:]
+    tree = etree.fromstring(raw)
+    item = oeb.manifest.add(id_, href, XHTML_MIME, data=tree)
+    try:
+        stylizer = Stylizer(tree, href, oeb, opts, profile,
+                user_css=common_data['user_css'], extra_css=common_data['extra_css'])
+        return etree.tostring(tree, encoding='utf-8'), stylizer.dump(tree), recorder.messages[:]
+    finally:
+        oeb.manifest.remove(item)
+
+
+def stylize_in_parallel(oeb, items, opts, profile=None, max_workers=None, user_css='', extra_css=''):
+    ''' Create the Stylizers for the specified HTML items using a pool of
+    worker processes. Returns a mapping of item to Stylizer. The trees of the
+    items are replaced by the trees the Stylizers were created for. Items for
+    which the styles could not be computed in a worker are left out, and must
+    be styled in this process instead. '''
+    from calibre.ebooks.oeb.stylizer import Stylizer
+    from calibre.utils.ipc.pool import Pool, Failure
+    ans, pending = {}, {}
+    pool = Pool(max_workers=max_workers, name='Stylizer')
+    try:
+        pool.set_common_data(common_data(oeb, opts, profile, user_css, extra_css))
+        for i, item in enumerate(items):
+            pending[i] = item
+            pool(i, 'calibre.ebooks.oeb.parallel', 'stylize', item.id, item.href, etree.tostring(item.data, encoding='utf-8'))
+        results = {}
+        while len(results) < len(pending):
+            result = pool.results.get()
+            if result.is_terminal_failure:
+                raise Failure(pool.terminal_failure)
+            results[result.id] = result.result
+    except Failure as err:
+        oeb.log.warn('Failed to compute styles in worker processes, computing them here instead. Error: %s' % err.failure_message)
+        oeb.log.debug(err.details)
+        return ans
+    finally:
+        pool.shutdown()
+    # Merge the results in the order of the items, so that the log and the
+    # trees are the same as when styling in a single process
+    for i in sorted(results):
+        item, result = pending[i], results[i]
+        if result.err:
+            oeb.log.warn('Failed to compute the styles of %s in a worker process, computing them here instead. Error: %s' % (item.href, result.err))
+            oeb.log.debug(result.traceback)
+            continue
+        raw, dump, messages = result.value
+        for level, msg in messages:
+            oeb.log.prints(level, msg)
+        item.data = tree = etree.fromstring(raw)
+        ans[item] = Stylizer.from_dump(dump, tree, oeb, opts, profile)
+    return ans
+
+
+def benchmark(paths, max_workers=None, extra_css=None):
+    ''' Compare the time taken to compute the styles of all the documents in
+    the specified EPUB files in this process and in worker processes. Run
+    with: calibre-debug -c "from calibre.ebooks.oeb.parallel import *;
+    benchmark(['book.epub'], 4)" '''
+    from calibre.ebooks.conversion.plumber import Plumber, create_oebbook
+    from calibre.ebooks.oeb.base import OEB_DOCS
+    from calibre.ebooks.oeb.polish.container import get_container
+    from calibre.ebooks.oeb.stylizer import Stylizer
+    from calibre.utils.logging import default_log
+    from calibre.utils.monotonic import monotonic
+    if extra_css:
+        with open(extra_css, 'rb') as f:
+            extra_css = f.read().decode('utf-8')
+    for path in paths:
+        container = get_container(path)
+        opf = container.name_to_abspath(container.opf_name)
+        plumber = Plumber(opf, opf.rpartition('.')[0] + '.epub', default_log)
+        plumber.setup_options()
+        times, results = [], []
+        for parallel in (False, True):
+            oeb = create_oebbook(default_log, opf, plumber.opts)
+            items = [item for item in oeb.spine if item.media_type in OEB_DOCS]
+            start = monotonic()
+            stylizers = stylize_in_parallel(oeb, items, plumber.opts, max_workers=max_workers, extra_css=extra_css) if parallel else {}
+            for item in items:
+                if item not in stylizers:
+                    stylizers[item] = Stylizer(item.data, item.href, oeb, plumber.opts, extra_css=extra_css)
+            times.append(monotonic() - start)
+            results.append([[stylizers[item].style(elem).cssdict() for elem in item.data.iter('*')] for item in items])
+        if results[0] != results[1]:
+            raise SystemExit('The worker processes computed different styles for: %s' % path)
+        print('%-50s documents: %-4d in process: %.3fs in workers: %.3fs speedup: %.1fx' % (
+            os.path.basename(path)[:50], len(items), times[0], times[1], times[0] / max(times[1], 1e-9)))
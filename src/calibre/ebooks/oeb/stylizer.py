@@ -9,7 +9,8 @@ __license__   = 'GPL v3'
 __copyright__ = '2008, Marshall T. Vandegrift <llasram@gmail.com>'
 
 import os, re, logging, copy, unicodedata
-from weakref import WeakKeyDictionary
+from functools import partial
+from weakref import WeakKeyDictionary, ref
 from xml.dom import SyntaxErr as CSSSyntaxError
 from cssutils.css import (CSSStyleRule, CSSPageRule, CSSFontFaceRule,
         cssproperties, CSSRule)
@@ -19,7 +20,7 @@ from calibre import force_unicode, as_unicode
 from calibre.ebooks import unit_convert
 from calibre.ebooks.oeb.base import XHTML, XHTML_NS, CSS_MIME, OEB_STYLES, xpath, urlnormalize
 from calibre.ebooks.oeb.normalize_css import DEFAULTS, normalizers
-from css_selectors import Select, SelectorError, INAPPROPRIATE_PSEUDO_CLASSES
+from css_selectors import Select, SelectorError, RuleIndex, rule_index_key, INAPPROPRIATE_PSEUDO_CLASSES
 from tinycss.media3 import CSSMedia3Parser
 
 cssutils_log.setLevel(logging.WARN)
@@ -94,33 +95,68 @@ def test_media_ok():
     assert not media_ok('screen and (device-width:10px)')
 
 
+class StylesheetCache(object):
+
+    ''' The stylesheets used by the documents of a book, parsed and flattened
+    into rules. Stylesheets are usually shared by many documents, so this
+    avoids parsing and flattening them again for every document. Code that
+    changes a stylesheet of the book in place must call invalidate(). '''
+
+    def __init__(self):
+        self.parsed = {}
+        self.flattened = {}
+
+    def parse(self, key, parse):
+        ' Stylesheets that are not in the manifest, keyed by their contents '
+        try:
+            return self.parsed[key]
+        except KeyError:
+            ans = self.parsed[key] = parse()
+            return ans
+
+    def flatten(self, stylesheet, key, flatten):
+        key = (id(stylesheet),) + key
+        entry = self.flattened.get(key)
+        if entry is None or entry[0]() is not stylesheet:
+            entry = self.flattened[key] = (ref(stylesheet, partial(self.stylesheet_deleted, key)), flatten(stylesheet))
+        return entry[1]
+
+    def stylesheet_deleted(self, key, wr):
+        entry = self.flattened.get(key)
+        if entry is not None and entry[0] is wr:
+            del self.flattened[key]
+
+    def invalidate(self, stylesheet=None):
+        if stylesheet is None:
+            self.parsed.clear(), self.flattened.clear()
+            return
+        for key, entry in tuple(self.flattened.iteritems()):
+            if entry[0]() is stylesheet:
+                del self.flattened[key]
+
+
+def stylesheet_cache(oeb):
+    try:
+        return Stylizer.STYLESHEETS[oeb]
+    except KeyError:
+        ans = Stylizer.STYLESHEETS[oeb] = StylesheetCache()
+        return ans
+
+
 class Stylizer(object):
     STYLESHEETS = WeakKeyDictionary()
+    use_rule_index = True
 
     def __init__(self, tree, path, oeb, opts, profile=None,
             extra_css='', user_css='', base_css=''):
-        self.oeb, self.opts = oeb, opts
-        self.profile = profile
-        if self.profile is None:
-            # Use the default profile. This should really be using
-            # opts.output_profile, but I don't want to risk changing it, as
-            # doing so might well have hard to debug font size effects.
-            from calibre.customize.ui import output_profiles
-            for x in output_profiles():
-                if x.short_name == 'default':
-                    self.profile = x
-                    break
-        if self.profile is None:
-            # Just in case the default profile is removed in the future :)
-            self.profile = opts.output_profile
-        self.body_font_size = self.profile.fbase
-        self.logger = oeb.logger
+        self.setup(oeb, opts, profile)
         item = oeb.manifest.hrefs[path]
         basename = os.path.basename(path)
         cssname = os.path.splitext(basename)[0] + '.css'
-        stylesheets = [html_css_stylesheet()]
+        cache = stylesheet_cache(oeb)
+        stylesheets = [(html_css_stylesheet(), None)]
         if base_css:
-            stylesheets.append(parseString(base_css, validate=False))
+            stylesheets.append((cache.parse(('base_css', base_css), partial(parseString, base_css, validate=False)), None))
         style_tags = xpath(tree, '//*[local-name()="style" or local-name()="link"]')
 
         # Add cssutils parsing profiles from output_profile
@@ -145,11 +181,9 @@ class Stylizer(object):
                         text += u'\n\n' + force_unicode(t, u'utf-8')
                 if text:
                     text = oeb.css_preprocessor(text)
-                    # We handle @import rules separately
-                    parser.setFetcher(lambda x: ('utf-8', b''))
-                    stylesheet = parser.parseString(text, href=cssname,
-                            validate=False)
-                    parser.setFetcher(self._fetch_css_file)
+                    # The URLs in the stylesheet are relative to the folder of the document
+                    stylesheet = cache.parse(('style', os.path.dirname(item.href), text), partial(
+                        self._parse_style_tag, parser, text, cssname, item))
                     for rule in stylesheet.cssRules:
                         if rule.type == rule.IMPORT_RULE:
                             ihref = item.abshref(rule.href)
@@ -163,14 +197,8 @@ class Stylizer(object):
                             if sitem.media_type not in OEB_STYLES:
                                 self.logger.warn('CSS @import of non-CSS file %r' % rule.href)
                                 continue
-                            stylesheets.append(sitem.data)
-                    for rule in tuple(stylesheet.cssRules.rulesOfType(CSSRule.PAGE_RULE)):
-                        stylesheet.cssRules.remove(rule)
-                    # Make links to resources absolute, since these rules will
-                    # be folded into a stylesheet at the root
-                    replaceUrls(stylesheet, item.abshref,
-                            ignoreImportRules=True)
-                    stylesheets.append(stylesheet)
+                            stylesheets.append((sitem.data, sitem.data.href))
+                    stylesheets.append((stylesheet, cssname))
             elif (elem.tag == XHTML('link') and elem.get('href') and
                   elem.get('rel', 'stylesheet').lower() == 'stylesheet' and
                   elem.get('type', CSS_MIME).lower() in OEB_STYLES and
@@ -189,40 +217,46 @@ class Stylizer(object):
                     'Stylesheet %r referenced by file %r is not CSS'%(path,
                         item.href))
                     continue
-                stylesheets.append(sitem.data)
+                stylesheets.append((sitem.data, sitem.data.href))
         csses = {'extra_css':extra_css, 'user_css':user_css}
         for w, x in csses.items():
             if x:
                 try:
                     text = x
-                    stylesheet = parser.parseString(text, href=cssname,
-                            validate=False)
-                    stylesheets.append(stylesheet)
+                    stylesheet = cache.parse((w, text), partial(parser.parseString, text, href=cssname, validate=False))
+                    stylesheets.append((stylesheet, cssname))
                 except:
                     self.logger.exception('Failed to parse %s, ignoring.'%w)
                     self.logger.debug('Bad css: ')
                     self.logger.debug(x)
         rules = []
+        rule_index_keys = {}
         index = 0
         self.stylesheets = set()
         self.page_rule = {}
-        for sheet_index, stylesheet in enumerate(stylesheets):
-            href = stylesheet.href
+        for sheet_index, (stylesheet, href) in enumerate(stylesheets):
             self.stylesheets.add(href)
-            for rule in stylesheet.cssRules:
-                if rule.type == rule.MEDIA_RULE:
-                    if media_ok(rule.media.mediaText):
-                        for subrule in rule.cssRules:
-                            rules.extend(self.flatten_rule(subrule, href, index, is_user_agent_sheet=sheet_index==0))
-                            index += 1
-                else:
-                    rules.extend(self.flatten_rule(rule, href, index, is_user_agent_sheet=sheet_index==0))
-                    index = index + 1
+            sheet_rules, page_styles, font_face_rules, num_rules = cache.flatten(stylesheet, self.flatten_key, self.flatten_stylesheet)
+            precedence = 0 if sheet_index == 0 else 1  # The user agent stylesheet
+            for specificity, rule_index, selector, style, text, key in sheet_rules:
+                rules.append(((precedence,) + specificity + (index + rule_index,), selector, style, text, href))
+                rule_index_keys[text] = key
+            for style in page_styles:
+                self.page_rule.update(style)
+            self.font_face_rules.extend(font_face_rules)
+            index += num_rules
         rules.sort()
         self.rules = rules
         self._styles = {}
         pseudo_pat = re.compile(ur':{1,2}(%s)' % ('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
         select = Select(tree, ignore_inappropriate_pseudo_classes=True)
+        if self.use_rule_index:
+            # Only run the selectors of the rules that could match elements of
+            # this document
+            rule_index = RuleIndex()
+            for rule in rules:
+                rule_index.add(rule_index_keys[rule[3]], rule)
+            rules = rule_index.candidates(select)
 
         for _, _, cssdict, text, _ in rules:
             fl = pseudo_pat.search(text)
@@ -289,6 +323,59 @@ class Stylizer(object):
                 if upd:
                     style._update_cssdict(upd)
 
+    def setup(self, oeb, opts, profile):
+        self.oeb, self.opts = oeb, opts
+        self.profile = profile
+        if self.profile is None:
+            # Use the default profile. This should really be using
+            # opts.output_profile, but I don't want to risk changing it, as
+            # doing so might well have hard to debug font size effects.
+            from calibre.customize.ui import output_profiles
+            for x in output_profiles():
+                if x.short_name == 'default':
+                    self.profile = x
+                    break
+        if self.profile is None:
+            # Just in case the default profile is removed in the future :)
+            self.profile = opts.output_profile
+        self.body_font_size = self.profile.fbase
+        self.logger = oeb.logger
+        # The flattened rules depend on the font sizes of the profile and on
+        # the change_justification option
+        self.flatten_key = (self.__class__, self.profile, self.opts.change_justification)
+
+    def dump(self, tree):
+        ''' Return the styles computed for tree in a form that can be pickled,
+        so that they can be computed in a worker process and restored with
+        :meth:`from_dump` for a copy of tree. '''
+        positions = {elem:i for i, elem in enumerate(tree.iter('*'))}
+        return {
+            'styles': sorted((positions[elem], style._style, style._pseudo_classes) for elem, style in self._styles.iteritems()),
+            'page_rule': self.page_rule,
+            'font_face_rules': [r.cssText for r in self.font_face_rules],
+            'stylesheets': sorted(self.stylesheets),
+        }
+
+    @classmethod
+    def from_dump(cls, dump, tree, oeb, opts, profile=None):
+        ''' Create a Stylizer for tree from the output of :meth:`dump`,
+        without running any selectors. The rules of the stylesheets are not
+        restored, so :meth:`stylesheet` returns nothing. '''
+        self = cls.__new__(cls)
+        self.setup(oeb, opts, profile)
+        cache = stylesheet_cache(oeb)
+        self.rules = []
+        self.stylesheets = set(dump['stylesheets'])
+        self.page_rule = dump['page_rule']
+        self.font_face_rules = [cache.parse(('font_face', text), partial(parseString, text, validate=False)).cssRules[0]
+                                for text in dump['font_face_rules']]
+        self._styles = {}
+        elements = tuple(tree.iter('*'))
+        for i, cssdict, pseudo_classes in dump['styles']:
+            style = Style(elements[i], self)
+            style._style, style._pseudo_classes = cssdict, pseudo_classes
+        return self
+
     def _fetch_css_file(self, path):
         hrefs = self.oeb.manifest.hrefs
         if path not in hrefs:
@@ -301,26 +388,52 @@ class Stylizer(object):
         data = item.data.cssText
         return ('utf-8', data)
 
-    def flatten_rule(self, rule, href, index, is_user_agent_sheet=False):
-        results = []
-        sheet_index = 0 if is_user_agent_sheet else 1
+    def _parse_style_tag(self, parser, text, cssname, item):
+        # We handle @import rules separately
+        parser.setFetcher(lambda x: ('utf-8', b''))
+        stylesheet = parser.parseString(text, href=cssname,
+                validate=False)
+        parser.setFetcher(self._fetch_css_file)
+        for rule in tuple(stylesheet.cssRules.rulesOfType(CSSRule.PAGE_RULE)):
+            stylesheet.cssRules.remove(rule)
+        # Make links to resources absolute, since these rules will
+        # be folded into a stylesheet at the root
+        replaceUrls(stylesheet, item.abshref,
+                ignoreImportRules=True)
+        return stylesheet
+
+    def flatten_stylesheet(self, stylesheet):
+        ''' Return the style rules of stylesheet, with the index of each rule
+        in it and its key in the RuleIndex, the styles of its page rules, its font face rules and the
+        number of rules. These do not depend on the document, and so are
+        cached in the StylesheetCache of the book. '''
+        rules, page_styles, font_face_rules = [], [], []
+        index = 0
+        for rule in stylesheet.cssRules:
+            if rule.type == rule.MEDIA_RULE:
+                if media_ok(rule.media.mediaText):
+                    for subrule in rule.cssRules:
+                        self.flatten_rule(subrule, index, rules, page_styles, font_face_rules)
+                        index += 1
+            else:
+                self.flatten_rule(rule, index, rules, page_styles, font_face_rules)
+                index = index + 1
+        return rules, page_styles, font_face_rules, index
+
+    def flatten_rule(self, rule, index, rules, page_styles, font_face_rules):
         if isinstance(rule, CSSStyleRule):
             style = self.flatten_style(rule.style)
             for selector in rule.selectorList:
-                specificity = (sheet_index,) + selector.specificity + (index,)
                 text = selector.selectorText
-                selector = list(selector.seq)
-                results.append((specificity, selector, style, text, href))
+                rules.append((selector.specificity, index, list(selector.seq), style, text, rule_index_key(text)))
         elif isinstance(rule, CSSPageRule):
-            style = self.flatten_style(rule.style)
-            self.page_rule.update(style)
+            page_styles.append(self.flatten_style(rule.style))
         elif isinstance(rule, CSSFontFaceRule):
             if rule.style.length > 1:
                 # Ignore the meaningless font face rules generated by the
                 # benighted MS Word that contain only a font-family declaration
                 # and nothing else
-                self.font_face_rules.append(rule)
-        return results
+                font_face_rules.append(rule)
 
     def flatten_style(self, cssstyle):
         style = {}
@@ -775,3 +888,45 @@ class Style(object):
     @property
     def is_hidden(self):
         return self._style.get('display') == 'none' or self._style.get('visibility') == 'hidden'
+
+
+def benchmark_rule_index(paths, extra_css=None, repeat=3):
+    ''' Compare the time taken to style all the documents in the specified
+    EPUB files, with and without the RuleIndex. extra_css is the path to a
+    large stylesheet, such as a CSS framework, to apply to every document. Run
+    with: calibre-debug -c "from calibre.ebooks.oeb.stylizer import *;
+    benchmark_rule_index(['book.epub'], 'framework.css')" '''
+    from calibre.ebooks.conversion.plumber import Plumber, create_oebbook
+    from calibre.ebooks.oeb.base import OEB_DOCS
+    from calibre.ebooks.oeb.polish.container import get_container
+    from calibre.utils.logging import default_log
+    from calibre.utils.monotonic import monotonic
+    if extra_css:
+        with open(extra_css, 'rb') as f:
+            extra_css = f.read().decode('utf-8')
+    for path in paths:
+        container = get_container(path)
+        opf = container.name_to_abspath(container.opf_name)
+        plumber = Plumber(opf, opf.rpartition('.')[0] + '.epub', default_log)
+        plumber.setup_options()
+        oeb = create_oebbook(default_log, opf, plumber.opts)
+        items = [item for item in oeb.spine if item.media_type in OEB_DOCS]
+        times, results = [], []
+        for use_rule_index in (False, True):
+            Stylizer.use_rule_index = use_rule_index
+            # Parse and flatten the stylesheets before timing
+            for item in items:
+                Stylizer(item.data, item.href, oeb, plumber.opts, extra_css=extra_css)
+            start = monotonic()
+            for i in xrange(repeat):
+                ans = []
+                for item in items:
+                    stylizer = Stylizer(item.data, item.href, oeb, plumber.opts, extra_css=extra_css)
+                    ans.append([stylizer.style(elem).cssdict() for elem in item.data.iter('*')])
+            times.append(monotonic() - start)
+            results.append(ans)
+        Stylizer.use_rule_index = True
+        if results[0] != results[1]:
+            raise SystemExit('The rule index changed the styles of: %s' % path)
+        print('%-50s documents: %-4d without index: %.3fs with index: %.3fs speedup: %.1fx' % (
+            os.path.basename(path)[:50], len(items), times[0], times[1], times[0] / max(times[1], 1e-9)))
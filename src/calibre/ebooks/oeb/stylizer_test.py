@@ -0,0 +1,173 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+import cPickle, unittest
+
+from cssutils import parseString
+from lxml import etree
+
+from calibre.ebooks.oeb.base import CSS_MIME, XHTML_MIME, OEBBook
+from calibre.ebooks.oeb.stylizer import Stylizer, stylesheet_cache
+from calibre.utils.logging import Log
+
+CSS = '''
+p { color: red; text-align: justify; font-size: large }
+p:first-line { font-size: 2em }
+.c { color: green }
+@font-face { font-family: Test; src: url(test.ttf) }
+@page { margin: 1in }
+'''
+
+
+def html(body, style=''):
+    return (
+        '<html xmlns="http://www.w3.org/1999/xhtml"><head><link rel="stylesheet" href="style.css"/>'
+        '<style type="text/css">%s</style></head><body>%s</body></html>' % (style, body))
+
+
+class Opts(object):
+
+    def __init__(self, change_justification='original'):
+        from calibre.customize.ui import output_profiles
+        self.output_profile = [p for p in output_profiles() if p.short_name == 'default'][0]
+        self.change_justification = change_justification
+
+
+class CountingStylizer(Stylizer):
+
+    flattened = []
+
+    def flatten_stylesheet(self, stylesheet):
+        self.flattened.append(stylesheet)
+        return Stylizer.flatten_stylesheet(self, stylesheet)
+
+
+def create_book(*docs):
+    log = Log(level=Log.ERROR)
+    oeb = OEBBook(log, None)
+    oeb.manifest.add('css', 'style.css', CSS_MIME, data=parseString(CSS, href='style.css', validate=False))
+    for i, doc in enumerate(docs):
+        oeb.manifest.add('doc%d' % i, 'doc%d.html' % i, XHTML_MIME, data=etree.fromstring(doc))
+    return oeb
+
+
+def styles(stylizer, tree):
+    return [(stylizer.style(elem).cssdict(), stylizer.style(elem)._pseudo_classes) for elem in tree.iter('*')]
+
+
+class StylizerTest(unittest.TestCase):
+
+    ae = unittest.TestCase.assertEqual
+
+    def stylizer(self, oeb, href, opts=None, profile=None, cls=Stylizer, **kw):
+        return cls(oeb.manifest.hrefs[href].data, href, oeb, opts or Opts(), profile, **kw)
+
+    def test_stylesheet_cache_reuse(self):
+        oeb = create_book(html('<p>one</p>', 'b { color: blue }'), html('<p class="c">two</p>', 'b { color: blue }'))
+        del CountingStylizer.flattened[:]
+        s1 = self.stylizer(oeb, 'doc0.html', cls=CountingStylizer, extra_css='i { color: red }')
+        # The user agent stylesheet, style.css, the <style> tag and the extra css
+        self.ae(len(CountingStylizer.flattened), 4)
+        css = oeb.manifest.hrefs['style.css'].data
+        self.assertIn(css, CountingStylizer.flattened)
+        del CountingStylizer.flattened[:]
+        s2 = self.stylizer(oeb, 'doc1.html', cls=CountingStylizer, extra_css='i { color: red }')
+        self.ae(CountingStylizer.flattened, [])
+        self.ae(len(stylesheet_cache(oeb).parsed), 2)
+        p1, p2 = oeb.manifest.hrefs['doc0.html'].data[1][0], oeb.manifest.hrefs['doc1.html'].data[1][0]
+        self.ae(s1.style(p1)['color'], 'red')
+        self.ae(s2.style(p2)['color'], 'green')
+        self.ae(len(s1.font_face_rules), 1)
+        self.ae(len(s2.font_face_rules), 1)
+
+    def test_stylesheet_cache_invalidate(self):
+        oeb = create_book(html('<p>one</p>'))
+        p = oeb.manifest.hrefs['doc0.html'].data[1][0]
+        self.ae(self.stylizer(oeb, 'doc0.html').style(p)['color'], 'red')
+        css = oeb.manifest.hrefs['style.css'].data
+        css.cssRules[0].style['color'] = 'blue'
+        # Changes made in place are not seen until the stylesheet is invalidated
+        self.ae(self.stylizer(oeb, 'doc0.html').style(p)['color'], 'red')
+        stylesheet_cache(oeb).invalidate(css)
+        self.ae(self.stylizer(oeb, 'doc0.html').style(p)['color'], 'blue')
+        css.cssRules[0].style['color'] = 'green'
+        stylesheet_cache(oeb).invalidate()
+        self.ae(self.stylizer(oeb, 'doc0.html').style(p)['color'], 'green')
+        # Replacing the stylesheet object needs no invalidation
+        oeb.manifest.hrefs['style.css'].data = parseString('p { color: yellow }', href='style.css', validate=False)
+        self.ae(self.stylizer(oeb, 'doc0.html').style(p)['color'], 'yellow')
+
+    def test_stylesheet_cache_keys(self):
+        from calibre.customize.ui import output_profiles
+        oeb = create_book(html('<p>one</p>'))
+        p = oeb.manifest.hrefs['doc0.html'].data[1][0]
+        css = oeb.manifest.hrefs['style.css'].data
+        cache = stylesheet_cache(oeb)
+
+        def keys():
+            return {k[1:] for k in cache.flattened if k[0] == id(css)}
+
+        s = self.stylizer(oeb, 'doc0.html')
+        self.ae(s.style(p)['text-align'], 'justify')
+        self.ae(keys(), {s.flatten_key})
+        s = self.stylizer(oeb, 'doc0.html', opts=Opts('left'))
+        self.ae(s.style(p)['text-align'], 'left')
+        self.ae(len(keys()), 2)
+        self.assertIn(s.flatten_key, keys())
+        other = [x for x in output_profiles() if x.fnames['large'] != s.profile.fnames['large']][0]
+        s = self.stylizer(oeb, 'doc0.html', profile=other)
+        self.ae(s.style(p).cssdict()['font-size'], '%dpt' % other.fnames['large'])
+        self.ae(len(keys()), 3)
+        self.assertIn(s.flatten_key, keys())
+
+    def test_dump(self):
+        oeb = create_book(html('<p>one <b>bold</b></p><p class="c" style="margin: 1em">two</p>', 'b { font-weight: normal }'))
+        tree = oeb.manifest.hrefs['doc0.html'].data
+        s = self.stylizer(oeb, 'doc0.html', extra_css='b { color: blue }')
+        expected = styles(s, tree)
+        self.assertTrue(any(pseudo_classes for cssdict, pseudo_classes in expected))
+        dump = cPickle.loads(cPickle.dumps(s.dump(tree), -1))
+        tree = etree.fromstring(etree.tostring(tree))
+        r = Stylizer.from_dump(dump, tree, oeb, Opts())
+        self.ae(styles(r, tree), expected)
+        self.ae(r.page_rule, s.page_rule)
+        self.ae(r.page_rule['margin-top'], '1in')
+        self.ae([x.cssText for x in r.font_face_rules], [x.cssText for x in s.font_face_rules])
+        self.ae(len(r.font_face_rules), 1)
+        self.ae(r.stylesheets, s.stylesheets)
+
+    def test_stylize_in_parallel(self):
+        from calibre.ebooks.oeb.parallel import stylize_in_parallel
+        docs = (html('<p>one <b>bold</b></p>', 'b { font-weight: normal }'), html('<p class="c">two</p><div><p>three</p></div>'))
+        extra_css = 'div p { color: blue }'
+        oeb = create_book(*docs)
+        expected = [styles(self.stylizer(oeb, 'doc%d.html' % i, extra_css=extra_css), oeb.manifest.hrefs['doc%d.html' % i].data) for i in range(2)]
+        oeb = create_book(*docs)
+        items = [oeb.manifest.hrefs['doc%d.html' % i] for i in range(2)]
+        stylizers = stylize_in_parallel(oeb, items, Opts(), max_workers=2, extra_css=extra_css)
+        self.ae(set(stylizers), set(items))
+        for item, item_styles in zip(items, expected):
+            self.ae(styles(stylizers[item], item.data), item_styles)
+
+
+def find_tests():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(StylizerTest)
+
+
+class TestRunner(unittest.main):
+
+    def createTests(self):
+        self.test = find_tests()
+
+
+def run(verbosity=4):
+    TestRunner(verbosity=verbosity, exit=False)
+
+
+if __name__ == '__main__':
+    run()
@@ -14,6 +14,7 @@ from lxml import etree
 
 from calibre import guess_type
 from calibre.ebooks.oeb.base import XPath, CSS_MIME, XHTML
+from calibre.ebooks.oeb.stylizer import stylesheet_cache
 from calibre.ebooks.oeb.transforms.subset import get_font_properties, find_font_face_rules, elem_style
 from calibre.utils.filenames import ascii_filename
 from calibre.utils.fonts.scanner import font_scanner, NoFonts
@@ -208,6 +209,7 @@ class EmbedFonts(object):
                 rule.style.setProperty('src', 'url(%s)' % href)
                 ff_rules.append(find_font_face_rules(sheet, self.oeb)[0])
                 page_sheet.data.insertRule(rule, len(page_sheet.data.cssRules))
+                stylesheet_cache(self.oeb).invalidate(page_sheet.data)
 
     def embed_font(self, style):
         from calibre.ebooks.oeb.polish.embed import find_matching_font, weight_as_number
@@ -239,6 +241,7 @@ class EmbedFonts(object):
                 f['font-family'], f['font-weight'], f['font-style'], f['font-stretch'], href)
             sheet = self.parser.parseString(css, validate=False)
             page_sheet.data.insertRule(sheet.cssRules[0], len(page_sheet.data.cssRules))
+            stylesheet_cache(self.oeb).invalidate(page_sheet.data)
             return find_font_face_rules(sheet, self.oeb)[0]
 
         for f in fonts:
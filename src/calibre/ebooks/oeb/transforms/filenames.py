@@ -11,6 +11,7 @@ from urlparse import urldefrag, urlparse
 from lxml import etree
 
 from calibre.ebooks.oeb.base import rewrite_links, urlnormalize
+from calibre.ebooks.oeb.stylizer import stylesheet_cache
 
 
 class RenameFiles(object):  # {{{
@@ -36,6 +37,7 @@ class RenameFiles(object):  # {{{
                 rewrite_links(self.current_item.data, self.url_replacer)
             elif hasattr(item.data, 'cssText'):
                 cssutils.replaceUrls(item.data, self.url_replacer)
+                stylesheet_cache(oeb).invalidate(item.data)
 
         if self.oeb.guide:
             for ref in self.oeb.guide.values():
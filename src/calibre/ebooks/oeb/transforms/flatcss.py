@@ -17,9 +17,10 @@ from cssutils.css import Property
 from calibre import guess_type
 from calibre.ebooks.oeb.base import (XHTML, XHTML_NS, CSS_MIME, OEB_STYLES,
         namespace, barename, XPath)
-from calibre.ebooks.oeb.stylizer import Stylizer
+from calibre.ebooks.oeb.stylizer import Stylizer, stylesheet_cache
 from calibre.utils.filenames import ascii_filename, ascii_text
 from calibre.utils.icu import numeric_sort_key
+from calibre.utils.monotonic import monotonic
 
 COLLAPSE = re.compile(r'[ \t\r\n\v]+')
 STRIPNUM = re.compile(r'[-0-9]+$')
@@ -199,6 +200,7 @@ class CSSFlattener(object):
             if item.media_type in OEB_STYLES:
                 cssutils.replaceUrls(item.data, item.abshref,
                         ignoreImportRules=True)
+                stylesheet_cache(oeb).invalidate(item.data)
 
         self.body_font_family, self.embed_font_rules = self.get_embed_font_info(
                 self.opts.embed_font_family)
@@ -290,10 +292,18 @@ class CSSFlattener(object):
             if self.body_font_family:
                 bs.append(u'font-family: '+self.body_font_family)
             body.set('style', '; '.join(bs))
-            stylizer = Stylizer(html, item.href, self.oeb, self.context, profile,
-                    user_css=self.context.extra_css,
-                    extra_css=css)
-            self.stylizers[item] = stylizer
+        start = monotonic()
+        parallel_jobs = getattr(self.context, 'parallel_jobs', 0)
+        if parallel_jobs > 0 and self.items:
+            from calibre.ebooks.oeb.parallel import stylize_in_parallel
+            self.stylizers = stylize_in_parallel(self.oeb, self.items, self.context, profile,
+                    max_workers=parallel_jobs, user_css=self.context.extra_css, extra_css=css)
+        for item in self.items:
+            if item not in self.stylizers:
+                self.stylizers[item] = Stylizer(item.data, item.href, self.oeb, self.context, profile,
+                        user_css=self.context.extra_css,
+                        extra_css=css)
+        self.oeb.logger.debug('Computed the styles of %d HTML files in %.2f seconds' % (len(self.items), monotonic() - start))
 
     def baseline_node(self, node, stylizer, sizes, csize):
         csize = stylizer.style(node)['font-size']
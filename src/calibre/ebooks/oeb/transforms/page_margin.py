@@ -10,6 +10,7 @@ __docformat__ = 'restructuredtext en'
 from collections import Counter
 
 from calibre.ebooks.oeb.base import barename, XPath
+from calibre.ebooks.oeb.stylizer import stylesheet_cache
 
 
 class RemoveAdobeMargins(object):
@@ -77,6 +78,7 @@ class RemoveFakeMargins(object):
             except NegativeTextIndent:
                 self.log.debug('Negative text indent detected at level '
                         ' %s, ignoring this level'%level)
+        stylesheet_cache(self.oeb).invalidate(stylesheet)
 
     def get_margins(self, elem):
         cls = elem.get('class', None)
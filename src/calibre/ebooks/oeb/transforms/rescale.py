@@ -7,6 +7,7 @@ __copyright__ = '2009, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
 from calibre import fit_image
+from calibre.ebooks.conversion.profiling import pipeline_stage
 
 
 class RescaleImages(object):
@@ -18,7 +19,8 @@ class RescaleImages(object):
 
     def __call__(self, oeb, opts):
         self.oeb, self.opts, self.log = oeb, opts, oeb.log
-        self.rescale()
+        with pipeline_stage(opts, 'RescaleImages'):
+            self.rescale()
 
     def rescale(self):
         from PIL import Image
@@ -16,10 +16,12 @@ from lxml.etree import XPath as _XPath
 from lxml import etree
 
 from calibre import as_unicode
+from calibre.ebooks.conversion.profiling import pipeline_stage
 from calibre.ebooks.epub import rules
 from calibre.ebooks.oeb.base import (OEB_STYLES, XPNSMAP as NAMESPACES,
         urldefrag, rewrite_links, urlunquote, XHTML, urlnormalize)
 from calibre.ebooks.oeb.polish.split import do_split
+from calibre.ebooks.oeb.stylizer import stylesheet_cache
 from css_selectors import Select, SelectorError
 
 XPath = functools.partial(_XPath, namespaces=NAMESPACES)
@@ -59,11 +61,12 @@ class Split(object):
         self.log('Splitting markup on page breaks and flow limits, if any...')
         self.opts = opts
         self.map = {}
-        for item in list(self.oeb.manifest.items):
-            if item.spine_position is not None and etree.iselement(item.data):
-                self.split_item(item)
+        with pipeline_stage(opts, 'Split'):
+            for item in list(self.oeb.manifest.items):
+                if item.spine_position is not None and etree.iselement(item.data):
+                    self.split_item(item)
 
-        self.fix_links()
+            self.fix_links()
 
     def split_item(self, item):
         page_breaks, page_break_ids = [], []
@@ -101,6 +104,9 @@ class Split(object):
                             rule.style.removeProperty('page-break-after')
                 except:
                     pass
+            if self.remove_css_pagebreaks:
+                for sheet in stylesheets:
+                    stylesheet_cache(self.oeb).invalidate(sheet)
         page_breaks = set()
         select = Select(item.data)
         if not self.page_break_selectors:
@@ -10,6 +10,7 @@ __docformat__ = 'restructuredtext en'
 from collections import defaultdict
 
 from calibre.ebooks.oeb.base import urlnormalize
+from calibre.ebooks.oeb.stylizer import stylesheet_cache
 from calibre.utils.fonts.sfnt.subset import subset, NoGlyphs, UnsupportedFont
 from tinycss.fonts3 import parse_font_family
 
@@ -141,7 +142,9 @@ class SubsetFonts(object):
         def remove(font):
             totals[1] += len(font['item'].data)
             self.oeb.manifest.remove(font['item'])
-            font['rule'].parentStyleSheet.deleteRule(font['rule'])
+            sheet = font['rule'].parentStyleSheet
+            sheet.deleteRule(font['rule'])
+            stylesheet_cache(self.oeb).invalidate(sheet)
 
         fonts = {}
         for font in self.embedded_fonts:
@@ -23,7 +23,7 @@ from calibre.utils.serialize import MSGPACK_MIME, json_loads, msgpack_loads
 receive_data_methods = {'GET', 'POST'}
 
 
-@endpoint('/cdb/cmd/{which}/{version=0}', postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache')
+@endpoint('/cdb/cmd/{which}/{version=0}', postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache', writes_to_db=True)
 def cdb_run(ctx, rd, which, version):
     try:
         m = module_for_cmd(which)
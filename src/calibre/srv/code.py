@@ -21,8 +21,10 @@ from calibre.srv.errors import (
     BookNotFound, HTTPBadRequest, HTTPForbidden, HTTPNotFound
 )
 from calibre.srv.metadata import (
-    book_as_json, categories_as_json, categories_settings, icon_map
+    book_as_json, books_as_json, categories_as_json, categories_settings,
+    icon_map
 )
+from calibre.srv.metrics import request_metrics
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data, get_use_roman
 from calibre.utils.config import prefs, tweaks
@@ -61,6 +63,17 @@ def ajax_setup(ctx, rd):
 print_lock = Lock()
 
 
+@endpoint('/metrics', cache_control='no-cache')
+def metrics(ctx, rd):
+    '''
+    Statistics about the requests handled by the server, in the Prometheus
+    text format. When the server runs in multiple processes, each process has
+    its own statistics.
+    '''
+    rd.outheaders.set('Content-Type', 'text/plain; version=0.0.4; charset=UTF-8', replace_all=True)
+    return request_metrics.render()
+
+
 @endpoint('/console-print', methods=('POST', ))
 def console_print(ctx, rd):
     if not getattr(rd.opts, 'allow_console_print', False):
@@ -199,19 +212,13 @@ def get_library_init_data(ctx, rd, db, num, sorts, orders, vl):
         ans['field_metadata'] = db.field_metadata.all_metadata()
         ans['virtual_libraries'] = db._pref('virtual_libraries', {})
         ans['book_display_fields'] = get_field_list(db)
-        mdata = ans['metadata'] = {}
         try:
             extra_books = set(
                 int(x) for x in rd.query.get('extra_books', '').split(',')
             )
         except Exception:
             extra_books = ()
-        for coll in (ans['search_result']['book_ids'], extra_books):
-            for book_id in coll:
-                if book_id not in mdata:
-                    data = book_as_json(db, book_id)
-                    if data is not None:
-                        mdata[book_id] = data
+        ans['metadata'] = books_as_json(db, set(ans['search_result']['book_ids']) | set(extra_books))
     return ans
 
 
@@ -292,11 +299,7 @@ def more_books(ctx, rd):
         ans['search_result'] = search_result(
             ctx, rd, db, query, num, offset, sorts, orders, vl
         )
-        mdata = ans['metadata'] = {}
-        for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
-            if data is not None:
-                mdata[book_id] = data
+        ans['metadata'] = books_as_json(db, ans['search_result']['book_ids'])
 
     return ans
 
@@ -334,7 +337,6 @@ def get_books(ctx, rd):
     searchq = rd.query.get('search', '')
     db = get_library_data(ctx, rd)[0]
     ans = {}
-    mdata = ans['metadata'] = {}
     with db.safe_read_lock:
         try:
             ans['search_result'] = search_result(
@@ -344,10 +346,7 @@ def get_books(ctx, rd):
             # This must not be translated as it is used by the front end to
             # detect invalid search expressions
             raise HTTPBadRequest('Invalid search expression: %s' % as_unicode(err))
-        for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
-            if data is not None:
-                mdata[book_id] = data
+        ans['metadata'] = books_as_json(db, ans['search_result']['book_ids'])
     return ans
 
 
@@ -6,7 +6,7 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import os, errno
+import os, errno, hashlib
 from binascii import hexlify
 from io import BytesIO
 from threading import Lock
@@ -23,9 +23,13 @@ from calibre.ebooks.metadata.meta import set_metadata
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
 from calibre.library.save_to_disk import find_plugboard
 from calibre.srv.errors import HTTPNotFound, BookNotFound
+from calibre.srv.http_response import (
+    StaticOutput, guess_content_type, is_compressible, parse_if_none_match, precompress_files)
+from calibre.srv.metrics import request_metrics
 from calibre.srv.routes import endpoint, json
+from calibre.srv.thumbnails import (
+    is_fresh, render_thumbnail, shutdown_stores, thumbnail_quality, thumbnail_store)
 from calibre.srv.utils import http_date, get_db, get_use_roman
-from calibre.utils.config_base import tweaks
 from calibre.utils.date import timestampfromdt
 from calibre.utils.img import scale_image, image_from_data
 from calibre.utils.filenames import ascii_filename, atomic_rename
@@ -46,6 +50,7 @@ rename_counter = 0
 
 def reset_caches():
     mtimes.clear()
+    shutdown_stores()
 
 
 def open_for_write(fname):
@@ -109,6 +114,7 @@ def create_file_copy(ctx, rd, prefix, library_id, book_id, ext, mtime, copy_func
                 mtimes[bname] = mtime
                 copy_func(ans)
                 ans.seek(0)
+        request_metrics.cache_used('files', used_cache == 'yes')
         if ctx.testing:
             rd.outheaders['Used-Cache'] = used_cache
             rd.outheaders['Tempfile'] = hexlify(fname.encode('utf-8'))
@@ -146,17 +152,53 @@ def cover(ctx, rd, library_id, db, book_id, width=None, height=None):
         def copy_func(dest):
             db.copy_cover_to(book_id, dest)
     else:
+        store = thumbnail_store_for(ctx, rd, db, width, height)
+        if store is not None:
+            return stored_thumbnail(ctx, rd, store, db, book_id, width, height, timestampfromdt(mtime))
         prefix += '-%sx%s' % (width, height)
 
         def copy_func(dest):
             buf = BytesIO()
             db.copy_cover_to(book_id, buf)
-            quality = min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
-            data = scale_image(buf.getvalue(), width=width, height=height, compression_quality=quality)[-1]
-            dest.write(data)
+            dest.write(render_thumbnail(buf.getvalue(), width, height))
     return create_file_copy(ctx, rd, prefix, library_id, book_id, 'jpg', mtime, copy_func)
 
 
+def thumbnail_store_for(ctx, rd, db, width, height):
+    max_size = ctx.opts.max_thumbnail_cache_size
+    if max_size <= 0 or width is None or height is None:
+        return
+    # Keep the thumbnails of test servers with their library, so that they are
+    # deleted with it
+    return thumbnail_store(
+        db.library_id, width, height, max_size, location=db.backend.library_path if ctx.testing else None, process_name=ctx.thumbnail_store_name)
+
+
+def stored_thumbnail(ctx, rd, store, db, book_id, width, height, mtime):
+    etag = hashlib.sha1()
+    for x in (db.library_id, book_id, width, height, mtime, thumbnail_quality()):
+        etag.update(type('')(x).encode('utf-8'))
+    etag = '"%s"' % etag.hexdigest()
+    rd.outheaders.set('Content-Type', 'image/jpeg', replace_all=True)
+    none_match = parse_if_none_match(rd.inheaders.get('If-None-Match', ''))
+    if '*' in none_match or etag in none_match:
+        # The client already has the thumbnail, finalize_output() sends a 304
+        # response for the matching etag, so there is nothing to generate
+        return StaticOutput(b'', etag)
+    data, timestamp = store[book_id]
+    used_cache = 'yes'
+    if data is None or not is_fresh(timestamp, mtime):
+        buf = BytesIO()
+        db.copy_cover_to(book_id, buf)
+        data = render_thumbnail(buf.getvalue(), width, height)
+        store.insert(book_id, mtime, data)
+        used_cache = 'no'
+    request_metrics.cache_used('thumbnails', used_cache == 'yes')
+    if ctx.testing:
+        rd.outheaders['Used-Cache'] = used_cache
+    return StaticOutput(data, etag)
+
+
 def book_filename(rd, book_id, mi, fmt, as_encoded_unicode=False):
     au = authors_to_string(mi.authors or [_('Unknown')])
     title = mi.title or _('Unknown')
@@ -226,6 +268,36 @@ def static(ctx, rd, what):
         raise HTTPNotFound()
 
 
+class StaticPrecompressor(object):
+
+    ''' A server loop plugin that compresses the files of the browser
+    interface when the server starts, so that they are served already
+    compressed to the first clients. '''
+
+    def __init__(self):
+        self.stopped = False
+
+    def static_files(self):
+        base = P('content-server', allow_user_override=False)
+        for dirpath, dirnames, filenames in os.walk(base):
+            for name in filenames:
+                if self.stopped:
+                    return
+                path = os.path.relpath(os.path.join(dirpath, name), base).replace(os.sep, '/')
+                # The same paths as used by the static() and index() endpoints
+                path = P('content-server/' + path)
+                mt = guess_content_type(path)
+                if mt and is_compressible(mt):
+                    yield path
+
+    def start(self, loop):
+        if loop.opts.max_compressed_cache_size > 0 and loop.opts.compress_min_size > -1:
+            precompress_files(self.static_files(), loop.opts)
+
+    def stop(self):
+        self.stopped = True
+
+
 @endpoint('/favicon.png', auth_required=False, cache_control=24)
 def favicon(ctx, rd):
     return share_open(I('lt.png'), 'rb')
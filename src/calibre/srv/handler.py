@@ -6,11 +6,12 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import json
 from functools import partial
 from importlib import import_module
-from threading import Lock
+from threading import Event, Lock
 
 from calibre.srv.auth import AuthController
 from calibre.srv.errors import HTTPForbidden
-from calibre.srv.library_broker import LibraryBroker, path_for_db
+from calibre.srv.library_broker import LibraryBroker, canonicalize_path, path_for_db
+from calibre.srv.metrics import request_metrics
 from calibre.srv.routes import Router
 from calibre.srv.users import UserManager
 from calibre.utils.date import utcnow
@@ -22,8 +23,14 @@ class Context(object):
     log = None
     url_for = None
     jobs_manager = None
+    # Set when the server runs in multiple processes, see calibre.srv.prefork
+    forward_write = None
+    forwarded_requests_token = None
+    thumbnail_store_name = None
     CATEGORY_CACHE_SIZE = 25
     SEARCH_CACHE_SIZE = 100
+    ALLOWED_IDS_CACHE_SIZE = 100
+    SORT_CACHE_SIZE = 25
 
     def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self.opts = opts
@@ -36,6 +43,7 @@ class Context(object):
         self._notify_changes = notify_changes
 
     def notify_changes(self, library_path, change_event):
+        self.update_allowed_ids(library_path, change_event)
         if self._notify_changes is not None:
             self._notify_changes(library_path, change_event)
 
@@ -84,14 +92,59 @@ class Context(object):
         restriction = self.restriction_for(request_data, db)
         if restriction:
             try:
-                return book_id in db.search('', restriction=restriction)
+                return book_id in self.allowed_ids_for_restriction(db, restriction)
             except ParseException:
                 return False
         return db.has_id(book_id)
 
+    def allowed_ids_for_restriction(self, db, restriction):
+        ''' The ids of the books matching a per-user library restriction. These
+        are cached separately from the search cache, which is shared by all
+        searches, and updated incrementally by change events. '''
+        with self.lock:
+            cache = self.library_broker.allowed_ids_caches[db.server_library_id]
+            old = cache.pop(restriction, None)
+            if old is None or old[0] < db.clear_search_cache_count:
+                stamp = db.clear_search_cache_count
+                old = (stamp, frozenset(db.search('', restriction=restriction, as_id_set=True)))
+                if len(cache) >= self.ALLOWED_IDS_CACHE_SIZE:
+                    cache.popitem(last=False)
+                request_metrics.cache_used('restrictions', False)
+            else:
+                request_metrics.cache_used('restrictions', True)
+            cache[restriction] = old
+            return old[1]
+
+    def update_allowed_ids(self, library_path, change_event):
+        library_path = canonicalize_path(library_path)
+        for library_id, db in self.library_broker.loaded_dbs.items():
+            if db is not None and canonicalize_path(path_for_db(db)) == library_path:
+                break
+        else:
+            return
+        db = db.new_api
+        with self.lock:
+            cache = self.library_broker.allowed_ids_caches.get(library_id)
+            if not cache:
+                return
+            book_ids = getattr(change_event, 'book_ids', None)
+            if book_ids is None:
+                # Saved searches, which may be used by restrictions, changed
+                cache.clear()
+                return
+            stamp = db.clear_search_cache_count
+            existing = book_ids & db.all_book_ids(type=set)
+            for restriction, (old_stamp, allowed_ids) in tuple(cache.iteritems()):
+                try:
+                    matches = db.search('', restriction=restriction, book_ids=existing) if existing else ()
+                except ParseException:
+                    del cache[restriction]
+                    continue
+                cache[restriction] = (stamp, (allowed_ids - book_ids) | frozenset(matches))
+
     def get_allowed_book_ids_from_restriction(self, request_data, db):
         restriction = self.restriction_for(request_data, db)
-        return frozenset(db.search('', restriction=restriction)) if restriction else None
+        return self.allowed_ids_for_restriction(db, restriction) if restriction else None
 
     def allowed_book_ids(self, request_data, db):
         try:
@@ -131,8 +184,32 @@ class Context(object):
                 cache[key] = old = (utcnow(), categories)
                 if len(cache) > self.CATEGORY_CACHE_SIZE:
                     cache.popitem(last=False)
+                request_metrics.cache_used('categories', False)
             else:
                 cache[key] = old
+                request_metrics.cache_used('categories', True)
+            return old[1]
+
+    def get_category_index(self, request_data, db, category, create_index):
+        ''' The result of create_index() for the items of the specified
+        category, as returned by get_categories(). It is cached and created
+        again only when the categories are. '''
+        categories = self.get_categories(request_data, db)
+        if category not in categories:
+            return
+        # The cached value keeps categories alive, so its id is not re-used
+        key = id(categories), category
+        with self.lock:
+            cache = self.library_broker.category_index_caches[db.server_library_id]
+            old = cache.pop(key, None)
+            if old is None:
+                old = (categories, create_index(categories[category]))
+                if len(cache) >= self.CATEGORY_CACHE_SIZE:
+                    cache.popitem(last=False)
+                request_metrics.cache_used('category_index', False)
+            else:
+                request_metrics.cache_used('category_index', True)
+            cache[key] = old
             return old[1]
 
     def get_tag_browser(self, request_data, db, opts, render, vl=''):
@@ -149,8 +226,10 @@ class Context(object):
                 cache[key] = old = (utcnow(), data)
                 if len(cache) > self.CATEGORY_CACHE_SIZE:
                     cache.popitem(last=False)
+                request_metrics.cache_used('tag_browser', False)
             else:
                 cache[key] = old
+                request_metrics.cache_used('tag_browser', True)
             return old[1]
 
     def search(self, request_data, db, query, vl='', report_restriction_errors=False):
@@ -172,12 +251,86 @@ class Context(object):
                 cache[key] = old = (db.clear_search_cache_count, matches)
                 if len(cache) > self.SEARCH_CACHE_SIZE:
                     cache.popitem(last=False)
+                request_metrics.cache_used('search', False)
             else:
                 cache[key] = old
+                request_metrics.cache_used('search', True)
             if report_restriction_errors:
                 return old[1], None
             return old[1]
 
+    def sorted_book_ids(self, db, book_ids, sort_by, ascending=True):
+        ''' The specified books sorted by a single field. Sorting needs the
+        sort keys of all the books, so the result is cached, to make paging
+        through large numbers of books cheap. '''
+        key = frozenset(book_ids), sort_by, ascending
+        with self.lock:
+            cache = self.library_broker.sort_caches[db.server_library_id]
+            old = cache.pop(key, None)
+            if old is None or old[0] < db.clear_search_cache_count:
+                old = (db.clear_search_cache_count, tuple(db.multisort([(sort_by, ascending)], key[0])))
+                if len(cache) >= self.SORT_CACHE_SIZE:
+                    cache.popitem(last=False)
+                request_metrics.cache_used('sort', False)
+            else:
+                request_metrics.cache_used('sort', True)
+            cache[key] = old
+            return old[1]
+
+    def warm_up_library(self, library_id):
+        ''' Load the specified library and fill the caches used by the first
+        requests for it, with the default search, categories and sort orders of
+        the browser interface and the OPDS feeds. '''
+        db = self.library_broker.get(library_id)
+        if db is None:
+            return
+        rd = AnonymousRequest()
+        book_ids = self.search(rd, db, '')
+        self.get_categories(rd, db)
+        for sort_by, ascending in (('timestamp', False), ('title', True)):
+            self.sorted_book_ids(db, book_ids, sort_by, ascending)
+        return db
+
+
+class AnonymousRequest(object):
+
+    ' Stands in for the request data of an anonymous request '
+
+    username = None
+
+
+class LibraryWarmer(object):
+
+    ''' A server loop plugin that loads the libraries of the server in the
+    background when it starts, and closes the ones that have not been used
+    recently when the server uses too much memory. '''
+
+    PRUNE_INTERVAL = 60  # seconds
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.stopped = Event()
+
+    def start(self, loop):
+        broker = self.ctx.library_broker
+        if loop.opts.warm_up_libraries:
+            with broker:
+                library_ids = tuple(broker.lmap)
+            for library_id in library_ids:
+                if self.stopped.is_set():
+                    return
+                try:
+                    self.ctx.warm_up_library(library_id)
+                except Exception:
+                    loop.log.exception('Failed to load the library:', library_id)
+        max_memory = loop.opts.max_library_memory * 1024 * 1024
+        if max_memory > 0:
+            while not self.stopped.wait(self.PRUNE_INTERVAL):
+                broker.prune_loaded_dbs(max_memory)
+
+    def stop(self):
+        self.stopped.set()
+
 
 SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api')
 
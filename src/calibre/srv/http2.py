@@ -0,0 +1,1206 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+'''
+HTTP/2 support for the server. Connections switch to HTTP/2 when it is
+negotiated with ALPN over SSL, when a client upgrades a HTTP/1.1 connection to
+it (h2c) or when a client starts with the HTTP/2 connection preface. Every
+stream is a request that is processed by the normal request handler in the
+thread pool, so a client can have many requests in flight on a single
+connection, and responses are sent interleaved, as flow control permits.
+'''
+
+import httplib, struct, sys, traceback
+from base64 import urlsafe_b64decode
+from collections import deque
+from functools import partial
+from io import BytesIO, DEFAULT_BUFFER_SIZE
+from operator import itemgetter
+from Queue import Full
+
+from calibre import force_unicode
+from calibre.constants import __version__
+from calibre.ptempfile import SpooledTemporaryFile
+from calibre.srv.errors import HTTPSimpleResponse
+from calibre.srv.http_request import (
+    HTTP_METHODS, comma_separated_headers, decoded_headers, normalize_header_name, parse_uri)
+from calibre.srv.http_response import GeneratedOutput, HTTPConnection, Range, RequestData
+from calibre.srv.loop import READ, RDWR, WRITE
+from calibre.srv.sendfile import transfer_stats
+from calibre.srv.utils import HTTP2, MultiDict, http_date
+from calibre.utils.speedups import ReadOnlyFileBuffer
+
+PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+PREFACE_REQUEST_LINE = b'PRI * HTTP/2.0\r\n'
+H2C_UPGRADE = (
+    "HTTP/1.1 101 Switching Protocols\r\n"
+    "Connection: Upgrade\r\n"
+    "Upgrade: h2c\r\n\r\n"
+)
+
+# Frame types
+DATA, HEADERS, PRIORITY, RST_STREAM, SETTINGS, PUSH_PROMISE, PING, GOAWAY, WINDOW_UPDATE, CONTINUATION = range(10)
+# Frame flags
+END_STREAM = ACK = 0x1
+END_HEADERS = 0x4
+PADDED = 0x8
+PRIORITY_FLAG = 0x20
+# Settings
+SETTINGS_HEADER_TABLE_SIZE, SETTINGS_ENABLE_PUSH, SETTINGS_MAX_CONCURRENT_STREAMS = 1, 2, 3
+SETTINGS_INITIAL_WINDOW_SIZE, SETTINGS_MAX_FRAME_SIZE, SETTINGS_MAX_HEADER_LIST_SIZE = 4, 5, 6
+# Error codes
+NO_ERROR, PROTOCOL_ERROR, INTERNAL_ERROR, FLOW_CONTROL_ERROR = 0, 1, 2, 3
+STREAM_CLOSED, FRAME_SIZE_ERROR, REFUSED_STREAM, CANCEL, COMPRESSION_ERROR = 5, 6, 7, 8, 9
+ENHANCE_YOUR_CALM = 11
+
+FRAME_HEADER = struct.Struct(b'!HBBBL')
+SETTING = struct.Struct(b'!HL')
+UINT32 = struct.Struct(b'!L')
+
+DEFAULT_WINDOW_SIZE = 65535
+MAX_WINDOW_SIZE = 2**31 - 1
+DEFAULT_MAX_FRAME_SIZE = 16384
+MAX_FRAME_SIZE = 2**24 - 1
+MAX_CONCURRENT_STREAMS = 100
+MAX_HEADER_BLOCK_SIZE = 64 * 1024
+# Received data is acknowledged with WINDOW_UPDATE frames in batches of this size
+WINDOW_UPDATE_THRESHOLD = DEFAULT_WINDOW_SIZE // 2
+# The amount of data to gather from the streams for a single write to the socket
+OUTPUT_BATCH_SIZE = 64 * 1024
+READ_SIZE = 64 * 1024
+# Headers that are specific to a single HTTP/1 connection, not allowed in HTTP/2
+CONNECTION_HEADERS = frozenset((b'connection', b'keep-alive', b'proxy-connection', b'transfer-encoding', b'upgrade'))
+
+
+class ProtocolError(Exception):
+
+    ' A connection error, the connection is closed with a GOAWAY frame '
+
+    def __init__(self, msg, code=PROTOCOL_ERROR):
+        Exception.__init__(self, msg)
+        self.code = code
+
+
+def frame(ftype, flags, stream_id, payload=b''):
+    n = len(payload)
+    return FRAME_HEADER.pack(n >> 8, n & 0xff, ftype, flags, stream_id) + payload
+
+
+# HPACK {{{
+
+STATIC_TABLE = (
+    (b':authority', b''),
+    (b':method', b'GET'),
+    (b':method', b'POST'),
+    (b':path', b'/'),
+    (b':path', b'/index.html'),
+    (b':scheme', b'http'),
+    (b':scheme', b'https'),
+    (b':status', b'200'),
+    (b':status', b'204'),
+    (b':status', b'206'),
+    (b':status', b'304'),
+    (b':status', b'400'),
+    (b':status', b'404'),
+    (b':status', b'500'),
+    (b'accept-charset', b''),
+    (b'accept-encoding', b'gzip, deflate'),
+    (b'accept-language', b''),
+    (b'accept-ranges', b''),
+    (b'accept', b''),
+    (b'access-control-allow-origin', b''),
+    (b'age', b''),
+    (b'allow', b''),
+    (b'authorization', b''),
+    (b'cache-control', b''),
+    (b'content-disposition', b''),
+    (b'content-encoding', b''),
+    (b'content-language', b''),
+    (b'content-length', b''),
+    (b'content-location', b''),
+    (b'content-range', b''),
+    (b'content-type', b''),
+    (b'cookie', b''),
+    (b'date', b''),
+    (b'etag', b''),
+    (b'expect', b''),
+    (b'expires', b''),
+    (b'from', b''),
+    (b'host', b''),
+    (b'if-match', b''),
+    (b'if-modified-since', b''),
+    (b'if-none-match', b''),
+    (b'if-range', b''),
+    (b'if-unmodified-since', b''),
+    (b'last-modified', b''),
+    (b'link', b''),
+    (b'location', b''),
+    (b'max-forwards', b''),
+    (b'proxy-authenticate', b''),
+    (b'proxy-authorization', b''),
+    (b'range', b''),
+    (b'referer', b''),
+    (b'refresh', b''),
+    (b'retry-after', b''),
+    (b'server', b''),
+    (b'set-cookie', b''),
+    (b'strict-transport-security', b''),
+    (b'transfer-encoding', b''),
+    (b'user-agent', b''),
+    (b'vary', b''),
+    (b'via', b''),
+    (b'www-authenticate', b''),
+)
+STATIC_FIELDS, STATIC_NAMES = {}, {}
+for i, field in enumerate(STATIC_TABLE, 1):
+    STATIC_FIELDS.setdefault(field, i)
+    STATIC_NAMES.setdefault(field[0], i)
+del i, field
+DEFAULT_HEADER_TABLE_SIZE = 4096
+
+# The (code, length in bits) of every byte and of EOS
+HUFFMAN_CODES = (
+    (0x1ff8, 13), (0x7fffd8, 23), (0xfffffe2, 28), (0xfffffe3, 28), (0xfffffe4, 28),
+    (0xfffffe5, 28), (0xfffffe6, 28), (0xfffffe7, 28), (0xfffffe8, 28), (0xffffea, 24),
+    (0x3ffffffc, 30), (0xfffffe9, 28), (0xfffffea, 28), (0x3ffffffd, 30), (0xfffffeb, 28),
+    (0xfffffec, 28), (0xfffffed, 28), (0xfffffee, 28), (0xfffffef, 28), (0xffffff0, 28),
+    (0xffffff1, 28), (0xffffff2, 28), (0x3ffffffe, 30), (0xffffff3, 28), (0xffffff4, 28),
+    (0xffffff5, 28), (0xffffff6, 28), (0xffffff7, 28), (0xffffff8, 28), (0xffffff9, 28),
+    (0xffffffa, 28), (0xffffffb, 28), (0x14, 6), (0x3f8, 10), (0x3f9, 10), (0xffa, 12),
+    (0x1ff9, 13), (0x15, 6), (0xf8, 8), (0x7fa, 11), (0x3fa, 10), (0x3fb, 10), (0xf9, 8),
+    (0x7fb, 11), (0xfa, 8), (0x16, 6), (0x17, 6), (0x18, 6), (0x0, 5), (0x1, 5), (0x2, 5),
+    (0x19, 6), (0x1a, 6), (0x1b, 6), (0x1c, 6), (0x1d, 6), (0x1e, 6), (0x1f, 6), (0x5c, 7),
+    (0xfb, 8), (0x7ffc, 15), (0x20, 6), (0xffb, 12), (0x3fc, 10), (0x1ffa, 13), (0x21, 6),
+    (0x5d, 7), (0x5e, 7), (0x5f, 7), (0x60, 7), (0x61, 7), (0x62, 7), (0x63, 7), (0x64, 7),
+    (0x65, 7), (0x66, 7), (0x67, 7), (0x68, 7), (0x69, 7), (0x6a, 7), (0x6b, 7), (0x6c, 7),
+    (0x6d, 7), (0x6e, 7), (0x6f, 7), (0x70, 7), (0x71, 7), (0x72, 7), (0xfc, 8), (0x73, 7),
+    (0xfd, 8), (0x1ffb, 13), (0x7fff0, 19), (0x1ffc, 13), (0x3ffc, 14), (0x22, 6), (0x7ffd, 15),
+    (0x3, 5), (0x23, 6), (0x4, 5), (0x24, 6), (0x5, 5), (0x25, 6), (0x26, 6), (0x27, 6), (0x6, 5),
+    (0x74, 7), (0x75, 7), (0x28, 6), (0x29, 6), (0x2a, 6), (0x7, 5), (0x2b, 6), (0x76, 7),
+    (0x2c, 6), (0x8, 5), (0x9, 5), (0x2d, 6), (0x77, 7), (0x78, 7), (0x79, 7), (0x7a, 7),
+    (0x7b, 7), (0x7ffe, 15), (0x7fc, 11), (0x3ffd, 14), (0x1ffd, 13), (0xffffffc, 28),
+    (0xfffe6, 20), (0x3fffd2, 22), (0xfffe7, 20), (0xfffe8, 20), (0x3fffd3, 22), (0x3fffd4, 22),
+    (0x3fffd5, 22), (0x7fffd9, 23), (0x3fffd6, 22), (0x7fffda, 23), (0x7fffdb, 23), (0x7fffdc, 23),
+    (0x7fffdd, 23), (0x7fffde, 23), (0xffffeb, 24), (0x7fffdf, 23), (0xffffec, 24), (0xffffed, 24),
+    (0x3fffd7, 22), (0x7fffe0, 23), (0xffffee, 24), (0x7fffe1, 23), (0x7fffe2, 23), (0x7fffe3, 23),
+    (0x7fffe4, 23), (0x1fffdc, 21), (0x3fffd8, 22), (0x7fffe5, 23), (0x3fffd9, 22), (0x7fffe6, 23),
+    (0x7fffe7, 23), (0xffffef, 24), (0x3fffda, 22), (0x1fffdd, 21), (0xfffe9, 20), (0x3fffdb, 22),
+    (0x3fffdc, 22), (0x7fffe8, 23), (0x7fffe9, 23), (0x1fffde, 21), (0x7fffea, 23), (0x3fffdd, 22),
+    (0x3fffde, 22), (0xfffff0, 24), (0x1fffdf, 21), (0x3fffdf, 22), (0x7fffeb, 23), (0x7fffec, 23),
+    (0x1fffe0, 21), (0x1fffe1, 21), (0x3fffe0, 22), (0x1fffe2, 21), (0x7fffed, 23), (0x3fffe1, 22),
+    (0x7fffee, 23), (0x7fffef, 23), (0xfffea, 20), (0x3fffe2, 22), (0x3fffe3, 22), (0x3fffe4, 22),
+    (0x7ffff0, 23), (0x3fffe5, 22), (0x3fffe6, 22), (0x7ffff1, 23), (0x3ffffe0, 26),
+    (0x3ffffe1, 26), (0xfffeb, 20), (0x7fff1, 19), (0x3fffe7, 22), (0x7ffff2, 23), (0x3fffe8, 22),
+    (0x1ffffec, 25), (0x3ffffe2, 26), (0x3ffffe3, 26), (0x3ffffe4, 26), (0x7ffffde, 27),
+    (0x7ffffdf, 27), (0x3ffffe5, 26), (0xfffff1, 24), (0x1ffffed, 25), (0x7fff2, 19),
+    (0x1fffe3, 21), (0x3ffffe6, 26), (0x7ffffe0, 27), (0x7ffffe1, 27), (0x3ffffe7, 26),
+    (0x7ffffe2, 27), (0xfffff2, 24), (0x1fffe4, 21), (0x1fffe5, 21), (0x3ffffe8, 26),
+    (0x3ffffe9, 26), (0xffffffd, 28), (0x7ffffe3, 27), (0x7ffffe4, 27), (0x7ffffe5, 27),
+    (0xfffec, 20), (0xfffff3, 24), (0xfffed, 20), (0x1fffe6, 21), (0x3fffe9, 22), (0x1fffe7, 21),
+    (0x1fffe8, 21), (0x7ffff3, 23), (0x3fffea, 22), (0x3fffeb, 22), (0x1ffffee, 25),
+    (0x1ffffef, 25), (0xfffff4, 24), (0xfffff5, 24), (0x3ffffea, 26), (0x7ffff4, 23),
+    (0x3ffffeb, 26), (0x7ffffe6, 27), (0x3ffffec, 26), (0x3ffffed, 26), (0x7ffffe7, 27),
+    (0x7ffffe8, 27), (0x7ffffe9, 27), (0x7ffffea, 27), (0x7ffffeb, 27), (0xffffffe, 28),
+    (0x7ffffec, 27), (0x7ffffed, 27), (0x7ffffee, 27), (0x7ffffef, 27), (0x7fffff0, 27),
+    (0x3ffffee, 26), (0x3fffffff, 30),
+)
+HUFFMAN_SYMBOLS = {(length, code):sym for sym, (code, length) in enumerate(HUFFMAN_CODES)}
+HUFFMAN_LENGTHS = sorted({length for code, length in HUFFMAN_CODES})
+HUFFMAN_EOS = 256
+
+# Headers that change in nearly every response are not added to the table
+UNINDEXED_HEADERS = frozenset((
+    b'calibre-uncompressed-length', b'content-disposition', b'content-length', b'content-range',
+    b'date', b'etag', b'expires', b'last-modified', b'location', b'tempfile', b'www-authenticate'))
+# Headers that intermediaries must never add to their tables either
+SENSITIVE_HEADERS = frozenset((b'authorization', b'set-cookie'))
+
+
+class HPACKError(ValueError):
+    pass
+
+
+def huffman_encode(data):
+    ans = bytearray()
+    bits = num_bits = 0
+    for byte in bytearray(data):
+        code, length = HUFFMAN_CODES[byte]
+        bits = (bits << length) | code
+        num_bits += length
+        while num_bits >= 8:
+            num_bits -= 8
+            ans.append((bits >> num_bits) & 0xff)
+        bits &= (1 << num_bits) - 1
+    if num_bits:
+        # Pad with the most significant bits of EOS
+        ans.append(((bits << (8 - num_bits)) | ((1 << (8 - num_bits)) - 1)) & 0xff)
+    return bytes(ans)
+
+
+def huffman_decode(data):
+    ans = bytearray()
+    bits = num_bits = 0
+    symbols, lengths = HUFFMAN_SYMBOLS, HUFFMAN_LENGTHS
+    for byte in bytearray(data):
+        bits = (bits << 8) | byte
+        num_bits += 8
+        while num_bits >= lengths[0]:
+            sym = None
+            for length in lengths:
+                if length > num_bits:
+                    break
+                sym = symbols.get((length, bits >> (num_bits - length)))
+                if sym is not None:
+                    break
+            if sym is None:
+                if num_bits >= lengths[-1]:
+                    raise HPACKError('Invalid Huffman code')
+                break
+            if sym == HUFFMAN_EOS:
+                raise HPACKError('EOS in Huffman encoded string')
+            ans.append(sym)
+            num_bits -= length
+            bits &= (1 << num_bits) - 1
+    if num_bits > 7 or bits != (1 << num_bits) - 1:
+        raise HPACKError('Invalid padding in Huffman encoded string')
+    return bytes(ans)
+
+
+def encode_integer(value, prefix_bits, flags=0):
+    limit = (1 << prefix_bits) - 1
+    if value < limit:
+        return bytearray((flags | value,))
+    ans = bytearray((flags | limit,))
+    value -= limit
+    while value >= 128:
+        ans.append((value & 0x7f) | 0x80)
+        value >>= 7
+    ans.append(value)
+    return ans
+
+
+def decode_integer(data, pos, prefix_bits):
+    ' Decode the integer at pos in the bytearray data, return it and the position after it '
+    limit = (1 << prefix_bits) - 1
+    value = data[pos] & limit
+    pos += 1
+    if value == limit:
+        shift = 0
+        while True:
+            if pos >= len(data):
+                raise HPACKError('Truncated integer')
+            b = data[pos]
+            pos += 1
+            value += (b & 0x7f) << shift
+            if not b & 0x80:
+                break
+            shift += 7
+            if shift > 28:
+                raise HPACKError('Integer too large')
+    return value, pos
+
+
+def encode_string(data):
+    hdata = huffman_encode(data)
+    if len(hdata) < len(data):
+        return encode_integer(len(hdata), 7, 0x80) + hdata
+    return encode_integer(len(data), 7) + data
+
+
+class HeaderTable(object):
+
+    ' The dynamic table of HPACK, with the newest entries first '
+
+    def __init__(self, max_size=DEFAULT_HEADER_TABLE_SIZE):
+        self.entries = deque()
+        self.size = 0
+        self.max_size = max_size
+
+    def add(self, name, value):
+        self.entries.appendleft((name, value))
+        self.size += len(name) + len(value) + 32
+        self.evict()
+
+    def evict(self):
+        while self.size > self.max_size:
+            name, value = self.entries.pop()
+            self.size -= len(name) + len(value) + 32
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self.evict()
+
+    def __getitem__(self, index):
+        if 0 < index <= len(STATIC_TABLE):
+            return STATIC_TABLE[index - 1]
+        index -= len(STATIC_TABLE) + 1
+        if 0 <= index < len(self.entries):
+            return self.entries[index]
+        raise HPACKError('Invalid header table index')
+
+    def index(self, field):
+        for i, x in enumerate(self.entries):
+            if x == field:
+                return i + len(STATIC_TABLE) + 1
+
+
+class Decoder(object):
+
+    def __init__(self, max_header_list_size=MAX_HEADER_BLOCK_SIZE):
+        self.table = HeaderTable()
+        # The table size we allow the client to use, we never change it
+        self.max_table_size = DEFAULT_HEADER_TABLE_SIZE
+        self.max_header_list_size = max_header_list_size
+
+    def decode_string(self, data, pos):
+        if pos >= len(data):
+            raise HPACKError('Truncated string')
+        huffman = data[pos] & 0x80
+        length, pos = decode_integer(data, pos, 7)
+        end = pos + length
+        if end > len(data):
+            raise HPACKError('Truncated string')
+        ans = bytes(data[pos:end])
+        return (huffman_decode(ans) if huffman else ans), end
+
+    def decode_literal(self, data, pos, prefix_bits):
+        index, pos = decode_integer(data, pos, prefix_bits)
+        if index:
+            name = self.table[index][0]
+        else:
+            name, pos = self.decode_string(data, pos)
+        value, pos = self.decode_string(data, pos)
+        return (name, value), pos
+
+    def __call__(self, block):
+        ' Return the list of (name, value) pairs in a header block '
+        data, pos, ans, size = bytearray(block), 0, [], 0
+        table = self.table
+        size_update_allowed = True
+        while pos < len(data):
+            b = data[pos]
+            if b & 0x80:
+                # Indexed field
+                index, pos = decode_integer(data, pos, 7)
+                field = table[index]
+            elif b & 0x40:
+                # Literal with incremental indexing
+                field, pos = self.decode_literal(data, pos, 6)
+                table.add(*field)
+            elif b & 0x20:
+                # Dynamic table size update, only allowed at the start of a block
+                if not size_update_allowed:
+                    raise HPACKError('Table size update after the start of a header block')
+                max_size, pos = decode_integer(data, pos, 5)
+                if max_size > self.max_table_size:
+                    raise HPACKError('Table size update larger than allowed')
+                table.resize(max_size)
+                continue
+            else:
+                # Literal without indexing or never indexed
+                field, pos = self.decode_literal(data, pos, 4)
+            size_update_allowed = False
+            size += len(field[0]) + len(field[1]) + 32
+            if size > self.max_header_list_size:
+                raise HPACKError('Header list too large')
+            ans.append(field)
+        return ans
+
+
+class Encoder(object):
+
+    def __init__(self):
+        self.table = HeaderTable()
+        self.size_updates = []
+
+    def resize(self, max_size):
+        ' Called with the header table size from the settings of the client '
+        max_size = min(max_size, DEFAULT_HEADER_TABLE_SIZE)
+        if max_size != self.table.max_size:
+            self.table.resize(max_size)
+            self.size_updates.append(max_size)
+
+    def __call__(self, headers):
+        ' Encode a list of (name, value) pairs with lowercase names into a header block '
+        ans = bytearray()
+        if self.size_updates:
+            # The client must see the smallest size the table had
+            smallest, last = min(self.size_updates), self.size_updates[-1]
+            ans += encode_integer(smallest, 5, 0x20)
+            if last != smallest:
+                ans += encode_integer(last, 5, 0x20)
+            del self.size_updates[:]
+        table = self.table
+        for field in headers:
+            index = STATIC_FIELDS.get(field) or table.index(field)
+            if index:
+                ans += encode_integer(index, 7, 0x80)
+                continue
+            name, value = field
+            if name in SENSITIVE_HEADERS:
+                prefix_bits, flags = 4, 0x10
+            elif name in UNINDEXED_HEADERS:
+                prefix_bits, flags = 4, 0
+            else:
+                prefix_bits, flags = 6, 0x40
+                table.add(name, value)
+            name_index = STATIC_NAMES.get(name, 0)
+            ans += encode_integer(name_index, prefix_bits, flags)
+            if not name_index:
+                ans += encode_string(name)
+            ans += encode_string(value)
+        return bytes(ans)
+# }}}
+
+
+def as_bytes(x):
+    if isinstance(x, bytes):
+        return x
+    return type('')(x).encode('utf-8')
+
+
+def decode_header_value(name, value):
+    # The same as the decoding of HTTP/1 header values in HTTPHeaderParser
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        if name in decoded_headers:
+            raise ValueError('Undecodeable value for the header: %s' % name)
+    return value
+
+
+DEFAULT_OUTPUT_CHUNK = DEFAULT_MAX_FRAME_SIZE
+
+
+def read_chunks(f, size=None):
+    while size is None or size > 0:
+        data = f.read(DEFAULT_OUTPUT_CHUNK if size is None else min(size, DEFAULT_OUTPUT_CHUNK))
+        if not data:
+            break
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        if size is not None:
+            size -= len(data)
+        yield data
+
+
+def output_chunks(output):
+    ' The body of a response from HTTPConnection.finalize_output(), as a sequence of chunks '
+    if isinstance(output, GeneratedOutput):
+        for chunk in output.output:
+            if chunk:
+                yield as_bytes(chunk.tobytes() if isinstance(chunk, memoryview) else chunk)
+        return
+    src, ranges = output.src_file, output.ranges
+    if ranges is None:
+        for chunk in read_chunks(src):
+            yield chunk
+    elif isinstance(ranges, Range):
+        src.seek(ranges.start)
+        for chunk in read_chunks(src, ranges.size):
+            yield chunk
+    else:
+        # multipart/byteranges, the same as HTTPConnection.write_ranges()
+        first = True
+        for r, range_part in ranges:
+            if r is None:
+                yield b'\r\n' + range_part
+                break
+            yield (b'' if first else b'\r\n') + range_part + b'\r\n'
+            first = False
+            src.seek(r.start)
+            for chunk in read_chunks(src, r.size):
+                yield chunk
+
+
+class Stream(object):
+
+    def __init__(self, stream_id, send_window):
+        self.stream_id = stream_id
+        self.send_window = send_window
+        self.recv_window = DEFAULT_WINDOW_SIZE
+        self.recv_unacked = 0
+        self.method = self.path = self.query = self.inheaders = None
+        self.request_line = ''
+        self.forwarded_for = None
+        self.content_length = None
+        self.body = None
+        self.body_size = 0
+        self.remote_closed = self.local_closed = False
+        # Set when a response was sent before the request body was received
+        self.discard_body = False
+        self.refused = False
+        # The body of the response, waiting to be sent
+        self.chunks = None
+        self.pending = b''
+        self.blocked = False
+
+
+class HTTP2Connection(HTTPConnection):
+
+    in_http2_mode = False
+
+    # Switching to HTTP/2 {{{
+    def connection_ready(self):
+        if self.ssl_context is not None and self.opts.use_http2 and not self.in_http2_mode:
+            selected_alpn_protocol = getattr(self.socket, 'selected_alpn_protocol', None)
+            if selected_alpn_protocol is not None and selected_alpn_protocol() == 'h2':
+                return self.start_http2(PREFACE)
+        HTTPConnection.connection_ready(self)
+
+    def http2_preface_received(self):
+        if not self.opts.use_http2:
+            return HTTPConnection.http2_preface_received(self)
+        self.start_http2(PREFACE[len(PREFACE_REQUEST_LINE):])
+
+    def finalize_headers(self, inheaders):
+        if self.ssl_context is None and self.opts.use_http2:
+            upgrade = {x.strip().lower() for x in inheaders.get('Upgrade', '').split(',')}
+            conn = {x.strip().lower() for x in inheaders.get('Connection', '').split(',')}
+            settings = inheaders.get('Http2-Settings')
+            try:
+                content_length = int(inheaders.get('Content-Length', 0))
+            except ValueError:
+                return self.simple_response(httplib.BAD_REQUEST, 'Invalid Content-Length')
+            if ('h2c' in upgrade and {'upgrade', 'http2-settings'}.issubset(conn) and settings is not None and
+                    not content_length and 'Transfer-Encoding' not in inheaders):
+                try:
+                    settings = urlsafe_b64decode(settings.encode('ascii') + b'=' * (-len(settings) % 4))
+                except Exception:
+                    settings = None
+                if settings is not None and len(settings) % SETTING.size == 0:
+                    # Requests with bodies are not upgraded, so that the
+                    # request is complete when the connection is upgraded
+                    buf = ReadOnlyFileBuffer(H2C_UPGRADE.encode('ascii'))
+                    return self.set_state(WRITE, self.upgrade_connection_to_h2, buf, inheaders, settings)
+        return HTTPConnection.finalize_headers(self, inheaders)
+
+    def upgrade_connection_to_h2(self, buf, inheaders, settings, event):
+        if self.write(buf):
+            self.start_http2(PREFACE, settings)
+            # The request becomes stream 1
+            for name in ('Connection', 'Upgrade', 'Http2-Settings'):
+                inheaders.pop(name, all=True)
+            stream = self.h2_streams[1] = Stream(1, self.h2_initial_window)
+            self.h2_last_stream_id = 1
+            stream.method, stream.path, stream.query, stream.inheaders = self.method, self.path, self.query, inheaders
+            stream.request_line = force_unicode(self.request_line or '', 'utf-8')
+            stream.forwarded_for = inheaders.get('X-Forwarded-For')
+            self.h2_request_received(stream)
+            self.update_h2_state()
+
+    def start_http2(self, expected_preface, settings=None):
+        self.in_http2_mode = True
+        # Unhandled errors close the connection, see ServerLoop.tick()
+        self.response_started = True
+        self.request_line = 'HTTP/2 connection'
+        self.h2_expected_preface = expected_preface
+        self.h2_expect_settings = True
+        self.h2_inbuf = b''
+        self.h2_outbuf, self.h2_outpos = b'', 0
+        self.h2_streams = {}
+        self.h2_last_stream_id = 0
+        # Frames that are not flow controlled, sent before any DATA frames
+        self.h2_control = deque()
+        # Streams with response data to send
+        self.h2_ready = deque()
+        self.h2_send_window = self.h2_recv_window = DEFAULT_WINDOW_SIZE
+        self.h2_recv_unacked = 0
+        # The settings of the client
+        self.h2_initial_window = DEFAULT_WINDOW_SIZE
+        self.h2_max_frame_size = DEFAULT_MAX_FRAME_SIZE
+        # A header block awaiting CONTINUATION frames
+        self.h2_header_block = None
+        self.h2_decoder, self.h2_encoder = Decoder(), Encoder()
+        self.h2_goaway_received = self.h2_closing = False
+        self.h2_active_stream = None
+        # Requests waiting to be handled, at most h2_max_in_pool requests of a
+        # connection are in the thread pool at a time, so that a single
+        # connection cannot starve the other clients of the server
+        self.h2_waiting = deque()
+        self.h2_in_pool = 0
+        self.h2_max_in_pool = max(1, self.opts.worker_count // 2)
+        self.h2_control.append(frame(SETTINGS, 0, 0, b''.join(SETTING.pack(k, v) for k, v in (
+            (SETTINGS_MAX_CONCURRENT_STREAMS, MAX_CONCURRENT_STREAMS), (SETTINGS_MAX_HEADER_LIST_SIZE, MAX_HEADER_BLOCK_SIZE)))))
+        if settings:
+            # Settings sent in the HTTP2-Settings header when upgrading,
+            # acknowledged by the 101 response
+            self.h2_apply_settings(settings)
+        self.handle_event = self.h2_duplex
+        self.update_h2_state()
+    # }}}
+
+    def h2_duplex(self, event):
+        try:
+            if event is READ:
+                self.h2_read()
+            elif event is WRITE:
+                self.h2_write()
+            else:
+                self.h2_job_done(*event)
+                self.h2_dispatch()
+        except ProtocolError as err:
+            self.log.warn('HTTP/2 protocol error from %s: %s' % (self.remote_addr, err))
+            self.h2_close(err.code, type('')(err))
+        self.update_h2_state()
+
+    def update_h2_state(self):
+        if not self.ready:
+            return
+        has_output = (self.h2_outpos < len(self.h2_outbuf) or bool(self.h2_control) or
+                      (bool(self.h2_ready) and self.h2_send_window > 0))
+        if self.h2_closing or (self.h2_goaway_received and not self.h2_streams):
+            if has_output:
+                self.wait_for = WRITE
+            else:
+                self.ready = False
+            return
+        self.wait_for = RDWR if has_output else READ
+
+    def handle_timeout(self):
+        if not self.in_http2_mode:
+            return HTTPConnection.handle_timeout(self)
+        if self.h2_closing:
+            return False
+        if not self.h2_streams:
+            self.h2_close(NO_ERROR, 'Idle connection')
+            self.update_h2_state()
+        return True
+
+    def h2_close(self, code, msg=''):
+        ' Close the connection with a GOAWAY frame, once everything queued so far has been sent '
+        self.h2_control.append(frame(GOAWAY, 0, 0, UINT32.pack(self.h2_last_stream_id) + UINT32.pack(code) + msg.encode('utf-8')))
+        self.h2_closing = True
+        self.h2_ready.clear()
+        self.h2_streams.clear()
+        self.h2_waiting.clear()
+
+    # Reading {{{
+    def h2_read(self):
+        data = self.recv(READ_SIZE)
+        if not data or self.h2_closing:
+            return
+        buf = self.h2_inbuf + data if self.h2_inbuf else data
+        pos = 0
+        if self.h2_expected_preface:
+            expected = self.h2_expected_preface
+            pos = min(len(expected), len(buf))
+            if buf[:pos] != expected[:pos]:
+                raise ProtocolError('Invalid HTTP/2 connection preface')
+            self.h2_expected_preface = expected[pos:]
+        while len(buf) - pos >= FRAME_HEADER.size:
+            hi, lo, ftype, flags, stream_id = FRAME_HEADER.unpack_from(buf, pos)
+            length = (hi << 8) | lo
+            if length > DEFAULT_MAX_FRAME_SIZE:
+                raise ProtocolError('Frame larger than the maximum frame size', FRAME_SIZE_ERROR)
+            end = pos + FRAME_HEADER.size + length
+            if end > len(buf):
+                break
+            self.h2_frame_received(ftype, flags, stream_id & 0x7fffffff, buf[pos + FRAME_HEADER.size:end])
+            pos = end
+            if self.h2_closing:
+                return
+        self.h2_inbuf = buf[pos:]
+
+    def h2_frame_received(self, ftype, flags, stream_id, payload):
+        if self.h2_header_block is not None and ftype != CONTINUATION:
+            raise ProtocolError('Header block not followed by a CONTINUATION frame')
+        if self.h2_expect_settings:
+            if ftype != SETTINGS or flags & ACK:
+                raise ProtocolError('Connection preface not followed by a SETTINGS frame')
+            self.h2_expect_settings = False
+        if ftype == DATA:
+            self.h2_data_frame(flags, stream_id, payload)
+        elif ftype == HEADERS:
+            self.h2_headers_frame(flags, stream_id, payload)
+        elif ftype == CONTINUATION:
+            self.h2_continuation_frame(flags, stream_id, payload)
+        elif ftype == SETTINGS:
+            self.h2_settings_frame(flags, stream_id, payload)
+        elif ftype == WINDOW_UPDATE:
+            self.h2_window_update_frame(flags, stream_id, payload)
+        elif ftype == PING:
+            if stream_id:
+                raise ProtocolError('PING frame for a stream')
+            if len(payload) != 8:
+                raise ProtocolError('PING frame of incorrect size', FRAME_SIZE_ERROR)
+            if not flags & ACK:
+                self.h2_control.append(frame(PING, ACK, 0, payload))
+        elif ftype == RST_STREAM:
+            if not stream_id or stream_id > self.h2_last_stream_id:
+                raise ProtocolError('RST_STREAM frame for an idle stream')
+            if len(payload) != 4:
+                raise ProtocolError('RST_STREAM frame of incorrect size', FRAME_SIZE_ERROR)
+            stream = self.h2_streams.pop(stream_id, None)
+            if stream is not None:
+                stream.local_closed = stream.remote_closed = True
+                stream.chunks = None
+        elif ftype == PRIORITY:
+            if not stream_id:
+                raise ProtocolError('PRIORITY frame for the connection')
+            if len(payload) != 5:
+                self.h2_reset_stream(stream_id, FRAME_SIZE_ERROR)
+        elif ftype == GOAWAY:
+            if stream_id:
+                raise ProtocolError('GOAWAY frame for a stream')
+            self.h2_goaway_received = True
+        elif ftype == PUSH_PROMISE:
+            raise ProtocolError('Clients must not send PUSH_PROMISE frames')
+        # Frames of unknown types are ignored
+
+    def h2_strip_padding(self, flags, payload):
+        if flags & PADDED:
+            if not payload:
+                raise ProtocolError('Padded frame without padding length', FRAME_SIZE_ERROR)
+            pad_length = bytearray(payload[:1])[0]
+            if pad_length >= len(payload):
+                raise ProtocolError('Padding larger than the frame')
+            payload = payload[1:len(payload) - pad_length]
+        return payload
+
+    def h2_settings_frame(self, flags, stream_id, payload):
+        if stream_id:
+            raise ProtocolError('SETTINGS frame for a stream')
+        if flags & ACK:
+            if payload:
+                raise ProtocolError('SETTINGS acknowledgement with a payload', FRAME_SIZE_ERROR)
+            return
+        if len(payload) % SETTING.size:
+            raise ProtocolError('SETTINGS frame of incorrect size', FRAME_SIZE_ERROR)
+        self.h2_apply_settings(payload)
+        self.h2_control.append(frame(SETTINGS, ACK, 0))
+
+    def h2_apply_settings(self, payload):
+        for pos in xrange(0, len(payload), SETTING.size):
+            key, val = SETTING.unpack_from(payload, pos)
+            if key == SETTINGS_HEADER_TABLE_SIZE:
+                self.h2_encoder.resize(val)
+            elif key == SETTINGS_ENABLE_PUSH:
+                if val > 1:
+                    raise ProtocolError('Invalid value for SETTINGS_ENABLE_PUSH')
+            elif key == SETTINGS_INITIAL_WINDOW_SIZE:
+                if val > MAX_WINDOW_SIZE:
+                    raise ProtocolError('Invalid value for SETTINGS_INITIAL_WINDOW_SIZE', FLOW_CONTROL_ERROR)
+                delta, self.h2_initial_window = val - self.h2_initial_window, val
+                for stream in self.h2_streams.itervalues():
+                    stream.send_window += delta
+                    if stream.send_window > MAX_WINDOW_SIZE:
+                        raise ProtocolError('Stream window too large', FLOW_CONTROL_ERROR)
+                    self.h2_unblock(stream)
+            elif key == SETTINGS_MAX_FRAME_SIZE:
+                if not DEFAULT_MAX_FRAME_SIZE <= val <= MAX_FRAME_SIZE:
+                    raise ProtocolError('Invalid value for SETTINGS_MAX_FRAME_SIZE')
+                self.h2_max_frame_size = val
+
+    def h2_window_update_frame(self, flags, stream_id, payload):
+        if len(payload) != 4:
+            raise ProtocolError('WINDOW_UPDATE frame of incorrect size', FRAME_SIZE_ERROR)
+        increment = UINT32.unpack(payload)[0] & 0x7fffffff
+        if not stream_id:
+            if not increment:
+                raise ProtocolError('WINDOW_UPDATE with zero increment')
+            self.h2_send_window += increment
+            if self.h2_send_window > MAX_WINDOW_SIZE:
+                raise ProtocolError('Connection window too large', FLOW_CONTROL_ERROR)
+            return
+        if stream_id > self.h2_last_stream_id:
+            raise ProtocolError('WINDOW_UPDATE frame for an idle stream')
+        stream = self.h2_streams.get(stream_id)
+        if stream is None:
+            return  # Closed stream
+        if not increment:
+            return self.h2_reset_stream(stream_id, PROTOCOL_ERROR)
+        stream.send_window += increment
+        if stream.send_window > MAX_WINDOW_SIZE:
+            return self.h2_reset_stream(stream_id, FLOW_CONTROL_ERROR)
+        self.h2_unblock(stream)
+
+    def h2_headers_frame(self, flags, stream_id, payload):
+        if not stream_id & 1:
+            raise ProtocolError('HEADERS frame for a stream not initiated by the client')
+        payload = self.h2_strip_padding(flags, payload)
+        if flags & PRIORITY_FLAG:
+            if len(payload) < 5:
+                raise ProtocolError('HEADERS frame with priority of incorrect size', FRAME_SIZE_ERROR)
+            payload = payload[5:]
+        stream = self.h2_streams.get(stream_id)
+        if stream is None:
+            if stream_id <= self.h2_last_stream_id:
+                raise ProtocolError('HEADERS frame for a closed stream', STREAM_CLOSED)
+            self.h2_last_stream_id = stream_id
+            stream = self.h2_streams[stream_id] = Stream(stream_id, self.h2_initial_window)
+            # The header block must be decoded anyway, to keep the header
+            # table in sync with the client
+            stream.refused = self.h2_goaway_received or len(self.h2_streams) > MAX_CONCURRENT_STREAMS
+        self.h2_header_block = stream, flags, [payload]
+        if flags & END_HEADERS:
+            self.h2_header_block_received()
+
+    def h2_continuation_frame(self, flags, stream_id, payload):
+        block = self.h2_header_block
+        if block is None or block[0].stream_id != stream_id:
+            raise ProtocolError('Unexpected CONTINUATION frame')
+        block[2].append(payload)
+        if sum(map(len, block[2])) > MAX_HEADER_BLOCK_SIZE:
+            raise ProtocolError('Header block too large', ENHANCE_YOUR_CALM)
+        if flags & END_HEADERS:
+            self.h2_header_block_received()
+
+    def h2_header_block_received(self):
+        stream, flags, fragments = self.h2_header_block
+        self.h2_header_block = None
+        try:
+            headers = self.h2_decoder(b''.join(fragments))
+        except HPACKError as err:
+            raise ProtocolError('Failed to decode header block: %s' % err, COMPRESSION_ERROR)
+        if stream.refused:
+            return self.h2_reset_stream(stream.stream_id, REFUSED_STREAM)
+        if stream.remote_closed:
+            return self.h2_reset_stream(stream.stream_id, STREAM_CLOSED)
+        if stream.inheaders is not None:
+            # Trailers, which are ignored
+            if not flags & END_STREAM:
+                return self.h2_reset_stream(stream.stream_id, PROTOCOL_ERROR)
+        else:
+            try:
+                self.h2_parse_request_headers(stream, headers)
+            except ValueError:
+                return self.h2_reset_stream(stream.stream_id, PROTOCOL_ERROR)
+            except HTTPSimpleResponse as err:
+                stream.method = stream.method or 'GET'
+                self.h2_simple_response(stream, err.http_code, err.message)
+        if flags & END_STREAM:
+            self.h2_request_received(stream)
+
+    def h2_parse_request_headers(self, stream, headers):
+        pseudo, inheaders, cookies = {}, MultiDict(), []
+        for name, value in headers:
+            if name.startswith(b':'):
+                if inheaders or cookies or name in pseudo or name not in (b':method', b':scheme', b':authority', b':path'):
+                    raise ValueError('Invalid pseudo header: %r' % name)
+                pseudo[name] = value
+                continue
+            if name.lower() != name or name in CONNECTION_HEADERS or (name == b'te' and value != b'trailers'):
+                raise ValueError('Invalid header: %r' % name)
+            if name == b'cookie':
+                # Cookies can be split into several fields in HTTP/2
+                cookies.append(value)
+                continue
+            key = normalize_header_name(name.decode('ascii'))
+            val = decode_header_value(key, value)
+            if key in comma_separated_headers:
+                existing = inheaders.pop(key)
+                if existing is not None:
+                    val = existing + ', ' + val
+            inheaders[key] = val
+        if cookies:
+            inheaders['Cookie'] = decode_header_value('Cookie', b'; '.join(cookies))
+        if b':authority' in pseudo and 'Host' not in inheaders:
+            inheaders['Host'] = decode_header_value('Host', pseudo[b':authority'])
+        if b':method' not in pseudo or b':path' not in pseudo or b':scheme' not in pseudo:
+            raise ValueError('Missing pseudo headers')
+        stream.inheaders = inheaders
+        stream.method = method = pseudo[b':method'].decode('ascii', 'replace').upper()
+        stream.request_line = '%s %s %s' % (method, pseudo[b':path'].decode('utf-8', 'replace'), HTTP2)
+        stream.forwarded_for = inheaders.get('X-Forwarded-For')
+        if method not in HTTP_METHODS:
+            raise HTTPSimpleResponse(httplib.BAD_REQUEST, 'Unknown HTTP method')
+        scheme, stream.path, stream.query = parse_uri(pseudo[b':path'])
+        cl = inheaders.get('Content-Length')
+        if cl is not None:
+            try:
+                stream.content_length = int(cl)
+            except Exception:
+                raise HTTPSimpleResponse(httplib.BAD_REQUEST, 'Invalid Content-Length')
+            if stream.content_length > self.max_request_body_size:
+                raise HTTPSimpleResponse(httplib.REQUEST_ENTITY_TOO_LARGE,
+                    "The entity sent with the request exceeds the maximum "
+                    "allowed bytes (%d)." % self.max_request_body_size)
+
+    def h2_data_frame(self, flags, stream_id, payload):
+        if not stream_id:
+            raise ProtocolError('DATA frame for the connection')
+        size = len(payload)
+        self.h2_recv_window -= size
+        if self.h2_recv_window < 0:
+            raise ProtocolError('Connection window exceeded', FLOW_CONTROL_ERROR)
+        stream = self.h2_streams.get(stream_id)
+        self.h2_data_consumed(stream, size)
+        if stream is None:
+            if stream_id > self.h2_last_stream_id:
+                raise ProtocolError('DATA frame for an idle stream')
+            return self.h2_reset_stream(stream_id, STREAM_CLOSED)
+        if stream.remote_closed or stream.inheaders is None:
+            return self.h2_reset_stream(stream_id, STREAM_CLOSED)
+        stream.recv_window -= size
+        if stream.recv_window < 0:
+            return self.h2_reset_stream(stream_id, FLOW_CONTROL_ERROR)
+        data = self.h2_strip_padding(flags, payload)
+        if not stream.discard_body:
+            stream.body_size += len(data)
+            if stream.body_size > self.max_request_body_size:
+                stream.discard_body = True
+                self.h2_simple_response(stream, httplib.REQUEST_ENTITY_TOO_LARGE,
+                    "The entity sent with the request exceeds the maximum "
+                    "allowed bytes (%d)." % self.max_request_body_size)
+            else:
+                if stream.body is None:
+                    stream.body = SpooledTemporaryFile(prefix='rq-body-', max_size=DEFAULT_BUFFER_SIZE, dir=self.tdir)
+                stream.body.write(data)
+        if flags & END_STREAM:
+            self.h2_request_received(stream)
+
+    def h2_data_consumed(self, stream, size):
+        ' Let the client send more data, as received data is processed immediately '
+        self.h2_recv_unacked += size
+        if self.h2_recv_unacked >= WINDOW_UPDATE_THRESHOLD:
+            self.h2_control.append(frame(WINDOW_UPDATE, 0, 0, UINT32.pack(self.h2_recv_unacked)))
+            self.h2_recv_window += self.h2_recv_unacked
+            self.h2_recv_unacked = 0
+        if stream is not None and not stream.remote_closed:
+            stream.recv_unacked += size
+            if stream.recv_unacked >= WINDOW_UPDATE_THRESHOLD:
+                self.h2_control.append(frame(WINDOW_UPDATE, 0, stream.stream_id, UINT32.pack(stream.recv_unacked)))
+                stream.recv_window += stream.recv_unacked
+                stream.recv_unacked = 0
+
+    def h2_reset_stream(self, stream_id, code):
+        self.h2_control.append(frame(RST_STREAM, 0, stream_id, UINT32.pack(code)))
+        stream = self.h2_streams.pop(stream_id, None)
+        if stream is not None:
+            stream.local_closed = stream.remote_closed = True
+            stream.chunks = None
+    # }}}
+
+    # Processing requests {{{
+    def h2_request_received(self, stream):
+        stream.remote_closed = True
+        if stream.local_closed:
+            # A response was sent before the request was complete
+            self.h2_streams.pop(stream.stream_id, None)
+            return
+        if stream.discard_body:
+            return
+        if stream.content_length is not None and stream.content_length != stream.body_size:
+            return self.h2_simple_response(stream, httplib.BAD_REQUEST, 'The request body does not match its Content-Length')
+        if stream.method == 'TRACE':
+            msg = force_unicode(stream.request_line, 'utf-8') + '\n' + stream.inheaders.pretty()
+            return self.h2_simple_response(stream, httplib.OK, msg)
+        body = stream.body or BytesIO()
+        stream.body = None
+        body.seek(0)
+        data = RequestData(
+            stream.method, stream.path, stream.query, stream.inheaders, body,
+            MultiDict(), HTTP2, self.static_cache, self.opts,
+            self.remote_addr, self.remote_port, self.is_local_connection,
+            self.translator_cache, self.tdir, stream.forwarded_for
+        )
+        self.h2_waiting.append((stream, data))
+        self.h2_dispatch()
+
+    def h2_dispatch(self):
+        while self.h2_waiting and self.h2_in_pool < self.h2_max_in_pool:
+            stream, data = self.h2_waiting.popleft()
+            if stream.local_closed:
+                continue  # The stream was reset while waiting
+            try:
+                self.pool.put_nowait(self.socket.fileno(), partial(self.run_stream_request_handler, stream.stream_id, data))
+            except Full:
+                self.log.error('Server busy handling request: %s' % stream.request_line)
+                self.h2_simple_response(stream, httplib.SERVICE_UNAVAILABLE)
+            else:
+                self.h2_in_pool += 1
+
+    def run_stream_request_handler(self, stream_id, data):
+        # Runs in a worker thread. Errors are returned with the id of the
+        # stream, so that they can be reported on the right stream.
+        try:
+            return stream_id, data, True, self.request_handler(data)
+        except Exception:
+            return stream_id, data, False, sys.exc_info()
+
+    def h2_job_done(self, ok, result):
+        self.h2_in_pool -= 1
+        if not ok:
+            etype, e, tb = result
+            raise etype, e, tb
+        stream_id, data, ok, output = result
+        stream = self.h2_streams.get(stream_id)
+        if stream is None or stream.local_closed:
+            return  # The stream was reset by the client
+        if not ok:
+            etype, e, tb = output
+            if isinstance(e, HTTPSimpleResponse):
+                eh = {}
+                if e.location:
+                    eh['Location'] = e.location
+                if e.authenticate:
+                    eh['WWW-Authenticate'] = e.authenticate
+                if e.log:
+                    self.log.warn(e.log)
+                return self.h2_simple_response(stream, e.http_code, e.message or '', extra_headers=eh, username=data.username)
+            self.log.error('Unhandled exception in request: %s\n%s' % (
+                stream.request_line, ''.join(traceback.format_exception(etype, e, tb))))
+            return self.h2_simple_response(stream, httplib.INTERNAL_SERVER_ERROR)
+        self.h2_activate(stream)
+        output = self.finalize_output(output, data, False)
+        if output is None:
+            return
+        outheaders = data.outheaders
+        outheaders.set('Date', http_date(), replace_all=True)
+        outheaders.set('Server', 'calibre %s' % __version__, replace_all=True)
+        ct = outheaders.get('Content-Type', '')
+        if ct.startswith('text/') and 'charset=' not in ct:
+            outheaders.set('Content-Type', ct + '; charset=UTF-8', replace_all=True)
+        headers = []
+        for header, value in sorted(outheaders.iteritems(), key=itemgetter(0)):
+            name = header.lower().encode('ascii')
+            if name not in CONNECTION_HEADERS:
+                headers.append((name, as_bytes(value)))
+        for morsel in data.outcookie.itervalues():
+            morsel['version'] = '1'
+            headers.append((b'set-cookie', as_bytes(morsel.OutputString())))
+        if self.access_log is not None:
+            sz = outheaders.get('Content-Length')
+            self.log_access(status_code=data.status_code, response_size=None if sz is None else int(sz), username=data.username)
+        self.h2_start_response(stream, data.status_code, headers, output_chunks(output))
+
+    def h2_activate(self, stream):
+        # finalize_output() and log_access() use the attributes of the
+        # connection for the current request
+        self.h2_active_stream = stream
+        self.method, self.request_line, self.forwarded_for = stream.method, stream.request_line, stream.forwarded_for
+
+    def h2_simple_response(self, stream, status_code, msg='', extra_headers=None, username=None):
+        self.h2_activate(stream)
+        msg = msg.encode('utf-8')
+        headers = [
+            (b'content-length', b'%d' % len(msg)),
+            (b'content-type', b'text/plain; charset=UTF-8'),
+            (b'date', as_bytes(http_date())),
+        ]
+        if extra_headers:
+            for h, v in extra_headers.iteritems():
+                headers.append((h.lower().encode('ascii'), as_bytes(v)))
+        self.log_access(status_code=status_code, response_size=len(msg), username=username)
+        self.h2_start_response(stream, status_code, headers, iter((msg,)) if msg else None)
+
+    def h2_start_response(self, stream, status_code, headers, chunks=None):
+        if stream.local_closed:
+            return
+        block = self.h2_encoder([(b':status', b'%d' % status_code)] + headers)
+        end_stream = chunks is None or stream.method == 'HEAD'
+        size = self.h2_max_frame_size
+        for i, pos in enumerate(xrange(0, max(1, len(block)), size)):
+            last = pos + size >= len(block)
+            flags = (END_HEADERS if last else 0) | (END_STREAM if i == 0 and end_stream else 0)
+            self.h2_control.append(frame(CONTINUATION if i else HEADERS, flags, stream.stream_id, block[pos:pos + size]))
+        if end_stream:
+            self.h2_stream_finished(stream)
+        else:
+            stream.chunks = chunks
+            self.h2_ready.append(stream)
+
+    def h2_stream_finished(self, stream):
+        stream.local_closed = True
+        stream.chunks = None
+        if stream.remote_closed:
+            self.h2_streams.pop(stream.stream_id, None)
+
+    # Overrides of HTTPConnection used by finalize_output()
+    def simple_response(self, status_code, msg='', close_after_response=True, extra_headers=None):
+        if not self.in_http2_mode:
+            return HTTPConnection.simple_response(
+                self, status_code, msg=msg, close_after_response=close_after_response, extra_headers=extra_headers)
+        self.h2_simple_response(self.h2_active_stream, status_code, msg, extra_headers=extra_headers)
+
+    def send_not_modified(self, etag=None):
+        if not self.in_http2_mode:
+            return HTTPConnection.send_not_modified(self, etag)
+        headers = [(b'date', as_bytes(http_date()))]
+        if etag is not None:
+            headers.append((b'etag', as_bytes(etag)))
+        self.log_access(status_code=httplib.NOT_MODIFIED)
+        self.h2_start_response(self.h2_active_stream, httplib.NOT_MODIFIED, headers)
+
+    def send_range_not_satisfiable(self, content_length):
+        if not self.in_http2_mode:
+            return HTTPConnection.send_range_not_satisfiable(self, content_length)
+        headers = [(b'content-range', b'bytes */%d' % content_length), (b'date', as_bytes(http_date()))]
+        self.log_access(status_code=httplib.REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.h2_start_response(self.h2_active_stream, httplib.REQUESTED_RANGE_NOT_SATISFIABLE, headers)
+    # }}}
+
+    # Writing {{{
+    def h2_unblock(self, stream):
+        if stream.blocked and stream.send_window > 0:
+            stream.blocked = False
+            self.h2_ready.append(stream)
+
+    def h2_write(self):
+        if self.h2_outpos >= len(self.h2_outbuf):
+            self.h2_outbuf, self.h2_outpos = self.h2_fill_output(), 0
+            if not self.h2_outbuf:
+                return
+        sent = self.send(memoryview(self.h2_outbuf)[self.h2_outpos:])
+        self.h2_outpos += sent
+
+    def h2_fill_output(self):
+        parts, size = [], 0
+        control, ready = self.h2_control, self.h2_ready
+        while control:
+            f = control.popleft()
+            parts.append(f)
+            size += len(f)
+        # Send DATA frames from all streams with data in turn, so that
+        # small responses are not stuck behind large ones
+        while ready and size < OUTPUT_BATCH_SIZE and self.h2_send_window > 0:
+            stream = ready.popleft()
+            if stream.local_closed:
+                continue
+            f = self.h2_next_data_frame(stream)
+            if f is not None:
+                parts.append(f)
+                size += len(f)
+            if not stream.local_closed:
+                if stream.send_window > 0:
+                    ready.append(stream)
+                else:
+                    stream.blocked = True
+        return b''.join(parts)
+
+    def h2_next_data_frame(self, stream):
+        limit = min(self.h2_send_window, stream.send_window, self.h2_max_frame_size)
+        pending = stream.pending
+        try:
+            while len(pending) < limit and stream.chunks is not None:
+                try:
+                    chunk = next(stream.chunks)
+                except StopIteration:
+                    stream.chunks = None
+                    break
+                pending = pending + chunk if pending else chunk
+        except Exception:
+            self.log.exception('Failed to generate response for request: %s' % stream.request_line)
+            self.h2_reset_stream(stream.stream_id, INTERNAL_ERROR)
+            return
+        if stream.chunks is None and len(pending) <= limit:
+            payload, stream.pending, flags = pending, b'', END_STREAM
+        elif limit <= 0:
+            stream.pending = pending
+            return
+        else:
+            payload, stream.pending, flags = pending[:limit], pending[limit:], 0
+        sz = len(payload)
+        self.h2_send_window -= sz
+        stream.send_window -= sz
+        transfer_stats.copied += sz
+        if flags & END_STREAM:
+            self.h2_stream_finished(stream)
+        return frame(DATA, flags, stream.stream_id, payload)
+    # }}}
@@ -269,6 +269,10 @@ class HTTPRequest(Connection):
         except Exception:
             return self.simple_response(httplib.BAD_REQUEST, "Malformed Request-Line")
 
+        if self.method == 'PRI' and rp == (2, 0) and uri == b'*':
+            # The start of the HTTP/2 connection preface
+            return self.http2_preface_received()
+
         if self.method not in HTTP_METHODS:
             return self.simple_response(httplib.BAD_REQUEST, "Unknown HTTP method")
 
@@ -305,7 +309,10 @@ class HTTPRequest(Connection):
             self.finalize_headers(parser.hdict)
 
     def finalize_headers(self, inheaders):
-        request_content_length = int(inheaders.get('Content-Length', 0))
+        try:
+            request_content_length = int(inheaders.get('Content-Length', 0))
+        except ValueError:
+            return self.simple_response(httplib.BAD_REQUEST, 'Invalid Content-Length')
         if request_content_length > self.max_request_body_size:
             return self.simple_response(httplib.REQUEST_ENTITY_TOO_LARGE,
                 "The entity sent with the request exceeds the maximum "
@@ -399,6 +406,9 @@ class HTTPRequest(Connection):
         else:
             self.set_state(READ, self.read_chunk_length, inheaders, Accumulator(), buf, bytes_read)
 
+    def http2_preface_received(self):
+        return self.simple_response(httplib.HTTP_VERSION_NOT_SUPPORTED)
+
     def handle_timeout(self):
         if self.response_started:
             return False
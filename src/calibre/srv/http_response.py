@@ -7,22 +7,25 @@ __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import os, httplib, hashlib, uuid, struct, repr as reprlib
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from io import BytesIO, DEFAULT_BUFFER_SIZE
 from itertools import chain, repeat, izip_longest
 from operator import itemgetter
 from functools import wraps
 from future_builtins import map
+from threading import Lock
 
 from calibre import guess_type, force_unicode
 from calibre.constants import __version__, plugins
 from calibre.srv.loop import WRITE
 from calibre.srv.errors import HTTPSimpleResponse
 from calibre.srv.http_request import HTTPRequest, read_headers
-from calibre.srv.sendfile import file_metadata, sendfile_to_socket_async, CannotSendfile, SendfileInterrupted
+from calibre.srv.metrics import request_metrics
+from calibre.srv.sendfile import (
+    file_metadata, sendfile_to_socket_async, CannotSendfile, SendfileInterrupted, transfer_stats)
 from calibre.srv.utils import (
     MultiDict, http_date, HTTP1, HTTP11, socket_errors_socket_closed,
-    sort_q_values, get_translator_for_lang, Cookie, fast_now_strftime)
+    sort_q_values, parse_q_values, get_translator_for_lang, Cookie, fast_now_strftime)
 from calibre.utils.speedups import ReadOnlyFileBuffer
 from calibre.utils.monotonic import monotonic
 
@@ -33,6 +36,12 @@ zlib, zlib2_err = plugins['zlib2']
 if zlib2_err:
     raise RuntimeError('Failed to laod the zlib2 module with error: ' + zlib2_err)
 del zlib2_err
+try:
+    import brotli
+except ImportError:
+    brotli = None
+# brotli compresses better than gzip, so it is preferred if available
+AVAILABLE_ENCODINGS = frozenset({'gzip', 'br'} if brotli is not None else {'gzip'})
 
 
 def header_list_to_file(buf):  # {{{
@@ -83,11 +92,19 @@ def parse_if_none_match(val):  # {{{
 # }}}
 
 
-def acceptable_encoding(val, allowed=frozenset({'gzip'})):  # {{{
-    for x in sort_q_values(val):
+def acceptable_encoding(val, allowed=AVAILABLE_ENCODINGS):  # {{{
+    ans = ans_q = None
+    for x, q in parse_q_values(val):
         x = x.lower()
         if x in allowed:
-            return x
+            if ans is None:
+                ans, ans_q = x, q
+            elif q < ans_q:
+                break
+            elif x == 'br':
+                # Browsers accept gzip and br with the same priority
+                ans = x
+    return ans
 # }}}
 
 
@@ -179,6 +196,105 @@ def compress_readable_output(src_file, compress_level=6):
             data = gzip_prefix() + data
         yield data
     yield zobj.flush() + struct.pack(b"<L", crc & 0xffffffff) + struct.pack(b"<L", size)
+
+
+def brotli_compress_readable_output(src_file, quality=5):
+    compressor = brotli.Compressor(quality=quality)
+    while True:
+        data = src_file.read(DEFAULT_BUFFER_SIZE)
+        if not data:
+            break
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        yield compressor.process(data)
+    yield compressor.finish()
+
+
+def compress_data(data, encoding):
+    ' Compress at the highest level, for data that is compressed only once '
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    return b''.join(compress_readable_output(BytesIO(data), compress_level=9))
+# }}}
+
+
+# Cache of compressed responses {{{
+
+CompressedResponse = namedtuple('CompressedResponse', 'data uncompressed_length content_type')
+# Responses larger than this are compressed on the fly, without being cached
+MAX_CACHED_RESPONSE_SIZE = 8 * 1024 * 1024
+
+
+class CompressedCache(object):
+
+    ''' An LRU cache of compressed responses, keyed by ETag and encoding, so
+    that responses that do not change are compressed only once, at the highest
+    compression level. '''
+
+    def __init__(self):
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+    def get(self, etag, encoding):
+        key = etag, encoding
+        with self.lock:
+            ans = self.items.pop(key, None)
+            if ans is not None:
+                self.items[key] = ans
+            return ans
+
+    def set(self, etag, encoding, item, max_size):
+        key = etag, encoding
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old.data)
+            self.items[key] = item
+            self.size += len(item.data)
+            while self.size > max_size and self.items:
+                self.size -= len(self.items.popitem(last=False)[1].data)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+
+compressed_cache = CompressedCache()
+
+
+def cache_compressed_output(chunks, etag, encoding, uncompressed_length, content_type, max_size):
+    ''' Pass through the chunks of a compressed response, storing the complete
+    response in the cache once it has been sent. Compression happens in the
+    event loop, so it is done incrementally, as the response is sent. '''
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    compressed_cache.set(etag, encoding, CompressedResponse(b''.join(parts), uncompressed_length, content_type), max_size)
+
+
+def precompress_files(paths, opts):
+    ''' Compress the specified files with every available encoding and store
+    them in the cache, so that they are never compressed while a client waits
+    for them. '''
+    max_size = opts.max_compressed_cache_size * 1024 * 1024
+    for path in paths:
+        try:
+            with lopen(path, 'rb') as f:
+                stat_result = os.fstat(f.fileno())
+                if stat_result.st_size > MAX_CACHED_RESPONSE_SIZE:
+                    continue
+                data = f.read()
+        except EnvironmentError:
+            continue
+        # The same ETag as used when the file is served
+        etag = '"%s"' % filesystem_file_etag(path, stat_result)
+        ct = guess_content_type(path)
+        for encoding in AVAILABLE_ENCODINGS:
+            if compressed_cache.get(etag, encoding) is None:
+                compressed_cache.set(etag, encoding, CompressedResponse(compress_data(data, encoding), len(data), ct), max_size)
 # }}}
 
 
@@ -299,10 +415,26 @@ class ReadableOutput(object):
         self.src_file.seek(0)
 
 
+def filesystem_file_etag(name, stat_result):
+    return hashlib.sha1(type('')(stat_result.st_mtime) + force_unicode(name or '')).hexdigest()
+
+
+def guess_content_type(name):
+    mt = guess_type(name)[0]
+    if mt in {'text/plain', 'text/html', 'application/javascript', 'text/css'}:
+        mt += '; charset=UTF-8'
+    return mt
+
+
+def is_compressible(content_type):
+    ct = content_type.partition(';')[0]
+    return not ct or ct.startswith('text/') or ct.startswith('image/svg') or ct in COMPRESSIBLE_TYPES
+
+
 def filesystem_file_output(output, outheaders, stat_result):
     etag = getattr(output, 'etag', None)
     if etag is None:
-        etag = hashlib.sha1(type('')(stat_result.st_mtime) + force_unicode(output.name or '')).hexdigest()
+        etag = filesystem_file_etag(output.name, stat_result)
     else:
         output = output.output
     etag = '"%s"' % etag
@@ -345,17 +477,25 @@ class GeneratedOutput(object):
 
 class StaticOutput(object):
 
-    def __init__(self, data):
+    def __init__(self, data, etag=None):
         if isinstance(data, type('')):
             data = data.encode('utf-8')
         self.data = data
-        self.etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        self.etag = etag or '"%s"' % hashlib.sha1(data).hexdigest()
         self.content_length = len(data)
 
 
 class HTTPConnection(HTTPRequest):
 
     use_sendfile = False
+    copy_buffer = None
+
+    def read_file_chunk(self, f, size):
+        # Re-use the same buffer for every chunk of files that cannot be sent
+        # with sendfile(), for example, over SSL connections
+        if self.copy_buffer is None or len(self.copy_buffer) < size:
+            self.copy_buffer = bytearray(size)
+        return memoryview(self.copy_buffer)[:f.readinto(memoryview(self.copy_buffer)[:size])]
 
     def write(self, buf, end=None):
         pos = buf.tell()
@@ -386,9 +526,14 @@ class HTTPConnection(HTTPRequest):
                 # another process?
                 self.use_sendfile = self.ready = False
                 raise IOError('sendfile() failed to write any bytes to the socket')
+            transfer_stats.zero_copy += sent
         else:
-            data = buf.read(min(limit, self.send_bufsize))
+            if isinstance(buf, (BytesIO, ReadOnlyFileBuffer)) or not hasattr(buf, 'readinto'):
+                data = buf.read(min(limit, self.send_bufsize))
+            else:
+                data = self.read_file_chunk(buf, min(limit, self.send_bufsize))
             sent = self.send(data)
+            transfer_stats.copied += sent
         buf.seek(pos + sent)
         return buf.tell() >= end
 
@@ -632,14 +777,16 @@ class HTTPConnection(HTTPRequest):
 
         opts = self.opts
         outheaders = request.outheaders
+        encoding = None
+        if not is_http1 and request.status_code == httplib.OK and opts.compress_min_size > -1:
+            encoding = acceptable_encoding(request.inheaders.get('Accept-Encoding', ''))
+        cached = None
         stat_result = file_metadata(output)
         if stat_result is not None:
             output = filesystem_file_output(output, outheaders, stat_result)
             if 'Content-Type' not in outheaders:
-                mt = guess_type(output.name)[0]
+                mt = guess_content_type(output.name)
                 if mt:
-                    if mt in {'text/plain', 'text/html', 'application/javascript', 'text/css'}:
-                        mt += '; charset=UTF-8'
                     outheaders['Content-Type'] = mt
         elif isinstance(output, (bytes, type(''))):
             output = dynamic_output(output, outheaders)
@@ -648,15 +795,20 @@ class HTTPConnection(HTTPRequest):
         elif isinstance(output, StaticOutput):
             output = ReadableOutput(ReadOnlyFileBuffer(output.data), etag=output.etag, content_length=output.content_length)
         elif isinstance(output, ETaggedDynamicOutput):
-            output = dynamic_output(output(), outheaders, etag=output.etag)
+            cached = compressed_cache.get(output.etag, encoding) if encoding else None
+            if cached is None:
+                output = dynamic_output(output(), outheaders, etag=output.etag)
+            else:
+                # No need to generate the response again
+                if cached.content_type:
+                    outheaders.set('Content-Type', cached.content_type, replace_all=True)
+                output = ReadableOutput(ReadOnlyFileBuffer(b''), etag=output.etag, content_length=cached.uncompressed_length)
+                output.accept_ranges = False
         else:
             output = GeneratedOutput(output)
-        ct = outheaders.get('Content-Type', '').partition(';')[0]
-        compressible = (not ct or ct.startswith('text/') or ct.startswith('image/svg') or
-                        ct.partition(';')[0] in COMPRESSIBLE_TYPES)
-        compressible = (compressible and request.status_code == httplib.OK and
-                        (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and
-                        acceptable_encoding(request.inheaders.get('Accept-Encoding', '')) and not is_http1)
+        compressible = cached is not None or (
+            encoding and request.status_code == httplib.OK and is_compressible(outheaders.get('Content-Type', '')) and
+            output.content_length >= opts.compress_min_size)
         accept_ranges = (not compressible and output.accept_ranges is not None and request.status_code == httplib.OK and
                         not is_http1)
         ranges = get_ranges(request.inheaders.get('Range'), output.content_length) if output.accept_ranges and self.method in ('GET', 'HEAD') else None
@@ -684,10 +836,25 @@ class HTTPConnection(HTTPRequest):
         if accept_ranges:
             outheaders.set('Accept-Ranges', 'bytes', replace_all=True)
         if compressible and not ranges:
-            outheaders.set('Content-Encoding', 'gzip', replace_all=True)
+            outheaders.set('Content-Encoding', encoding, replace_all=True)
             if getattr(output, 'content_length', None):
                 outheaders.set('Calibre-Uncompressed-Length', '%d' % output.content_length)
-            output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
+            if cached is None and output.etag:
+                cached = compressed_cache.get(output.etag, encoding)
+            if output.etag:
+                request_metrics.cache_used('compressed', cached is not None)
+            if cached is None:
+                compress = brotli_compress_readable_output if encoding == 'br' else compress_readable_output
+                chunks = compress(output.src_file)
+                if output.etag and output.content_length <= MAX_CACHED_RESPONSE_SIZE and opts.max_compressed_cache_size > 0:
+                    chunks = cache_compressed_output(
+                        chunks, output.etag, encoding, output.content_length, outheaders.get('Content-Type'),
+                        opts.max_compressed_cache_size * 1024 * 1024)
+                output = GeneratedOutput(chunks, etag=output.etag)
+            else:
+                output = ReadableOutput(ReadOnlyFileBuffer(cached.data), etag=output.etag, content_length=len(cached.data))
+                output.ranges = None
+                compressible = False
         if output.content_length is not None and not compressible and not ranges:
             outheaders.set('Content-Length', '%d' % output.content_length, replace_all=True)
 
@@ -4,9 +4,9 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import os
+import gc, os
 from collections import OrderedDict, defaultdict
-from threading import RLock as Lock
+from threading import Lock as LoadLock, RLock as Lock
 
 from calibre import filesystem_encoding
 from calibre.db.cache import Cache
@@ -14,6 +14,8 @@ from calibre.db.legacy import LibraryDatabase, create_backend, set_global_state
 from calibre.utils.filenames import samefile as _samefile
 from calibre.utils.monotonic import monotonic
 
+EXPIRED_AGE = 300  # seconds
+
 
 def canonicalize_path(p):
     if isinstance(p, bytes):
@@ -87,37 +89,112 @@ class LibraryBroker(object):
             self.library_name_map[library_id] = basename(original_path)
             self.original_path_map[path] = original_path
         self.loaded_dbs = {}
-        self.category_caches, self.search_caches, self.tag_browser_caches = (
-            defaultdict(OrderedDict), defaultdict(OrderedDict),
-            defaultdict(OrderedDict))
+        # Libraries are loaded outside the broker lock, so that loading a large
+        # library does not block requests for the other libraries
+        self.load_locks = defaultdict(LoadLock)
+        self.last_used_times = defaultdict(lambda: -EXPIRED_AGE)
+        (self.category_caches, self.search_caches, self.tag_browser_caches, self.allowed_ids_caches,
+         self.sort_caches, self.category_index_caches) = (
+            defaultdict(OrderedDict), defaultdict(OrderedDict), defaultdict(OrderedDict),
+            defaultdict(OrderedDict), defaultdict(OrderedDict), defaultdict(OrderedDict))
 
     def get(self, library_id=None):
         with self:
             library_id = library_id or self.default_library
+            self.last_used_times[library_id] = monotonic()
             if library_id in self.loaded_dbs:
                 return self.loaded_dbs[library_id]
             path = self.lmap.get(library_id)
             if path is None:
                 return
+            is_default_library = library_id == self.default_library
+            load_lock = self.load_locks[library_id]
+        with load_lock:
+            with self:
+                if library_id in self.loaded_dbs:
+                    # Loaded by another thread while we were waiting
+                    return self.loaded_dbs[library_id]
             try:
-                self.loaded_dbs[library_id] = ans = self.init_library(
-                    path, library_id == self.default_library)
+                ans = self.init_library(path, is_default_library)
                 ans.new_api.server_library_id = library_id
             except Exception:
-                self.loaded_dbs[library_id] = None
+                with self:
+                    if self.lmap.get(library_id) == path:
+                        self.loaded_dbs[library_id] = None
                 raise
-            return ans
+            with self:
+                if self.lmap.get(library_id) == path:
+                    self.loaded_dbs[library_id] = ans
+                    return ans
+        # The library was removed or the broker closed while it was loading
+        self.close_db(ans)
 
     def init_library(self, library_path, is_default_library):
         library_path = self.original_path_map.get(library_path, library_path)
         return init_library(library_path, is_default_library)
 
+    def library_changed(self, library_path, book_ids=None):
+        ''' Reload the library at library_path, after it was changed by another
+        process. If book_ids is not None, only the data for those books is
+        reloaded. '''
+        path = canonicalize_path(library_path)
+        with self:
+            for library_id, lpath in self.lmap.iteritems():
+                if lpath == path:
+                    break
+            else:
+                return
+            for cache in (self.category_caches, self.search_caches, self.tag_browser_caches, self.allowed_ids_caches,
+                          self.sort_caches, self.category_index_caches):
+                cache.pop(library_id, None)
+            db = self.loaded_dbs.get(library_id)
+        if db is not None:
+            if book_ids is None:
+                db.reload_from_db()
+            else:
+                db.reload_books_from_db(book_ids)
+
     def close(self):
         with self:
             for db in self.loaded_dbs.itervalues():
                 getattr(db, 'close', lambda: None)()
             self.lmap, self.loaded_dbs = OrderedDict(), {}
 
+    def close_db(self, db):
+        db.close()
+        getattr(db, 'break_cycles', lambda: None)()
+
+    @property
+    def pinned_library_id(self):
+        ' The library that is never closed by prune_loaded_dbs() '
+        return self.default_library if self.lmap else None
+
+    def _prune_loaded_dbs(self, max_memory=0):
+        now = monotonic()
+        idle = sorted(
+            (self.last_used_times[library_id], library_id) for library_id in self.loaded_dbs
+            if library_id != self.pinned_library_id and now - self.last_used_times[library_id] > EXPIRED_AGE)
+        for last_used, library_id in idle:
+            if max_memory > 0:
+                from calibre.utils.mem import get_memory
+                gc.collect()
+                if get_memory() <= max_memory:
+                    break
+            db = self.loaded_dbs.pop(library_id)
+            for cache in (self.category_caches, self.search_caches, self.tag_browser_caches, self.allowed_ids_caches,
+                          self.sort_caches, self.category_index_caches):
+                cache.pop(library_id, None)
+            if db is not None:
+                self.close_db(db)
+
+    def prune_loaded_dbs(self, max_memory=0):
+        ''' Close the libraries that have not been used for EXPIRED_AGE seconds.
+        If max_memory (in bytes) is positive, libraries are closed, least
+        recently used first, only while the memory used by this process is more
+        than it. '''
+        with self:
+            self._prune_loaded_dbs(max_memory)
+
     @property
     def default_library(self):
         return next(self.lmap.iterkeys())
@@ -142,9 +219,6 @@ class LibraryBroker(object):
         self.lock.release()
 
 
-EXPIRED_AGE = 300  # seconds
-
-
 def load_gui_libraries(gprefs=None):
     if gprefs is None:
         from calibre.utils.config import JSONConfig
@@ -161,7 +235,6 @@ class GuiLibraryBroker(LibraryBroker):
 
     def __init__(self, db):
         from calibre.gui2 import gprefs
-        self.last_used_times = defaultdict(lambda: -EXPIRED_AGE)
         self.gui_library_id = None
         LibraryBroker.__init__(self, load_gui_libraries(gprefs))
         self.gui_library_changed(db)
@@ -171,10 +244,7 @@ class GuiLibraryBroker(LibraryBroker):
         return LibraryDatabase(library_path, is_second_db=True)
 
     def get(self, library_id=None):
-        try:
-            return getattr(LibraryBroker.get(self, library_id), 'new_api', None)
-        finally:
-            self.last_used_times[library_id or self.default_library] = monotonic()
+        return getattr(LibraryBroker.get(self, library_id), 'new_api', None)
 
     def get_library(self, original_library_path):
         library_path = canonicalize_path(original_library_path)
@@ -240,18 +310,9 @@ class GuiLibraryBroker(LibraryBroker):
                 return samefile(library_path, self.lmap[self.gui_library_id])
             return False
 
-    def _prune_loaded_dbs(self):
-        now = monotonic()
-        for library_id in tuple(self.loaded_dbs):
-            if library_id != self.gui_library_id and now - self.last_used_times[
-                library_id] > EXPIRED_AGE:
-                db = self.loaded_dbs.pop(library_id)
-                db.close()
-                db.break_cycles()
-
-    def prune_loaded_dbs(self):
-        with self:
-            self._prune_loaded_dbs()
+    @property
+    def pinned_library_id(self):
+        return self.gui_library_id
 
     def unload_library(self, library_path):
         with self:
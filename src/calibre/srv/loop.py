@@ -17,6 +17,7 @@ from calibre.srv.errors import JobQueueFull
 from calibre.srv.pool import ThreadPool, PluginPool
 from calibre.srv.opts import Options
 from calibre.srv.jobs import JobsManager
+from calibre.srv.poller import create_poller, POLL_READ, POLL_WRITE
 from calibre.srv.utils import (
     socket_errors_socket_closed, socket_errors_nonblocking, HandleInterrupt,
     socket_errors_eintr, start_cork, stop_cork, DESIRED_SEND_BUFFER_SIZE,
@@ -28,6 +29,7 @@ from calibre.utils.mdns import get_external_ip
 
 READ, WRITE, RDWR, WAIT = 'READ', 'WRITE', 'RDWR', 'WAIT'
 WAKEUP, JOB_DONE = bytes(bytearray(xrange(2)))
+INTEREST = {READ: POLL_READ, WRITE: POLL_WRITE, RDWR: POLL_READ | POLL_WRITE, WAIT: 0}
 
 
 class ReadBuffer(object):  # {{{
@@ -120,6 +122,11 @@ class ReadBuffer(object):  # {{{
 
 class Connection(object):  # {{{
 
+    _wait_for = None
+    # Called with no arguments whenever wait_for changes, set by the server
+    # loop. Can be called from any thread.
+    state_changed = None
+
     def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log, wakeup):
         self.opts, self.pool, self.log, self.wakeup, self.access_log = opts, pool, log, wakeup, access_log
         try:
@@ -164,6 +171,17 @@ class Connection(object):  # {{{
         if self.send_bufsize != self.orig_send_bufsize:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.orig_send_bufsize)
 
+    @property
+    def wait_for(self):
+        return self._wait_for
+
+    @wait_for.setter
+    def wait_for(self, val):
+        if val is not self._wait_for:
+            self._wait_for = val
+            if self.state_changed is not None:
+                self.state_changed()
+
     def set_state(self, wait_for, func, *args, **kwargs):
         self.wait_for = wait_for
         if args or kwargs:
@@ -330,6 +348,8 @@ class Connection(object):  # {{{
 class ServerLoop(object):
 
     LISTENING_MSG = 'calibre server listening on'
+    # The poller to use, see calibre.srv.poller. None means the best available
+    POLLER = None
 
     def __init__(
         self,
@@ -357,12 +377,18 @@ class ServerLoop(object):
         self.bind_address = ba
         self.bound_address = None
         self.connection_map = {}
+        self.poller = None
+        # The file descriptors of connections that must be re-synced with the
+        # poller, because their state changed or they handled an event
+        self.changed_connections = set()
 
         self.ssl_context = None
         if self.opts.ssl_certfile is not None and self.opts.ssl_keyfile is not None:
             self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
             self.ssl_context.load_cert_chain(certfile=self.opts.ssl_certfile, keyfile=self.opts.ssl_keyfile)
             self.ssl_context.set_servername_callback(self.on_ssl_servername)
+            if self.opts.use_http2 and getattr(ssl, 'HAS_ALPN', False):
+                self.ssl_context.set_alpn_protocols(['h2', 'http/1.1'])
 
         self.pre_activated_socket = None
         if self.opts.allow_socket_preallocation:
@@ -385,7 +411,11 @@ class ServerLoop(object):
             return ssl.ALERT_DESCRIPTION_NO_RENEGOTIATION
 
     def create_control_connection(self):
+        if self.poller is not None:
+            self.poller.unregister(self.control_out.fileno())
         self.control_in, self.control_out = create_sock_pair()
+        if self.poller is not None:
+            self.poller.set_interest(self.control_out.fileno(), POLL_READ)
 
     def __str__(self):
         return "%s(%r)" % (self.__class__.__name__, self.bind_address)
@@ -447,7 +477,14 @@ class ServerLoop(object):
 
     def serve(self):
         self.connection_map = {}
+        self.changed_connections.clear()
         self.socket.listen(min(socket.SOMAXCONN, 128))
+        self.poller = create_poller(self.POLLER)
+        self.poller.set_interest(self.socket.fileno(), POLL_READ)
+        self.poller.set_interest(self.control_out.fileno(), POLL_READ)
+        # Inactive connections are looked for periodically, not on every tick
+        self.timeout_check_interval = min(1.0, self.opts.timeout / 10)
+        self.next_timeout_check = monotonic() + self.timeout_check_interval
         self.bound_address = ba = self.socket.getsockname()
         if isinstance(ba, tuple):
             ba = ':'.join(map(type(''), ba))
@@ -478,6 +515,10 @@ class ServerLoop(object):
 
     def setup_socket(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.opts.server_processes > 0:
+            # Every server process binds its own socket to the same port and
+            # the kernel distributes connections between them
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         # If listening on the IPV6 any address ('::' = IN6ADDR_ANY),
@@ -502,54 +543,28 @@ class ServerLoop(object):
 
     def tick(self):
         now = monotonic()
-        read_needed, write_needed, readable, remove, close_needed = [], [], [], [], []
-        has_ssl = self.ssl_context is not None
-        for s, conn in self.connection_map.iteritems():
-            if now - conn.last_activity > self.opts.timeout:
-                if conn.handle_timeout():
-                    conn.last_activity = now
-                else:
-                    remove.append((s, conn))
-                    continue
-            wf = conn.wait_for
-            if wf is READ or wf is RDWR:
-                if wf is RDWR:
-                    write_needed.append(s)
-                if conn.read_buffer.has_data:
-                    readable.append(s)
-                else:
-                    if has_ssl:
-                        conn.drain_ssl_buffer()
-                        if conn.ready:
-                            (readable if conn.read_buffer.has_data else read_needed).append(s)
-                        else:
-                            close_needed.append((s, conn))
-                    else:
-                        read_needed.append(s)
-            elif wf is WRITE:
-                write_needed.append(s)
-
-        for s, conn in remove:
-            self.log('Closing connection because of extended inactivity: %s' % conn.state_description)
-            self.close(s, conn)
-
-        for x, conn in close_needed:
-            self.close(s, conn)
-
+        if now >= self.next_timeout_check:
+            self.close_inactive_connections(now)
+        readable = self.sync_changed_connections()
         if readable:
-            writable = []
+            # Connections with buffered data are handled without waiting
+            timeout = 0
+        elif self.connection_map:
+            timeout = max(0, self.next_timeout_check - now)
         else:
-            try:
-                readable, writable, _ = select.select([self.socket.fileno(), self.control_out.fileno()] + read_needed, write_needed, [], self.opts.timeout)
-            except ValueError:  # self.socket.fileno() == -1
-                self.ready = False
-                self.log.error('Listening socket was unexpectedly terminated')
+            timeout = self.opts.timeout
+        try:
+            polled, writable = self.poller.poll(timeout)
+        except ValueError:  # self.socket.fileno() == -1
+            self.ready = False
+            self.log.error('Listening socket was unexpectedly terminated')
+            return
+        except (select.error, socket.error) as e:
+            # select.error has no errno attribute. errno is instead
+            # e.args[0]
+            if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
                 return
-            except (select.error, socket.error) as e:
-                # select.error has no errno attribute. errno is instead
-                # e.args[0]
-                if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
-                    return
+            if self.poller.name == 'select':
                 for s, conn in tuple(self.connection_map.iteritems()):
                     try:
                         select.select([s], [], [], 0)
@@ -557,14 +572,22 @@ class ServerLoop(object):
                         if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
                             self.close(s, conn)  # Bad socket, discard
                 return
+            raise
+        if readable:
+            buffered = set(readable).difference(polled)
+            readable = polled + [s for s in readable if s in buffered]
+        else:
+            readable = polled
 
         if not self.ready:
             return
 
         ignore = set()
+        changed = self.changed_connections
         for s, conn, event in self.get_actions(readable, writable):
             if s in ignore:
                 continue
+            changed.add(s)
             try:
                 conn.handle_event(event)
                 if not conn.ready:
@@ -599,6 +622,48 @@ class ServerLoop(object):
                         self.log.error('Error in SSL handshake, terminating connection: %s' % as_unicode(e))
                         self.close(s, conn)
 
+    def close_inactive_connections(self, now):
+        self.next_timeout_check = now + self.timeout_check_interval
+        for s, conn in tuple(self.connection_map.iteritems()):
+            if now - conn.last_activity > self.opts.timeout:
+                if conn.handle_timeout():
+                    conn.last_activity = now
+                else:
+                    self.log('Closing connection because of extended inactivity: %s' % conn.state_description)
+                    self.close(s, conn)
+
+    def sync_changed_connections(self):
+        ''' Update the interest of the poller in connections whose state has
+        changed. Returns the connections that have buffered data to read, which
+        must be handled even if their sockets are not readable. '''
+        readable = []
+        changed, connection_map = self.changed_connections, self.connection_map
+        has_ssl = self.ssl_context is not None
+        while changed:
+            try:
+                s = changed.pop()
+            except KeyError:
+                break  # emptied by another thread
+            conn = connection_map.get(s)
+            if conn is None:
+                continue
+            wf = conn.wait_for
+            if wf is READ or wf is RDWR:
+                if has_ssl and not conn.read_buffer.has_data:
+                    # Data already decrypted by OpenSSL does not make the
+                    # socket readable
+                    conn.drain_ssl_buffer()
+                    if not conn.ready:
+                        self.close(s, conn)
+                        continue
+                if conn.read_buffer.has_data:
+                    readable.append(s)
+            try:
+                self.poller.set_interest(s, INTEREST[wf])
+            except EnvironmentError:
+                self.close(s, conn)  # Bad socket, discard
+        return readable
+
     def wakeup(self):
         self.control_in.sendall(WAKEUP)
 
@@ -617,6 +682,9 @@ class ServerLoop(object):
 
     def close(self, s, conn):
         self.connection_map.pop(s, None)
+        self.changed_connections.discard(s)
+        if self.poller is not None:
+            self.poller.unregister(s)
         conn.close()
 
     def get_actions(self, readable, writable):
@@ -630,6 +698,8 @@ class ServerLoop(object):
                     if s > -1:
                         self.connection_map[s] = conn = self.handler(
                             sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
+                        conn.state_changed = partial(self.changed_connections.add, s)
+                        self.changed_connections.add(s)
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
             elif s == control:
@@ -652,7 +722,9 @@ class ServerLoop(object):
                     self.log.error('Control socket failed to recv(), resetting')
                     self.create_control_connection()
             else:
-                yield s, self.connection_map[s], READ
+                conn = self.connection_map.get(s)
+                if conn is not None:
+                    yield s, conn, READ
         for s in writable:
             try:
                 conn = self.connection_map[s]
@@ -682,6 +754,9 @@ class ServerLoop(object):
             pass
         for s, conn in tuple(self.connection_map.iteritems()):
             self.close(s, conn)
+        if self.poller is not None:
+            self.poller.close()
+            self.poller = None
         wait_till = monotonic() + self.opts.shutdown_timeout
         for pool in (self.plugin_pool, self.pool):
             pool.stop(wait_till)
@@ -43,10 +43,9 @@ empty_val = ((), '', {})
 passthrough_comment_types = {'long-text', 'short-text'}
 
 
-def add_field(field, db, book_id, ans, field_metadata):
+def add_field(field, val, ans, field_metadata):
     datatype = field_metadata.get('datatype')
     if datatype is not None:
-        val = db._field_for(field, book_id)
         if val is not None and val not in empty_val:
             if datatype == 'datetime':
                 val = encode_datetime(val)
@@ -65,29 +64,39 @@ def add_field(field, db, book_id, ans, field_metadata):
 
 
 def book_as_json(db, book_id):
+    return books_as_json(db, (book_id,)).get(book_id)
+
+
+def books_as_json(db, book_ids):
+    ''' Return a dict mapping book ids to the metadata of the books, as
+    JSON serializable dicts. Books that do not exist are omitted. The field
+    values for all books are read at once. '''
     db = db.new_api
+    book_ids = tuple(book_ids)
+    ans = {}
     with db.safe_read_lock:
-        fmts = db._formats(book_id, verify_formats=False)
-        ans = []
-        fm = {}
-        for fmt in fmts:
-            m = db.format_metadata(book_id, fmt)
-            if m and m.get('size', 0) > 0:
-                ans.append(fmt)
-                fm[fmt] = m['size']
-        ans = {'formats': ans, 'format_sizes': fm}
-        if not ans['formats'] and not db.has_id(book_id):
-            return None
         fm = db.field_metadata
-        for field in fm.all_field_keys():
-            if field not in IGNORED_FIELDS:
-                add_field(field, db, book_id, ans, fm[field])
-        ids = ans.get('identifiers')
-        if ids:
-            ans['urls_from_identifiers'] = urls_from_identifiers(ids)
-        langs = ans.get('languages')
-        if langs:
-            ans['lang_names'] = {l:calibre_langcode_to_name(l) for l in langs}
+        fields = tuple(field for field in fm.all_field_keys() if field not in IGNORED_FIELDS)
+        values = db._fields_for_books(fields, book_ids)
+        for book_id in book_ids:
+            fmts = db._formats(book_id, verify_formats=False)
+            formats, sizes = [], {}
+            for fmt in fmts:
+                m = db.format_metadata(book_id, fmt)
+                if m and m.get('size', 0) > 0:
+                    formats.append(fmt)
+                    sizes[fmt] = m['size']
+            if not formats and not db.has_id(book_id):
+                continue
+            data = ans[book_id] = {'formats': formats, 'format_sizes': sizes}
+            for field in fields:
+                add_field(field, values[field][book_id], data, fm[field])
+            ids = data.get('identifiers')
+            if ids:
+                data['urls_from_identifiers'] = urls_from_identifiers(ids)
+            langs = data.get('languages')
+            if langs:
+                data['lang_names'] = {l:calibre_langcode_to_name(l) for l in langs}
     return ans
 
 
@@ -0,0 +1,219 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+import errno, os, re, time
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+
+from calibre.constants import cache_dir
+from calibre.srv.pool import thread_pools
+from calibre.srv.sendfile import transfer_stats
+from calibre.utils.monotonic import monotonic
+
+# The upper bounds (in seconds) of the buckets of the request latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# The number of profiles of slow requests that are kept on disk
+MAX_STORED_PROFILES = 50
+
+
+class Histogram(object):
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, val):
+        idx = bisect_left(LATENCY_BUCKETS, val)
+        if idx < len(self.counts):
+            self.counts[idx] += 1
+        self.total += val
+        self.count += 1
+
+    def cumulative_counts(self):
+        ans, total = [], 0
+        for c in self.counts:
+            total += c
+            ans.append(total)
+        return ans
+
+
+class RequestMetrics(object):
+
+    ''' Statistics about the requests handled by the server in this process,
+    served in the Prometheus text format by the /metrics endpoint in code.py '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.latencies = defaultdict(Histogram)
+        self.responses = defaultdict(int)
+        self.caches = defaultdict(lambda: [0, 0])
+
+    def record_request(self, route, status_code, duration):
+        with self.lock:
+            self.latencies[route].add(duration)
+            self.responses[(route, status_code)] += 1
+
+    def cache_used(self, name, hit):
+        with self.lock:
+            self.caches[name][0 if hit else 1] += 1
+
+    def clear(self):
+        with self.lock:
+            self.latencies.clear(), self.responses.clear(), self.caches.clear()
+
+    def render(self):
+        lines = []
+        a = lines.append
+
+        def metric(name, mtype, doc):
+            a('# HELP %s %s' % (name, doc))
+            a('# TYPE %s %s' % (name, mtype))
+
+        with self.lock:
+            latencies = {k:(v.cumulative_counts(), v.total, v.count) for k, v in self.latencies.iteritems()}
+            responses = dict(self.responses)
+            caches = {k:tuple(v) for k, v in self.caches.iteritems()}
+
+        name = 'calibre_server_request_duration_seconds'
+        metric(name, 'histogram', 'Time taken to handle requests, by route')
+        for route in sorted(latencies):
+            counts, total, count = latencies[route]
+            r = label_value(route)
+            for le, c in zip(LATENCY_BUCKETS, counts):
+                a('%s_bucket{route="%s",le="%s"} %d' % (name, r, le, c))
+            a('%s_bucket{route="%s",le="+Inf"} %d' % (name, r, count))
+            a('%s_sum{route="%s"} %s' % (name, r, repr(total)))
+            a('%s_count{route="%s"} %d' % (name, r, count))
+
+        name = 'calibre_server_responses_total'
+        metric(name, 'counter', 'Number of responses, by route and status code')
+        for (route, status_code), count in sorted(responses.iteritems()):
+            a('%s{route="%s",code="%d"} %d' % (name, label_value(route), status_code, count))
+
+        name = 'calibre_server_cache_lookups_total'
+        metric(name, 'counter', 'Number of lookups in the caches of the server, by result')
+        for cache in sorted(caches):
+            for result, count in zip(('hit', 'miss'), caches[cache]):
+                a('%s{cache="%s",result="%s"} %d' % (name, label_value(cache), result, count))
+
+        pools = tuple(thread_pools)
+        for name, doc, val in (
+            ('calibre_server_worker_threads', 'Number of threads that handle requests', sum(len(p.workers) for p in pools)),
+            ('calibre_server_busy_worker_threads', 'Number of threads that are handling a request', sum(p.busy for p in pools)),
+            ('calibre_server_queued_requests', 'Number of requests waiting for a thread', sum(p.request_queue.qsize() for p in pools)),
+        ):
+            metric(name, 'gauge', doc)
+            a('%s %d' % (name, val))
+
+        name = 'calibre_server_rejected_requests_total'
+        metric(name, 'counter', 'Number of requests rejected because all threads were busy')
+        a('%s %d' % (name, sum(p.rejected for p in pools)))
+
+        name = 'calibre_server_sent_bytes_total'
+        metric(name, 'counter', 'Number of bytes of files and responses sent, by method')
+        a('%s{method="sendfile"} %d' % (name, transfer_stats.zero_copy))
+        a('%s{method="copy"} %d' % (name, transfer_stats.copied))
+        a('')
+        return '\n'.join(lines).encode('utf-8')
+
+
+request_metrics = RequestMetrics()
+
+
+def label_value(x):
+    return x.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class RequestProfiler(object):
+
+    ''' Run a sample of the requests under cProfile and store the statistics
+    of the ones that take longer than the profile_slow_requests option. '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counter = 0
+
+    def start(self, opts):
+        if opts is None or opts.profile_slow_requests <= 0:
+            return
+        with self.lock:
+            self.counter += 1
+            if self.counter < opts.profile_sample_interval:
+                return
+            self.counter = 0
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile, duration, ctx, data):
+        profile.disable()
+        if duration < ctx.opts.profile_slow_requests:
+            return
+        log = getattr(ctx, 'log', None)
+        try:
+            path = self.save(profile, ctx, data)
+        except Exception:
+            # Failing to save the profile must not fail the request
+            if log is None:
+                import traceback
+                traceback.print_exc()
+            else:
+                log.exception('Failed to save the profile of the request for /%s' % '/'.join(data.path))
+            return
+        if log is not None:
+            log.warn('Request for /%s took %.2f seconds, profile saved to: %s' % ('/'.join(data.path), duration, path))
+
+    def save(self, profile, ctx, data):
+        location = os.path.join(data.tdir if ctx.testing else cache_dir(), 'server-profiles')
+        try:
+            os.makedirs(location)
+        except EnvironmentError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        name = re.sub(r'[^a-zA-Z0-9]+', '_', '/'.join(data.path)).strip('_')[:50] or 'root'
+        path = os.path.join(location, '%s-%d-%s.prof' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid(), name))
+        with self.lock:
+            profile.dump_stats(path)
+            profiles = sorted(x for x in os.listdir(location) if x.endswith('.prof'))
+            for x in profiles[:-MAX_STORED_PROFILES]:
+                os.remove(os.path.join(location, x))
+        return path
+
+
+request_profiler = RequestProfiler()
+
+
+class TimedRequest(object):
+
+    ' Record the time taken by a request and profile it, if needed '
+
+    __slots__ = ('route', 'ctx', 'data', 'profile', 'started')
+
+    def __init__(self, route, ctx, data):
+        self.route, self.ctx, self.data = route, ctx, data
+        self.profile = request_profiler.start(getattr(ctx, 'opts', None))
+        self.started = monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        duration = monotonic() - self.started
+        if exc_type is None:
+            status_code = self.data.status_code
+        else:
+            status_code = getattr(exc_value, 'http_code', 500)
+        request_metrics.record_request(self.route, status_code, duration)
+        if self.profile is not None:
+            request_profiler.finish(self.profile, duration, self.ctx, self.data)
+
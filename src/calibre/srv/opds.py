@@ -7,7 +7,7 @@ __docformat__ = 'restructuredtext en'
 
 import hashlib, binascii
 from functools import partial
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict, defaultdict, namedtuple
 from urllib import urlencode
 
 from lxml import etree, html
@@ -252,6 +252,8 @@ default_feed_title = __appname__ + ' ' + _('Library')
 
 class Feed(object):  # {{{
 
+    entries = ()
+
     def __init__(self, id_, updated, request_context, subtitle=None,
             title=None,
             up_link=None, first_link=None, last_link=None,
@@ -281,6 +283,17 @@ class Feed(object):  # {{{
         if subtitle:
             self.root.insert(1, SUBTITLE(subtitle))
 
+    def serialize(self):
+        ''' Serialize the feed. The entries are created and serialized one at
+        a time, so that the tree for all of them is never in memory. '''
+        head = etree.tostring(self.root, encoding='utf-8', xml_declaration=True, pretty_print=True)
+        head, tail = head.rpartition(b'</feed>')[::2]
+        ans = [head]
+        for entry in self.entries:
+            ans.append(etree.tostring(entry, encoding='utf-8', pretty_print=True))
+        ans.append(b'</feed>' + tail)
+        return b''.join(ans)
+
     # }}}
 
 
@@ -334,8 +347,7 @@ class AcquisitionFeed(NavFeed):
 
     def __init__(self, id_, updated, request_context, items, offsets, page_url, up_url, title=None):
         NavFeed.__init__(self, id_, updated, request_context, offsets, page_url, up_url, title=title)
-        for book_id in items:
-            self.root.append(ACQUISITION_ENTRY(book_id, updated, request_context))
+        self.entries = (ACQUISITION_ENTRY(book_id, updated, request_context) for book_id in items)
 
 
 class CategoryFeed(NavFeed):
@@ -345,17 +357,38 @@ class CategoryFeed(NavFeed):
         ignore_count = False
         if which == 'search':
             ignore_count = True
-        for item in items:
-            self.root.append(CATALOG_ENTRY(
-                item, item.category, request_context, updated, which, ignore_count=ignore_count, add_kind=which != item.category))
+        self.entries = (CATALOG_ENTRY(
+            item, item.category, request_context, updated, which, ignore_count=ignore_count, add_kind=which != item.category)
+            for item in items)
 
 
 class CategoryGroupFeed(NavFeed):
 
     def __init__(self, items, which, id_, updated, request_context, offsets, page_url, up_url, title=None):
         NavFeed.__init__(self, id_, updated, request_context, offsets, page_url, up_url, title=title)
-        for item in items:
-            self.root.append(CATALOG_GROUP_ENTRY(item, which, request_context, updated))
+        self.entries = (CATALOG_GROUP_ENTRY(item, which, request_context, updated) for item in items)
+
+
+Group = namedtuple('Group', 'text count')
+
+
+def group_for_item(item):
+    val = getattr(item, 'sort', item.name) or 'A'
+    return val[0].upper()
+
+
+class CategoryIndex(object):
+
+    ''' The items of a category, and the items grouped by the first letter of
+    their sort value, so that pages of large categories can be created
+    without looking at all their items. '''
+
+    def __init__(self, items):
+        self.items = tuple(items)
+        groups = defaultdict(list)
+        for item in self.items:
+            groups[group_for_item(item)].append(item)
+        self.groups = OrderedDict((x, tuple(groups[x])) for x in sorted(groups, key=sort_key))
 
 
 class RequestContext(object):
@@ -389,23 +422,29 @@ class RequestContext(object):
         return self.ctx.get_categories(self.rd, self.db,
                                        report_parse_errors=report_parse_errors)
 
+    def get_category_index(self, category):
+        return self.ctx.get_category_index(self.rd, self.db, category, CategoryIndex)
+
     def search(self, query):
         return self.ctx.search(self.rd, self.db, query)
 
+    def sorted_book_ids(self, book_ids, sort_by, ascending=True):
+        return self.ctx.sorted_book_ids(self.db, book_ids, sort_by, ascending)
+
 
 def get_acquisition_feed(rc, ids, offset, page_url, up_url, id_,
         sort_by='title', ascending=True, feed_title=None):
     if not ids:
         raise HTTPNotFound('No books found')
+    sort_by = sanitize_sort_field_name(rc.db.field_metadata, sort_by)
+    items = rc.sorted_book_ids(ids, sort_by, ascending)
+    max_items = rc.opts.max_opds_items
+    offsets = Offsets(offset, max_items, len(items))
+    items = items[offsets.offset:offsets.offset+max_items]
     with rc.db.safe_read_lock:
-        sort_by = sanitize_sort_field_name(rc.db.field_metadata, sort_by)
-        items = rc.db.multisort([(sort_by, ascending)], ids)
-        max_items = rc.opts.max_opds_items
-        offsets = Offsets(offset, max_items, len(items))
-        items = items[offsets.offset:offsets.offset+max_items]
         lm = rc.last_modified()
         rc.outheaders['Last-Modified'] = http_date(timestampfromdt(lm))
-        return AcquisitionFeed(id_, lm, rc, items, offsets, page_url, up_url, title=feed_title).root
+        return AcquisitionFeed(id_, lm, rc, items, offsets, page_url, up_url, title=feed_title).serialize()
 
 
 def get_all_books(rc, which, page_url, up_url, offset=0):
@@ -426,11 +465,11 @@ def get_all_books(rc, which, page_url, up_url, offset=0):
 
 
 def get_navcatalog(request_context, which, page_url, up_url, offset=0):
-    categories = request_context.get_categories()
-    if which not in categories:
+    index = request_context.get_category_index(which)
+    if index is None:
         raise HTTPNotFound('Category %r not found'%which)
 
-    items = categories[which]
+    items = index.items
     updated = request_context.last_modified()
     category_meta = request_context.db.field_metadata
     meta = category_meta.get(which, {})
@@ -444,22 +483,11 @@ def get_navcatalog(request_context, which, page_url, up_url, offset=0):
     if MAX_ITEMS > 0 and len(items) <= MAX_ITEMS:
         max_items = request_context.opts.max_opds_items
         offsets = Offsets(offset, max_items, len(items))
-        items = list(items)[offsets.offset:offsets.offset+max_items]
+        items = items[offsets.offset:offsets.offset+max_items]
         ans = CategoryFeed(items, which, id_, updated, request_context, offsets,
             page_url, up_url, title=feed_title)
     else:
-        Group = namedtuple('Group', 'text count')
-        starts = set()
-        for x in items:
-            val = getattr(x, 'sort', x.name)
-            if not val:
-                val = 'A'
-            starts.add(val[0].upper())
-        category_groups = OrderedDict()
-        for x in sorted(starts, key=sort_key):
-            category_groups[x] = len([y for y in items if
-                getattr(y, 'sort', y.name).upper().startswith(x)])
-        items = [Group(x, y) for x, y in category_groups.items()]
+        items = [Group(x, len(y)) for x, y in index.groups.iteritems()]
         max_items = request_context.opts.max_opds_items
         offsets = Offsets(offset, max_items, len(items))
         items = items[offsets.offset:offsets.offset+max_items]
@@ -468,7 +496,7 @@ def get_navcatalog(request_context, which, page_url, up_url, offset=0):
 
     request_context.outheaders['Last-Modified'] = http_date(timestampfromdt(updated))
 
-    return ans.root
+    return ans.serialize()
 
 
 @endpoint('/opds', postprocess=atom)
@@ -503,7 +531,7 @@ def opds(ctx, rd):
         cats.append((meta['name'], meta['name'], 'N'+category))
     last_modified = db.last_modified()
     rd.outheaders['Last-Modified'] = http_date(timestampfromdt(last_modified))
-    return TopLevel(last_modified, cats, rc).root
+    return TopLevel(last_modified, cats, rc).serialize()
 
 
 @endpoint('/opds/navcatalog/{which}', postprocess=atom)
@@ -589,11 +617,11 @@ def opds_categorygroup(ctx, rd, category, which):
         raise HTTPNotFound('Not found')
 
     rc = RequestContext(ctx, rd)
-    categories = rc.get_categories()
     page_url = rc.url_for('/opds/categorygroup', category=category, which=which)
 
     category = unhexlify(category)
-    if category not in categories:
+    index = rc.get_category_index(category)
+    if index is None:
         raise HTTPNotFound('Category %r not found'%which)
     category_meta = rc.db.field_metadata
     meta = category_meta.get(category, {})
@@ -602,11 +630,7 @@ def opds_categorygroup(ctx, rd, category, which):
     feed_title = default_feed_title + ' :: ' + (_('By {0} :: {1}').format(category_name, which))
     owhich = hexlify('N'+which)
     up_url = rc.url_for('/opds/navcatalog', which=owhich)
-    items = categories[category]
-
-    def belongs(x, which):
-        return getattr(x, 'sort', x.name).lower().startswith(which.lower())
-    items = [x for x in items if belongs(x, which)]
+    items = index.groups.get(which.upper())
     if not items:
         raise HTTPNotFound('No items in group %r:%r'%(category, which))
     updated = rc.last_modified()
@@ -615,11 +639,11 @@ def opds_categorygroup(ctx, rd, category, which):
 
     max_items = rc.opts.max_opds_items
     offsets = Offsets(offset, max_items, len(items))
-    items = list(items)[offsets.offset:offsets.offset+max_items]
+    items = items[offsets.offset:offsets.offset+max_items]
 
     rc.outheaders['Last-Modified'] = http_date(timestampfromdt(updated))
 
-    return CategoryFeed(items, category, id_, updated, rc, offsets, page_url, up_url, title=feed_title).root
+    return CategoryFeed(items, category, id_, updated, rc, offsets, page_url, up_url, title=feed_title).serialize()
 
 
 @endpoint('/opds/search/{query=""}', postprocess=atom)
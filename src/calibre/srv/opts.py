@@ -64,10 +64,24 @@ raw_options = (
     'compress_min_size', 1024,
     None,
 
+    _('Max. memory used for cached compressed responses (in MB)'),
+    'max_compressed_cache_size', 32,
+    _('Compressed versions of responses that do not change, such as the files of the'
+    ' browser interface, are kept in memory, so that they do not have to be compressed'
+    ' again for every client. Set to zero to disable.'),
+
     _('Number of worker threads used to process requests'),
     'worker_count', 10,
     None,
 
+    _('Number of server processes'),
+    'server_processes', 0,
+    _('Run the server in this many processes, so that it can use more than one CPU'
+      ' core. The processes share the listening port and changes to the calibre'
+      ' libraries are made by one extra process. Set to zero to run the server in'
+      ' a single process. Only works on operating systems that support SO_REUSEPORT,'
+      ' such as Linux.'),
+
     _('Maximum number of worker processes'),
     'max_jobs', 0,
     _('Worker processes are launched as needed and used for large jobs such as preparing'
@@ -125,11 +139,51 @@ raw_options = (
     ' increasing performance. However, it can cause corrupted file transfers on some'
     ' broken filesystems. If you experience corrupted file transfers, turn it off.'),
 
+    _('Use HTTP/2 when the client supports it'),
+    'use_http2', True,
+    _('HTTP/2 allows clients to make many requests at the same time over a single'
+    ' connection, which is faster, especially over SSL. It is used with clients that'
+    ' request it, other clients continue to use HTTP/1.1.'),
+
+    _('Profile requests that take longer than this (in seconds)'),
+    'profile_slow_requests', 0.0,
+    _('Some requests are run under the Python profiler and the profiling statistics of'
+    ' the ones that take longer than this are saved in the calibre cache folder, for'
+    ' finding out why they are slow. The profiler makes requests slower, so only a'
+    ' sample of them is profiled. Set to zero to disable.'),
+
+    _('Profile one in this many requests'),
+    'profile_sample_interval', 10,
+    _('When profiling of slow requests is enabled, one in this many requests is'
+    ' profiled. Set to one to profile every request.'),
+
     _('Max. log file size (in MB)'),
     'max_log_size', 20,
     _('The maximum size of log files, generated by the server. When the log becomes larger'
     ' than this size, it is automatically rotated. Set to zero to disable log rotation.'),
 
+    _('Max. disk space for stored thumbnails (in MB)'),
+    'max_thumbnail_cache_size', 200,
+    _('Cover thumbnails are stored on disk, so that they do not have to be generated'
+    ' again after the server is restarted. This is the maximum space used for the'
+    ' thumbnails of a single size, in a single library. When it is exceeded, the least'
+    ' recently used thumbnails are removed. When the server runs in multiple processes,'
+    ' every process stores its own thumbnails, so up to that many times this space is used.'
+    ' Set to zero to not store thumbnails.'),
+
+    _('Load libraries when the server starts'),
+    'warm_up_libraries', True,
+    _('Normally, the libraries are loaded in the background when the server starts,'
+    ' so that the first requests for them are fast. Turn this option off to load'
+    ' each library only when it is first used.'),
+
+    _('Max. memory before unused libraries are closed (in MB)'),
+    'max_library_memory', 0,
+    _('When the server uses more than this much memory, libraries that have not been'
+    ' used for a few minutes are closed, least recently used first. Useful when serving'
+    ' many libraries on a computer with little memory. Set to zero to keep libraries'
+    ' open once they have been loaded.'),
+
     _('Log HTTP 404 (Not Found) requests'),
     'log_not_found', True,
     _('Normally, the server logs all HTTP requests for resources that are not found.'
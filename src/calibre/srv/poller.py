@@ -0,0 +1,134 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+'''
+Pollers wait for sockets to become readable or writable. The server loop
+tells the poller which sockets it is interested in only when the interest
+changes, instead of passing the complete list of sockets on every iteration.
+'''
+
+import errno, select
+
+from calibre.srv.utils import socket_errors_eintr
+
+POLL_READ, POLL_WRITE = 1, 2
+
+
+class SelectPoller(object):
+
+    ''' Uses select(), available everywhere, but the cost of every poll is
+    proportional to the number of sockets and it cannot handle more than
+    FD_SETSIZE sockets. '''
+
+    name = 'select'
+
+    def __init__(self):
+        self.interest = {}
+        self.readers, self.writers = set(), set()
+
+    def set_interest(self, fd, mask):
+        if self.interest.get(fd, 0) == mask:
+            return
+        if mask:
+            self.interest[fd] = mask
+        else:
+            self.interest.pop(fd, None)
+        (self.readers.add if mask & POLL_READ else self.readers.discard)(fd)
+        (self.writers.add if mask & POLL_WRITE else self.writers.discard)(fd)
+
+    def unregister(self, fd):
+        self.set_interest(fd, 0)
+
+    def poll(self, timeout):
+        ' Return the lists of readable and writable sockets '
+        readable, writable, _ = select.select(self.readers, self.writers, (), timeout)
+        return readable, writable
+
+    def close(self):
+        self.interest.clear(), self.readers.clear(), self.writers.clear()
+
+
+class EpollPoller(object):
+
+    ''' Uses epoll() on Linux. The kernel keeps the set of sockets, so the cost
+    of every poll is proportional only to the number of ready sockets. Level
+    triggered, so sockets that still have data after an event are reported
+    again, which is what the connection handlers, that read and write bounded
+    amounts per event, rely on. '''
+
+    name = 'epoll'
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.interest = {}
+        # Hangups and errors are reported as both readable and writable, like
+        # select() does
+        self.read_events = select.EPOLLIN | select.EPOLLPRI | select.EPOLLHUP | select.EPOLLERR
+        self.write_events = select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR
+
+    def set_interest(self, fd, mask):
+        old = self.interest.get(fd, 0)
+        if old == mask:
+            return
+        if not mask:
+            return self.unregister(fd)
+        events = (select.EPOLLIN if mask & POLL_READ else 0) | (select.EPOLLOUT if mask & POLL_WRITE else 0)
+        self.interest[fd] = mask
+        try:
+            if old:
+                self.epoll.modify(fd, events)
+            else:
+                self.epoll.register(fd, events)
+        except EnvironmentError as e:
+            # The kernel removes closed sockets from the epoll set, so a new
+            # socket may get the file descriptor of a socket we never
+            # unregistered, or vice versa
+            if e.errno == errno.ENOENT:
+                self.epoll.register(fd, events)
+            elif e.errno == errno.EEXIST:
+                self.epoll.modify(fd, events)
+            else:
+                del self.interest[fd]
+                raise
+
+    def unregister(self, fd):
+        if self.interest.pop(fd, None) is not None:
+            try:
+                self.epoll.unregister(fd)
+            except (EnvironmentError, ValueError):
+                pass
+
+    def poll(self, timeout):
+        ' Return the lists of readable and writable sockets '
+        try:
+            events = self.epoll.poll(-1 if timeout is None else timeout)
+        except EnvironmentError as e:
+            if e.errno in socket_errors_eintr:
+                return [], []
+            raise
+        readable, writable = [], []
+        interest, read_events, write_events = self.interest, self.read_events, self.write_events
+        for fd, ev in events:
+            mask = interest.get(fd, 0)
+            if mask & POLL_READ and ev & read_events:
+                readable.append(fd)
+            if mask & POLL_WRITE and ev & write_events:
+                writable.append(fd)
+        return readable, writable
+
+    def close(self):
+        self.interest.clear()
+        self.epoll.close()
+
+
+def create_poller(name=None):
+    ''' Return the best poller available on this platform, or the poller
+    named name ('epoll' or 'select') '''
+    if name is None:
+        name = 'epoll' if hasattr(select, 'epoll') else 'select'
+    return {'epoll':EpollPoller, 'select':SelectPoller}[name]()
@@ -9,9 +9,13 @@ __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 import sys
 from Queue import Queue, Full
 from threading import Thread
+from weakref import WeakSet
 
 from calibre.utils.monotonic import monotonic
 
+# All the thread pools in this process, for reporting their state
+thread_pools = WeakSet()
+
 
 class Worker(Thread):
 
@@ -53,13 +57,20 @@ class ThreadPool(object):
     def __init__(self, log, notify_server, count=10, queue_size=1000):
         self.request_queue, self.result_queue = Queue(queue_size), Queue(queue_size)
         self.workers = [Worker(log, notify_server, i, self.request_queue, self.result_queue) for i in xrange(count)]
+        # The number of jobs rejected because the queue was full
+        self.rejected = 0
+        thread_pools.add(self)
 
     def start(self):
         for w in self.workers:
             w.start()
 
     def put_nowait(self, job_id, func):
-        self.request_queue.put_nowait((job_id, func))
+        try:
+            self.request_queue.put_nowait((job_id, func))
+        except Full:
+            self.rejected += 1
+            raise
 
     def get_nowait(self):
         return self.result_queue.get_nowait()
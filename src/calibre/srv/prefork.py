@@ -0,0 +1,352 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+'''
+Running the server in several processes, so that it can use more than one CPU
+core. The master process forks server processes that each bind the listening
+port with SO_REUSEPORT, so that the kernel distributes connections between
+them. Requests that change a calibre library are forwarded to a single writer
+process, that listens on a private port on the loopback interface. The changes
+made by the writer are sent to the master, which fans them out to the server
+processes, which then reload the changed library.
+'''
+
+import copy, errno, httplib, os, select, signal, socket, sys, time, traceback
+from binascii import hexlify
+from collections import OrderedDict
+from multiprocessing import Pipe
+from threading import Event, Lock, local
+from urllib import quote, unquote, urlencode
+
+from calibre.constants import iswindows
+from calibre.srv.errors import HTTPForbidden, HTTPSimpleResponse
+from calibre.srv.utils import socket_errors_eintr
+from calibre.utils.monotonic import monotonic
+
+try:
+    from hmac import compare_digest
+except ImportError:  # python < 2.7.7
+    def compare_digest(a, b):
+        return a == b
+
+TOKEN_HEADER = 'X-Calibre-Worker-Token'
+USERNAME_HEADER = 'X-Calibre-Worker-Username'
+LOCAL_HEADER = 'X-Calibre-Worker-Local'
+# The request headers that endpoints which change the database use
+FORWARDED_HEADERS = ('Accept', 'Accept-Language', 'Content-Type', 'Cookie')
+# Processes that die within STARTUP_TIME seconds of being started more than
+# MAX_QUICK_FAILURES times in a row are assumed to be unable to start at all
+STARTUP_TIME = 5
+MAX_QUICK_FAILURES = 3
+
+
+def accept_forwarded_request(data, token):
+    ''' Used by the writer process, instead of the normal authentication, to
+    accept only requests forwarded by the server processes, with the identity
+    of the user that made the original request. '''
+    received = data.inheaders.get(TOKEN_HEADER) or ''
+    if not compare_digest(received.encode('utf-8'), token.encode('utf-8')):
+        raise HTTPForbidden('Only requests forwarded by the other server processes are allowed')
+    username = data.inheaders.get(USERNAME_HEADER)
+    data.username = unquote(username.encode('utf-8')).decode('utf-8') if username else None
+    data.is_local_connection = data.inheaders.get(LOCAL_HEADER) == '1'
+
+
+class WriteForwarder(object):
+
+    ''' Used by the server processes to forward requests that change the
+    database to the writer process. Returns the body of the response from the
+    writer, which is already serialized. '''
+
+    def __init__(self, address, token, timeout=60):
+        self.address, self.token, self.timeout = address, token, timeout
+        self.local = local()
+
+    def connection(self, fresh=False):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and fresh:
+            conn.close()
+            conn = None
+        if conn is None:
+            conn = self.local.conn = httplib.HTTPConnection(self.address[0], self.address[1], timeout=self.timeout)
+        return conn
+
+    def url_for(self, rd):
+        url = '/' + '/'.join(quote(x.encode('utf-8'), safe=b'') for x in rd.path)
+        if rd.query:
+            url += '?' + urlencode([(k.encode('utf-8'), v.encode('utf-8')) for k, v in rd.query.items()])
+        return url
+
+    def headers_for(self, rd):
+        headers = {TOKEN_HEADER: self.token}
+        for name in FORWARDED_HEADERS:
+            vals = rd.inheaders.get(name, all=True)
+            if vals:
+                headers[name] = ('; ' if name == 'Cookie' else ', ').join(vals)
+        if rd.username:
+            headers[USERNAME_HEADER] = quote(rd.username.encode('utf-8'))
+        if rd.is_local_connection:
+            headers[LOCAL_HEADER] = '1'
+        body = rd.request_body_file
+        body.seek(0, os.SEEK_END)
+        headers['Content-Length'] = type('')(body.tell())
+        body.seek(0)
+        return headers, body
+
+    def __call__(self, rd):
+        url = self.url_for(rd)
+        headers, body = self.headers_for(rd)
+        conn = self.connection()
+        reused = conn.sock is not None
+        try:
+            conn.request(rd.method, url, body=body, headers=headers)
+            response = conn.getresponse()
+        except (httplib.BadStatusLine, socket.error) as err:
+            # The writer closes keep-alive connections that were idle for
+            # too long, retry once on a new connection
+            if not reused or (isinstance(err, socket.error) and err.errno not in (errno.ECONNRESET, errno.EPIPE)):
+                self.connection(fresh=True)
+                raise
+            conn = self.connection(fresh=True)
+            headers, body = self.headers_for(rd)
+            conn.request(rd.method, url, body=body, headers=headers)
+            response = conn.getresponse()
+        data = response.read()
+        if response.will_close:
+            self.connection(fresh=True)
+        if response.status >= 400:
+            raise HTTPSimpleResponse(response.status, data.decode('utf-8', 'replace'))
+        rd.status_code = response.status
+        ct = response.getheader('Content-Type')
+        if ct:
+            rd.outheaders.set('Content-Type', ct, replace_all=True)
+        return data
+
+
+class ChangesSender(object):
+
+    ''' Used as the notify_changes callback of the writer process, to send
+    changes to the master process '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = Lock()
+
+    def __call__(self, library_path, change_event):
+        with self.lock:
+            try:
+                self.conn.send((library_path, change_event))
+            except EnvironmentError:
+                pass  # The master process has gone away
+
+
+class ChangesReceiver(object):
+
+    ''' A server loop plugin that reloads libraries that were changed by the
+    writer process '''
+
+    def __init__(self, conn, library_broker):
+        self.conn, self.library_broker = conn, library_broker
+        self.shutdown = Event()
+        self.stop = self.shutdown.set
+
+    def start(self, loop):
+        while not self.shutdown.is_set():
+            changed = OrderedDict()
+            try:
+                if not self.conn.poll(0.5):
+                    continue
+                # Reload each library only once for a burst of changes, only
+                # the changed books are reloaded, unless a change does not say
+                # which books it affects
+                while self.conn.poll():
+                    library_path, change_event = self.conn.recv()
+                    book_ids = getattr(change_event, 'book_ids', None)
+                    if book_ids is None:
+                        changed[library_path] = None
+                    else:
+                        pending = changed.setdefault(library_path, set())
+                        if pending is not None:
+                            pending |= book_ids
+            except (EOFError, EnvironmentError):
+                break
+            for library_path, book_ids in changed.iteritems():
+                try:
+                    self.library_broker.library_changed(library_path, book_ids)
+                except Exception:
+                    loop.log.exception('Failed to reload the changed library:', library_path)
+
+
+class Child(object):
+
+    def __init__(self, pid, conn, slot, quick_failures):
+        self.pid, self.conn, self.slot = pid, conn, slot
+        self.quick_failures = quick_failures
+        self.started_at = monotonic()
+
+
+class Master(object):
+
+    ''' Runs the server in opts.server_processes processes, plus a writer
+    process. create_server(libraries, opts, notify_changes=None, plugins=())
+    must return a server object with loop and handler attributes that
+    run_server() serves until it is stopped. '''
+
+    WRITER = 'writer'
+
+    def __init__(self, libraries, opts, create_server, run_server):
+        if iswindows or not hasattr(socket, 'SO_REUSEPORT'):
+            raise SystemExit('Running the server in multiple processes is not supported on this operating system')
+        self.libraries, self.opts = libraries, opts
+        self.create_server, self.run_server = create_server, run_server
+        self.token = hexlify(os.urandom(32)).decode('ascii')
+        # Created here, so that the writer can be restarted on the same port
+        self.writer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.writer_socket.bind(('127.0.0.1', 0))
+        self.writer_address = self.writer_socket.getsockname()[:2]
+        self.children = {}
+        self.stopped = False
+
+    def log(self, *args):
+        print(*args)
+        sys.stdout.flush()
+
+    def stop(self):
+        self.stopped = True
+
+    def spawn(self, slot, quick_failures=0):
+        parent_conn, child_conn = Pipe()
+        pid = os.fork()
+        if pid == 0:
+            parent_conn.close()
+            for child in self.children.itervalues():
+                child.conn.close()
+            code = 0
+            try:
+                self.run_child(slot, child_conn)
+            except SystemExit as err:
+                code = err.code if isinstance(err.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush(), sys.stderr.flush()
+                os._exit(code)
+        child_conn.close()
+        self.children[slot] = Child(pid, parent_conn, slot, quick_failures)
+
+    def run_child(self, slot, conn):
+        for sig in (signal.SIGTERM, signal.SIGHUP):
+            signal.signal(sig, signal.SIG_DFL)
+        opts = copy.copy(self.opts)
+        # Only one process should advertise the server via BonJour
+        opts.use_bonjour = opts.use_bonjour and slot == 0
+        from calibre.srv.library_broker import LibraryBroker
+        broker = LibraryBroker(self.libraries)
+        if slot == self.WRITER:
+            # The writer is only reachable from the loopback interface
+            opts.ssl_certfile = opts.ssl_keyfile = None
+            server = self.create_server(broker, opts, notify_changes=ChangesSender(conn))
+            server.loop.pre_activated_socket = self.writer_socket
+            server.loop.LISTENING_MSG = 'calibre server writer process listening on'
+            server.handler.ctx.forwarded_requests_token = self.token
+        else:
+            self.writer_socket.close()
+            server = self.create_server(broker, opts, plugins=(ChangesReceiver(conn, broker),))
+            server.handler.ctx.forward_write = WriteForwarder(self.writer_address, self.token, timeout=opts.timeout)
+        # Every process stores thumbnails in its own directory, which is
+        # re-used when the process is restarted in the same slot
+        server.handler.ctx.thumbnail_store_name = 'process-%s' % slot
+        signal.signal(signal.SIGTERM, lambda s, f: server.stop())
+        signal.signal(signal.SIGHUP, lambda s, f: server.stop())
+        self.run_server(server)
+
+    def serve_forever(self):
+        self.spawn(self.WRITER)
+        for slot in xrange(self.opts.server_processes):
+            self.spawn(slot)
+        try:
+            while not self.stopped:
+                self.relay_changes()
+                self.reap_children()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def relay_changes(self):
+        writer = self.children.get(self.WRITER)
+        if writer is None or writer.conn.closed:
+            time.sleep(1)
+            return
+        try:
+            readable = select.select([writer.conn], [], [], 1)[0]
+        except select.error as err:
+            if err.args[0] in socket_errors_eintr:
+                return
+            raise
+        if not readable:
+            return
+        try:
+            msg = writer.conn.recv()
+        except (EOFError, EnvironmentError):
+            writer.conn.close()  # The writer has died, it is restarted by reap_children()
+            return
+        for slot, child in self.children.iteritems():
+            if slot != self.WRITER and not child.conn.closed:
+                try:
+                    child.conn.send(msg)
+                except EnvironmentError:
+                    child.conn.close()
+
+    def reap_children(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except EnvironmentError as err:
+                if err.errno == errno.EINTR:
+                    continue
+                if err.errno == errno.ECHILD:
+                    break
+                raise
+            if pid == 0:
+                break
+            for slot, child in tuple(self.children.iteritems()):
+                if child.pid == pid:
+                    del self.children[slot]
+                    child.conn.close()
+                    if self.stopped:
+                        break
+                    quick_failures = child.quick_failures + 1 if monotonic() - child.started_at < STARTUP_TIME else 0
+                    if quick_failures >= MAX_QUICK_FAILURES:
+                        self.stopped = True
+                        raise SystemExit('The server process {} failed to start, see the log for details'.format(slot))
+                    self.log('The server process {} exited with status {}, restarting it'.format(slot, status))
+                    self.spawn(slot, quick_failures)
+                    break
+
+    def shutdown(self):
+        self.stopped = True
+        for child in self.children.itervalues():
+            try:
+                os.kill(child.pid, signal.SIGTERM)
+            except EnvironmentError:
+                pass
+        wait_till = monotonic() + self.opts.shutdown_timeout + 1
+        while self.children and monotonic() < wait_till:
+            self.reap_children()
+            if self.children:
+                time.sleep(0.05)
+        for child in self.children.itervalues():
+            try:
+                os.kill(child.pid, signal.SIGKILL)
+            except EnvironmentError:
+                pass
+            child.conn.close()
+        self.children.clear()
+        self.writer_socket.close()
@@ -12,6 +12,7 @@ from itertools import izip
 from operator import attrgetter
 
 from calibre.srv.errors import HTTPSimpleResponse, HTTPNotFound, RouteError
+from calibre.srv.metrics import TimedRequest
 from calibre.srv.utils import http_date
 from calibre.utils.serialize import msgpack_dumps, json_dumps, MSGPACK_MIME
 
@@ -69,7 +70,13 @@ def endpoint(route,
              postprocess=None,
 
              # Needs write access to the calibre database
-             needs_db_write=False
+             needs_db_write=False,
+
+             # Changes the calibre database, even without needing write
+             # access. When the server runs in multiple processes, such
+             # requests are forwarded to the writer process. Implied by
+             # needs_db_write.
+             writes_to_db=False
 
 ):
     from calibre.srv.handler import Context
@@ -87,6 +94,7 @@ def endpoint(route,
         f.ok_code = ok_code
         f.is_endpoint = True
         f.needs_db_write = needs_db_write
+        f.writes_to_db = writes_to_db or needs_db_write
         argspec = inspect.getargspec(f)
         if len(argspec.args) < 2:
             raise TypeError('The endpoint %r must take at least two arguments' % f.route)
@@ -298,10 +306,17 @@ class Router(object):
         endpoint_, args = self.find_route(data.path)
         if data.method not in endpoint_.methods:
             raise HTTPSimpleResponse(httplib.METHOD_NOT_ALLOWED)
+        with TimedRequest(endpoint_.route, self.ctx, data):
+            return self.run_endpoint(endpoint_, args, data)
 
+    def run_endpoint(self, endpoint_, args, data):
         self.read_cookies(data)
 
-        if endpoint_.auth_required and self.auth_controller is not None:
+        token = getattr(self.ctx, 'forwarded_requests_token', None)
+        if token is not None:
+            from calibre.srv.prefork import accept_forwarded_request
+            accept_forwarded_request(data, token)
+        elif endpoint_.auth_required and self.auth_controller is not None:
             self.auth_controller(data, endpoint_)
 
         if endpoint_.ok_code is not None:
@@ -310,7 +325,11 @@ class Router(object):
         self.init_session(endpoint_, data)
         if endpoint_.needs_db_write:
             self.ctx.check_for_write_access(data)
-        ans = endpoint_(self.ctx, data, *args)
+        forward_write = getattr(self.ctx, 'forward_write', None)
+        if endpoint_.writes_to_db and forward_write is not None:
+            ans = forward_write(data)
+        else:
+            ans = endpoint_(self.ctx, data, *args)
         self.finalize_session(endpoint_, data, ans)
         outheaders = data.outheaders
 
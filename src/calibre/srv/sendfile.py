@@ -36,6 +36,20 @@ def copy_range(src_file, start, size, dest):
     return total_sent
 
 
+class TransferStats(object):
+
+    ''' The number of bytes sent to clients with sendfile() and by copying
+    through userspace, by all connections in this process '''
+
+    __slots__ = ('zero_copy', 'copied')
+
+    def __init__(self):
+        self.zero_copy = self.copied = 0
+
+
+transfer_stats = TransferStats()
+
+
 class CannotSendfile(Exception):
     pass
 
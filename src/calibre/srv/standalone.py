@@ -13,12 +13,14 @@ from calibre.constants import is_running_from_develop, isosx, iswindows, plugins
 from calibre.db.legacy import LibraryDatabase
 from calibre.db.delete_service import shutdown as shutdown_delete_service
 from calibre.srv.bonjour import BonJour
-from calibre.srv.handler import Handler
+from calibre.srv.content import StaticPrecompressor
+from calibre.srv.handler import Handler, LibraryWarmer
 from calibre.srv.http_response import create_http_handler
 from calibre.srv.library_broker import load_gui_libraries
 from calibre.srv.loop import ServerLoop
 from calibre.srv.manage_users_cli import manage_users_cli
 from calibre.srv.opts import opts_to_parser
+from calibre.srv.thumbnails import shutdown_stores
 from calibre.srv.utils import RotatingLog
 from calibre.utils.config import prefs
 from calibre.utils.localization import localize_user_manual_link
@@ -57,18 +59,20 @@ def daemonize():  # {{{
 
 class Server(object):
 
-    def __init__(self, libraries, opts):
+    def __init__(self, libraries, opts, notify_changes=None, plugins=()):
         log = access_log = None
         log_size = opts.max_log_size * 1024 * 1024
         if opts.log:
             log = RotatingLog(opts.log, max_size=log_size)
         if opts.access_log:
             access_log = RotatingLog(opts.access_log, max_size=log_size)
-        self.handler = Handler(libraries, opts)
+        self.handler = Handler(libraries, opts, notify_changes=notify_changes)
         if opts.custom_list_template:
             with lopen(opts.custom_list_template, 'rb') as f:
                 self.handler.router.ctx.custom_list_template = json.load(f)
-        plugins = []
+        plugins = list(plugins)
+        plugins.append(StaticPrecompressor())
+        plugins.append(LibraryWarmer(self.handler.ctx))
         if opts.use_bonjour:
             plugins.append(BonJour())
         self.loop = ServerLoop(
@@ -142,6 +146,15 @@ libraries that the main calibre program knows about will be used.
         help=_(
             'Manage the database of users allowed to connect to this server.'
             ' See also the %s option.') % '--userdb')
+    parser.add_option(
+        '--pregenerate-thumbnails',
+        default=False,
+        action='store_true',
+        help=_(
+            'Generate the cover thumbnails used by the server for all books in'
+            ' the libraries, in parallel, and exit. Useful to avoid slow loading'
+            ' of the book list in the browser, the first time it is shown. See'
+            ' also the %s option.') % '--max-thumbnail-cache-size')
     parser.get_option('--userdb').help = _(
         'Path to the user database to use for authentication. The database'
         ' is a SQLite file. To create it use {0}. You can read more'
@@ -158,6 +171,17 @@ libraries that the main calibre program knows about will be used.
 option_parser = create_option_parser
 
 
+def run_server(server):
+    # Needed for dynamic cover generation, which uses Qt for drawing
+    from calibre.gui2 import ensure_app, load_builtin_fonts
+    ensure_app(), load_builtin_fonts()
+    try:
+        server.serve_forever()
+    finally:
+        shutdown_delete_service()
+        shutdown_stores()
+
+
 def ensure_single_instance():
     if b'CALIBRE_NO_SI_DANGER_DANGER' not in os.environ and not singleinstance('db'):
         ext = '.exe' if iswindows else ''
@@ -188,6 +212,10 @@ def main(args=sys.argv):
         if not prefs['library_path']:
             raise SystemExit(_('You must specify at least one calibre library'))
         libraries = [prefs['library_path']]
+    if opts.pregenerate_thumbnails:
+        from calibre.srv.thumbnails import pregenerate_thumbnails
+        pregenerate_thumbnails(libraries, opts, max_workers=opts.max_jobs or None)
+        raise SystemExit(0)
 
     if opts.auto_reload:
         if getattr(opts, 'daemonize', False):
@@ -205,7 +233,13 @@ def main(args=sys.argv):
         raise SystemExit('The --log option must point to a file, not a directory')
     if opts.access_log and os.path.isdir(opts.access_log):
         raise SystemExit('The --access-log option must point to a file, not a directory')
-    server = Server(libraries, opts)
+    if opts.server_processes > 0:
+        from calibre.srv.prefork import Master
+        # The server processes are forked by the master process and create
+        # their own servers, after it has daemonized
+        server = Master(libraries, opts, Server, run_server)
+    else:
+        server = Server(libraries, opts)
     if getattr(opts, 'daemonize', False):
         if not opts.log and not iswindows:
             raise SystemExit(
@@ -218,10 +252,7 @@ def main(args=sys.argv):
     signal.signal(signal.SIGTERM, lambda s, f: server.stop())
     if not getattr(opts, 'daemonize', False) and not iswindows:
         signal.signal(signal.SIGHUP, lambda s, f: server.stop())
-    # Needed for dynamic cover generation, which uses Qt for drawing
-    from calibre.gui2 import ensure_app, load_builtin_fonts
-    ensure_app(), load_builtin_fonts()
-    try:
+    if opts.server_processes > 0:
         server.serve_forever()
-    finally:
-        shutdown_delete_service()
+    else:
+        run_server(server)
@@ -6,7 +6,7 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import httplib, zlib, json, base64, os
+import httplib, zlib, json, base64, os, time
 from io import BytesIO
 from functools import partial
 from urllib import urlencode, quote
@@ -155,6 +155,20 @@ class ContentTest(LibraryBaseTest):
             ok(url_for('/get', what='thumb', book_id=1))
             nf(url_for('/get', what='thumb', book_id=3))
 
+            # The books allowed by a restriction follow changes to the library
+            from calibre.srv.changes import MetadataChanged
+            server.handler.ctx.user_manager.add_user('tagged', 'test', restriction={
+                'library_restrictions':{os.path.basename(db.backend.library_path): 'tags:present'}})
+
+            def tagged(book_id):
+                return make_request(conn, url_for('/ajax/book', book_id=book_id), username='tagged', password='test', prefix='')[0].status
+            ae(tagged(1), OK), ae(tagged(3), NOT_FOUND)
+            db.set_field('tags', {3: ['present']})
+            ae(tagged(3), OK)
+            db.set_field('tags', {1: ['missing']})
+            server.handler.ctx.notify_changes(db.backend.library_path, MetadataChanged((1,)))
+            ae(tagged(1), NOT_FOUND), ae(tagged(3), OK)
+
             # Not going test legacy and opds as they are too painful
     # }}}
 
@@ -193,3 +207,96 @@ class ContentTest(LibraryBaseTest):
             d((1,), username='ro', status=FORBIDDEN)
             d((1, data['book_id']))
     # }}}
+
+    def test_srv_forwarded_writes(self):  # {{{
+        from multiprocessing import Pipe
+        from calibre.srv.library_broker import LibraryBroker
+        from calibre.srv.prefork import ChangesReceiver, ChangesSender, WriteForwarder
+        token = 'secret'
+        changes_out, changes_in = Pipe()
+
+        def writer_specialize(server):
+            server.handler.ctx.forwarded_requests_token = token
+            server.handler.ctx._notify_changes = ChangesSender(changes_out)
+
+        ae = self.assertEqual
+        with self.create_server(specialize=writer_specialize) as writer:
+            broker = LibraryBroker((self.library_path,))
+            receiver = ChangesReceiver(changes_in, broker)
+            with self.create_server(
+                libraries=broker, plugins=(receiver,), auth=True, auth_mode='basic',
+                specialize=lambda s: setattr(s.handler.ctx, 'forward_write', WriteForwarder(writer.address, token))
+            ) as server:
+                for s in (writer, server):
+                    s.handler.ctx.user_manager.add_user('12', 'test')
+                    s.handler.ctx.user_manager.add_user('ro', 'test', readonly=True)
+                conn = server.connect()
+                db = broker.get()
+                num_books = len(db.all_book_ids())
+
+                def a(filename, status=OK, username='12', conn=conn):
+                    r, data = make_request(conn, '/cdb/add-book/1/n/{}'.format(quote(filename.encode('utf-8')).decode('ascii')),
+                                           username=username, password='test', prefix='', method='POST', data=b'content')
+                    ae(status, r.status)
+                    return data
+
+                a('test.txt', username='ro', status=FORBIDDEN)
+                data = a('test forwarded.txt')
+                book_id = data['book_id']
+                ae(data['filename'], 'test forwarded.txt')
+                ae(writer.handler.ctx.library_broker.get().field_for('title', book_id), data['title'])
+                # The change is sent to the reloading plugin of the server
+                for i in xrange(100):
+                    if len(db.all_book_ids()) > num_books:
+                        break
+                    time.sleep(0.02)
+                ae(len(db.all_book_ids()), num_books + 1)
+                r, q = make_request(conn, '/get/txt/{}'.format(book_id), username='12', password='test', prefix='')
+                ae(r.status, OK)
+                ae(q, b'content')
+                # The writer accepts only forwarded requests
+                a('test.txt', status=FORBIDDEN, conn=writer.connect())
+    # }}}
+
+    def test_library_warm_up(self):  # {{{
+        from calibre.srv.handler import Context, LibraryWarmer
+        from calibre.srv.library_broker import EXPIRED_AGE
+        from calibre.srv.opts import Options
+        other_path = self.mkdtemp()
+        self.create_db(other_path)
+        ctx = Context((self.library_path, other_path), Options(userdb=':memory:'), testing=True)
+        broker = ctx.library_broker
+        default_id, other_id = tuple(broker.lmap)
+        ae = self.assertEqual
+
+        class Loop(object):
+            opts = ctx.opts
+            log = None
+
+        LibraryWarmer(ctx).start(Loop)
+        ae(set(broker.loaded_dbs), {default_id, other_id})
+        for library_id in (default_id, other_id):
+            self.assertTrue(broker.search_caches[library_id])
+            self.assertTrue(broker.category_caches[library_id])
+            ae(len(broker.sort_caches[library_id]), 2)
+
+        # Only libraries that are idle and not the default library are closed
+        broker.prune_loaded_dbs()
+        ae(set(broker.loaded_dbs), {default_id, other_id})
+        for library_id in (default_id, other_id):
+            broker.last_used_times[library_id] -= EXPIRED_AGE + 1
+        broker.prune_loaded_dbs()
+        ae(set(broker.loaded_dbs), {default_id})
+        self.assertNotIn(other_id, broker.search_caches)
+        db = broker.get(other_id)
+        ae(db.server_library_id, other_id)
+        ae(set(broker.loaded_dbs), {default_id, other_id})
+
+        # With a memory limit, idle libraries are closed only when it is exceeded
+        broker.last_used_times[other_id] -= EXPIRED_AGE + 1
+        broker.prune_loaded_dbs(max_memory=1024**4)
+        ae(set(broker.loaded_dbs), {default_id, other_id})
+        broker.prune_loaded_dbs(max_memory=1)
+        ae(set(broker.loaded_dbs), {default_id})
+        broker.close()
+    # }}}
@@ -169,6 +169,10 @@ class ContentTest(LibraryBaseTest):
             r, data = get('thumb', 1, q='sz=100x100')
             self.ae(r.status, httplib.OK)
             self.ae(r.getheader('Used-Cache'), 'yes')
+            conn.request('GET', '/get/thumb/1?sz=100x100', headers={'If-None-Match': r.getheader('ETag')})
+            r = conn.getresponse()
+            self.ae(r.status, httplib.NOT_MODIFIED)
+            r.read()
             change_cover(1, 1)
             r, data = get('thumb', 1, q='sz=100')
             self.ae(r.status, httplib.OK)
@@ -223,4 +227,48 @@ class ContentTest(LibraryBaseTest):
             raw = r.read()
             self.ae(zlib.decompress(raw, 16+zlib.MAX_WBITS), data)
 
+        # Test that stored thumbnails survive a restart of the server
+        from calibre.srv.opts import Options
+        from calibre.srv.thumbnails import pregenerate_thumbnails, shutdown_stores
+        shutdown_stores()  # As happens when the server process exits
+
+        def get_thumb(conn, book_id, sz):
+            conn.request('GET', '/get/thumb/%d?sz=%s' % (book_id, sz))
+            r = conn.getresponse()
+            return r, r.read()
+
+        with self.create_server() as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            conn = server.connect()
+            r, data = get_thumb(conn, 1, '100')
+            self.ae(r.status, httplib.OK)
+            self.ae(identify(data), ('jpeg', 100, 100))
+            self.ae(r.getheader('Used-Cache'), 'yes')
+            etag = r.getheader('ETag')
+
+            # Changing the cover replaces the stored thumbnail
+            db.set_cover({1:I('polish.png', data=True)})
+            cpath = db.format_abspath(1, '__COVER_INTERNAL__')
+            t = time.time() + 10
+            os.utime(cpath, (t, t))
+            r, data = get_thumb(conn, 1, '100')
+            self.ae(r.status, httplib.OK)
+            self.ae(r.getheader('Used-Cache'), 'no')
+            self.assertNotEqual(r.getheader('ETag'), etag)
+            r, data = get_thumb(conn, 1, '100')
+            self.ae(r.getheader('Used-Cache'), 'yes')
+        shutdown_stores()
+
+        # Test pre-generating thumbnails with worker processes
+        pregenerate_thumbnails([self.library_path], Options(), sizes=((60, 80),), max_workers=1,
+                               report=lambda *a: None, location=self.library_path)
+        with self.create_server() as server:
+            conn = server.connect()
+            for book_id in (1, 2):
+                r, data = get_thumb(conn, book_id, '60x80')
+                self.ae(r.status, httplib.OK)
+                self.ae(identify(data)[0], 'jpeg')
+                self.ae(r.getheader('Used-Cache'), 'yes')
+        shutdown_stores()
+
     # }}}
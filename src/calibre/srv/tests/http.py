@@ -69,6 +69,8 @@ class TestHTTP(BaseTest):
         test('Case insensitive', 'GZIp', 'gzip')
         test('Multiple', 'gzip, identity', 'gzip')
         test('Priority', '1;q=0.5, 2;q=0.75, 3;q=1.0', '3', {'1', '2', '3'})
+        test('Prefer brotli', 'gzip, deflate, br', 'br', {'gzip', 'br'})
+        test('Brotli with lower priority', 'br;q=0.5, gzip', 'gzip', {'gzip', 'br'})
     # }}}
 
     def test_accept_language(self):  # {{{
@@ -306,6 +308,7 @@ class TestHTTP(BaseTest):
     def test_http_response(self):  # {{{
         'Test HTTP protocol responses'
         from calibre.srv.http_response import parse_multipart_byterange
+        from calibre.srv.sendfile import sendfile_to_socket_async, transfer_stats
 
         def handler(conn):
             return conn.generate_static_output('test', lambda : ''.join(conn.path))
@@ -335,6 +338,28 @@ class TestHTTP(BaseTest):
             self.ae(str(len(raw)), r.getheader('Calibre-Uncompressed-Length'))
             self.ae(r.status, httplib.OK), self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), raw)
 
+            # Test caching of compressed etagged content
+            num_calls = [0]
+
+            def cfunc():
+                num_calls[0] += 1
+                return raw
+            server.change_handler(lambda conn:conn.etagged_dynamic_response(hashlib.sha1(raw).hexdigest(), cfunc, content_type='text/plain'))
+            conn = server.connect()
+            for i in xrange(3):
+                conn.request('GET', '/an_etagged_path', headers={'Accept-Encoding':'gzip'})
+                r = conn.getresponse()
+                self.ae(r.status, httplib.OK), self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), raw)
+                self.ae(r.getheader('Content-Type'), 'text/plain; charset=UTF-8')
+                self.ae(r.getheader('Content-Encoding'), 'gzip')
+                if i > 0:
+                    self.assertIsNotNone(r.getheader('Content-Length'))
+            self.ae(num_calls[0], 1)
+            conn.request('GET', '/an_etagged_path')
+            r = conn.getresponse()
+            self.ae(r.status, httplib.OK), self.ae(r.read(), raw)
+            self.ae(num_calls[0], 2)
+
             # Test dynamic etagged content
             num_calls = [0]
 
@@ -359,6 +384,8 @@ class TestHTTP(BaseTest):
             for use_sendfile in (True, False):
                 server.change_handler(lambda conn: f)
                 server.loop.opts.use_sendfile = use_sendfile
+                counter = 'zero_copy' if use_sendfile and sendfile_to_socket_async is not None else 'copied'
+                before = getattr(transfer_stats, counter)
                 conn = server.connect()
                 conn.request('GET', '/test')
                 r = conn.getresponse()
@@ -368,6 +395,7 @@ class TestHTTP(BaseTest):
                 self.ae(type('')(r.getheader('Accept-Ranges')), 'bytes')
                 self.ae(int(r.getheader('Content-Length')), len(fdata))
                 self.ae(r.status, httplib.OK), self.ae(r.read(), fdata)
+                self.assertGreaterEqual(getattr(transfer_stats, counter) - before, len(fdata))
 
                 conn.request('GET', '/test', headers={'Range':'bytes=2-25'})
                 r = conn.getresponse()
@@ -440,3 +468,242 @@ class TestHTTP(BaseTest):
                 r = conn.getresponse()
                 self.assertEqual(data, r.read())
     # }}}
+
+    def test_http2(self):  # {{{
+        'Test HTTP/2'
+        import socket
+        from base64 import urlsafe_b64encode
+        from binascii import unhexlify
+        from threading import Lock
+        from calibre.srv import http2 as h
+
+        # HPACK, the examples from RFC 7541
+        d = h.Decoder()
+        self.ae(d(unhexlify(b'828684418cf1e3c2e5f23a6ba0ab90f4ff')), [
+            (b':method', b'GET'), (b':scheme', b'http'), (b':path', b'/'), (b':authority', b'www.example.com')])
+        self.ae(d(unhexlify(b'828684be5886a8eb10649cbf'))[-1], (b'cache-control', b'no-cache'))
+        self.ae(d.table.size, 110)
+        self.ae(h.huffman_encode(b'www.example.com'), unhexlify(b'f1e3c2e5f23a6ba0ab90f4ff'))
+        for x in (b'', b'a', b'\0\xff' * 10, bytes(bytearray(xrange(256)))):
+            self.ae(h.huffman_decode(h.huffman_encode(x)), x)
+        e, d = h.Encoder(), h.Decoder()
+        headers = [(b':status', b'200'), (b'content-type', b'text/html'), (b'set-cookie', b'a=b'), (b'x-test', b'x' * 100)]
+        first = e(headers)
+        self.ae(d(first), headers)
+        second = e(headers)
+        self.ae(d(second), headers)
+        self.assertLess(len(second), len(first))
+        e.resize(0)
+        self.ae(d(e(headers)), headers)
+        self.ae(d.table.size, 0)
+
+        body = b'x' * 100000
+
+        def handler(data):
+            if data.path[0] == 'body':
+                return body
+            if data.path[0] == 'echo':
+                return data.request_body_file.read()
+            return '%s %s' % (data.path[0], data.response_protocol)
+
+        class Client(object):
+
+            def __init__(self, server, preface=h.PREFACE, window=h.DEFAULT_WINDOW_SIZE):
+                self.sock = socket.create_connection(server.address, timeout=5)
+                self.encoder, self.decoder = h.Encoder(), h.Decoder()
+                self.buf = b''
+                self.responses = {}
+                if preface is not None:
+                    self.sock.sendall(preface + h.frame(h.SETTINGS, 0, 0, h.SETTING.pack(h.SETTINGS_INITIAL_WINDOW_SIZE, window)))
+
+            def request(self, stream_id, path, data=None):
+                block = self.encoder([(b':method', b'GET' if data is None else b'POST'), (b':scheme', b'http'),
+                                      (b':path', path), (b':authority', b'localhost')])
+                self.sock.sendall(h.frame(h.HEADERS, h.END_HEADERS | (h.END_STREAM if data is None else 0), stream_id, block))
+                if data is not None:
+                    self.sock.sendall(h.frame(h.DATA, h.END_STREAM, stream_id, data))
+
+            def read_frame(self):
+                while True:
+                    if len(self.buf) >= h.FRAME_HEADER.size:
+                        hi, lo, ftype, flags, stream_id = h.FRAME_HEADER.unpack_from(self.buf)
+                        end = h.FRAME_HEADER.size + ((hi << 8) | lo)
+                        if len(self.buf) >= end:
+                            payload, self.buf = self.buf[h.FRAME_HEADER.size:end], self.buf[end:]
+                            return ftype, flags, stream_id, payload
+                    data = self.sock.recv(65536)
+                    if not data:
+                        raise EOFError('Connection closed')
+                    self.buf += data
+
+            def read_responses(self, count, window_update=True):
+                done = []
+                while len(done) < count:
+                    ftype, flags, stream_id, payload = self.read_frame()
+                    if ftype == h.HEADERS:
+                        self.responses[stream_id] = [dict(self.decoder(payload)), b'']
+                    elif ftype == h.DATA:
+                        self.responses[stream_id][1] += payload
+                        if window_update and payload:
+                            self.sock.sendall(h.frame(h.WINDOW_UPDATE, 0, 0, h.UINT32.pack(len(payload))) +
+                                              h.frame(h.WINDOW_UPDATE, 0, stream_id, h.UINT32.pack(len(payload))))
+                    elif ftype == h.GOAWAY:
+                        raise EOFError('Connection closed by server')
+                    if ftype in (h.HEADERS, h.DATA) and flags & h.END_STREAM:
+                        done.append(stream_id)
+                return done
+
+        with TestServer(handler, timeout=1) as server:
+            # Multiplexing, the small responses are not blocked by the large one
+            c = Client(server)
+            c.request(1, b'/body'), c.request(3, b'/a'), c.request(5, b'/echo', b'test')
+            done = c.read_responses(3)
+            self.ae(done[-1], 1)
+            self.ae(c.responses[1][0][b':status'], b'200')
+            self.ae(c.responses[1][1], body)
+            self.ae(c.responses[3][1], b'a HTTP/2')
+            self.ae(c.responses[5][1], b'test')
+
+            # Flow control, no more data is sent than the client allows
+            c = Client(server, window=1000)
+            c.sock.settimeout(0.1)
+            c.request(1, b'/body')
+            self.assertRaises(socket.timeout, c.read_responses, 1, window_update=False)
+            self.ae(len(c.responses[1][1]), 1000)
+            c.sock.sendall(h.frame(h.WINDOW_UPDATE, 0, 1, h.UINT32.pack(len(body))))
+            self.assertRaises(socket.timeout, c.read_responses, 1, window_update=False)
+            self.ae(len(c.responses[1][1]), h.DEFAULT_WINDOW_SIZE)
+            c.sock.sendall(h.frame(h.WINDOW_UPDATE, 0, 0, h.UINT32.pack(len(body))))
+            c.sock.settimeout(5)
+            c.read_responses(1, window_update=False)
+            self.ae(c.responses[1][1], body)
+
+            # Protocol errors close the connection with GOAWAY
+            c = Client(server)
+            with server.silence_log:
+                c.sock.sendall(h.frame(h.HEADERS, h.END_HEADERS, 2, b''))
+                while True:
+                    ftype, flags, stream_id, payload = c.read_frame()
+                    if ftype == h.GOAWAY:
+                        break
+            self.ae(h.UINT32.unpack(payload[4:8])[0], h.PROTOCOL_ERROR)
+
+            # Upgrading a HTTP/1.1 connection
+            c = Client(server, preface=None)
+            settings = urlsafe_b64encode(h.SETTING.pack(h.SETTINGS_MAX_CONCURRENT_STREAMS, 10)).rstrip(b'=')
+            c.sock.sendall(b'GET /up HTTP/1.1\r\nHost: localhost\r\nConnection: Upgrade, HTTP2-Settings\r\n'
+                           b'Upgrade: h2c\r\nHTTP2-Settings: ' + settings + b'\r\n\r\n')
+            while b'\r\n\r\n' not in c.buf:
+                c.buf += c.sock.recv(1024)
+            response, c.buf = c.buf.partition(b'\r\n\r\n')[::2]
+            self.assertIn(b' 101 ', response.splitlines()[0])
+            c.sock.sendall(h.PREFACE + h.frame(h.SETTINGS, 0, 0))
+            c.read_responses(1)
+            self.ae(c.responses[1][1], b'up HTTP/2')
+
+            # An invalid Content-Length is rejected
+            c = Client(server, preface=None)
+            c.sock.sendall(b'GET /up HTTP/1.1\r\nHost: localhost\r\nConnection: Upgrade, HTTP2-Settings\r\n'
+                           b'Upgrade: h2c\r\nHTTP2-Settings: ' + settings + b'\r\nContent-Length: x\r\n\r\n')
+            self.assertIn(b' 400 ', c.sock.recv(1024).splitlines()[0])
+
+            # HTTP/1.1 still works
+            conn = server.connect()
+            conn.request('GET', '/a')
+            self.ae(conn.getresponse().read(), b'a HTTP/1.1')
+
+            # Idle connections are closed
+            c = Client(server)
+            self.assertRaises(EOFError, c.read_responses, 1)
+
+        with TestServer(handler, timeout=1, use_http2=False) as server:
+            c = Client(server)
+            self.assertIn(b' 505 ', c.sock.recv(1024).splitlines()[0])
+
+        # A single connection uses only half of the worker threads at a time
+        lock, running = Lock(), [0, 0]
+
+        def slow_handler(data):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return data.path[0]
+
+        with TestServer(slow_handler, timeout=1, worker_count=4) as server:
+            c = Client(server)
+            for i in xrange(6):
+                c.request(2 * i + 1, b'/%d' % i)
+            self.ae(len(c.read_responses(6)), 6)
+            self.ae(running[1], 2)
+            self.ae(c.responses[11][1], b'5')
+    # }}}
+
+    def test_request_metrics(self):  # {{{
+        'Test request metrics and profiling'
+        from calibre.srv.metrics import request_metrics
+        from calibre.srv.opts import Options
+        from calibre.srv.routes import Router, endpoint
+        from calibre.srv.errors import HTTPNotFound
+
+        @endpoint('/ok/{x}', auth_required=False)
+        def ok(ctx, rd, x):
+            return 'ok'
+
+        @endpoint('/missing', auth_required=False)
+        def missing(ctx, rd):
+            request_metrics.cache_used('test', False)
+            raise HTTPNotFound('missing')
+
+        @endpoint('/metrics', auth_required=False)
+        def metrics(ctx, rd):
+            request_metrics.cache_used('test', True)
+            ctx.tdir = rd.tdir
+            return request_metrics.render()
+
+        class Context(object):
+            testing = True
+            log = None
+            opts = Options(profile_slow_requests=1e-9, profile_sample_interval=2)
+
+        router = Router((ok, missing, metrics), ctx=Context())
+        request_metrics.clear()
+        with TestServer(router.dispatch) as server:
+            conn = server.connect()
+            for path in ('/ok/1', '/ok/2', '/missing', '/metrics'):
+                conn.request('GET', path)
+                conn.getresponse().read()
+            conn.request('GET', '/metrics')
+            r = conn.getresponse()
+            self.ae(r.status, httplib.OK)
+            lines = r.read().decode('utf-8').splitlines()
+            for line in (
+                'calibre_server_request_duration_seconds_count{route="/ok/{x}"} 2',
+                'calibre_server_request_duration_seconds_bucket{route="/ok/{x}",le="+Inf"} 2',
+                'calibre_server_responses_total{route="/ok/{x}",code="200"} 2',
+                'calibre_server_responses_total{route="/missing",code="404"} 1',
+                'calibre_server_cache_lookups_total{cache="test",result="hit"} 2',
+                'calibre_server_cache_lookups_total{cache="test",result="miss"} 1',
+                'calibre_server_worker_threads %d' % server.loop.opts.worker_count,
+            ):
+                self.assertIn(line, lines)
+            self.assertIn('# TYPE calibre_server_request_duration_seconds histogram', lines)
+            self.assertTrue([x for x in lines if x.startswith('calibre_server_sent_bytes_total{method="copy"} ')])
+            # One in two requests was profiled
+            profiles = os.path.join(router.ctx.tdir, 'server-profiles')
+            self.ae(len(os.listdir(profiles)), 2)
+            # Failing to save the profile does not fail the request
+            os.rename(profiles, profiles + '-saved')
+            with open(profiles, 'wb'):
+                pass
+            router.ctx.log = server.log
+            for path in ('/ok/3', '/ok/4'):
+                with server.silence_log:
+                    conn.request('GET', path)
+                    r = conn.getresponse()
+                    self.ae(r.status, httplib.OK)
+                    self.ae(r.read(), b'ok')
+        request_metrics.clear()
+    # }}}
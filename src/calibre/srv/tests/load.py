@@ -0,0 +1,112 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+'''
+A load test for the server loop. Opens a large number of idle keep-alive
+connections and then measures the rate at which new connections can be
+handled and the latency of requests on an active connection. Run it with:
+
+    calibre-debug -c "from calibre.srv.tests.load import main; main()" [options]
+'''
+
+import select, sys
+
+from calibre.constants import iswindows
+from calibre.srv.tests.base import TestServer
+from calibre.utils.monotonic import monotonic
+
+
+def raise_open_files_limit(needed):
+    if iswindows:
+        return needed
+    import resource  # POSIX only
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        soft = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    return soft
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def open_idle_connections(server, num):
+    ans = []
+    for i in xrange(num):
+        conn = server.connect(timeout=60)
+        conn.request('GET', '/idle')
+        conn.getresponse().read()
+        ans.append(conn)
+    return ans
+
+
+def connections_per_second(server, duration):
+    count, end = 0, monotonic() + duration
+    while monotonic() < end:
+        conn = server.connect(timeout=60)
+        conn.request('GET', '/new', headers={'Connection':'close'})
+        conn.getresponse().read()
+        conn.close()
+        count += 1
+    return count / duration
+
+
+def request_latencies(server, num):
+    conn = server.connect(timeout=60)
+    ans = []
+    try:
+        for i in xrange(num):
+            start = monotonic()
+            conn.request('GET', '/active')
+            conn.getresponse().read()
+            ans.append(monotonic() - start)
+    finally:
+        conn.close()
+    return ans
+
+
+def run(poller, num_idle, duration, num_requests):
+    with TestServer(lambda data:'ok', timeout=3600, specialize=lambda srv: setattr(srv.loop, 'POLLER', poller)) as server:
+        idle = open_idle_connections(server, num_idle)
+        try:
+            rate = connections_per_second(server, duration)
+            latencies = request_latencies(server, num_requests)
+        finally:
+            for conn in idle:
+                conn.close()
+    return rate, percentile(latencies, 0.5), percentile(latencies, 0.99)
+
+
+def main(args=sys.argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Load test the calibre server loop')
+    parser.add_argument('--pollers', default=','.join(['epoll', 'select'] if hasattr(select, 'epoll') else ['select']),
+                        help='Comma separated list of pollers to test')
+    parser.add_argument('--idle', default='1000,10000', help='Comma separated numbers of idle keep-alive connections')
+    parser.add_argument('--duration', default=5, type=float, help='Seconds to spend opening new connections')
+    parser.add_argument('--requests', default=2000, type=int, help='Number of requests to measure latency with')
+    opts = parser.parse_args(args[1:])
+    print('%-8s %8s %12s %10s %10s' % ('poller', 'idle', 'conns/sec', 'p50 ms', 'p99 ms'))
+    for num_idle in map(int, opts.idle.split(',')):
+        # The client and server ends of every connection, plus some spares
+        limit = raise_open_files_limit(2 * num_idle + 64)
+        for poller in opts.pollers.split(','):
+            if limit < 2 * num_idle + 64:
+                print('%-8s %8d skipped, the limit on open files is too low: %d' % (poller, num_idle, limit))
+                continue
+            if poller == 'select' and 2 * num_idle + 64 >= 1024:
+                print('%-8s %8d skipped, select() cannot handle more than 1024 file descriptors' % (poller, num_idle))
+                continue
+            rate, p50, p99 = run(poller, num_idle, opts.duration, opts.requests)
+            print('%-8s %8d %12.1f %10.3f %10.3f' % (poller, num_idle, rate, p50 * 1000, p99 * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -75,6 +75,52 @@ class LoopTest(BaseTest):
         self.assertTrue(plugin.event.wait(5))
         self.assertFalse(plugin.running.is_set())
 
+    def test_pollers(self):
+        ' Test the server with the available pollers '
+        import select
+        from calibre.srv.poller import create_poller, POLL_READ, POLL_WRITE
+        pollers = ['select'] + (['epoll'] if hasattr(select, 'epoll') else [])
+        a, b = socket.socketpair()
+        try:
+            for name in pollers:
+                p = create_poller(name)
+                p.set_interest(a.fileno(), POLL_READ | POLL_WRITE)
+                self.ae(p.poll(0), ([], [a.fileno()]))
+                b.sendall(b'x')
+                self.ae(p.poll(0), ([a.fileno()], [a.fileno()]))
+                p.set_interest(a.fileno(), POLL_READ)
+                self.ae(p.poll(0), ([a.fileno()], []))
+                a.recv(1)
+                self.ae(p.poll(0), ([], []))
+                p.unregister(a.fileno())
+                b.sendall(b'x')
+                self.ae(p.poll(0), ([], []))
+                a.recv(1)
+                p.close()
+        finally:
+            a.close(), b.close()
+
+        for name in pollers:
+            with TestServer(lambda data:(data.path[0] + data.read()), timeout=0.2,
+                            specialize=lambda srv: setattr(srv.loop, 'POLLER', name)) as server:
+                conns = [server.connect() for i in xrange(20)]
+                for i, conn in enumerate(conns):
+                    conn.request('POST', '/%d' % i, body=b'x' * i)
+                for i, conn in enumerate(conns):
+                    r = conn.getresponse()
+                    self.ae(r.status, httplib.OK)
+                    self.ae(r.read(), b'%d' % i + b'x' * i)
+                # Keep-alive connections are re-used
+                conns[0].request('GET', '/again')
+                self.ae(conns[0].getresponse().read(), b'again')
+                self.ae(server.loop.poller.name, name)
+                self.ae(server.loop.num_active_connections, 20)
+                # Inactive connections are closed
+                time.sleep(0.5)
+                self.ae(server.loop.num_active_connections, 0)
+                for conn in conns:
+                    conn.close()
+
     def test_workers(self):
         ' Test worker semantics '
         with TestServer(lambda data:(data.path[0] + data.read()), worker_count=3) as server:
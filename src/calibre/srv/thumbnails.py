@@ -0,0 +1,143 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2018, Kovid Goyal <kovid at kovidgoyal.net>'
+
+'''
+A persistent store for cover thumbnails, so that thumbnails survive server
+restarts and do not have to be rendered again. Thumbnails are stored per
+library and size in a calibre.db.utils.ThumbnailCache, which evicts the least
+recently used thumbnails when it grows too large. A ThumbnailCache must only
+be used by a single process, so when the server runs in multiple processes,
+each process has its own stores.
+'''
+
+import os
+from threading import Lock
+
+from calibre import prints
+from calibre.constants import cache_dir
+from calibre.db.utils import ThumbnailCache
+from calibre.utils.config_base import tweaks
+
+# The thumbnail sizes used by the book list in the browser (for devices with
+# one and two physical pixels per CSS pixel) and by the OPDS feeds
+STANDARD_THUMBNAIL_SIZES = ((60, 80), (105, 140), (210, 280), (300, 400), (600, 800))
+# Thumbnails of at most this many different sizes are stored per library, so
+# that clients requesting arbitrary sizes cannot use unlimited disk space
+MAX_THUMBNAIL_SIZES = 16
+
+stores = {}
+lock = Lock()
+
+
+def thumbnail_quality():
+    return min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
+
+
+def thumbnail_store(library_uuid, width, height, max_size, location=None, process_name=None):
+    ''' Return the store for the thumbnails of the specified size, or None if
+    thumbnails of too many sizes are already being stored. process_name must
+    be unique for every process of a server running in multiple processes. '''
+    location = os.path.join(location or cache_dir(), 'srv-thumbnails')
+    if process_name:
+        location = os.path.join(location, process_name)
+    location = os.path.join(location, library_uuid)
+    key = location, width, height
+    with lock:
+        ans = stores.get(key)
+        if ans is None:
+            if sum(1 for k in stores if k[0] == location) >= MAX_THUMBNAIL_SIZES:
+                return
+            ans = stores[key] = ThumbnailCache(
+                max_size=max_size, name='%dx%d' % (width, height), thumbnail_size=(width, height), location=location)
+        return ans
+
+
+def shutdown_stores():
+    ' Save the order of thumbnails in the stores, used for LRU eviction '
+    with lock:
+        for store in stores.itervalues():
+            store.shutdown()
+        stores.clear()
+
+
+def render_thumbnail(cover_data, width, height, quality=None):
+    from calibre.utils.img import scale_image
+    if quality is None:
+        quality = thumbnail_quality()
+    return scale_image(cover_data, width=width, height=height, compression_quality=quality)[-1]
+
+
+def render_thumbnails(cover_path, sizes, quality):
+    ' Run in a worker process to render the thumbnails of the specified sizes for a single cover '
+    from calibre.gui2 import ensure_app
+    ensure_app()
+    with lopen(cover_path, 'rb') as f:
+        cover_data = f.read()
+    return [(width, height, render_thumbnail(cover_data, width, height, quality)) for width, height in sizes]
+
+
+def is_fresh(timestamp, mtime):
+    # The same tolerance as used for the thumbnails in the calibre GUI
+    return timestamp is not None and abs(timestamp - mtime) < 0.1
+
+
+def pregenerate_thumbnails(libraries, opts, sizes=STANDARD_THUMBNAIL_SIZES, max_workers=None, report=prints, location=None):
+    ''' Render the thumbnails of the specified sizes for every book with a
+    cover in the specified libraries, in parallel worker processes, so that
+    the server does not have to render them on demand. The thumbnails are
+    stored under location, which defaults to the calibre cache directory, in
+    the stores of every server process if opts.server_processes is set. '''
+    from calibre.srv.library_broker import LibraryBroker
+    from calibre.utils.date import timestampfromdt
+    from calibre.utils.ipc.pool import Pool
+    if opts.max_thumbnail_cache_size <= 0:
+        raise SystemExit('Storing thumbnails is disabled by the max_thumbnail_cache_size option')
+    broker = LibraryBroker(libraries)
+    quality = thumbnail_quality()
+    # The thumbnail stores used by the server processes, see calibre.srv.prefork
+    process_names = ['process-%d' % i for i in xrange(opts.server_processes)] or [None]
+    pool = Pool(max_workers=max_workers, name='Thumbnails')
+    try:
+        for library_id in broker.library_map:
+            db = broker.get(library_id)
+            library_uuid = db.library_id
+            size_stores = [(size, [
+                thumbnail_store(library_uuid, size[0], size[1], opts.max_thumbnail_cache_size, location=location, process_name=process_name)
+                for process_name in process_names]) for size in sizes]
+            pending, done = {}, 0
+            for book_id in db.all_book_ids():
+                mtime = db.cover_last_modified(book_id)
+                if mtime is None:
+                    continue
+                mtime = timestampfromdt(mtime)
+                needed = [size for size, process_stores in size_stores if any(
+                    store is not None and not is_fresh(store[book_id][1], mtime) for store in process_stores)]
+                if needed:
+                    pending[book_id] = mtime
+                    pool(book_id, 'calibre.srv.thumbnails', 'render_thumbnails', db.format_abspath(book_id, '__COVER_INTERNAL__'), needed, quality)
+            report('Rendering thumbnails for %d books in the library %s' % (len(pending), broker.library_map[library_id]))
+            stores_by_size = dict(size_stores)
+            while done < len(pending):
+                result = pool.results.get()
+                done += 1
+                if result.is_terminal_failure:
+                    tf = pool.terminal_failure
+                    raise SystemExit('%s while rendering thumbnails for book %s:\n%s' % (tf.message, tf.job_id, tf.tb))
+                if result.result.err:
+                    report('Failed to render thumbnails for book %d: %s' % (result.id, result.result.err))
+                    continue
+                for width, height, data in result.result.value:
+                    for store in stores_by_size[(width, height)]:
+                        if store is not None:
+                            store.insert(result.id, pending[result.id], data)
+                if done % 100 == 0:
+                    report('Rendered thumbnails for %d of %d books' % (done, len(pending)))
+    finally:
+        pool.shutdown()
+        broker.close()
+        shutdown_stores()
@@ -28,6 +28,7 @@ from calibre.utils.shared_file import share_open, raise_winerror
 
 HTTP1  = 'HTTP/1.0'
 HTTP11 = 'HTTP/1.1'
+HTTP2  = 'HTTP/2'
 DESIRED_SEND_BUFFER_SIZE = 16 * 1024  # windows 7 uses an 8KB sndbuf
 
 
@@ -245,8 +246,13 @@ def parse_http_dict(header_val):
 
 def sort_q_values(header_val):
     'Get sorted items from an HTTP header of type: a;q=0.5, b;q=0.7...'
+    return tuple(map(itemgetter(0), parse_q_values(header_val)))
+
+
+def parse_q_values(header_val):
+    'Get sorted (item, q) pairs from an HTTP header of type: a;q=0.5, b;q=0.7...'
     if not header_val:
-        return []
+        return ()
 
     def item(x):
         e, r = x.partition(';')[::2]
@@ -258,7 +264,7 @@ def sort_q_values(header_val):
             except Exception:
                 pass
         return e.strip(), q
-    return tuple(map(itemgetter(0), sorted(map(item, parse_http_list(header_val)), key=itemgetter(1), reverse=True)))
+    return tuple(sorted(map(item, parse_http_list(header_val)), key=itemgetter(1), reverse=True))
 
 
 def eintr_retry_call(func, *args, **kwargs):
@@ -16,6 +16,7 @@ from threading import Lock
 from calibre import as_unicode
 from calibre.constants import plugins
 from calibre.srv.loop import ServerLoop, HandleInterrupt, WRITE, READ, RDWR, Connection
+from calibre.srv.http2 import HTTP2Connection
 from calibre.srv.http_response import HTTPConnection, create_http_handler
 from calibre.srv.utils import DESIRED_SEND_BUFFER_SIZE
 from calibre.utils.speedups import ReadOnlyFileBuffer
@@ -253,7 +254,7 @@ class UTF8Decoder(object):  # {{{
 # }}}
 
 
-class WebSocketConnection(HTTPConnection):
+class WebSocketConnection(HTTP2Connection):
 
     # Internal API {{{
     in_websocket_mode = False
@@ -261,7 +262,7 @@ class WebSocketConnection(HTTPConnection):
 
     def __init__(self, *args, **kwargs):
         global conn_id
-        HTTPConnection.__init__(self, *args, **kwargs)
+        HTTP2Connection.__init__(self, *args, **kwargs)
         self.sendq = Queue()
         self.control_frames = deque()
         self.cf_lock = Lock()
@@ -278,7 +279,7 @@ class WebSocketConnection(HTTPConnection):
         key = inheaders.get('Sec-WebSocket-Key', None)
         conn = {x.strip().lower() for x in inheaders.get('Connection', '').split(',')}
         if key is None or upgrade.lower() != 'websocket' or 'upgrade' not in conn:
-            return HTTPConnection.finalize_headers(self, inheaders)
+            return HTTP2Connection.finalize_headers(self, inheaders)
         ver = inheaders.get('Sec-WebSocket-Version', 'Unknown')
         try:
             ver_ok = int(ver) >= 13
@@ -36,7 +36,7 @@ class _Parser(object):
         self.locals = {'$':val}
         self.funcs = funcs
 
-    def error(self, message):
+    def error_message(self, message):
         m = 'Formatter: ' + message + _(' near ')
         if self.lex_pos > 0:
             m = '{0} {1}'.format(m, self.prog[self.lex_pos-1][1])
@@ -44,7 +44,10 @@ class _Parser(object):
             m = '{0} {1}'.format(m, self.prog[self.lex_pos+1][1])
         else:
             m = '{0} {1}'.format(m, _('end of program'))
-        raise ValueError(m)
+        return m
+
+    def error(self, message):
+        raise ValueError(self.error_message(message))
 
     def token(self):
         if self.lex_pos >= self.prog_len:
@@ -174,6 +177,129 @@ class _Parser(object):
             self.error(_('expression is not function or constant'))
 
 
+class _Compiler(_Parser):
+    '''
+    Compiles a lex'ed template program into a tree of closures that evaluate
+    it exactly as :class:`_Parser` would, without re-interpreting the tokens.
+    Every closure is called with the arguments (formatter, kwargs, book,
+    locals, funcs). Errors that the parser would report while reading the
+    program are raised at runtime with the same messages. Programs with syntax
+    errors cannot be compiled, they are left to the parser so that the error
+    is reported at the same point of the evaluation.
+    '''
+
+    def __init__(self, prog):
+        self.lex_pos = 0
+        self.prog = prog[0]
+        self.prog_len = len(self.prog)
+        if prog[1] != '':
+            self.error(_('failed to scan program. Invalid input {0}').format(prog[1]))
+
+    def compile(self):
+        node = self.program()
+
+        def run(formatter, val):
+            return node(formatter, formatter.kwargs, formatter.book, {'$':val}, formatter.funcs)
+        return run
+
+    def program(self):
+        node = self.statement()
+        if not self.token_is_eof():
+            self.error(_('syntax error - program ends before EOF'))
+        return node
+
+    def statement(self):
+        nodes = []
+        while True:
+            nodes.append(self.expr())
+            if self.token_is_eof() or not self.token_op_is_a_semicolon():
+                break
+            self.consume()
+            if self.token_is_eof():
+                break
+        if len(nodes) == 1:
+            return nodes[0]
+        nodes = tuple(nodes)
+
+        def sequence(formatter, kwargs, book, locals, funcs):
+            for node in nodes:
+                val = node(formatter, kwargs, book, locals, funcs)
+            return val
+        return sequence
+
+    def constant(self, val):
+        def constant(formatter, kwargs, book, locals, funcs):
+            return val
+        return constant
+
+    def expr(self):
+        if self.token_is_id():
+            id = self.token()
+            if not self.token_op_is_a_lparen():
+                if self.token_op_is_a_equals():
+                    self.consume()
+                    value = self.expr()
+
+                    def assignment(formatter, kwargs, book, locals, funcs):
+                        return funcs['assign'].eval_(formatter, kwargs, book, locals,
+                                id, value(formatter, kwargs, book, locals, funcs))
+                    return assignment
+                unknown = self.error_message(_('Unknown identifier ') + id)
+
+                def identifier(formatter, kwargs, book, locals, funcs):
+                    val = locals.get(id, None)
+                    if val is None:
+                        raise ValueError(unknown)
+                    return val
+                return identifier
+            id = id.strip()
+            unknown = self.error_message(_('unknown function {0}').format(id))
+            self.consume()
+            args = []
+            while not self.token_op_is_a_rparen():
+                if id == 'assign' and len(args) == 0:
+                    if not self.token_is_id():
+                        self.error('assign requires the first parameter be an id')
+                    args.append(self.constant(self.token()))
+                else:
+                    args.append(self.statement())
+                if not self.token_op_is_a_comma():
+                    break
+                self.consume()
+            if self.token() != ')':
+                self.error(_('missing closing parenthesis'))
+            wrong_count = self.error_message('incorrect number of arguments for function {}'.format(id))
+            args, num_args = tuple(args), len(args)
+
+            def call(formatter, kwargs, book, locals, funcs):
+                if id not in funcs:
+                    raise ValueError(unknown)
+                vals = [arg(formatter, kwargs, book, locals, funcs) for arg in args]
+                cls = funcs[id]
+                if cls.arg_count != -1 and num_args != cls.arg_count:
+                    raise ValueError(wrong_count)
+                return cls.eval_(formatter, kwargs, book, locals, *vals)
+            return call
+        elif self.token_is_constant():
+            return self.constant(self.token())
+        else:
+            self.error(_('expression is not function or constant'))
+
+
+# Compiled programs, format specifications and templates, shared by all
+# formatters. Maps keys to a function or to None if the key could not be
+# compiled.
+compiled_templates = {}
+MAX_COMPILED_TEMPLATES = 2048
+# Attributes that a formatter class must not override for the compiled
+# templates to be equivalent to its own evaluation
+FORMATTING_ATTRIBUTES = frozenset((
+    'vformat', '_vformat', 'parse', 'get_field', 'convert_field', 'check_unused_args',
+    'format_field', '_explode_format_string', '_eval_program', 'lex_scanner',
+    'arg_parser', 'backslash_comma_to_comma', 'format_string_re'))
+formatter_classes_using_compiled_templates = {}
+
+
 class TemplateFormatter(string.Formatter):
     '''
     Provides a format function that substitutes '' for any missing value
@@ -185,6 +311,11 @@ class TemplateFormatter(string.Formatter):
     # method to use it. It is cleared when starting to format a template
     composite_values = {}
 
+    # Evaluate templates using compiled programs and format specifications
+    # instead of re-parsing them every time. Set to False to always use the
+    # interpreter.
+    compile_templates = True
+
     def __init__(self):
         string.Formatter.__init__(self)
         self.book = None
@@ -250,6 +381,10 @@ class TemplateFormatter(string.Formatter):
         ], flags=re.DOTALL)
 
     def _eval_program(self, val, prog, column_name):
+        if self._use_compiled_templates():
+            program = self._compiled(('program', prog), self._compile_program, prog)
+            if program is not None:
+                return program(self, val)
         # keep a cache of the lex'ed program under the theory that re-lexing
         # is much more expensive than the cache lookup. This is certainly true
         # for more than a few tokens, but it isn't clear for simple programs.
@@ -263,12 +398,169 @@ class TemplateFormatter(string.Formatter):
         parser = _Parser(val, lprog, self.funcs, self)
         return parser.program()
 
+    # ################# Compiled templates ##################################
+
+    def _use_compiled_templates(self):
+        if not self.compile_templates:
+            return False
+        cls = self.__class__
+        ans = formatter_classes_using_compiled_templates.get(cls)
+        if ans is None:
+            ans = True
+            for klass in cls.__mro__:
+                if klass is TemplateFormatter:
+                    break
+                if not FORMATTING_ATTRIBUTES.isdisjoint(vars(klass)):
+                    ans = False
+                    break
+            formatter_classes_using_compiled_templates[cls] = ans
+        return ans
+
+    def _compiled(self, key, compiler, text):
+        try:
+            return compiled_templates[key]
+        except KeyError:
+            pass
+        try:
+            ans = compiler(text)
+        except Exception:
+            ans = None
+        if len(compiled_templates) >= MAX_COMPILED_TEMPLATES:
+            compiled_templates.clear()
+        compiled_templates[key] = ans
+        return ans
+
+    def _compile_program(self, prog):
+        return _Compiler(self.lex_scanner.scan(prog)).compile()
+
+    def _compile_format_field(self, fmt):
+        ''' Return a function that takes (formatter, val) and does what
+        format_field(val, fmt) does for this fmt. '''
+        fmt, prefix, suffix = self._explode_format_string(fmt)
+        call = None
+
+        if fmt.startswith('\''):
+            p = 0
+        else:
+            p = fmt.find(':\'')
+            if p >= 0:
+                p += 1
+        if p >= 0 and fmt[-1] == '\'':
+            prog = fmt[p+1:-1]
+            call = self._compiled(('program', prog), self._compile_program, prog)
+            if call is None:
+                def call(formatter, val):
+                    return formatter._eval_program(val, prog, None)
+            colon = fmt[0:p].find(':')
+            if colon < 0:
+                dispfmt = ''
+            else:
+                dispfmt = fmt[0:colon]
+        else:
+            p = fmt.find('(')
+            dispfmt = fmt
+            if p >= 0 and fmt[-1] == ')':
+                colon = fmt[0:p].find(':')
+                if colon < 0:
+                    dispfmt = ''
+                    colon = 0
+                else:
+                    dispfmt = fmt[0:colon]
+                    colon += 1
+
+                fname = fmt[colon:p].strip()
+                single_arg = [fmt[p+1:-1]]
+                args = self.arg_parser.scan(fmt[p+1:])[0]
+                args = [self.backslash_comma_to_comma.sub(',', a) for a in args]
+                wrong_count = 'Incorrect number of arguments for function '+ fmt[0:p]
+                unknown = _('%s: unknown function')%fname
+
+                def format_field(formatter, val):
+                    if isinstance(val, (int, float)):
+                        if val:
+                            val = unicode(val)
+                        else:
+                            val = ''
+                    if fname not in formatter.funcs:
+                        return unknown
+                    func = formatter.funcs[fname]
+                    fargs = single_arg if func.arg_count == 2 else args
+                    if (func.arg_count == 1 and (len(fargs) != 1 or fargs[0])) or \
+                            (func.arg_count > 1 and func.arg_count != len(fargs)+1):
+                        raise ValueError(wrong_count)
+                    if func.arg_count == 1:
+                        val = func.eval_(formatter, formatter.kwargs, formatter.book, formatter.locals, val)
+                    else:
+                        val = func.eval_(formatter, formatter.kwargs, formatter.book, formatter.locals, val, *fargs)
+                    if formatter.strip_results:
+                        val = val.strip()
+                    if val:
+                        val = formatter._do_format(val, dispfmt)
+                    if not val:
+                        return ''
+                    return prefix + val + suffix
+                return format_field
+
+        def format_field(formatter, val):
+            if isinstance(val, (int, float)):
+                if val:
+                    val = unicode(val)
+                else:
+                    val = ''
+            if call is not None:
+                val = call(formatter, val)
+            if val:
+                val = formatter._do_format(val, dispfmt)
+            if not val:
+                return ''
+            return prefix + val + suffix
+        return format_field
+
+    def _compile_template(self, fmt):
+        ''' Return a function that takes (formatter, args, kwargs) and does what
+        vformat(fmt, args, kwargs) does for this fmt. '''
+        pieces = []
+        for literal, field_name, format_spec, conversion in self.parse(fmt):
+            field = None
+            if field_name is not None:
+                if '{' in format_spec or '}' in format_spec:
+                    # Nested replacement fields in the format specification
+                    return None
+                first, rest = field_name._formatter_field_name_split()
+                format_field = self._compiled(('field', format_spec), self._compile_format_field, format_spec)
+                field = (first, tuple(rest), conversion, format_field)
+            pieces.append((literal, field))
+        pieces = tuple(pieces)
+
+        def vformat(formatter, args, kwargs):
+            result = []
+            for literal, field in pieces:
+                if literal:
+                    result.append(literal)
+                if field is not None:
+                    first, rest, conversion, format_field = field
+                    obj = formatter.get_value(first, args, kwargs)
+                    for is_attr, i in rest:
+                        if is_attr:
+                            obj = getattr(obj, i)
+                        else:
+                            obj = obj[i]
+                    if conversion is not None:
+                        obj = formatter.convert_field(obj, conversion)
+                    result.append(format_field(formatter, obj))
+            return ''.join(result)
+        return vformat
+
     # ################# Override parent classes methods #####################
 
     def get_value(self, key, args, kwargs):
         raise Exception('get_value must be implemented in the subclass')
 
     def format_field(self, val, fmt):
+        if self._use_compiled_templates():
+            format_field = self._compiled(('field', fmt), self._compile_format_field, fmt)
+            if format_field is not None:
+                return format_field(self, val)
         # ensure we are dealing with a string.
         if isinstance(val, (int, float)):
             if val:
@@ -339,7 +631,13 @@ class TemplateFormatter(string.Formatter):
         if fmt.startswith('program:'):
             ans = self._eval_program(kwargs.get('$', None), fmt[8:], self.column_name)
         else:
-            ans = self.vformat(fmt, args, kwargs)
+            vformat = None
+            if self._use_compiled_templates():
+                vformat = self._compiled(('template', fmt), self._compile_template, fmt)
+            if vformat is None:
+                ans = self.vformat(fmt, args, kwargs)
+            else:
+                ans = vformat(self, args, kwargs)
         if self.strip_results:
             return self.compress_spaces.sub(' ', ans).strip()
         return ans
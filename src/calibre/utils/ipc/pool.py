@@ -6,7 +6,7 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2014, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import os, cPickle, sys
+import os, cPickle, sys, time
 from threading import Thread
 from collections import namedtuple
 from Queue import Queue
@@ -93,6 +93,7 @@ class Worker(object):
         self.process, self.conn = p, conn
         self.events = events
         self.name = name or ''
+        self.jobs_done = 0
 
     def __call__(self, job):
         eintr_retry_call(self.conn.send_bytes, cPickle.dumps(job, -1))
@@ -120,9 +121,26 @@ class Pool(Thread):
 
     daemon = True
 
-    def __init__(self, max_workers=None, name=None):
+    def __init__(self, max_workers=None, name=None, initializer=None,
+                 max_jobs_per_worker=0, max_worker_memory=0, prestart_workers=False):
+        '''
+        :param initializer: A (module, function name) pair. The function is
+                            called in every worker process before it runs any
+                            jobs, for example, to import modules the jobs need.
+        :param max_jobs_per_worker: If greater than zero, worker processes are
+                                    replaced after running this many jobs.
+        :param max_worker_memory: If greater than zero, worker processes whose
+                                  resident memory is larger than this many MB
+                                  after a job are replaced.
+        :param prestart_workers: Start max_workers processes immediately,
+                                 instead of when jobs need them.
+        '''
         Thread.__init__(self, name=name)
         self.max_workers = max_workers or detect_ncpus()
+        self.initializer = initializer
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.max_worker_memory = max_worker_memory
+        self.prestart_workers = prestart_workers
         self.available_workers = []
         self.busy_workers = {}
         self.pending_jobs = []
@@ -211,9 +229,10 @@ class Pool(Thread):
         from calibre.utils.ipc.server import create_listener
         self.auth_key = os.urandom(32)
         self.address, self.listener = create_listener(self.auth_key)
-        self.worker_data = cPickle.dumps((self.address, self.auth_key), -1)
-        if self.start_worker() is False:
-            return
+        self.worker_data = cPickle.dumps((self.address, self.auth_key, self.initializer), -1)
+        for i in xrange(self.max_workers if self.prestart_workers else 1):
+            if self.start_worker() is False:
+                return
 
         while True:
             event = self.events.get()
@@ -234,14 +253,21 @@ class Pool(Thread):
             return self.run_job(job)
         elif isinstance(event, WorkerResult):
             worker_result = event
-            self.busy_workers.pop(worker_result.worker, None)
-            self.available_workers.append(worker_result.worker)
+            worker = worker_result.worker
+            self.busy_workers.pop(worker, None)
+            self.available_workers.append(worker)
             self.tracker.task_done()
             if worker_result.is_terminal_failure:
                 self.terminal_failure = TerminalFailure('Worker process crashed while executing job', worker_result.result.traceback, worker_result.id)
                 self.terminal_error()
                 return False
             self.results.put(worker_result)
+            worker.jobs_done += 1
+            if self.worker_is_spent(worker):
+                self.available_workers.remove(worker)
+                self.retire_worker(worker)
+                if self.start_worker() is False:
+                    return False
         else:
             self.common_data = cPickle.dumps(event, -1)
             if len(self.common_data) > MAX_SIZE:
@@ -262,6 +288,43 @@ class Pool(Thread):
             if self.run_job(self.pending_jobs.pop()) is False:
                 return False
 
+    def worker_is_spent(self, worker):
+        if self.max_jobs_per_worker > 0 and worker.jobs_done >= self.max_jobs_per_worker:
+            return True
+        if self.max_worker_memory > 0:
+            try:
+                import psutil
+                rss = psutil.Process(worker.process.pid).memory_info().rss
+            except Exception:
+                return False
+            return rss > self.max_worker_memory * 1024 * 1024
+        return False
+
+    def retire_worker(self, worker):
+        try:
+            worker(None)
+        except Exception:
+            pass
+
+        def reap():
+            for i in xrange(50):
+                if worker.process.poll() is not None:
+                    break
+                time.sleep(0.1)
+            else:
+                try:
+                    worker.process.kill()
+                except EnvironmentError:
+                    pass
+                worker.process.wait()
+            try:
+                worker.conn.close()
+            except Exception:
+                pass
+        t = Thread(target=reap, name='ReapPoolWorker')
+        t.daemon = True
+        t.start()
+
     def run_job(self, job):
         worker = self.available_workers.pop()
         try:
@@ -388,8 +451,12 @@ def worker_main(conn):
 def run_main(func):
     from multiprocessing.connection import Client
     from contextlib import closing
-    address, key = cPickle.loads(eintr_retry_call(sys.stdin.read))
+    address, key, initializer = cPickle.loads(eintr_retry_call(sys.stdin.read))
     with closing(Client(address, authkey=key)) as conn:
+        if initializer is not None:
+            from importlib import import_module
+            module, func_name = initializer
+            getattr(import_module(module), func_name)()
         raise SystemExit(func(conn))
 
 
@@ -397,6 +464,10 @@ def test_write():
     print ('Printing to stdout in worker')
 
 
+def test_initializer():
+    os.environ['CALIBRE_TEST_POOL_INITIALIZED'] = '1'
+
+
 def test():
     def get_results(pool, ignore_fail=False):
         ans = {}
@@ -476,6 +547,19 @@ def test():
         raise SystemExit('No expected terminal failure')
     p.shutdown(), p.join()
 
+    # Test initializer and replacing workers
+    p = Pool(name='Test', max_workers=2, initializer=('calibre.utils.ipc.pool', 'test_initializer'), max_jobs_per_worker=3, prestart_workers=True)
+    for i in range(20):
+        p(i, 'import os\ndef x(i):\n return os.getpid(), os.environ.get("CALIBRE_TEST_POOL_INITIALIZED")', 'x', i)
+    p.wait_for_tasks(30)
+    results = [r.value for r in get_results(p).itervalues()]
+    if len(results) != 20 or {r[1] for r in results} != {'1'}:
+        raise SystemExit('Initializer was not run: %r' % results)
+    pids = {r[0] for r in results}
+    if len(pids) < 7:
+        raise SystemExit('Workers were not replaced: %r' % pids)
+    p.shutdown(), p.join()
+
     # Test shutting down with busy workers
     p = Pool(name='Test')
     for i in range(1000):
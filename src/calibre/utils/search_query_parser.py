@@ -20,6 +20,7 @@ import weakref, re
 
 from calibre.constants import preferred_encoding
 from calibre.utils.icu import sort_key
+from calibre.utils.monotonic import monotonic
 from calibre import prints
 
 
@@ -281,6 +282,50 @@ class ParseException(Exception):
         return ""
 
 
+DEFAULT_COST, DEFAULT_SELECTIVITY = 1.0, 0.5
+
+
+class PlanNode(object):
+
+    '''
+    A node in a compiled query plan. Leaf nodes are search terms, other nodes
+    are and/or operations over any number of children or a not operation.
+    Each node carries an estimate of its cost per candidate and of the
+    fraction of candidates it matches (its selectivity). After evaluation,
+    the time spent in the node and the number of candidates and matches are
+    also available.
+    '''
+
+    __slots__ = ('op', 'children', 'location', 'query', 'cost', 'selectivity',
+                 'elapsed', 'num_candidates', 'num_matches')
+
+    def __init__(self, op, children=(), location=None, query=None):
+        self.op, self.children = op, tuple(children)
+        self.location, self.query = location, query
+        self.cost, self.selectivity = DEFAULT_COST, DEFAULT_SELECTIVITY
+        self.elapsed = self.num_candidates = self.num_matches = None
+
+    @property
+    def and_rank(self):
+        # Terms that are cheap and reject many candidates should run first
+        return self.cost / max(1.0 - self.selectivity, 0.01)
+
+    def as_dict(self):
+        ans = {'op': self.op, 'cost': self.cost, 'selectivity': self.selectivity,
+               'time': self.elapsed, 'candidates': self.num_candidates,
+               'matches': self.num_matches}
+        if self.op == 'token':
+            ans['location'], ans['query'] = self.location, self.query
+        if self.children:
+            ans['children'] = [c.as_dict() for c in self.children]
+        return ans
+
+    def __repr__(self):
+        if self.op == 'token':
+            return 'PlanNode(%s:%s)' % (self.location, self.query)
+        return 'PlanNode(%s, %r)' % (self.op, list(self.children))
+
+
 class SearchQueryParser(object):
     '''
     Parses a search query.
@@ -321,6 +366,7 @@ class SearchQueryParser(object):
         self.parser = Parser()
         self.lookup_saved_search = global_lookup_saved_search if lookup_saved_search is None else lookup_saved_search
         self.sqp_parse_cache = parse_cache
+        self.last_plan = None
 
     def sqp_change_locations(self, locations):
         self.sqp_initialize(locations, optimize=self.optimize)
@@ -336,9 +382,19 @@ class SearchQueryParser(object):
         # empty the list of searches used for recursion testing
         self.recurse_level = 0
         self.searches_seen = set([])
+        self.last_plan = None
         candidates = self.universal_set()
         return self._parse(query, candidates=candidates)
 
+    def explain(self, query):
+        '''
+        Evaluate query, returning the set of matches and the evaluated query
+        plan, from which the order of evaluation and the time spent in each
+        node can be read.
+        '''
+        matches = self.parse(query)
+        return matches, self.last_plan
+
     # this parse is used internally because it doesn't clear the
     # recursive search test list. However, we permit seeing the
     # same search a few times because the search might appear within
@@ -358,38 +414,88 @@ class SearchQueryParser(object):
                 self.sqp_parse_cache[query] = res
         if candidates is None:
             candidates = self.universal_set()
-        t = self.evaluate(res, candidates)
+        plan = self.compile_plan(res)
+        t = self.evaluate_plan(plan, candidates)
+        self.last_plan = plan
         self.recurse_level -= 1
         return t
 
-    def method(self, group_name):
-        return getattr(self, 'evaluate_'+group_name)
-
-    def evaluate(self, parse_result, candidates):
-        return self.method(parse_result[0])(parse_result[1:], candidates)
-
-    def evaluate_and(self, argument, candidates):
-        # RHS checks only those items matched by LHS
-        # returns result of RHS check: RHmatches(LHmatches(c))
-        #  return self.evaluate(argument[0]).intersection(self.evaluate(argument[1]))
-        l = self.evaluate(argument[0], candidates)
-        return l.intersection(self.evaluate(argument[1], l))
-
-    def evaluate_or(self, argument, candidates):
-        # RHS checks only those elements not matched by LHS
-        # returns LHS union RHS: LHmatches(c) + RHmatches(c-LHmatches(c))
-        #  return self.evaluate(argument[0]).union(self.evaluate(argument[1]))
-        l = self.evaluate(argument[0], candidates)
-        return l.union(self.evaluate(argument[1], candidates.difference(l)))
-
-    def evaluate_not(self, argument, candidates):
-        # unary op checks only candidates. Result: list of items matching
-        # returns: c - matches(c)
-        #  return self.universal_set().difference(self.evaluate(argument[0]))
-        return candidates.difference(self.evaluate(argument[0], candidates))
-
-#     def evaluate_parenthesis(self, argument, candidates):
-#         return self.evaluate(argument[0], candidates)
+    def estimate_term(self, location, query):
+        '''
+        Return the estimated (cost per candidate, selectivity) for the search
+        term location:query. Used to order the operands of and/or
+        expressions when optimizing. Subclasses can override this to provide
+        real estimates, the default estimates preserve the written order.
+        '''
+        return DEFAULT_COST, DEFAULT_SELECTIVITY
+
+    def compile_plan(self, parse_result):
+        ''' Turn the parse tree into a tree of :class:`PlanNode` objects, with
+        chains of the same binary operator flattened and, if optimizing,
+        reordered so that cheap, selective terms are evaluated first. '''
+        op = parse_result[0]
+        if op == 'token':
+            node = PlanNode(op, location=parse_result[1], query=parse_result[2])
+            node.cost, node.selectivity = self.estimate_term(node.location, node.query)
+            return node
+        if op == 'not':
+            child = self.compile_plan(parse_result[1])
+            node = PlanNode(op, (child,))
+            node.cost, node.selectivity = child.cost, 1.0 - child.selectivity
+            return node
+        operands, stack = [], [parse_result[2], parse_result[1]]
+        while stack:
+            operand = stack.pop()
+            if operand[0] == op:
+                stack.extend((operand[2], operand[1]))
+            else:
+                operands.append(operand)
+        children = [self.compile_plan(x) for x in operands]
+        cost, remaining = 0.0, 1.0
+        if op == 'and':
+            if self.optimize:
+                children.sort(key=lambda c: c.and_rank)
+            for c in children:
+                cost += remaining * c.cost
+                remaining *= c.selectivity
+            selectivity = remaining
+        else:
+            if self.optimize:
+                # Cheap terms first, their matches are removed from the
+                # candidates for the more expensive terms
+                children.sort(key=lambda c: c.cost)
+            for c in children:
+                cost += remaining * c.cost
+                remaining *= 1.0 - c.selectivity
+            selectivity = 1.0 - remaining
+        node = PlanNode(op, children)
+        node.cost, node.selectivity = cost, selectivity
+        return node
+
+    def evaluate_plan(self, node, candidates):
+        start = monotonic()
+        op = node.op
+        if op == 'token':
+            ans = self.evaluate_token((node.location, node.query), candidates)
+            if node.location.lower() == 'search' and self.last_plan is not None:
+                node.children = (self.last_plan,)
+        elif op == 'not':
+            ans = candidates.difference(self.evaluate_plan(node.children[0], candidates))
+        elif op == 'and':
+            # Each term checks only the items matched by the previous terms
+            ans = candidates
+            for child in node.children:
+                ans = ans.intersection(self.evaluate_plan(child, ans))
+        else:
+            # Each term checks only the items not matched by previous terms
+            ans, remaining = set(), candidates
+            for child in node.children:
+                m = self.evaluate_plan(child, remaining)
+                ans |= m
+                remaining = remaining.difference(m)
+        node.elapsed = monotonic() - start
+        node.num_candidates, node.num_matches = len(candidates), len(ans)
+        return ans
 
     def evaluate_token(self, argument, candidates):
         location = argument[0]
@@ -358,12 +358,15 @@ class Tester(SearchQueryParser):
 
 class TestSQP(unittest.TestCase):
 
-    def do_test(self, optimize=False):
-        tester = Tester(['authors', 'author', 'series', 'formats', 'format',
-            'publisher', 'rating', 'tags', 'tag', 'comments', 'comment', 'cover',
-            'isbn', 'ondevice', 'pubdate', 'size', 'date', 'title', u'#read',
-            'all', 'search'], test=True, optimize=optimize)
+    locations = ['authors', 'author', 'series', 'formats', 'format',
+        'publisher', 'rating', 'tags', 'tag', 'comments', 'comment', 'cover',
+        'isbn', 'ondevice', 'pubdate', 'size', 'date', 'title', u'#read',
+        'all', 'search']
+
+    def do_test(self, optimize=False, cls=Tester):
+        tester = cls(self.locations, test=True, optimize=optimize)
         tester.run_tests(self.assertEqual)
+        return tester
 
     def test_sqp_optimized(self):
         self.do_test(True)
@@ -371,6 +374,32 @@ class TestSQP(unittest.TestCase):
     def test_sqp_unoptimized(self):
         self.do_test(False)
 
+    def test_sqp_plan(self):
+
+        class CostedTester(Tester):
+
+            def estimate_term(self, location, query):
+                # Make title searches expensive so they are evaluated last
+                return (10.0 if location == 'title' else 1.0), 0.5
+
+        tester = self.do_test(True, cls=CostedTester)
+        matches, plan = tester.explain('title:complete and author:william and tag:lrf')
+        self.assertEqual(matches, {5})
+        self.assertEqual(plan.op, 'and')
+        self.assertEqual([c.location for c in plan.children], ['author', 'tag', 'title'])
+        self.assertEqual(plan.num_candidates, len(tester.universal_set()))
+        self.assertEqual(plan.children[-1].num_candidates, plan.children[1].num_matches)
+        for c in plan.children:
+            self.assertIsNotNone(c.elapsed)
+        d = plan.as_dict()
+        self.assertEqual(d['matches'], 1)
+        self.assertEqual(len(d['children']), 3)
+        matches, plan = tester.explain('title:the or author:william or tag:lrf')
+        self.assertEqual([c.location for c in plan.children], ['author', 'tag', 'title'])
+        matches, plan = tester.explain('not (author:william and title:the)')
+        self.assertEqual(plan.op, 'not')
+        self.assertEqual([c.location for c in plan.children[0].children], ['author', 'title'])
+
     def test_sqp_tokenizer(self):
         p = Parser()
 
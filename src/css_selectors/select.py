@@ -10,11 +10,12 @@ import re, itertools
 from collections import OrderedDict, defaultdict
 from functools import wraps
 from itertools import chain
+from operator import itemgetter
 
 from lxml import etree
 
-from css_selectors.errors import ExpressionError
-from css_selectors.parser import parse, ascii_lower, Element
+from css_selectors.errors import ExpressionError, SelectorError
+from css_selectors.parser import parse, ascii_lower, Element, CombinedSelector, Hash, Class, Pseudo
 from css_selectors.ordered_set import OrderedSet
 
 PARSE_CACHE_SIZE = 200
@@ -321,6 +322,79 @@ class Select(object):
 
     # }}}
 
+# Rule index {{{
+
+def rule_index_key(selector):
+    ''' The id, class or tag name an element must have to match the rightmost
+    compound of selector, as a tuple of ('#', id), ('.', class) or ('', tag),
+    in that order of preference. None if selector can match any element. '''
+    try:
+        selectors = parse(selector)
+    except SelectorError:
+        return None
+    if len(selectors) != 1:
+        return None
+    tree = selectors[0].parsed_tree
+    if isinstance(tree, CombinedSelector):
+        tree = tree.subselector
+    id_ = class_ = None
+    while not isinstance(tree, Element):
+        if isinstance(tree, Hash):
+            id_ = tree.id
+        elif isinstance(tree, Class):
+            class_ = tree.class_name
+        elif isinstance(tree, Pseudo) and tree.ident == 'root':
+            # :root matches the root element, whatever its other selectors
+            return None
+        tree = getattr(tree, 'selector', None)
+        if tree is None:
+            return None
+    if id_:
+        return '#', ascii_lower(id_)
+    if class_:
+        return '.', ascii_lower(class_)
+    if tree.element and tree.element != '*':
+        return '', ascii_lower(tree.element)
+
+class RuleIndex(object):
+
+    '''
+    An index of CSS rules by the id, class or tag name of the rightmost
+    compound of their selectors, the way browsers index rules. Most of the
+    rules in large stylesheets cannot match any element of a given document,
+    and the index allows skipping them without running their selectors. To use:
+
+    >>> index = RuleIndex()
+    >>> for rule in rules:
+    ...     index.add(rule_index_key(rule.selector), rule)
+    >>> select = Select(root)
+    >>> for rule in index.candidates(select):
+    ...     matches = tuple(select(rule.selector))
+
+    '''
+
+    def __init__(self):
+        self.buckets = defaultdict(list)
+        self.count = 0
+
+    def add(self, key, rule):
+        ' Add rule, where key is the rule_index_key() of its selector '
+        self.buckets[key].append((self.count, rule))
+        self.count += 1
+
+    def candidates(self, select):
+        ''' The rules that could match elements in the document of the Select
+        object select, in the order in which they were added. '''
+        maps = {'#': select.id_map, '.': select.class_map, '': select.element_map}
+        ans = []
+        for key, rules in self.buckets.iteritems():
+            if key is None or maps[key[0]].get(key[1]):
+                ans.extend(rules)
+        ans.sort(key=itemgetter(0))
+        return [rule for i, rule in ans]
+
+# }}}
+
 # Combinators {{{
 
 def select_combinedselector(cache, combined):
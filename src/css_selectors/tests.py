@@ -12,7 +12,7 @@ from lxml import etree, html
 
 from css_selectors.errors import SelectorSyntaxError, ExpressionError
 from css_selectors.parser import tokenize, parse
-from css_selectors.select import Select
+from css_selectors.select import Select, RuleIndex, rule_index_key
 
 class TestCSSSelectors(unittest.TestCase):
 
@@ -742,6 +742,30 @@ by William Shakespeare
         select = Select(document, ignore_inappropriate_pseudo_classes=True)
         self.assertGreater(len(tuple(select('p:hover'))), 0)
 
+    def test_rule_index(self):  # {{{
+        ae = self.ae
+        ae(rule_index_key('div#a.b'), ('#', 'a'))
+        ae(rule_index_key('DIV.B:first-child'), ('.', 'b'))
+        ae(rule_index_key('#a div'), ('', 'div'))
+        ae(rule_index_key('div > *:not(.a)'), None)
+        ae(rule_index_key('p:root'), None)
+        ae(rule_index_key('a, b'), None)
+        ae(rule_index_key('a[x'), None)
+
+        document = etree.fromstring(self.HTML_IDS)
+        select = Select(document)
+        selectors = ('div', 'span.nothere', 'ol#first-ol li', 'li#nothere', 'a[rel]', 'blink',
+                     'ol *.C', ':root', 'li:root', '* :root', 'P', '.x > b', 'li:empty', '#first-li ~ :nth-child(3)')
+        index = RuleIndex()
+        for selector in selectors:
+            index.add(rule_index_key(selector), selector)
+        candidates = index.candidates(select)
+        ae(candidates, [s for s in selectors if s not in ('span.nothere', 'li#nothere', 'blink')])
+        for selector in selectors:
+            if selector not in candidates:
+                ae(tuple(select(selector)), ())
+    # }}}
+
     def test_select_shakespeare(self):
         document = html.document_fromstring(self.HTML_SHAKESPEARE)
         select = Select(document)